@@ -15,7 +15,7 @@ from typing import TYPE_CHECKING
 from efro.error import CleanError
 import _babase
 import bacommon.cloud
-from bacommon.transfer import DirectoryManifest
+from bacommon.transfer import DirectoryManifest, DirectoryManifestStatCache
 
 if TYPE_CHECKING:
     from typing import Callable
@@ -89,7 +89,7 @@ class WorkspaceSubsystem:
             if not plus.cloud.is_connected():
                 raise _SkipSyncError()
 
-            manifest = DirectoryManifest.create_from_disk(wspath)
+            manifest = self._create_manifest(wspath)
 
             # FIXME: Should implement a way to pass account credentials in
             # from the logic thread.
@@ -172,6 +172,36 @@ class WorkspaceSubsystem:
         # Job's done!
         _babase.pushcall(on_completed, from_other_thread=True)
 
+    def _create_manifest(self, wspath: Path) -> DirectoryManifest:
+        """Create a manifest for a workspace dir.
+
+        We keep the last manifest and stats for its files alongside the
+        workspace dir so we only need to re-hash files that changed.
+        """
+        from efro.dataclassio import dataclass_from_json, dataclass_to_json
+
+        manifestpath = Path(f'{wspath}.manifest')
+        statcachepath = Path(f'{wspath}.statcache')
+        previous: DirectoryManifest | None
+        try:
+            with open(manifestpath, encoding='utf-8') as infile:
+                previous = dataclass_from_json(DirectoryManifest, infile.read())
+        except Exception:
+            previous = None
+        statcache = DirectoryManifestStatCache.load(statcachepath)
+
+        manifest = DirectoryManifest.create_from_disk(
+            wspath, previous=previous, stat_cache=statcache
+        )
+        try:
+            os.makedirs(wspath.parent, exist_ok=True)
+            with open(manifestpath, 'w', encoding='utf-8') as outfile:
+                outfile.write(dataclass_to_json(manifest))
+            statcache.save(statcachepath)
+        except Exception:
+            logging.exception('Error saving workspace manifest cache.')
+        return manifest
+
     def _handle_deletes(self, workspace_dir: Path, deletes: list[str]) -> None:
         """Handle file deletes."""
         for fname in deletes:
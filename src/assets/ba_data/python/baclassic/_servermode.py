@@ -6,11 +6,17 @@ from __future__ import annotations
 import sys
 import time
 import logging
-from typing import TYPE_CHECKING
+from collections import deque
+from typing import TYPE_CHECKING, TypeVar, cast
 
 from efro.terminal import Clr
+from efro.message import (
+    Message,
+    Response,
+    MessageSender,
+    MessageReceiver,
+)
 from bacommon.servermanager import (
-    ServerCommand,
     StartServerModeCommand,
     ShutdownCommand,
     ShutdownReason,
@@ -18,72 +24,199 @@ from bacommon.servermanager import (
     ScreenMessageCommand,
     ClientListCommand,
     KickCommand,
+    ExecCommand,
+    StatusQueryCommand,
+    ServerHelloMessage,
+    ServerClientInfo,
+    ClientListResponse,
+    ServerStatusResponse,
+    ServerStatusSnapshotMessage,
+    STATUS_SNAPSHOT_INTERVAL,
+    get_server_protocol,
 )
 import babase
 import bascenev1
 
 if TYPE_CHECKING:
-    from typing import Any
+    from typing import Any, Callable
 
+    from efro.rpc import RPCEndpoint
     from bacommon.servermanager import ServerConfig
 
+T = TypeVar('T', bound=Message)
 
-def _cmd(command_data: bytes) -> None:
-    """Handle commands coming in from our server manager parent process."""
-    import pickle
+# How often we sample logic thread timer lag, and how many samples we
+# keep for status queries.
+TICK_SAMPLE_INTERVAL = 0.1
+TICK_SAMPLE_COUNT = 100
 
-    assert babase.app.classic is not None
 
-    command = pickle.loads(command_data)
-    assert isinstance(command, ServerCommand)
+def connect_to_manager(port: int, token: str) -> None:
+    """Connect to our server manager parent process.
+
+    The server manager runs this through stdin when it launches us; all
+    further communication happens over the resulting connection.
+    """
+    babase.app.create_async_task(
+        _ManagerConnection(port, token).run(), name='server manager'
+    )
+
+
+class _CommandReceiver(MessageReceiver):
+    """Receives commands from our server manager."""
+
+    def __init__(self) -> None:
+        super().__init__(get_server_protocol())
+
+    def handler(self, call: Callable[[Any, T], Any]) -> Callable[[Any, T], Any]:
+        """Decorator to register command handlers."""
+        from typing import Callable, Any
+
+        self.register_handler(
+            cast(Callable[[Any, Message], Response | None], call)
+        )
+        return call
 
-    if isinstance(command, StartServerModeCommand):
-        assert babase.app.classic.server is None
-        babase.app.classic.server = ServerController(command.config)
-        return
 
-    if isinstance(command, ShutdownCommand):
-        assert babase.app.classic.server is not None
-        babase.app.classic.server.shutdown(
-            reason=command.reason, immediate=command.immediate
+class _ManagerConnection:
+    """Our connection to the server manager that launched us."""
+
+    sender = MessageSender(get_server_protocol())
+    receiver = _CommandReceiver()
+
+    def __init__(self, port: int, token: str) -> None:
+        self._port = port
+        self._token = token
+        self._endpoint: RPCEndpoint | None = None
+        self._snapshot_timer: babase.AppTimer | None = None
+
+    async def run(self) -> None:
+        """Connect and handle commands until the connection goes down."""
+        import asyncio
+
+        from efro.rpc import RPCEndpoint
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', self._port)
+        self._endpoint = RPCEndpoint(
+            self._handle_raw_message,
+            reader,
+            writer,
+            label='server manager',
+        )
+        runtask = asyncio.create_task(self._endpoint.run())
+        await self.sender.send_async(
+            self, ServerHelloMessage(token=self._token)
         )
-        return
+        await runtask
 
-    if isinstance(command, ChatMessageCommand):
-        assert babase.app.classic.server is not None
-        bascenev1.chatmessage(command.message, clients=command.clients)
-        return
+        # Without a manager nobody can control us, so don't hang around.
+        logging.warning('Lost connection to server manager; exiting.')
+        babase.quit()
 
-    if isinstance(command, ScreenMessageCommand):
-        assert babase.app.classic.server is not None
+    @sender.send_async_method
+    async def _send_raw_message(self, message: str) -> str:
+        assert self._endpoint is not None
+        return (await self._endpoint.send_message(message.encode())).decode()
+
+    async def _handle_raw_message(self, message: bytes) -> bytes:
+        # Commands used to arrive through stdin in an empty context;
+        # keep it that way.
+        with babase.ContextRef.empty():
+            return self.receiver.handle_raw_message(self, message).encode()
+
+    @receiver.handler
+    def _handle_start_server_mode(self, msg: StartServerModeCommand) -> None:
+        assert babase.app.classic is not None
+        assert babase.app.classic.server is None
+        babase.app.classic.server = ServerController(msg.config)
 
-        # Note: we have to do transient messages if
-        # clients is specified, so they won't show up
-        # in replays.
+        # If the manager is serving metrics, keep it up to date.
+        if (
+            msg.config.metrics_port is not None
+            or msg.config.metrics_socket_path is not None
+        ):
+            babase.app.classic.server.start_tick_sampling()
+            self._send_status_snapshot()
+            self._snapshot_timer = babase.AppTimer(
+                STATUS_SNAPSHOT_INTERVAL,
+                self._send_status_snapshot,
+                repeat=True,
+            )
+
+    @receiver.handler
+    def _handle_shutdown(self, msg: ShutdownCommand) -> None:
+        _get_server().shutdown(reason=msg.reason, immediate=msg.immediate)
+
+    @receiver.handler
+    def _handle_chat_message(self, msg: ChatMessageCommand) -> None:
+        _get_server()
+        bascenev1.chatmessage(msg.message, clients=msg.clients)
+
+    @receiver.handler
+    def _handle_screen_message(self, msg: ScreenMessageCommand) -> None:
+        _get_server()
+
+        # Note: we have to do transient messages if clients is
+        # specified, so they won't show up in replays.
         bascenev1.broadcastmessage(
-            command.message,
-            color=command.color,
-            clients=command.clients,
-            transient=command.clients is not None,
+            msg.message,
+            color=msg.color,
+            clients=msg.clients,
+            transient=msg.clients is not None,
         )
-        return
 
-    if isinstance(command, ClientListCommand):
-        assert babase.app.classic.server is not None
-        babase.app.classic.server.print_client_list()
-        return
+    @receiver.handler
+    def _handle_client_list(self, msg: ClientListCommand) -> ClientListResponse:
+        del msg  # Unused.
+        return ClientListResponse(clients=_get_server().get_client_list())
+
+    @receiver.handler
+    def _handle_kick(self, msg: KickCommand) -> None:
+        _get_server().kick(client_id=msg.client_id, ban_time=msg.ban_time)
+
+    @receiver.handler
+    def _handle_exec(self, msg: ExecCommand) -> None:
+        # pylint: disable=exec-used
+        exec(msg.statement, vars(sys.modules['__main__']))
+
+    @receiver.handler
+    def _handle_status_query(
+        self, msg: StatusQueryCommand
+    ) -> ServerStatusResponse:
+        del msg  # Unused.
+        server = _get_server()
+        server.start_tick_sampling()
+        return server.get_status()
+
+    def _send_status_snapshot(self) -> None:
+        babase.app.create_async_task(
+            self._send_status_snapshot_async(), name='server status snapshot'
+        )
 
-    if isinstance(command, KickCommand):
-        assert babase.app.classic.server is not None
-        babase.app.classic.server.kick(
-            client_id=command.client_id, ban_time=command.ban_time
+    async def _send_status_snapshot_async(self) -> None:
+        await self.sender.send_async(
+            self, ServerStatusSnapshotMessage(status=_get_server().get_status())
         )
-        return
 
-    print(
-        f'{Clr.SRED}ERROR: server process'
-        f' got unknown command: {type(command)}{Clr.RST}'
-    )
+
+def _get_memory_rss() -> int | None:
+    """Return our resident memory size in bytes if we can (Linux only)."""
+    import os
+
+    try:
+        with open('/proc/self/statm', encoding='utf-8') as infile:
+            pages = int(infile.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return None
+
+
+def _get_server() -> ServerController:
+    classic = babase.app.classic
+    assert classic is not None
+    if classic.server is None:
+        raise RuntimeError('Server mode has not been started.')
+    return classic.server
 
 
 class ServerController:
@@ -102,6 +235,12 @@ class ServerController:
         self._shutdown_reason: ShutdownReason | None = None
         self._executing_shutdown = False
 
+        # Keep tabs on how promptly the logic thread runs our timers
+        # (once someone is interested; see start_tick_sampling()).
+        self._tick_lags: deque[float] = deque(maxlen=TICK_SAMPLE_COUNT)
+        self._last_tick_time = 0.0
+        self._tick_timer: babase.AppTimer | None = None
+
         # Make note if they want us to import a playlist; we'll need to
         # do that first if so.
         self._playlist_fetch_running = self._config.playlist_code is not None
@@ -117,30 +256,53 @@ class ServerController:
                 0.25, self._prepare_to_serve, repeat=True
             )
 
-    def print_client_list(self) -> None:
-        """Print info about all connected clients."""
+    def get_client_list(self) -> list[ServerClientInfo]:
+        """Return info about all connected clients."""
         import json
 
-        roster = bascenev1.get_game_roster()
-        title1 = 'Client ID'
-        title2 = 'Account Name'
-        title3 = 'Players'
-        col1 = 10
-        col2 = 16
-        out = (
-            f'{Clr.BLD}'
-            f'{title1:<{col1}} {title2:<{col2}} {title3}'
-            f'{Clr.RST}'
+        return [
+            ServerClientInfo(
+                client_id=client['client_id'],
+                account_name=json.loads(client['spec_string'])['n'],
+                players=[p['name'] for p in client['players']],
+            )
+            for client in bascenev1.get_game_roster()
+            if client['client_id'] != -1
+        ]
+
+    def get_status(self) -> ServerStatusResponse:
+        """Return the server's current state."""
+        clients = self.get_client_list()
+        session = bascenev1.get_foreground_host_session()
+        lags = self._tick_lags
+        return ServerStatusResponse(
+            session_type=(None if session is None else type(session).__name__),
+            client_count=len(clients),
+            player_count=sum(len(c.players) for c in clients),
+            app_time=babase.apptime(),
+            tick_lag_mean=sum(lags) / len(lags) if lags else 0.0,
+            tick_lag_max=max(lags, default=0.0),
+            shutdown_reason=self._shutdown_reason,
+            cpu_time=time.process_time(),
+            memory_rss=_get_memory_rss(),
+        )
+
+    def start_tick_sampling(self) -> None:
+        """Start measuring tick lag for status reports (if not already)."""
+        if self._tick_timer is not None:
+            return
+        self._last_tick_time = time.monotonic()
+        with babase.ContextRef.empty():
+            self._tick_timer = babase.AppTimer(
+                TICK_SAMPLE_INTERVAL, self._sample_tick, repeat=True
+            )
+
+    def _sample_tick(self) -> None:
+        now = time.monotonic()
+        self._tick_lags.append(
+            max(0.0, now - self._last_tick_time - TICK_SAMPLE_INTERVAL)
         )
-        for client in roster:
-            if client['client_id'] == -1:
-                continue
-            spec = json.loads(client['spec_string'])
-            name = spec['n']
-            players = ', '.join(n['name'] for n in client['players'])
-            clientid = client['client_id']
-            out += f'\n{clientid:<{col1}} {name:<{col2}} {players}'
-        print(out)
+        self._last_tick_time = now
 
     def kick(self, client_id: int, ban_time: int | None) -> None:
         """Kick the provided client id.
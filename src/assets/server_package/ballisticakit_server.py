@@ -3,19 +3,24 @@
 #
 # pylint: disable=too-many-lines
 """BallisticaKit server manager."""
+
 from __future__ import annotations
 
 import os
 import sys
 import time
 import json
+import stat
 import signal
+import asyncio
+import secrets
 import tomllib
 import logging
 import subprocess
+import dataclasses
 from pathlib import Path
-from threading import Lock, Thread, current_thread
-from typing import TYPE_CHECKING
+from threading import Event, Lock, Thread, current_thread
+from typing import TYPE_CHECKING, TypeVar, cast
 
 # We make use of the bacommon and efro packages as well as site-packages
 # included with our bundled Ballistica dist, so we need to add those
@@ -25,19 +30,73 @@ sys.path += [
     str(Path(Path(__file__).parent, 'dist', 'ba_data', 'python-site-packages')),
 ]
 
-from bacommon.servermanager import ServerConfig, StartServerModeCommand
+from bacommon.servermanager import (
+    ServerConfig,
+    StartServerModeCommand,
+    ServerHelloMessage,
+    ServerStatusSnapshotMessage,
+    STATUS_SNAPSHOT_INTERVAL,
+    get_server_protocol,
+)
 from efro.dataclassio import dataclass_from_dict, dataclass_validate
-from efro.error import CleanError
+from efro.error import CleanError, CommunicationError
+from efro.message import Message, Response, MessageSender, MessageReceiver
+from efro.rpc import RPCEndpoint
 from efro.terminal import Clr
 
 if TYPE_CHECKING:
     from types import FrameType
-    from bacommon.servermanager import ServerCommand
+    from typing import IO, Any, Callable, TextIO
+    from bacommon.servermanager import (
+        ServerCommand,
+        ServerInstanceConfig,
+        ServerStatusResponse,
+    )
+
+T = TypeVar('T', bound=Message)
 
-VERSION_STR = '1.3.3'
+VERSION_STR = '1.6.0'
 
 # Version history:
 #
+# 1.6.0
+#
+#  - Added 'metrics_port' and 'metrics_socket_path' config options for
+#    serving Prometheus-style metrics (players, session type, uptime,
+#    restarts and their reasons, cpu and memory use, etc.) and a health
+#    check from the server manager. Servers only send the status
+#    snapshots these are built from when one is enabled.
+#
+#  - status() responses now include cpu and memory use.
+#
+# 1.5.0
+#
+#  - Added 'instances' config option for running multiple server
+#    binaries from one server manager, each with its own port and party
+#    settings. Their output is combined and labeled by instance, and
+#    their scheduled restarts are staggered. Commands such as cmd() and
+#    status() take an instance name when running multiple instances.
+#
+#  - Config file changes now only restart the server binary if they
+#    change its effective config.
+#
+#  - Added 'cpu_affinity' config option for pinning server binaries to
+#    particular CPUs (Linux only).
+#
+# 1.4.0
+#
+#  - Commands now go to the server binary over a local efro.rpc
+#    connection instead of as pickled exec statements through stdin.
+#    This means cmd() and clientlist() now wait until the server has
+#    actually handled them, and clientlist() output is printed by the
+#    manager.
+#
+#  - Added status() for querying player counts, session type, and
+#    timing info from the server binary.
+#
+#  - The manager no longer polls; it wakes up only for commands,
+#    subprocess exits, and scheduled restart checks.
+#
 # 1.3.3
 #
 #  - Added log_levels dict in server config for setting levels on
@@ -110,37 +169,36 @@ class ServerManagerApp:
     """An app which manages BallisticaKit server execution.
 
     Handles configuring, launching, re-launching, and otherwise
-    managing BallisticaKit operating in server mode.
+    managing BallisticaKit operating in server mode. If the config
+    contains 'instances', one server binary is managed per instance.
     """
 
     # How many seconds we wait after asking our subprocess to do an immediate
     # shutdown before bringing down the hammer.
     IMMEDIATE_SHUTDOWN_TIME_LIMIT = 5.0
 
+    # How long we wait for a response when sending commands that have
+    # them.
+    COMMAND_TIMEOUT = 30.0
+
     def __init__(self) -> None:
         self._user_provided_config_path: str | None = None
         self._config = ServerConfig()
+        self._config_lock = Lock()
         self._ba_root_path = os.path.abspath('dist/ba_root')
         self._interactive = sys.stdin.isatty()
         self._wrapper_shutdown_desired = False
         self._done = False
-        self._subprocess_commands: list[str | ServerCommand] = []
-        self._subprocess_commands_lock = Lock()
-        self._subprocess_force_kill_time: float | None = None
+        self._done_lock = Lock()
+        self._channel: _ServerChannel | None = None
+        self._instances: list[_ServerInstance] = []
+        self._metrics_server: _MetricsServer | None = None
         self._auto_restart = True
         self._config_auto_restart = True
         self._config_mtime: float | None = None
-        self._last_config_mtime_check_time: float | None = None
         self._should_report_subprocess_error = False
         self._running = False
         self._interpreter_start_time: float | None = None
-        self._subprocess: subprocess.Popen[bytes] | None = None
-        self._subprocess_launch_time: float | None = None
-        self._subprocess_sent_config_auto_restart = False
-        self._subprocess_sent_clean_exit = False
-        self._subprocess_sent_unclean_exit = False
-        self._subprocess_thread: Thread | None = None
-        self._subprocess_exited_cleanly: bool | None = None
         self._did_multi_config_warning = False
 
         # This may override the above defaults.
@@ -182,29 +240,97 @@ class ServerManagerApp:
         # avoid zombie processes)
         signal.signal(signal.SIGTERM, self._handle_term_signal)
 
+        # Set up the connection our server binaries will talk to us
+        # through.
+        self._channel = _ServerChannel()
+
         # During a run, we make the assumption that cwd is the dir
         # containing this script, so make that so. Up until now that may
         # not be the case (we support being called from any location).
         os.chdir(os.path.abspath(os.path.dirname(__file__)))
 
-        # Fire off a background thread to wrangle our server binaries.
-        self._subprocess_thread = Thread(target=self._bg_thread_main)
-        self._subprocess_thread.start()
+        # Fire off a background thread for each server binary we
+        # wrangle.
+        overrides = self._config.instances
+        if overrides:
+            names = ', '.join(o.get_name() for o in overrides)
+            print(
+                f'{Clr.CYN}Running {len(overrides)} server instances:'
+                f' {names}.{Clr.RST}',
+                flush=True,
+            )
+            self._instances = [
+                _ServerInstance(
+                    self,
+                    self._channel,
+                    slot=i,
+                    slot_count=len(overrides),
+                    overrides=instance,
+                    ba_root_path=f'{self._ba_root_path}-{instance.get_name()}',
+                )
+                for i, instance in enumerate(overrides)
+            ]
+        else:
+            self._instances = [
+                _ServerInstance(
+                    self,
+                    self._channel,
+                    slot=0,
+                    slot_count=1,
+                    overrides=None,
+                    ba_root_path=self._ba_root_path,
+                )
+            ]
+
+        # Serve metrics if they're wanted (we don't even open a port
+        # otherwise).
+        port = self._config.metrics_port
+        socket_path = self._config.metrics_socket_path
+        if port is not None or socket_path is not None:
+            if socket_path is not None and not hasattr(
+                asyncio, 'start_unix_server'
+            ):
+                raise CleanError(
+                    'metrics_socket_path is not supported on this platform.'
+                )
+            try:
+                self._metrics_server = _MetricsServer(
+                    self._channel, self._instances, port, socket_path
+                )
+            except OSError as exc:
+                raise CleanError(
+                    f'Unable to start metrics server: {exc}'
+                ) from exc
+            where = ' and '.join(
+                ([] if port is None else [f'127.0.0.1:{port}'])
+                + ([] if socket_path is None else [socket_path])
+            )
+            print(f'{Clr.CYN}Serving metrics at {where}.{Clr.RST}', flush=True)
+
+        for instance in self._instances:
+            instance.start()
 
     def _postrun(self) -> None:
         """Common code at the end of any run."""
         print(f'{Clr.CYN}Server manager shutting down...{Clr.RST}', flush=True)
 
-        assert self._subprocess_thread is not None
-        if self._subprocess_thread.is_alive():
+        if any(instance.is_alive() for instance in self._instances):
             print(
                 f'{Clr.CYN}Waiting for subprocess exit...{Clr.RST}', flush=True
             )
 
-        # Mark ourselves as shutting down and wait for the process to
+        # Mark ourselves as shutting down and wait for the processes to
         # wrap up.
-        self._done = True
-        self._subprocess_thread.join()
+        with self._done_lock:
+            self._done = True
+        for instance in self._instances:
+            instance.stop()
+        for instance in self._instances:
+            instance.join()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        assert self._channel is not None
+        self._channel.close()
 
         # If there's a server error we should care about, exit the
         # entire wrapper uncleanly.
@@ -276,109 +402,146 @@ class ServerManagerApp:
 
         self._postrun()
 
-    def cmd(self, statement: str) -> None:
+    def cmd(self, statement: str, instance: str | None = None) -> None:
         """Exec a Python command on the current running server subprocess.
 
-        Note that commands are executed asynchronously and no status or
-        return value is accessible from this manager app.
+        Blocks until the command has run. Exceptions raised by the
+        command come back as efro.error.RemoteErrors. When running
+        multiple instances, 'instance' must be the name of the one to
+        use.
         """
+        from bacommon.servermanager import ExecCommand
+
         if not isinstance(statement, str):
             raise TypeError(f'Expected a string arg; got {type(statement)}')
-        with self._subprocess_commands_lock:
-            self._subprocess_commands.append(statement)
-        self._block_for_command_completion()
-
-    def _block_for_command_completion(self) -> None:
-        # Ideally we'd block here until the command was run so our
-        # prompt would print after it's results. We currently don't get
-        # any response from the app so the best we can do is block until
-        # our bg thread has sent it. In the future we can perhaps add a
-        # proper 'command port' interface for proper blocking two way
-        # communication.
-        while True:
-            with self._subprocess_commands_lock:
-                if not self._subprocess_commands:
-                    break
-            time.sleep(0.1)
+        self._get_instance(instance).send_command(
+            ExecCommand(statement=statement)
+        )
 
-        # One last short delay so if we come out *just* as the command
-        # is sent we'll hopefully still give it enough time to
-        # process/print.
-        time.sleep(0.1)
+    def status(self, instance: str | None = None) -> ServerStatusResponse:
+        """Return the current state of the server subprocess.
+
+        Raises an efro.error.CommunicationError if the subprocess can't
+        be reached. When running multiple instances, 'instance' must be
+        the name of the one to query.
+        """
+        from bacommon.servermanager import (
+            StatusQueryCommand,
+            ServerStatusResponse,
+        )
+
+        response = self._get_instance(instance).send_command(
+            StatusQueryCommand()
+        )
+        assert isinstance(response, ServerStatusResponse)
+        return response
 
     def screenmessage(
         self,
         message: str,
         color: tuple[float, float, float] | None = None,
         clients: list[int] | None = None,
+        instance: str | None = None,
     ) -> None:
         """Display a screen-message.
 
         This will have no name attached and not show up in chat history.
         They will show up in replays, however (unless clients is passed).
+        Goes to all instances unless 'instance' is passed.
         """
         from bacommon.servermanager import ScreenMessageCommand
 
-        self._enqueue_server_command(
-            ScreenMessageCommand(message=message, color=color, clients=clients)
-        )
+        for inst in self._get_instances(instance):
+            inst.enqueue_command(
+                ScreenMessageCommand(
+                    message=message, color=color, clients=clients
+                )
+            )
 
     def chatmessage(
-        self, message: str, clients: list[int] | None = None
+        self,
+        message: str,
+        clients: list[int] | None = None,
+        instance: str | None = None,
     ) -> None:
         """Send a chat message from the server.
 
         This will have the server's name attached and will be logged
         in client chat windows, just like other chat messages.
+        Goes to all instances unless 'instance' is passed.
         """
         from bacommon.servermanager import ChatMessageCommand
 
-        self._enqueue_server_command(
-            ChatMessageCommand(message=message, clients=clients)
-        )
+        for inst in self._get_instances(instance):
+            inst.enqueue_command(
+                ChatMessageCommand(message=message, clients=clients)
+            )
+
+    def clientlist(self, instance: str | None = None) -> None:
+        """Print a list of connected clients.
 
-    def clientlist(self) -> None:
-        """Print a list of connected clients."""
-        from bacommon.servermanager import ClientListCommand
+        When running multiple instances, 'instance' must be the name of
+        the one to list.
+        """
+        from bacommon.servermanager import (
+            ClientListCommand,
+            ClientListResponse,
+        )
 
-        self._enqueue_server_command(ClientListCommand())
-        self._block_for_command_completion()
+        response = self._get_instance(instance).send_command(
+            ClientListCommand()
+        )
+        assert isinstance(response, ClientListResponse)
+        title1 = 'Client ID'
+        title2 = 'Account Name'
+        title3 = 'Players'
+        col1 = 10
+        col2 = 16
+        out = (
+            f'{Clr.BLD}'
+            f'{title1:<{col1}} {title2:<{col2}} {title3}'
+            f'{Clr.RST}'
+        )
+        for client in response.clients:
+            players = ', '.join(client.players)
+            out += (
+                f'\n{client.client_id:<{col1}}'
+                f' {client.account_name:<{col2}} {players}'
+            )
+        print(out, flush=True)
 
-    def kick(self, client_id: int, ban_time: int | None = None) -> None:
+    def kick(
+        self,
+        client_id: int,
+        ban_time: int | None = None,
+        instance: str | None = None,
+    ) -> None:
         """Kick the client with the provided id.
 
         If ban_time is provided, the client will be banned for that
         length of time in seconds. If it is None, ban duration will
         be determined automatically. Pass 0 or a negative number for no
-        ban time.
+        ban time. When running multiple instances, 'instance' must be
+        the name of the one the client is in.
         """
         from bacommon.servermanager import KickCommand
 
-        self._enqueue_server_command(
+        self._get_instance(instance).enqueue_command(
             KickCommand(client_id=client_id, ban_time=ban_time)
         )
 
-    def restart(self, immediate: bool = True) -> None:
+    def restart(
+        self, immediate: bool = True, instance: str | None = None
+    ) -> None:
         """Restart the server subprocess.
 
         By default, the current server process will exit immediately.
         If 'immediate' is passed as False, however, it will instead exit at
         the next clean transition point (the end of a series, etc).
+        Restarts all instances unless 'instance' is passed.
         """
-        from bacommon.servermanager import ShutdownCommand, ShutdownReason
-
-        self._enqueue_server_command(
-            ShutdownCommand(
-                reason=ShutdownReason.RESTARTING, immediate=immediate
-            )
-        )
-
-        # If we're asking for an immediate restart but don't get one
-        # within the grace period, bring down the hammer.
-        if immediate:
-            self._subprocess_force_kill_time = (
-                time.time() + self.IMMEDIATE_SHUTDOWN_TIME_LIMIT
-            )
+        for inst in self._get_instances(instance):
+            inst.restart(immediate=immediate, restagger=instance is None)
 
     def shutdown(self, immediate: bool = True) -> None:
         """Shut down the server subprocess and exit the wrapper.
@@ -387,22 +550,31 @@ class ServerManagerApp:
         If 'immediate' is passed as False, however, it will instead exit at
         the next clean transition point (the end of a series, etc).
         """
-        from bacommon.servermanager import ShutdownCommand, ShutdownReason
-
-        self._enqueue_server_command(
-            ShutdownCommand(reason=ShutdownReason.NONE, immediate=immediate)
-        )
-
         # An explicit shutdown means we know to bail completely once
-        # this subprocess completes.
+        # our subprocesses complete.
         self._wrapper_shutdown_desired = True
-
-        # If we're asking for an immediate shutdown but don't get one
-        # within the grace period, bring down the hammer.
-        if immediate:
-            self._subprocess_force_kill_time = (
-                time.time() + self.IMMEDIATE_SHUTDOWN_TIME_LIMIT
-            )
+        for inst in self._instances:
+            inst.shutdown(immediate=immediate)
+
+    def _get_instance(self, name: str | None) -> _ServerInstance:
+        if not self._instances:
+            raise CommunicationError('Server manager is not running.')
+        if name is None:
+            if len(self._instances) == 1:
+                return self._instances[0]
+            names = ', '.join(repr(i.name) for i in self._instances)
+            raise ValueError(f'Please specify an instance; one of {names}.')
+        for inst in self._instances:
+            if inst.name == name:
+                return inst
+        raise ValueError(f'No instance named {name!r}.')
+
+    def _get_instances(self, name: str | None) -> list[_ServerInstance]:
+        return (
+            list(self._instances)
+            if name is None
+            else [self._get_instance(name)]
+        )
 
     def _parse_command_line_args(self) -> None:
         """Parse command line args."""
@@ -632,7 +804,6 @@ class ServerManagerApp:
                         flush=True,
                     )
                 self._config_mtime = None
-                self._last_config_mtime_check_time = time.time()
                 return ServerConfig()
 
             # Don't be so lenient if the user pointed us at one though.
@@ -650,10 +821,10 @@ class ServerManagerApp:
                 )
 
         out = dataclass_from_dict(ServerConfig, user_config_raw)
+        self._check_instances(out)
 
         # Update our known mod-time since we know it exists.
         self._config_mtime = Path(config_path).stat().st_mtime
-        self._last_config_mtime_check_time = time.time()
 
         if print_confirmation:
             print(
@@ -662,6 +833,24 @@ class ServerManagerApp:
             )
         return out
 
+    def _check_instances(self, config: ServerConfig) -> None:
+        """Make sure a config's instances make sense."""
+        names: set[str] = set()
+        ports: set[int] = set()
+        for instance in config.instances or []:
+            name = instance.get_name()
+            if not name or not name.replace('-', '').replace('_', '').isalnum():
+                raise CleanError(
+                    f'Invalid instance name {name!r}; names can contain'
+                    f' only letters, numbers, dashes, and underscores.'
+                )
+            if name in names:
+                raise CleanError(f'Duplicate instance name {name!r}.')
+            if instance.port in ports:
+                raise CleanError(f'Duplicate instance port {instance.port}.')
+            names.add(name)
+            ports.add(instance.port)
+
     def _enable_tab_completion(self, locs: dict) -> None:
         """Enable tab-completion on platforms where available (linux/mac)."""
         try:
@@ -674,76 +863,297 @@ class ServerManagerApp:
             # This is expected (readline doesn't exist under windows).
             pass
 
-    def _bg_thread_main(self) -> None:
-        """Top level method run by our bg thread."""
-        while not self._done:
-            self._run_server_cycle()
-
     def _handle_term_signal(self, sig: int, frame: FrameType | None) -> None:
         """Handle signals (will always run in the main thread)."""
         del sig, frame  # Unused.
         sys.exit(1 if self._should_report_subprocess_error else 0)
 
+    def _reload_config(self) -> tuple[ServerConfig, float | None]:
+        """Reload our config, returning it along with its mod-time.
+
+        Can be called from any thread.
+        """
+        # Reload non-strict this time to give the user repeated attempts
+        # if they mess up while modifying the config on the fly.
+        with self._config_lock:
+            self.load_config(strict=False, print_confirmation=True)
+            return self._config, self._config_mtime
+
+    def _on_instance_finished(self) -> None:
+        """Called by an instance once it has finished running for good."""
+        with self._done_lock:
+            # If the main thread is already waiting for us to die, don't
+            # poke it; otherwise it can lead to deadlock. (we hang in
+            # os.kill while main thread is blocked in Thread.join)
+            if self._done or not all(i.finished for i in self._instances):
+                return
+            self._done = True
+
+        # This should break the main thread out of its blocking
+        # interpreter call.
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+class _ServerInstance:
+    """Runs and re-runs one server binary for a ServerManagerApp.
+
+    Lives in a thread of its own. When there are multiple instances,
+    each one's output is piped through us and labeled with its name,
+    and scheduled restarts are staggered by slot.
+    """
+
+    # Keeps lines from different instances from getting jumbled.
+    _output_lock = Lock()
+
+    def __init__(
+        self,
+        app: ServerManagerApp,
+        channel: _ServerChannel,
+        slot: int,
+        slot_count: int,
+        overrides: ServerInstanceConfig | None,
+        ba_root_path: str,
+    ) -> None:
+        # pylint: disable=too-many-positional-arguments
+        self._app = app
+        self._channel = channel
+        self._slot = slot
+        self._slot_count = slot_count
+        self._overrides = overrides
+        self._ba_root_path = ba_root_path
+        self.name = None if overrides is None else overrides.get_name()
+        self._prefix = (
+            '' if self.name is None else f'{Clr.BLU}[{self.name}]{Clr.RST} '
+        )
+        self.finished = False
+        self._shutting_down = False
+        self._done = False
+        self._wakeup = Event()
+        self._thread = Thread(target=self._thread_main)
+        self._config = app.config
+        self._config_mtime: float | None = None
+        self._last_config_mtime_check_time: float | None = None
+        self._stagger_next_exit = True
+        self._exit_time_scale = 1.0
+        self.restart_counts: dict[str, int] = {}
+        self.last_restart_reason: str | None = None
+        self._restart_reason: str | None = None
+        self._initial_cpus = (
+            os.sched_getaffinity(0)
+            if hasattr(os, 'sched_getaffinity')
+            else None
+        )
+        self._did_cpu_affinity_warning = False
+        self._subprocess_force_kill_time: float | None = None
+        self._subprocess: subprocess.Popen[bytes] | None = None
+        self._subprocess_launch_time: float | None = None
+        self._subprocess_sent_config_auto_restart = False
+        self._subprocess_sent_clean_exit = False
+        self._subprocess_sent_unclean_exit = False
+        self._subprocess_exited_cleanly: bool | None = None
+
+    def start(self) -> None:
+        """Start running."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop running as soon as possible (the app is going down)."""
+        self._done = True
+        self._wakeup.set()
+
+    def join(self) -> None:
+        """Wait for us to finish running."""
+        self._thread.join()
+
+    def is_alive(self) -> bool:
+        """Whether we are still running."""
+        return self._thread.is_alive()
+
+    def send_command(self, command: ServerCommand) -> Response | None:
+        """Send a command to our server and return its response.
+
+        Can be called from any thread except the one running our
+        channel.
+        """
+        return self._channel.send_command(
+            self._slot, command, ServerManagerApp.COMMAND_TIMEOUT
+        )
+
+    def enqueue_command(self, command: ServerCommand) -> None:
+        """Enqueue a command to be sent to our server.
+
+        Can be called from any thread. Does not wait for the command to
+        be handled; any errors are logged.
+        """
+        self._channel.send_command_nowait(self._slot, command)
+
+    @property
+    def launch_time(self) -> float | None:
+        """When our current server subprocess was launched (if any).
+
+        This is a time.time() value.
+        """
+        return self._subprocess_launch_time
+
+    def get_status_snapshot(self) -> tuple[ServerStatusResponse, float] | None:
+        """Return our server's latest status snapshot and its arrival time.
+
+        Arrival times come from time.monotonic().
+        """
+        return self._channel.get_status_snapshot(self._slot)
+
+    def restart(
+        self, immediate: bool, restagger: bool = False, reason: str = 'command'
+    ) -> None:
+        """Restart our server subprocess.
+
+        If 'restagger' is True, the next run's scheduled exit times are
+        staggered as they are on the first run; use this when restarting
+        all instances at once. The 'reason' shows up in metrics.
+        """
+        from bacommon.servermanager import ShutdownCommand, ShutdownReason
+
+        if self._restart_reason is None:
+            self._restart_reason = reason
+        self.enqueue_command(
+            ShutdownCommand(
+                reason=ShutdownReason.RESTARTING, immediate=immediate
+            )
+        )
+        if restagger:
+            self._stagger_next_exit = True
+
+        # If we're asking for an immediate restart but don't get one
+        # within the grace period, bring down the hammer.
+        if immediate:
+            self._subprocess_force_kill_time = (
+                time.time() + ServerManagerApp.IMMEDIATE_SHUTDOWN_TIME_LIMIT
+            )
+            self._wakeup.set()
+
+    def shutdown(self, immediate: bool) -> None:
+        """Shut down our server subprocess and don't start another."""
+        from bacommon.servermanager import ShutdownCommand, ShutdownReason
+
+        self.enqueue_command(
+            ShutdownCommand(reason=ShutdownReason.NONE, immediate=immediate)
+        )
+        self._shutting_down = True
+
+        # If we're asking for an immediate shutdown but don't get one
+        # within the grace period, bring down the hammer.
+        if immediate:
+            self._subprocess_force_kill_time = (
+                time.time() + ServerManagerApp.IMMEDIATE_SHUTDOWN_TIME_LIMIT
+            )
+            self._wakeup.set()
+
+    def _print(self, text: str, file: TextIO | None = None) -> None:
+        """Print text labeled as coming from us."""
+        if file is None:
+            file = sys.stdout
+        with self._output_lock:
+            file.write(
+                ''.join(
+                    f'{self._prefix}{line}\n'
+                    for line in text.splitlines() or ['']
+                )
+            )
+            file.flush()
+
+    def _thread_main(self) -> None:
+        """Top level method run by our thread."""
+        while not self._done and not self._shutting_down:
+            self._run_server_cycle()
+        self.finished = True
+        if self._shutting_down:
+            # pylint: disable=protected-access
+            self._app._on_instance_finished()
+
     def _run_server_cycle(self) -> None:
         """Spin up the server subprocess and run it until exit."""
         # pylint: disable=consider-using-with
+        # pylint: disable=protected-access
+        app = self._app
 
         # Reload our config, and update our overall behavior based on
-        # it. We do non-strict this time to give the user repeated
-        # attempts if if they mess up while modifying the config on the
-        # fly.
-        self.load_config(strict=False, print_confirmation=True)
+        # it.
+        config, self._config_mtime = app._reload_config()
+        self._last_config_mtime_check_time = time.time()
+        self._config = self._apply_overrides(config)
+
+        self._update_exit_time_scale()
 
         self._prep_subprocess_environment()
 
-        # Launch the binary and grab its stdin; we'll use this to feed
-        # it commands.
+        # Launch the binary and grab its stdin; we'll use this to tell
+        # it how to connect to us.
         self._subprocess_launch_time = time.time()
 
         # Set an environment var so the server process knows its being
         # run under us. This causes it to ignore ctrl-c presses and
         # other slight behavior tweaks. Hmm; should this be an argument
         # instead?
-        os.environ['BA_SERVER_WRAPPER_MANAGED'] = '1'
+        env = dict(os.environ)
+        env['BA_SERVER_WRAPPER_MANAGED'] = '1'
 
         # Set an environment var to change the device name. Device name
         # is used while making connection with master server,
         # cloud-console recognize us with this name.
-        os.environ['BA_DEVICE_NAME'] = self._config.party_name
+        env['BA_DEVICE_NAME'] = self._config.party_name
 
-        print(f'{Clr.CYN}Launching server subprocess...{Clr.RST}', flush=True)
+        self._print(f'{Clr.CYN}Launching server subprocess...{Clr.RST}')
         binary_name = (
             'BallisticaKitHeadless.exe'
             if os.name == 'nt'
             else './ballisticakit_headless'
         )
-        assert self._ba_root_path is not None
         self._subprocess = None
 
+        # The subprocess inherits our thread's cpu affinity.
+        self._set_cpu_affinity()
+
+        # Pipe output through us when we need to label it.
+        output = None if self.name is None else subprocess.PIPE
+
         # Launch!
         try:
             self._subprocess = subprocess.Popen(
                 [binary_name, '--config-dir', self._ba_root_path],
                 stdin=subprocess.PIPE,
+                stdout=output,
+                stderr=output,
                 cwd='dist',
+                env=env,
             )
         except Exception as exc:
             self._subprocess_exited_cleanly = False
-            print(
-                f'{Clr.RED}Error launching server subprocess: {exc}{Clr.RST}',
-                flush=True,
+            self._print(
+                f'{Clr.RED}Error launching server subprocess: {exc}{Clr.RST}'
             )
+        if self._subprocess is not None and output is not None:
+            assert self._subprocess.stdout is not None
+            assert self._subprocess.stderr is not None
+            for infile, outfile in (
+                (self._subprocess.stdout, sys.stdout),
+                (self._subprocess.stderr, sys.stderr),
+            ):
+                Thread(
+                    target=self._pump_output,
+                    args=(infile, outfile),
+                    daemon=True,
+                ).start()
 
         # Do the thing.
         try:
             self._run_subprocess_until_exit()
         except Exception as exc:
-            print(
-                f'{Clr.RED}Error running server subprocess: {exc}{Clr.RST}',
-                flush=True,
+            self._print(
+                f'{Clr.RED}Error running server subprocess: {exc}{Clr.RST}'
             )
 
         self._kill_subprocess()
+        self._channel.end_session(self._slot)
 
         assert self._subprocess_exited_cleanly is not None
 
@@ -751,47 +1161,113 @@ class ServerManagerApp:
         # started up the interpreter, its possible that it will not
         # break out of its loop via the usual SystemExit that gets sent
         # when we die.
-        if self._interactive:
+        if app._interactive:
             while (
-                self._interpreter_start_time is None
-                or time.time() - self._interpreter_start_time < 0.5
+                app._interpreter_start_time is None
+                or time.time() - app._interpreter_start_time < 0.5
             ):
                 time.sleep(0.1)
 
         # Avoid super fast death loops.
         if (
             not self._subprocess_exited_cleanly
-            and self._auto_restart
+            and app._auto_restart
             and not self._done
         ):
             time.sleep(5.0)
 
-        # If they don't want auto-restart, we'll exit the whole wrapper.
-        # (and with an error code if things ended badly).
-        if not self._auto_restart:
-            self._wrapper_shutdown_desired = True
+        # If they don't want auto-restart, we'll stop after one run
+        # (and the wrapper will exit with an error code if things ended
+        # badly).
+        if not app._auto_restart:
+            self._shutting_down = True
             if not self._subprocess_exited_cleanly:
-                self._should_report_subprocess_error = True
+                app._should_report_subprocess_error = True
+
+        # Note why this run ended if we'll be starting another. We swap
+        # in a new dict instead of modifying ours so metrics readers in
+        # other threads always see a consistent one.
+        if not self._done and not self._shutting_down:
+            reason = self._restart_reason or (
+                'exit' if self._subprocess_exited_cleanly else 'crash'
+            )
+            self.last_restart_reason = reason
+            self.restart_counts = {
+                **self.restart_counts,
+                reason: self.restart_counts.get(reason, 0) + 1,
+            }
 
         self._reset_subprocess_vars()
 
-        # If we want to die completely after this subprocess has ended,
-        # tell the main thread to die.
-        if self._wrapper_shutdown_desired:
-            # Only do this if the main thread is not already waiting for
-            # us to die; otherwise it can lead to deadlock. (we hang in
-            # os.kill while main thread is blocked in Thread.join)
-            if not self._done:
-                self._done = True
+    def _apply_overrides(self, config: ServerConfig) -> ServerConfig:
+        """Return our version of a config."""
+        if self._overrides is None:
+            return config
+
+        # Pick up any changes to our overrides (but not to the set of
+        # instances; that's fixed for our lifetime).
+        for overrides in config.instances or []:
+            if overrides.get_name() == self.name:
+                self._overrides = overrides
+                break
+        else:
+            self._print(
+                f'{Clr.YLW}Instance not found in config;'
+                f' using its previous settings. Restart the'
+                f' server manager to add or remove instances.{Clr.RST}'
+            )
+        values = {
+            field.name: getattr(self._overrides, field.name)
+            for field in dataclasses.fields(self._overrides)
+            if field.name != 'name'
+            and getattr(self._overrides, field.name) is not None
+        }
+        if self._overrides.cpu_affinity is None and config.cpu_affinity:
+            values['cpu_affinity'] = [
+                config.cpu_affinity[self._slot % len(config.cpu_affinity)]
+            ]
+        return dataclasses.replace(config, instances=None, **values)
+
+    def _update_exit_time_scale(self) -> None:
+        """Set how scheduled exit times are scaled for a new run."""
+        # Scheduled exits for the first run (or after everything has
+        # restarted together) happen at a fraction of their normal times
+        # based on our slot, so instances end up spread out over the
+        # period instead of all recycling at once.
+        self._exit_time_scale = (
+            (self._slot + 1) / self._slot_count
+            if self._stagger_next_exit
+            else 1.0
+        )
+        self._stagger_next_exit = False
+
+    def _set_cpu_affinity(self) -> None:
+        """Pin our thread to the CPUs our config asks for."""
+        cpus = self._config.cpu_affinity
+        if self._initial_cpus is None:
+            if cpus is not None and not self._did_cpu_affinity_warning:
+                self._did_cpu_affinity_warning = True
+                self._print(
+                    f'{Clr.YLW}cpu_affinity is not supported on this'
+                    f' platform; ignoring.{Clr.RST}'
+                )
+            return
+        try:
+            os.sched_setaffinity(
+                0, self._initial_cpus if cpus is None else cpus
+            )
+        except (OSError, ValueError) as exc:
+            self._print(
+                f'{Clr.RED}Error setting cpu_affinity {cpus}: {exc}{Clr.RST}'
+            )
 
-                # This should break the main thread out of its blocking
-                # interpreter call.
-                os.kill(os.getpid(), signal.SIGTERM)
+    def _pump_output(self, infile: IO[bytes], outfile: TextIO) -> None:
+        for line in infile:
+            self._print(line.decode(errors='replace').rstrip('\r\n'), outfile)
 
     def _prep_subprocess_environment(self) -> None:
         """Write files that must exist at process launch."""
 
-        assert self._ba_root_path is not None
         os.makedirs(self._ba_root_path, exist_ok=True)
         cfgpath = os.path.join(self._ba_root_path, 'config.json')
         if os.path.exists(cfgpath):
@@ -845,152 +1321,167 @@ class ServerManagerApp:
         with open(cfgpath, 'w', encoding='utf-8') as outfile:
             outfile.write(json.dumps(bincfg))
 
-    def _enqueue_server_command(self, command: ServerCommand) -> None:
-        """Enqueue a command to be sent to the server.
-
-        Can be called from any thread.
-        """
-        with self._subprocess_commands_lock:
-            self._subprocess_commands.append(command)
-
-    def _send_server_command(self, command: ServerCommand) -> None:
-        """Send a command to the server.
-
-        Must be called from the server process thread.
-        """
-        import pickle
-
-        assert current_thread() is self._subprocess_thread
-        assert self._subprocess is not None
-        assert self._subprocess.stdin is not None
-        val = repr(pickle.dumps(command))
-        assert '\n' not in val
-        execcode = (
-            f'import baclassic._servermode;'
-            f' baclassic._servermode._cmd({val})\n'
-        ).encode()
-        self._subprocess.stdin.write(execcode)
-        self._subprocess.stdin.flush()
-
     def _run_subprocess_until_exit(self) -> None:
         if self._subprocess is None:
             return
 
-        assert current_thread() is self._subprocess_thread
+        assert current_thread() is self._thread
         assert self._subprocess.stdin is not None
 
-        # Send the initial server config which should kick things off
-        # (but make sure its values are still valid first).
+        # Prep the initial server config which should kick things off
+        # (but make sure its values are still valid first). This gets
+        # sent as soon as the subprocess connects to us.
         dataclass_validate(self._config)
-        self._send_server_command(StartServerModeCommand(self._config))
+        token = self._channel.begin_session(
+            self._slot, StartServerModeCommand(self._config)
+        )
+
+        # This is the only thing we send through stdin; everything else
+        # goes through our channel.
+        self._subprocess.stdin.write(
+            (
+                f'import baclassic._servermode;'
+                f' baclassic._servermode.connect_to_manager('
+                f'{self._channel.port}, {token!r})\n'
+            ).encode()
+        )
+        self._subprocess.stdin.flush()
+
+        # Get woken up as soon as the subprocess exits.
+        Thread(
+            target=self._watch_subprocess, args=(self._subprocess,), daemon=True
+        ).start()
 
         while True:
+            self._wakeup.clear()
+
             # If the app is trying to shut down, nope out immediately.
             if self._done:
                 break
 
-            # Pass along any commands to our process.
-            with self._subprocess_commands_lock:
-                for incmd in self._subprocess_commands:
-                    # If we're passing a raw string to exec, no need to
-                    # wrap it in any proper structure.
-                    if isinstance(incmd, str):
-                        self._subprocess.stdin.write((incmd + '\n').encode())
-                        self._subprocess.stdin.flush()
-                    else:
-                        self._send_server_command(incmd)
-                self._subprocess_commands = []
-
             # Request restarts/shut-downs for various reasons.
-            self._request_shutdowns_or_restarts()
+            next_check_time = self._request_shutdowns_or_restarts()
 
             # If they want to force-kill our subprocess, simply exit
             # this loop; the cleanup code will kill the process if its
             # still alive.
-            if (
-                self._subprocess_force_kill_time is not None
-                and time.time() > self._subprocess_force_kill_time
-            ):
-                print(
-                    f'{Clr.CYN}Immediate shutdown time limit'
-                    f' ({self.IMMEDIATE_SHUTDOWN_TIME_LIMIT:.1f} seconds)'
-                    f' expired; force-killing subprocess...{Clr.RST}',
-                    flush=True,
+            if self._subprocess_force_kill_time is not None:
+                if time.time() > self._subprocess_force_kill_time:
+                    limit = ServerManagerApp.IMMEDIATE_SHUTDOWN_TIME_LIMIT
+                    self._print(
+                        f'{Clr.CYN}Immediate shutdown time limit'
+                        f' ({limit:.1f} seconds)'
+                        f' expired; force-killing subprocess...{Clr.RST}'
+                    )
+                    break
+                next_check_time = min(
+                    next_check_time, self._subprocess_force_kill_time
                 )
-                break
 
             # Watch for the server process exiting..
             code: int | None = self._subprocess.poll()
             if code is not None:
                 clr = Clr.CYN if code == 0 else Clr.RED
-                print(
+                self._print(
                     f'{clr}Server subprocess exited'
-                    f' with code {code}.{Clr.RST}',
-                    flush=True,
+                    f' with code {code}.{Clr.RST}'
                 )
                 self._subprocess_exited_cleanly = code == 0
                 break
 
-            time.sleep(0.25)
+            self._wakeup.wait(max(0.0, next_check_time - time.time()))
 
-    def _request_shutdowns_or_restarts(self) -> None:
+    def _watch_subprocess(self, process: subprocess.Popen[bytes]) -> None:
+        process.wait()
+        self._wakeup.set()
+
+    def _request_shutdowns_or_restarts(self) -> float:
+        """Check for needed restarts/shutdowns.
+
+        Returns the time at which this should next be called.
+        """
         # pylint: disable=too-many-branches
-        assert current_thread() is self._subprocess_thread
+        # pylint: disable=too-many-statements
+        # pylint: disable=protected-access
+        assert current_thread() is self._thread
         assert self._subprocess_launch_time is not None
+        auto_restart = self._app._auto_restart
         now = time.time()
         minutes_since_launch = (now - self._subprocess_launch_time) / 60.0
+        next_check_time = now + 60.0
 
         # If we're doing auto-restart with config changes, handle that.
         if (
-            self._auto_restart
-            and self._config_auto_restart
+            auto_restart
+            and self._app._config_auto_restart
             and not self._subprocess_sent_config_auto_restart
         ):
+            if self._last_config_mtime_check_time is not None:
+                next_check_time = min(
+                    next_check_time, self._last_config_mtime_check_time + 3.124
+                )
             if (
                 self._last_config_mtime_check_time is None
                 or (now - self._last_config_mtime_check_time) > 3.123
             ):
+                next_check_time = min(next_check_time, now + 3.124)
                 self._last_config_mtime_check_time = now
                 mtime: float | None
-                config_path = self._get_config_path()
+                config_path = self._app._get_config_path()
                 if os.path.isfile(config_path):
                     mtime = Path(config_path).stat().st_mtime
                 else:
                     mtime = None
                 if mtime != self._config_mtime:
-                    print(
-                        f'{Clr.CYN}Config-file change detected;'
-                        f' requesting immediate restart.{Clr.RST}',
-                        flush=True,
-                    )
-                    self.restart(immediate=True)
-                    self._subprocess_sent_config_auto_restart = True
+                    self._config_mtime = mtime
+
+                    # Instances share a config file, so only restart if
+                    # the change actually affects us.
+                    if self._config_changed():
+                        self._print(
+                            f'{Clr.CYN}Config-file change detected;'
+                            f' requesting immediate restart.{Clr.RST}'
+                        )
+                        self.restart(
+                            immediate=True,
+                            restagger=True,
+                            reason='config_change',
+                        )
+                        self._subprocess_sent_config_auto_restart = True
 
         # Attempt clean exit if our clean-exit-time passes (and enforce
-        # a 6 hour max if not provided).
+        # a 6 hour max if not provided). Exit times are scaled down on
+        # staggered runs.
         clean_exit_minutes = 360.0
         if self._config.clean_exit_minutes is not None:
             clean_exit_minutes = min(
                 clean_exit_minutes, self._config.clean_exit_minutes
             )
+        clean_exit_minutes *= self._exit_time_scale
         if clean_exit_minutes is not None:
             if (
                 minutes_since_launch > clean_exit_minutes
                 and not self._subprocess_sent_clean_exit
             ):
-                opname = 'restart' if self._auto_restart else 'shutdown'
-                print(
+                opname = 'restart' if auto_restart else 'shutdown'
+                self._print(
                     f'{Clr.CYN}clean_exit_minutes'
-                    f' ({clean_exit_minutes})'
+                    f' ({clean_exit_minutes:.1f})'
                     f' elapsed; requesting soft'
-                    f' {opname}.{Clr.RST}',
-                    flush=True,
+                    f' {opname}.{Clr.RST}'
                 )
-                if self._auto_restart:
-                    self.restart(immediate=False)
+                if auto_restart:
+                    self.restart(immediate=False, reason='clean_exit_minutes')
                 else:
                     self.shutdown(immediate=False)
                 self._subprocess_sent_clean_exit = True
+            if not self._subprocess_sent_clean_exit:
+                next_check_time = min(
+                    next_check_time,
+                    self._subprocess_launch_time
+                    + clean_exit_minutes * 60.0
+                    + 0.01,
+                )
 
         # Attempt unclean exit if our unclean-exit-time passes (and
         # enforce a 7 hour max if not provided).
@@ -999,24 +1490,50 @@ class ServerManagerApp:
             unclean_exit_minutes = min(
                 unclean_exit_minutes, self._config.unclean_exit_minutes
             )
+        unclean_exit_minutes *= self._exit_time_scale
         if unclean_exit_minutes is not None:
             if (
                 minutes_since_launch > unclean_exit_minutes
                 and not self._subprocess_sent_unclean_exit
             ):
-                opname = 'restart' if self._auto_restart else 'shutdown'
-                print(
+                opname = 'restart' if auto_restart else 'shutdown'
+                self._print(
                     f'{Clr.CYN}unclean_exit_minutes'
-                    f' ({unclean_exit_minutes})'
+                    f' ({unclean_exit_minutes:.1f})'
                     f' elapsed; requesting immediate'
-                    f' {opname}.{Clr.RST}',
-                    flush=True,
+                    f' {opname}.{Clr.RST}'
                 )
-                if self._auto_restart:
-                    self.restart(immediate=True)
+                if auto_restart:
+                    self.restart(immediate=True, reason='unclean_exit_minutes')
                 else:
                     self.shutdown(immediate=True)
                 self._subprocess_sent_unclean_exit = True
+            if not self._subprocess_sent_unclean_exit:
+                next_check_time = min(
+                    next_check_time,
+                    self._subprocess_launch_time
+                    + unclean_exit_minutes * 60.0
+                    + 0.01,
+                )
+
+        return next_check_time
+
+    def _config_changed(self) -> bool:
+        """Whether the config file now gives us a different config."""
+        # pylint: disable=protected-access
+        try:
+            with self._app._config_lock:
+                config = self._app._load_config_from_file(
+                    print_confirmation=False
+                )
+        except Exception as exc:
+            # Wait for them to fix it; we'll look again when it changes.
+            self._print(
+                f'{Clr.RED}Error loading changed config file;'
+                f' ignoring change:\n{exc}{Clr.RST}'
+            )
+            return False
+        return self._apply_overrides(config) != self._config
 
     def _reset_subprocess_vars(self) -> None:
         self._subprocess = None
@@ -1026,14 +1543,15 @@ class ServerManagerApp:
         self._subprocess_sent_unclean_exit = False
         self._subprocess_force_kill_time = None
         self._subprocess_exited_cleanly = None
+        self._restart_reason = None
 
     def _kill_subprocess(self) -> None:
         """End the server subprocess if it still exists."""
-        assert current_thread() is self._subprocess_thread
+        assert current_thread() is self._thread
         if self._subprocess is None:
             return
 
-        print(f'{Clr.CYN}Stopping subprocess...{Clr.RST}', flush=True)
+        self._print(f'{Clr.CYN}Stopping subprocess...{Clr.RST}')
 
         # First, ask it nicely to die and give it a moment. If that
         # doesn't work, bring down the hammer.
@@ -1044,7 +1562,535 @@ class ServerManagerApp:
         except subprocess.TimeoutExpired:
             self._subprocess_exited_cleanly = False
             self._subprocess.kill()
-        print(f'{Clr.CYN}Subprocess stopped.{Clr.RST}', flush=True)
+        self._print(f'{Clr.CYN}Subprocess stopped.{Clr.RST}')
+
+
+class _SubprocessReceiver(MessageReceiver):
+    """Receives messages from server subprocesses."""
+
+    def __init__(self) -> None:
+        super().__init__(get_server_protocol())
+
+    def handler(self, call: Callable[[Any, T], Any]) -> Callable[[Any, T], Any]:
+        """Decorator to register message handlers."""
+        from typing import Callable, Any
+
+        self.register_handler(
+            cast(Callable[[Any, Message], Response | None], call)
+        )
+        return call
+
+
+class _ServerConnection:
+    """A connection from a server subprocess."""
+
+    sender = MessageSender(get_server_protocol())
+    receiver = _SubprocessReceiver()
+
+    def __init__(
+        self,
+        channel: _ServerChannel,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        self._channel = channel
+        self.session: _ChannelSession | None = None
+        self.endpoint = RPCEndpoint(
+            self._handle_raw_message, reader, writer, label='server subprocess'
+        )
+
+    @sender.send_async_method
+    async def _send_raw_message(self, message: str) -> str:
+        return (await self.endpoint.send_message(message.encode())).decode()
+
+    async def _handle_raw_message(self, message: bytes) -> bytes:
+        return self.receiver.handle_raw_message(self, message).encode()
+
+    @receiver.handler
+    def _handle_hello(self, msg: ServerHelloMessage) -> None:
+        self._channel.on_hello(self, msg.token)
+
+    @receiver.handler
+    def _handle_status_snapshot(self, msg: ServerStatusSnapshotMessage) -> None:
+        # Ignore anything from connections that haven't said hello.
+        if self.session is not None:
+            self.session.status_snapshot = msg.status
+            self.session.status_snapshot_time = time.monotonic()
+
+
+class _ChannelSession:
+    """A single subprocess launch for a _ServerChannel slot."""
+
+    def __init__(
+        self,
+        token: str,
+        start_command: StartServerModeCommand,
+        connection: asyncio.Future[_ServerConnection],
+    ) -> None:
+        self.token = token
+        self.start_command = start_command
+        self.connection = connection
+        self.status_snapshot: ServerStatusResponse | None = None
+        self.status_snapshot_time = 0.0
+
+
+class _ServerChannel:
+    """A local efro.rpc channel between us and our server subprocesses.
+
+    Runs an asyncio event loop in its own thread; public methods can be
+    called from any other thread. Each server instance has a numbered
+    slot, and each subprocess launch in a slot is a new session with its
+    own token; the subprocess connects to us and identifies itself with
+    that token, at which point we send it the session's start command
+    followed by anything else sent to that slot.
+    """
+
+    def __init__(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(
+            target=self._loop.run_forever, name='server-channel', daemon=True
+        )
+        self._thread.start()
+        self._sessions: dict[int, _ChannelSession] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._server = self._run(
+            asyncio.start_server(self._handle_client, '127.0.0.1', 0)
+        )
+        self.port: int = self._server.sockets[0].getsockname()[1]
+
+    def begin_session(
+        self, slot: int, start_command: StartServerModeCommand
+    ) -> str:
+        """Prep for a new subprocess; returns the token it should use."""
+        token = secrets.token_hex(16)
+        self._run(self._begin_session(slot, token, start_command))
+        return token
+
+    def end_session(self, slot: int) -> None:
+        """Drop a slot's current subprocess connection (if any)."""
+        self._run(self._end_session(slot))
+
+    def close(self) -> None:
+        """Shut everything down."""
+        self._run(self._close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def send_command(
+        self, slot: int, command: ServerCommand, timeout: float
+    ) -> Response | None:
+        """Send a command and wait for its response.
+
+        If no subprocess is connected yet, waits for one to connect.
+        """
+        assert current_thread() is not self._thread
+        try:
+            return cast(
+                Response | None,
+                self._run(asyncio.wait_for(self._send(slot, command), timeout)),
+            )
+        except TimeoutError as exc:
+            raise CommunicationError(
+                'Timed out waiting for server subprocess.'
+            ) from exc
+
+    def send_command_nowait(self, slot: int, command: ServerCommand) -> None:
+        """Send a command without waiting; errors are logged."""
+        asyncio.run_coroutine_threadsafe(
+            self._send_logged(slot, command), self._loop
+        )
+
+    def get_status_snapshot(
+        self, slot: int
+    ) -> tuple[ServerStatusResponse, float] | None:
+        """Return a slot's latest status snapshot and its arrival time.
+
+        Snapshots are only sent when metrics are enabled. Arrival times
+        come from time.monotonic().
+        """
+        session = self._sessions.get(slot)
+        if session is None or session.status_snapshot is None:
+            return None
+        return session.status_snapshot, session.status_snapshot_time
+
+    def run_coroutine(self, coro: Any) -> Any:
+        """Run a coroutine in our event loop and return its result."""
+        assert current_thread() is not self._thread
+        return self._run(coro)
+
+    def on_hello(self, connection: _ServerConnection, token: str) -> None:
+        """Called when a connection identifies itself."""
+        session = next(
+            (
+                s
+                for s in self._sessions.values()
+                if secrets.compare_digest(token, s.token)
+            ),
+            None,
+        )
+        if session is None or session.connection.done():
+            logging.warning('Rejecting unexpected server connection.')
+            connection.endpoint.close()
+            return
+
+        # Kick things off. Sends go out in the order they are started,
+        # so this always lands before anything waiting on the
+        # connection.
+        task = self._loop.create_task(
+            self._send_logged(connection, session.start_command)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        connection.session = session
+        session.connection.set_result(connection)
+
+    def _run(self, coro: Any) -> Any:
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _begin_session(
+        self, slot: int, token: str, start_command: StartServerModeCommand
+    ) -> None:
+        await self._end_session(slot)
+        self._sessions[slot] = _ChannelSession(
+            token, start_command, self._loop.create_future()
+        )
+
+    async def _end_session(self, slot: int) -> None:
+        session = self._sessions.pop(slot, None)
+        if session is None:
+            return
+        future = session.connection
+        if not future.done():
+            future.set_exception(
+                CommunicationError('Server subprocess has exited.')
+            )
+            # Mark it as retrieved so nobody complains if nobody was
+            # waiting.
+            future.exception()
+        elif future.exception() is None:
+            endpoint = future.result().endpoint
+            endpoint.close()
+            await endpoint.wait_closed()
+
+    async def _close(self) -> None:
+        for slot in list(self._sessions):
+            await self._end_session(slot)
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        connection = _ServerConnection(self, reader, writer)
+        await connection.endpoint.run()
+
+    async def _send(
+        self, target: int | _ServerConnection, command: ServerCommand
+    ) -> Response | None:
+        # Targets are slots or specific connections.
+        if isinstance(target, int):
+            session = self._sessions.get(target)
+            if session is None:
+                raise CommunicationError('No server subprocess is running.')
+            connection = await asyncio.shield(session.connection)
+        else:
+            connection = target
+        return await connection.sender.send_async(connection, command)
+
+    async def _send_logged(
+        self, target: int | _ServerConnection, command: ServerCommand
+    ) -> None:
+        try:
+            await self._send(target, command)
+        except Exception:
+            logging.exception(
+                'Error sending %s to server subprocess.',
+                type(command).__name__,
+            )
+
+
+class _MetricsServer:
+    """Serves metrics for a ServerManagerApp's server instances.
+
+    Speaks just enough http to answer GET requests for /metrics (in
+    Prometheus text format) and /health. Runs in our channel's event
+    loop so it needs no thread of its own. Values come from the status
+    snapshots our server binaries send periodically, so serving them
+    never blocks on a server.
+    """
+
+    # Status snapshots older than this mean a server is not healthy.
+    STALE_TIME = STATUS_SNAPSHOT_INTERVAL * 3.0
+
+    # How long clients get to send us their request.
+    REQUEST_TIMEOUT = 10.0
+
+    def __init__(
+        self,
+        channel: _ServerChannel,
+        instances: list[_ServerInstance],
+        port: int | None,
+        socket_path: str | None,
+    ) -> None:
+        self._channel = channel
+        self._instances = instances
+        self._socket_path = socket_path
+        self._servers: list[asyncio.Server] = []
+        channel.run_coroutine(self._start(port))
+
+    def close(self) -> None:
+        """Stop serving."""
+        self._channel.run_coroutine(self._close())
+
+    async def _start(self, port: int | None) -> None:
+        if port is not None:
+            self._servers.append(
+                await asyncio.start_server(
+                    self._handle_client, '127.0.0.1', port
+                )
+            )
+        if self._socket_path is not None:
+            # Clear out any socket left behind by a previous run (but
+            # never anything else that happens to live there).
+            if stat.S_ISSOCK(_stat_mode(self._socket_path)):
+                os.unlink(self._socket_path)
+            self._servers.append(
+                await asyncio.start_unix_server(
+                    self._handle_client, self._socket_path
+                )
+            )
+
+    async def _close(self) -> None:
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        if self._socket_path is not None and self._servers:
+            if stat.S_ISSOCK(_stat_mode(self._socket_path)):
+                os.unlink(self._socket_path)
+
+    async def _handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b'\r\n\r\n'), self.REQUEST_TIMEOUT
+            )
+            method, target, _version = (
+                request.split(b'\r\n', 1)[0].decode().split(' ')
+            )
+            path = target.split('?', 1)[0]
+            if method not in ('GET', 'HEAD'):
+                status, body = '405 Method Not Allowed', 'Method not allowed.\n'
+            elif path in ('/', '/metrics'):
+                status, body = '200 OK', self._get_metrics_text()
+            elif path == '/health':
+                healthy, body = self._get_health_text()
+                status = '200 OK' if healthy else '503 Service Unavailable'
+            else:
+                status, body = '404 Not Found', 'Not found.\n'
+            data = body.encode()
+            writer.write(
+                f'HTTP/1.0 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(data)}\r\n'
+                f'Connection: close\r\n'
+                f'\r\n'.encode() + (b'' if method == 'HEAD' else data)
+            )
+            await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            TimeoutError,
+            ConnectionError,
+            ValueError,
+        ):
+            # Whatever it was, it wasn't a request we can answer.
+            pass
+        finally:
+            writer.close()
+
+    def _get_fresh_snapshot(
+        self, instance: _ServerInstance
+    ) -> ServerStatusResponse | None:
+        snapshot = instance.get_status_snapshot()
+        if snapshot is None or time.monotonic() - snapshot[1] > self.STALE_TIME:
+            return None
+        return snapshot[0]
+
+    def _get_health_text(self) -> tuple[bool, str]:
+        lines: list[str] = []
+        healthy = True
+        for instance in self._instances:
+            ok = self._get_fresh_snapshot(instance) is not None
+            healthy = healthy and ok
+            state = 'ok' if ok else 'down'
+            lines.append(
+                state if instance.name is None else f'{instance.name} {state}'
+            )
+        return healthy, ''.join(f'{line}\n' for line in lines)
+
+    def _get_metrics_text(self) -> str:
+        # pylint: disable=too-many-locals
+        now = time.monotonic()
+        walltime = time.time()
+        families: dict[
+            str, tuple[str, str, list[tuple[dict[str, str], float]]]
+        ] = {}
+
+        def _add(
+            name: str,
+            kind: str,
+            helptext: str,
+            labels: dict[str, str],
+            value: float,
+        ) -> None:
+            families.setdefault(name, (kind, helptext, []))[2].append(
+                (labels, value)
+            )
+
+        for instance in self._instances:
+            base = {} if instance.name is None else {'server': instance.name}
+            snapshot = instance.get_status_snapshot()
+            status = None if snapshot is None else snapshot[0]
+            fresh = self._get_fresh_snapshot(instance) is not None
+            _add(
+                'ballisticakit_up',
+                'gauge',
+                'Whether the server is running and reporting status.',
+                base,
+                int(fresh),
+            )
+            launch_time = instance.launch_time
+            if launch_time is not None:
+                _add(
+                    'ballisticakit_uptime_seconds',
+                    'gauge',
+                    'Time since the server binary was launched.',
+                    base,
+                    walltime - launch_time,
+                )
+            for reason, count in instance.restart_counts.items():
+                _add(
+                    'ballisticakit_restarts_total',
+                    'counter',
+                    'Server binary restarts by reason.',
+                    base | {'reason': reason},
+                    count,
+                )
+            if instance.last_restart_reason is not None:
+                _add(
+                    'ballisticakit_last_restart_info',
+                    'gauge',
+                    'Reason for the most recent server binary restart.',
+                    base | {'reason': instance.last_restart_reason},
+                    1,
+                )
+            if snapshot is None or status is None:
+                continue
+            _add(
+                'ballisticakit_status_age_seconds',
+                'gauge',
+                'Time since the server last reported its status.',
+                base,
+                now - snapshot[1],
+            )
+            _add(
+                'ballisticakit_players',
+                'gauge',
+                'Players currently in the game.',
+                base,
+                status.player_count,
+            )
+            _add(
+                'ballisticakit_clients',
+                'gauge',
+                'Clients currently connected.',
+                base,
+                status.client_count,
+            )
+            if status.session_type is not None:
+                _add(
+                    'ballisticakit_session_info',
+                    'gauge',
+                    'The type of the current session.',
+                    base | {'session_type': status.session_type},
+                    1,
+                )
+            if status.shutdown_reason is not None:
+                _add(
+                    'ballisticakit_shutdown_pending_info',
+                    'gauge',
+                    'Set when the server is going to shut down or restart.',
+                    base | {'reason': status.shutdown_reason.value},
+                    1,
+                )
+            _add(
+                'ballisticakit_tick_lag_mean_seconds',
+                'gauge',
+                'Mean lateness of logic-thread timers recently.',
+                base,
+                status.tick_lag_mean,
+            )
+            _add(
+                'ballisticakit_tick_lag_max_seconds',
+                'gauge',
+                'Max lateness of logic-thread timers recently.',
+                base,
+                status.tick_lag_max,
+            )
+            _add(
+                'ballisticakit_cpu_seconds_total',
+                'counter',
+                'CPU time used by the server binary.',
+                base,
+                status.cpu_time,
+            )
+            if status.memory_rss is not None:
+                _add(
+                    'ballisticakit_resident_memory_bytes',
+                    'gauge',
+                    'Resident memory used by the server binary.',
+                    base,
+                    status.memory_rss,
+                )
+
+        lines: list[str] = []
+        for name, (kind, helptext, samples) in families.items():
+            lines.append(f'# HELP {name} {helptext}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(
+                    f'{name}{_format_metric_labels(labels)}'
+                    f' {_format_metric_value(value)}'
+                )
+        return ''.join(f'{line}\n' for line in lines)
+
+
+def _stat_mode(path: str) -> int:
+    """Return the mode of a path, or 0 if it does not exist."""
+    try:
+        return os.stat(path).st_mode
+    except FileNotFoundError:
+        return 0
+
+
+def _format_metric_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ''
+    values = {
+        key: value.replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+        for key, value in labels.items()
+    }
+    return '{' + ','.join(f'{k}="{v}"' for k, v in values.items()) + '}'
+
+
+def _format_metric_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
 
 
 def main() -> None:
@@ -0,0 +1 @@
+# Released under the MIT License. See LICENSE for details.
@@ -0,0 +1,590 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Testing server manager functionality."""
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import tomllib
+import importlib
+import dataclasses
+from typing import TYPE_CHECKING
+
+import pytest
+
+from efro.error import CleanError, CommunicationError
+from efro.rpc import RPCEndpoint
+from efro.message import MessageSender, MessageReceiver
+from efro.dataclassio import dataclass_from_dict
+from bacommon.servermanager import (
+    ServerConfig,
+    ServerInstanceConfig,
+    StartServerModeCommand,
+    ShutdownCommand,
+    ShutdownReason,
+    ScreenMessageCommand,
+    ClientListCommand,
+    ExecCommand,
+    StatusQueryCommand,
+    ClientListResponse,
+    ServerClientInfo,
+    ServerStatusResponse,
+    ServerStatusSnapshotMessage,
+    ServerHelloMessage,
+    get_server_protocol,
+)
+
+if TYPE_CHECKING:
+    from typing import Any, Callable
+    from pathlib import Path
+
+    from efro.message import Message, Response
+
+
+def test_server_protocol() -> None:
+    """Test that server commands survive the trip to the server."""
+    protocol = get_server_protocol()
+    commands = [
+        StartServerModeCommand(
+            config=ServerConfig(
+                party_name='Test',
+                team_colors=((1.0, 0.0, 0.0), (0.0, 0.0, 1.0)),
+                playlist_inline=[{'type': 'bs_elimination.EliminationGame'}],
+            )
+        ),
+        ShutdownCommand(reason=ShutdownReason.RESTARTING, immediate=False),
+        ScreenMessageCommand(message='Hi', color=(1.0, 0.5, 0.0), clients=[3]),
+        ExecCommand(statement='print(1)'),
+    ]
+    for command in commands:
+        data = protocol.encode_dict(protocol.message_to_dict(command))
+        assert protocol.message_from_dict(protocol.decode_dict(data)) == command
+
+    # Queries should come with typed responses.
+    assert ClientListCommand.get_response_types() == [ClientListResponse]
+    assert StatusQueryCommand.get_response_types() == [ServerStatusResponse]
+    status = ServerStatusResponse(
+        session_type='FreeForAllSession',
+        client_count=1,
+        player_count=1,
+        app_time=12.5,
+        tick_lag_mean=0.001,
+        tick_lag_max=0.01,
+        shutdown_reason=None,
+        cpu_time=3.25,
+        memory_rss=123456789,
+    )
+    responses = [
+        ClientListResponse(
+            clients=[
+                ServerClientInfo(client_id=1, account_name='Bob', players=['B'])
+            ]
+        ),
+        status,
+    ]
+    for response in responses:
+        data = protocol.encode_dict(protocol.response_to_dict(response))
+        assert (
+            protocol.response_from_dict(protocol.decode_dict(data)) == response
+        )
+
+    # Status snapshots go the other way (server to manager) unprompted.
+    snapshot = ServerStatusSnapshotMessage(
+        status=dataclasses.replace(
+            status, memory_rss=None, shutdown_reason=ShutdownReason.NONE
+        )
+    )
+    data = protocol.encode_dict(protocol.message_to_dict(snapshot))
+    assert protocol.message_from_dict(protocol.decode_dict(data)) == snapshot
+
+
+def test_server_instances() -> None:
+    """Test configs for running multiple server instances."""
+    config = dataclass_from_dict(
+        ServerConfig,
+        tomllib.loads(
+            'party_name = "Base"\n'
+            'cpu_affinity = [0, 1]\n'
+            '[[instances]]\n'
+            'port = 43211\n'
+            '[[instances]]\n'
+            'port = 43212\n'
+            'name = "b"\n'
+            'party_name = "Party B"\n'
+        ),
+    )
+    assert config.instances == [
+        ServerInstanceConfig(port=43211),
+        ServerInstanceConfig(port=43212, name='b', party_name='Party B'),
+    ]
+    assert [i.get_name() for i in config.instances] == ['43211', 'b']
+    assert config.cpu_affinity == [0, 1]
+
+    # Instance configs get passed along as part of regular ones.
+    protocol = get_server_protocol()
+    command = StartServerModeCommand(config=config)
+    data = protocol.encode_dict(protocol.message_to_dict(command))
+    assert protocol.message_from_dict(protocol.decode_dict(data)) == command
+
+
+_MULTI_CONFIG = (
+    'party_name = "Base"\n'
+    'max_party_size = 6\n'
+    'cpu_affinity = [0, 1]\n'
+    '[[instances]]\n'
+    'port = 43211\n'
+    'name = "a"\n'
+    'party_name = "Party A"\n'
+    '[[instances]]\n'
+    'port = 43212\n'
+    'max_party_size = 8\n'
+    '[[instances]]\n'
+    'port = 43213\n'
+    'name = "c"\n'
+    'cpu_affinity = [2, 3]\n'
+)
+
+
+def _get_server_script() -> Any:
+    """Import the server manager script (it does not live in a package)."""
+    path = os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__), '../../src/assets/server_package'
+        )
+    )
+    if path not in sys.path:
+        sys.path.append(path)
+    return importlib.import_module('ballisticakit_server')
+
+
+def _make_app(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, config: str
+) -> Any:
+    """Create a ServerManagerApp using a config (without running it)."""
+    configpath = tmp_path / 'config.toml'
+    configpath.write_text(config)
+    monkeypatch.setattr(
+        sys, 'argv', ['ballisticakit_server.py', '--config', str(configpath)]
+    )
+    return _get_server_script().ServerManagerApp()
+
+
+class _StubChannel:
+    """Records commands instances send to their servers."""
+
+    def __init__(self) -> None:
+        self.sent: list[tuple[int, Any]] = []
+
+    def send_command_nowait(self, slot: int, command: Any) -> None:
+        """Pretend to send a command."""
+        self.sent.append((slot, command))
+
+
+def _make_instances(app: Any) -> tuple[list[Any], _StubChannel]:
+    """Create (but don't start) an app's server instances."""
+    script = _get_server_script()
+    channel = _StubChannel()
+    overrides = app.config.instances
+    instances = [
+        script._ServerInstance(  # pylint: disable=protected-access
+            app,
+            channel,
+            slot=i,
+            slot_count=len(overrides),
+            overrides=instance,
+            ba_root_path='ba_root',
+        )
+        for i, instance in enumerate(overrides)
+    ]
+    return instances, channel
+
+
+def test_server_instance_checks(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that bad instance configs get rejected."""
+    for config, error in [
+        (
+            '[[instances]]\nport = 1\nname = "a"\n'
+            '[[instances]]\nport = 1\nname = "b"\n',
+            'Duplicate instance port',
+        ),
+        (
+            '[[instances]]\nport = 1\nname = "a"\n'
+            '[[instances]]\nport = 2\nname = "a"\n',
+            'Duplicate instance name',
+        ),
+        ('[[instances]]\nport = 1\nname = "a b"\n', 'Invalid instance name'),
+        ('[[instances]]\nport = 1\nname = ""\n', 'Invalid instance name'),
+    ]:
+        with pytest.raises(CleanError, match=error):
+            _make_app(tmp_path, monkeypatch, config)
+    _make_app(tmp_path, monkeypatch, _MULTI_CONFIG)
+
+
+def test_server_instance_overrides(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test applying per-instance overrides to configs."""
+    # pylint: disable=protected-access
+    app = _make_app(tmp_path, monkeypatch, _MULTI_CONFIG)
+    instances, _channel = _make_instances(app)
+    assert [i.name for i in instances] == ['a', '43212', 'c']
+    configs = [i._apply_overrides(app.config) for i in instances]
+    assert [c.port for c in configs] == [43211, 43212, 43213]
+    assert [c.party_name for c in configs] == ['Party A', 'Base', 'Base']
+    assert [c.max_party_size for c in configs] == [6, 8, 6]
+    assert all(c.instances is None for c in configs)
+
+    # Shared cpus go round-robin unless an instance asks for its own.
+    assert [c.cpu_affinity for c in configs] == [[0], [1], [2, 3]]
+
+
+def test_server_instance_staggering(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test staggering of scheduled exits across instances."""
+    # pylint: disable=protected-access
+    app = _make_app(tmp_path, monkeypatch, _MULTI_CONFIG)
+    instances, channel = _make_instances(app)
+
+    def _get_scales() -> list[float]:
+        for instance in instances:
+            instance._update_exit_time_scale()
+        return [i._exit_time_scale for i in instances]
+
+    assert _get_scales() == pytest.approx([1 / 3, 2 / 3, 1.0])
+    assert _get_scales() == [1.0, 1.0, 1.0]
+
+    # Restarting everything together should stagger things again.
+    for instance in instances:
+        instance.restart(immediate=False, restagger=True)
+    assert [slot for slot, _cmd in channel.sent] == [0, 1, 2]
+    assert all(isinstance(cmd, ShutdownCommand) for _, cmd in channel.sent)
+    assert _get_scales() == pytest.approx([1 / 3, 2 / 3, 1.0])
+    instances[1].restart(immediate=False)
+    assert _get_scales() == [1.0, 1.0, 1.0]
+
+
+def test_server_instance_lookup(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test finding instances by name."""
+    # pylint: disable=protected-access
+    app = _make_app(tmp_path, monkeypatch, _MULTI_CONFIG)
+    with pytest.raises(CommunicationError):
+        app._get_instance(None)
+    instances, _channel = _make_instances(app)
+    app._instances = instances
+    with pytest.raises(ValueError, match='specify an instance'):
+        app._get_instance(None)
+    with pytest.raises(ValueError, match='No instance named'):
+        app._get_instance('b')
+    assert app._get_instance('c') is instances[2]
+    assert app._get_instance('43212') is instances[1]
+    assert app._get_instances(None) == instances
+    assert app._get_instances('a') == [instances[0]]
+
+    # With a single instance, no name is needed.
+    app._instances = instances[:1]
+    assert app._get_instance(None) is instances[0]
+
+
+def test_server_instance_config_changes(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that config edits only restart the instances they affect."""
+    # pylint: disable=protected-access
+    app = _make_app(tmp_path, monkeypatch, _MULTI_CONFIG)
+    instances, _channel = _make_instances(app)
+    for instance in instances:
+        instance._config = instance._apply_overrides(app.config)
+
+    for config, changed in [
+        (
+            _MULTI_CONFIG.replace('"Party A"', '"Party A2"'),
+            [True, False, False],
+        ),
+        (
+            _MULTI_CONFIG.replace('max_party_size = 6', 'max_party_size = 7'),
+            [True, False, True],
+        ),
+        ('# Just a comment.\n' + _MULTI_CONFIG, [False, False, False]),
+        ('not valid toml', [False, False, False]),
+    ]:
+        (tmp_path / 'config.toml').write_text(config)
+        assert [i._config_changed() for i in instances] == changed
+
+
+_TEST_STATUS = ServerStatusResponse(
+    session_type='FreeForAllSession',
+    client_count=0,
+    player_count=0,
+    app_time=1.0,
+    tick_lag_mean=0.001,
+    tick_lag_max=0.002,
+    shutdown_reason=None,
+    cpu_time=0.5,
+    memory_rss=None,
+)
+
+
+class _StandInReceiver(MessageReceiver):
+    """Receives commands for a stand-in server subprocess."""
+
+    def __init__(self) -> None:
+        super().__init__(get_server_protocol())
+
+    def handler(
+        self, call: Callable[[Any, Any], Any]
+    ) -> Callable[[Any, Any], Any]:
+        """Decorator to register command handlers."""
+        self.register_handler(call)
+        return call
+
+
+class _StandInServer:
+    """Talks to a _ServerChannel the way a server subprocess does.
+
+    Must be used from within the channel's event loop.
+    """
+
+    sender = MessageSender(get_server_protocol())
+    receiver = _StandInReceiver()
+
+    def __init__(self) -> None:
+        self.commands: list[Message] = []
+        self._endpoint: RPCEndpoint | None = None
+        self._runtask: asyncio.Task | None = None
+
+    async def connect(self, port: int, token: str) -> None:
+        """Connect and say hello."""
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        self._endpoint = RPCEndpoint(
+            self._handle_raw_message, reader, writer, label='test server'
+        )
+        self._runtask = asyncio.create_task(self._endpoint.run())
+        await self.sender.send_async(self, ServerHelloMessage(token=token))
+
+    async def wait_closed(self) -> None:
+        """Wait for our connection to go down."""
+        assert self._runtask is not None
+        await self._runtask
+
+    @sender.send_async_method
+    async def _send_raw_message(self, message: str) -> str:
+        assert self._endpoint is not None
+        return (await self._endpoint.send_message(message.encode())).decode()
+
+    async def _handle_raw_message(self, message: bytes) -> bytes:
+        return self.receiver.handle_raw_message(self, message).encode()
+
+    @receiver.handler
+    def _handle_start_server_mode(self, msg: StartServerModeCommand) -> None:
+        self.commands.append(msg)
+
+    @receiver.handler
+    def _handle_status_query(
+        self, msg: StatusQueryCommand
+    ) -> ServerStatusResponse:
+        self.commands.append(msg)
+        return _TEST_STATUS
+
+
+def test_server_channel() -> None:
+    """Test talking to server subprocesses through a channel."""
+    # pylint: disable=protected-access
+    channel = _get_server_script()._ServerChannel()
+    try:
+        start = StartServerModeCommand(config=ServerConfig(party_name='Test'))
+        token = channel.begin_session(0, start)
+
+        # Connections with the wrong token get dropped without being
+        # sent anything.
+        intruder = _StandInServer()
+        with pytest.raises(CommunicationError):
+            channel.run_coroutine(intruder.connect(channel.port, 'bad' + token))
+        channel.run_coroutine(intruder.wait_closed())
+        assert not intruder.commands
+
+        # The right token gets the start command before anything else,
+        # and queries come back typed.
+        server = _StandInServer()
+        channel.run_coroutine(server.connect(channel.port, token))
+        response = channel.send_command(0, StatusQueryCommand(), timeout=10.0)
+        assert response == _TEST_STATUS
+        assert server.commands == [start, StatusQueryCommand()]
+
+        # Ending a session drops its connection, and a token can only
+        # be used once.
+        channel.end_session(0)
+        channel.run_coroutine(server.wait_closed())
+        with pytest.raises(CommunicationError, match='No server subprocess'):
+            channel.send_command(0, StatusQueryCommand(), timeout=10.0)
+        server = _StandInServer()
+        with pytest.raises(CommunicationError):
+            channel.run_coroutine(server.connect(channel.port, token))
+        channel.run_coroutine(server.wait_closed())
+    finally:
+        channel.close()
+
+
+def test_server_channel_end_session() -> None:
+    """Test that ending a session fails anyone waiting on it."""
+    # pylint: disable=protected-access
+    channel = _get_server_script()._ServerChannel()
+    try:
+        channel.begin_session(
+            0, StartServerModeCommand(config=ServerConfig(party_name='Test'))
+        )
+
+        async def _start_send() -> asyncio.Task[Response | None]:
+            task = asyncio.create_task(channel._send(0, StatusQueryCommand()))
+
+            # Let it start waiting on a connection.
+            await asyncio.sleep(0)
+            return task
+
+        async def _finish_send(
+            task: asyncio.Task[Response | None],
+        ) -> Response | None:
+            return await task
+
+        task = channel.run_coroutine(_start_send())
+        assert not task.done()
+        channel.end_session(0)
+        with pytest.raises(CommunicationError, match='has exited'):
+            channel.run_coroutine(_finish_send(task))
+    finally:
+        channel.close()
+
+
+class _FakeInstance:
+    """Just enough of a _ServerInstance for serving metrics."""
+
+    def __init__(self, name: str | None) -> None:
+        self.name = name
+        self.launch_time: float | None = None
+        self.restart_counts: dict[str, int] = {}
+        self.last_restart_reason: str | None = None
+        self.snapshot: tuple[ServerStatusResponse, float] | None = None
+
+    def get_status_snapshot(self) -> tuple[ServerStatusResponse, float] | None:
+        """Return our canned snapshot."""
+        return self.snapshot
+
+
+def _metrics_request(path: str, request: bytes) -> tuple[str, str]:
+    """Send raw data to a metrics socket; return http status and body."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(10.0)
+        sock.connect(path)
+        sock.sendall(request)
+        sock.shutdown(socket.SHUT_WR)
+        response = b''
+        while data := sock.recv(4096):
+            response += data
+    if not response:
+        return '', ''
+    head, body = response.decode().split('\r\n\r\n', 1)
+    return head.split('\r\n', 1)[0].split(' ', 1)[1], body
+
+
+def test_server_metrics(tmp_path: Path) -> None:
+    """Test serving metrics and health checks."""
+    # pylint: disable=protected-access
+    script = _get_server_script()
+    stale_time = script._MetricsServer.STALE_TIME
+    instances = [_FakeInstance('a'), _FakeInstance('b"\\\n')]
+    instances[0].snapshot = (_TEST_STATUS, time.monotonic())
+    instances[0].launch_time = time.time() - 5.0
+    instances[0].restart_counts = {'crash': 2, 'config': 1}
+    instances[0].last_restart_reason = 'config'
+    instances[1].snapshot = (_TEST_STATUS, time.monotonic() - stale_time - 1.0)
+
+    # Leave a stale socket behind as a crashed previous run would.
+    path = str(tmp_path / 'metrics.sock')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(path)
+
+    channel = script._ServerChannel()
+    try:
+        metrics = script._MetricsServer(channel, instances, None, path)
+        try:
+            status, body = _metrics_request(
+                path, b'GET /metrics HTTP/1.1\r\n\r\n'
+            )
+            assert status == '200 OK'
+            lines = body.splitlines()
+            assert '# TYPE ballisticakit_restarts_total counter' in lines
+            assert 'ballisticakit_up{server="a"} 1' in lines
+            assert 'ballisticakit_up{server="b\\"\\\\\\n"} 0' in lines
+            assert (
+                'ballisticakit_restarts_total{server="a",reason="crash"} 2'
+                in lines
+            )
+            assert (
+                'ballisticakit_last_restart_info{server="a",reason="config"} 1'
+                in lines
+            )
+            assert 'ballisticakit_clients{server="a"} 0' in lines
+            assert 'ballisticakit_cpu_seconds_total{server="a"} 0.5' in lines
+            assert not any('resident_memory' in line for line in lines)
+
+            # Health depends on everybody reporting in recently.
+            assert _metrics_request(path, b'GET /health HTTP/1.1\r\n\r\n') == (
+                '503 Service Unavailable',
+                'a ok\nb"\\\n down\n',
+            )
+            instances[1].snapshot = (_TEST_STATUS, time.monotonic())
+            assert _metrics_request(path, b'GET /health HTTP/1.1\r\n\r\n') == (
+                '200 OK',
+                'a ok\nb"\\\n ok\n',
+            )
+
+            for request, expected in [
+                (b'HEAD /metrics HTTP/1.1\r\n\r\n', ('200 OK', '')),
+                (
+                    b'GET /nope HTTP/1.1\r\n\r\n',
+                    ('404 Not Found', 'Not found.\n'),
+                ),
+                (
+                    b'POST /metrics HTTP/1.1\r\n\r\n',
+                    ('405 Method Not Allowed', 'Method not allowed.\n'),
+                ),
+                # Garbage just gets hung up on.
+                (b'what\r\n\r\n', ('', '')),
+                (b'\xff\xfe /metrics x\r\n\r\n', ('', '')),
+                (b'GET /metrics HTTP/1.1\r\n', ('', '')),
+            ]:
+                assert _metrics_request(path, request) == expected
+        finally:
+            metrics.close()
+        assert not os.path.exists(path)
+
+        # Anything at our socket path that isn't a socket is left alone.
+        with open(path, 'w', encoding='utf-8') as outfile:
+            outfile.write('precious')
+        with pytest.raises(OSError):
+            script._MetricsServer(channel, instances, None, path)
+        with open(path, encoding='utf-8') as infile:
+            assert infile.read() == 'precious'
+    finally:
+        channel.close()
+
+
+def test_server_metric_labels() -> None:
+    """Test escaping of metric label values."""
+    # pylint: disable=protected-access
+    script = _get_server_script()
+    assert script._format_metric_labels({}) == ''
+    assert (
+        script._format_metric_labels({'a': 'x', 'b': 'q"b\\s\nn'})
+        == '{a="x",b="q\\"b\\\\s\\nn"}'
+    )
+    assert script._format_metric_value(3) == '3'
+    assert script._format_metric_value(0.25) == '0.25'
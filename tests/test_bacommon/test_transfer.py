@@ -0,0 +1,143 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Testing transfer functionality."""
+
+from __future__ import annotations
+
+import os
+import time
+import random
+from typing import TYPE_CHECKING
+
+import pytest
+
+from bacommon.transfer import (
+    DirectoryManifest,
+    DirectoryManifestStatCache,
+    DirectoryManifestDiff,
+    CHUNK_MAX_SIZE,
+    make_file_delta,
+    apply_file_delta,
+)
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def _write(path: Path, data: bytes, age: float = 100.0) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+    # Backdate files so their stats are trusted by the cache.
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def test_incremental_manifest(tmp_path: Path) -> None:
+    """Test creating manifests incrementally."""
+    root = tmp_path / 'ws'
+    _write(root / 'a.txt', b'a' * 10)
+    _write(root / 'sub' / 'b.txt', b'b' * 3000000)
+    _write(root / 'sub' / 'c.txt', b'c')
+
+    full = DirectoryManifest.create_from_disk(root)
+    cache = DirectoryManifestStatCache()
+    manifest = DirectoryManifest.create_from_disk(root, stat_cache=cache)
+    assert manifest == full
+    assert set(cache.files) == {'a.txt', 'sub/b.txt', 'sub/c.txt'}
+
+    # Round trip the cache through disk.
+    cache.save(tmp_path / 'cache')
+    cache = DirectoryManifestStatCache.load(tmp_path / 'cache')
+    assert set(cache.files) == {'a.txt', 'sub/b.txt', 'sub/c.txt'}
+
+    # Unchanged files should not get re-hashed; we can test that by
+    # feeding in a bogus previous entry.
+    bogus = DirectoryManifest.create_from_disk(root)
+    bogus.files['sub/b.txt'].hash_sha256 = 'bogus'
+    manifest = DirectoryManifest.create_from_disk(
+        root, previous=bogus, stat_cache=cache
+    )
+    assert manifest.files['sub/b.txt'].hash_sha256 == 'bogus'
+
+    # Changed files should. Recently modified files shouldn't get
+    # cached.
+    _write(root / 'sub' / 'b.txt', b'B' * 3000000, age=0.0)
+    _write(root / 'd.txt', b'd')
+    (root / 'a.txt').unlink()
+    manifest = DirectoryManifest.create_from_disk(
+        root, previous=bogus, stat_cache=cache
+    )
+    assert manifest == DirectoryManifest.create_from_disk(root)
+    assert set(cache.files) == {'sub/c.txt', 'd.txt'}
+
+    assert full.diff(manifest) == DirectoryManifestDiff(
+        added=['d.txt'], removed=['a.txt'], changed=['sub/b.txt']
+    )
+    assert manifest.diff(full) == DirectoryManifestDiff(
+        added=['a.txt'], removed=['d.txt'], changed=['sub/b.txt']
+    )
+    assert full.diff(full).empty
+    assert not full.diff(manifest).empty
+
+    # Bad cache files should just give us empty caches.
+    (tmp_path / 'cache').write_text('garbage')
+    assert not DirectoryManifestStatCache.load(tmp_path / 'cache').files
+    assert not DirectoryManifestStatCache.load(tmp_path / 'nope').files
+
+
+def test_file_deltas(tmp_path: Path) -> None:
+    """Test round-tripping typical edits through file deltas."""
+    rand = random.Random(123)
+    size = 512 * 1024
+    original = rand.randbytes(size)
+    mid = size // 2
+    edits = {
+        'append': original + rand.randbytes(1000),
+        'prepend': rand.randbytes(1000) + original,
+        'insert': original[:mid] + rand.randbytes(100) + original[mid:],
+        'modify': original[:mid] + b'x' * 100 + original[mid + 100 :],
+        'delete': original[:mid] + original[mid + 5000 :],
+        'truncate': original[:1000],
+    }
+    _write(tmp_path / 'old' / 'f', original)
+    old = DirectoryManifest.create_from_disk(tmp_path / 'old', chunked=True)
+    oldfile = old.files['f']
+    assert oldfile.chunks is not None and len(oldfile.chunks) > 4
+    assert oldfile.get_chunks() == oldfile.chunks
+
+    for name, data in edits.items():
+        _write(tmp_path / 'new' / 'f', data)
+        new = DirectoryManifest.create_from_disk(tmp_path / 'new', chunked=True)
+        newfile = new.files['f']
+
+        # Chunking shouldn't change regular hashes.
+        assert newfile.hash_sha256 == (
+            DirectoryManifest.create_from_disk(tmp_path / 'new')
+            .files['f']
+            .hash_sha256
+        )
+
+        # Only chunks near the edit should need to be sent.
+        delta = make_file_delta(oldfile, newfile, tmp_path / 'new' / 'f')
+        assert delta.data_size <= 2 * CHUNK_MAX_SIZE, name
+
+        # Apply in place on a copy of the old version.
+        _write(tmp_path / 'patched', original)
+        apply_file_delta(
+            oldfile, tmp_path / 'patched', delta, tmp_path / 'patched'
+        )
+        assert (tmp_path / 'patched').read_bytes() == data, name
+
+    # With nothing to start from, deltas carry everything.
+    delta = make_file_delta(None, oldfile, tmp_path / 'old' / 'f')
+    assert delta.data_size == size
+    apply_file_delta(None, None, delta, tmp_path / 'fresh')
+    assert (tmp_path / 'fresh').read_bytes() == original
+
+    # Bad deltas should fail and leave existing files alone.
+    delta.hash_sha256 = 'bogus'
+    with pytest.raises(RuntimeError):
+        apply_file_delta(None, None, delta, tmp_path / 'fresh')
+    assert (tmp_path / 'fresh').read_bytes() == original
+    assert sorted(os.listdir(tmp_path)) == ['fresh', 'new', 'old', 'patched']
@@ -1,6 +1,7 @@
 # Released under the MIT License. See LICENSE for details.
 #
 """Testing dataclasses functionality."""
+
 # pylint: disable=too-many-lines
 
 from __future__ import annotations
@@ -1820,3 +1821,522 @@ def test_multi_type_3() -> None:
     # particular MTTestClass1.
     wlobj3 = dataclass_from_dict(MTTest3OldListWrapper, wldata3, lossy=True)
     assert wlobj3 == MTTest3OldListWrapper(children=[MTTest3OldClass1(ival=42)])
+
+
+def test_compiled_codecs() -> None:
+    """Make sure compiled codecs match the interpreted ones."""
+    from efro.dataclassio._outputter import _Outputter
+    from efro.dataclassio._inputter import _Inputter
+
+    @ioprepped
+    @dataclass
+    class _TestClass:
+        ival: Annotated[int, IOAttrs('i')] = 0
+        fval: float = 1.0
+        sval: Annotated[str, IOAttrs('s', store_default=False)] = ''
+        enval: _EnumTest = _EnumTest.TEST1
+        oival: int | None = None
+        nval: _NestedClass = field(default_factory=_NestedClass)
+        lnval: list[_NestedClass] = field(default_factory=list)
+        ssval: set[str] = field(default_factory=set)
+        dictval: dict[_GoodEnum, list[int]] = field(default_factory=dict)
+        tupleval: tuple[int, str, Any] = (1, 'foo', None)
+        datetimeval: datetime.datetime | None = None
+        timedeltaval: datetime.timedelta | None = None
+        bytesval: bytes = b''
+        mtval: MTTestBase | None = None
+        mtlist: list[MTTestBase] = field(default_factory=list)
+        softval: Annotated[
+            list[str], IOAttrs('sv', soft_default_factory=list)
+        ] = field(default_factory=list)
+
+    obj = _TestClass(
+        ival=123,
+        fval=2,
+        sval='whee',
+        oival=7,
+        nval=_NestedClass(ival=1, dval={3: 'three'}),
+        lnval=[_NestedClass(), _NestedClass(sval='bar')],
+        ssval={'c', 'a', 'b'},
+        dictval={_GoodEnum.VAL1: [1, 2, 3]},
+        tupleval=(2, 'bar', {'x': [1]}),
+        datetimeval=utc_now(),
+        timedeltaval=datetime.timedelta(days=1, microseconds=3),
+        bytesval=b'\x00\x01\x02',
+        mtval=MTTestClass2(sval='mt'),
+        mtlist=[MTTestClass1(ival=1), MTTestClass2(sval='b')],
+        softval=['s'],
+    )
+
+    for codec in (Codec.JSON, Codec.FIRESTORE):
+        outputs = [
+            _Outputter(
+                obj,
+                create=True,
+                codec=codec,
+                coerce_to_float=True,
+                discard_extra_attrs=False,
+                compiled=compiled,
+            ).run()
+            for compiled in (True, False)
+        ]
+        assert outputs[0] == outputs[1]
+        assert outputs[0] == dataclass_to_dict(obj, codec=codec)
+
+        inputs = [
+            _Inputter(
+                _TestClass, codec=codec, coerce_to_float=True, compiled=compiled
+            ).run(outputs[0])
+            for compiled in (True, False)
+        ]
+        assert inputs[0] == inputs[1] == obj
+
+    # Default-valued fields with store_default=False should get skipped
+    # and soft-defaults should get filled back in.
+    out = dataclass_to_dict(_TestClass())
+    assert 's' not in out
+    del out['sv']
+    assert dataclass_from_dict(_TestClass, out) == _TestClass()
+
+    # Errors should be the same types in both paths.
+    for compiled in (True, False):
+        with pytest.raises(TypeError):
+            _Outputter(
+                _TestClass(nval=_NestedClass(ival='bad')),  # type: ignore
+                create=True,
+                codec=Codec.JSON,
+                coerce_to_float=True,
+                discard_extra_attrs=False,
+                compiled=compiled,
+            ).run()
+        with pytest.raises(TypeError):
+            _Inputter(
+                _TestClass,
+                codec=Codec.JSON,
+                coerce_to_float=True,
+                compiled=compiled,
+            ).run({'nval': {'ival': 'bad'}})
+        with pytest.raises(AttributeError):
+            _Inputter(
+                _TestClass,
+                codec=Codec.JSON,
+                coerce_to_float=True,
+                allow_unknown_attrs=False,
+                compiled=compiled,
+            ).run({'foo': 1})
+
+
+@ioprepped
+@dataclass
+class _StreamEntry:
+    name: Annotated[str, IOAttrs('n')]
+    val: float = 0.0
+    when: datetime.datetime | None = None
+
+
+@ioprepped
+@dataclass
+class _StreamContainer:
+    entries: Annotated[list[_StreamEntry], IOAttrs('e')]
+    byname: dict[str, _StreamEntry] = field(default_factory=dict)
+    nested: _NestedClass | None = None
+    mtlist: list[MTTestBase] = field(default_factory=list)
+    child: _RecursiveTest | None = None
+    tags: set[str] = field(default_factory=set)
+    count: Annotated[int, IOAttrs('c', store_default=False)] = 0
+
+
+def test_json_stream() -> None:
+    """Test incremental json reading/writing."""
+    import io
+    import json
+
+    from efro.dataclassio import (
+        dataclass_to_json,
+        dataclass_to_json_stream,
+        dataclass_from_json_stream,
+    )
+    from efro.dataclassio._jsonstream import (
+        _JsonStreamReader,
+        _JsonStreamWriter,
+    )
+
+    obj = _StreamContainer(
+        entries=[
+            _StreamEntry(name=f'entry{i}', val=i * 1.5, when=utc_now())
+            for i in range(20)
+        ],
+        byname={
+            'a': _StreamEntry(name='a'),
+            'b': _StreamEntry(name='b', val=3),
+        },
+        nested=_NestedClass(ival=3, dval={1: 'one'}),
+        mtlist=[MTTestClass1(ival=1), MTTestClass2(sval='two')],
+        child=_RecursiveTest(val=1, child=_RecursiveTest(val=2)),
+        tags={'z', 'y'},
+    )
+
+    # Stream output should exactly match regular output.
+    buf = io.StringIO()
+    dataclass_to_json_stream(obj, buf)
+    assert buf.getvalue() == dataclass_to_json(obj)
+    assert (
+        dataclass_from_json_stream(
+            _StreamContainer, io.StringIO(buf.getvalue())
+        )
+        == obj
+    )
+
+    # Run with tiny chunk sizes to exercise values spanning chunk
+    # boundaries. Pretty-printed input should work too.
+    for text in (
+        buf.getvalue(),
+        json.dumps(json.loads(buf.getvalue()), indent=2),
+    ):
+        for chunk_size in (1, 2, 7, 100):
+            obj2 = _JsonStreamReader(
+                _StreamContainer, coerce_to_float=True, chunk_size=chunk_size
+            ).run(io.StringIO(text))
+            assert obj2 == obj
+    for chunk_size in (1, 13):
+        buf = io.StringIO()
+        _JsonStreamWriter(buf, coerce_to_float=True, chunk_size=chunk_size).run(
+            obj
+        )
+        assert buf.getvalue() == dataclass_to_json(obj)
+
+    # Unknown attrs should be preserved (or rejected) like usual.
+    data = json.loads(dataclass_to_json(obj))
+    data['foo'] = {'bar': 1}
+    obj3 = dataclass_from_json_stream(
+        _StreamContainer, io.StringIO(json.dumps(data))
+    )
+    buf = io.StringIO()
+    dataclass_to_json_stream(obj3, buf)
+    assert json.loads(buf.getvalue()) == data
+    with pytest.raises(AttributeError):
+        dataclass_from_json_stream(
+            _StreamContainer,
+            io.StringIO(json.dumps(data)),
+            allow_unknown_attrs=False,
+        )
+
+    # Validation should happen as we go.
+    data = json.loads(dataclass_to_json(obj))
+    data['e'][3]['n'] = 123
+    with pytest.raises(TypeError):
+        dataclass_from_json_stream(
+            _StreamContainer, io.StringIO(json.dumps(data))
+        )
+    data = json.loads(dataclass_to_json(obj))
+    data['e'] = {}
+    with pytest.raises(TypeError):
+        dataclass_from_json_stream(
+            _StreamContainer, io.StringIO(json.dumps(data))
+        )
+    with pytest.raises(ValueError):
+        dataclass_from_json_stream(
+            _StreamContainer, io.StringIO(dataclass_to_json(obj)[:-10])
+        )
+    with pytest.raises(ValueError):
+        dataclass_from_json_stream(
+            _StreamContainer, io.StringIO(dataclass_to_json(obj) + '{}')
+        )
+    obj.entries[2].name = 123  # type: ignore
+    with pytest.raises(TypeError):
+        dataclass_to_json_stream(obj, io.StringIO())
+
+
+def test_binary() -> None:
+    """Test binary encoding/decoding."""
+    from efro.dataclassio import (
+        dataclass_to_json,
+        dataclass_to_binary,
+        dataclass_from_binary,
+    )
+    from efro.dataclassio._binary import pack, unpack
+
+    @ioprepped
+    @dataclass
+    class _TestClass:
+        bval: Annotated[bytes, IOAttrs('b')]
+        when: Annotated[datetime.datetime, IOAttrs('w')]
+        anyval: Any = None
+        ival: Annotated[int, IOAttrs('i', soft_default=-5)] = 0
+        tdval: datetime.timedelta = datetime.timedelta(seconds=3)
+        mtval: MTTestBase | None = None
+
+    # Raw values should survive a round trip exactly.
+    raw = {
+        'a': [
+            0,
+            1,
+            -1,
+            127,
+            128,
+            -129,
+            2**70,
+            -(2**70),
+            1.5,
+            float('inf'),
+            True,
+            False,
+            None,
+            '',
+            'héllo',
+            b'',
+            b'\x00\xff',
+        ],
+        'b': {'a': {'a': 'a'}, '': []},
+        'd': [
+            datetime.datetime(1, 1, 1, tzinfo=datetime.timezone.utc),
+            datetime.datetime(
+                9999, 12, 31, 23, 59, 59, 999999, tzinfo=datetime.timezone.utc
+            ),
+            utc_now(),
+        ],
+    }
+    assert unpack(pack(raw)) == raw
+    with pytest.raises(TypeError):
+        pack({1: 2})
+    with pytest.raises(TypeError):
+        pack((1, 2))
+    with pytest.raises(ValueError):
+        pack(utc_now_naive())
+
+    # Repeated keys should only be written once.
+    assert len(pack([{'longkeyname': i} for i in range(100)])) < 500
+
+    # Everything that goes through json should go through binary.
+    obj = _StreamContainer(
+        entries=[
+            _StreamEntry(name=f'entry{i}', val=i * 1.5, when=utc_now())
+            for i in range(20)
+        ],
+        byname={'a': _StreamEntry(name='a')},
+        nested=_NestedClass(ival=3, dval={1: 'one'}),
+        mtlist=[MTTestClass1(ival=1), MTTestClass2(sval='two')],
+        child=_RecursiveTest(val=1, child=_RecursiveTest(val=2)),
+        tags={'z', 'y'},
+    )
+    data = dataclass_to_binary(obj)
+    assert dataclass_from_binary(_StreamContainer, data) == obj
+    assert dataclass_from_binary(_StreamContainer, memoryview(data)) == obj
+    assert len(data) < len(dataclass_to_json(obj))
+
+    obj2 = _TestClass(
+        bval=b'\x01\x02' * 100,
+        when=utc_now(),
+        anyval={'x': [b'raw', utc_now(), 1.0]},
+        mtval=MTTestClass2(sval='foo'),
+    )
+    obj3 = dataclass_from_binary(_TestClass, dataclass_to_binary(obj2))
+    assert obj3 == obj2
+    assert dataclass_to_dict(obj3, codec=Codec.BINARY)['b'] == obj2.bval
+
+    # Soft defaults and unknown attrs behave as they do elsewhere.
+    values = dataclass_to_dict(obj2, codec=Codec.BINARY)
+    del values['i']
+    values['newattr'] = {'foo': b'bar'}
+    obj4 = dataclass_from_binary(_TestClass, pack(values))
+    assert obj4.ival == -5
+    assert dataclass_to_dict(obj4, codec=Codec.BINARY)['newattr'] == {
+        'foo': b'bar'
+    }
+    with pytest.raises(AttributeError):
+        dataclass_from_binary(
+            _TestClass, pack(values), allow_unknown_attrs=False
+        )
+
+    # Type validation still applies.
+    values['w'] = 'notadatetime'
+    with pytest.raises(TypeError):
+        dataclass_from_binary(_TestClass, pack(values))
+    with pytest.raises(TypeError):
+        dataclass_from_binary(_TestClass, pack([1, 2]))
+
+    # Malformed data should give ValueErrors.
+    for baddata in (
+        b'',
+        b'\x63',
+        data[:-1],
+        data[:3],
+        data + b'\x00',
+        bytes([data[0], 0x09, 0x01, 0x02, 0x00]),
+        bytes([data[0], 0x7F]),
+    ):
+        with pytest.raises(ValueError):
+            dataclass_from_binary(_StreamContainer, baddata)
+
+
+def test_lazy() -> None:
+    """Test lazy decoding."""
+    import pickle
+
+    @ioprepped
+    @dataclass(frozen=True)
+    class _FrozenClass:
+        ival: int
+        lval: list[int]
+
+    obj = _StreamContainer(
+        entries=[_StreamEntry(name=f'entry{i}', val=i * 1.5) for i in range(5)],
+        nested=_NestedClass(ival=3, dval={1: 'one'}),
+        mtlist=[MTTestClass1(ival=1), MTTestClass2(sval='two')],
+        count=4,
+    )
+    data = dataclass_to_dict(obj)
+    data['extra'] = [1, 2]
+
+    # Lazy instances should look like the real thing.
+    lazyobj = dataclass_from_dict(_StreamContainer, data, lazy=True)
+    assert isinstance(lazyobj, _StreamContainer)
+    assert lazyobj == obj and obj == lazyobj
+    assert lazyobj.entries[2].name == 'entry2'
+    assert dataclass_to_dict(lazyobj) == data
+
+    # Untouched values should pass through as-is, even if invalid.
+    data2 = copy.deepcopy(data)
+    data2['e'][1]['n'] = 123
+    lazyobj = dataclass_from_dict(_StreamContainer, data2, lazy=True)
+    assert lazyobj.count == 4
+    assert dataclass_to_dict(lazyobj)['e'] is data2['e']
+
+    # ...but will be validated when accessed or output with a
+    # different codec.
+    with pytest.raises(TypeError):
+        _ = lazyobj.entries
+    lazyobj = dataclass_from_dict(_StreamContainer, data2, lazy=True)
+    with pytest.raises(TypeError):
+        dataclass_to_dict(lazyobj, codec=Codec.FIRESTORE)
+    with pytest.raises(TypeError):
+        dataclass_validate(
+            dataclass_from_dict(_StreamContainer, data2, lazy=True)
+        )
+
+    # Accessed or assigned values get output normally.
+    lazyobj = dataclass_from_dict(_StreamContainer, data, lazy=True)
+    lazyobj.entries.append(_StreamEntry(name='new'))
+    lazyobj.nested = None
+    out = dataclass_to_dict(lazyobj)
+    assert len(out['e']) == 6
+    assert out['nested'] is None
+    assert out['mtlist'] is data['mtlist']
+    assert out['extra'] == [1, 2]
+
+    # Copies and pickles should come out as regular instances.
+    lazyobj = dataclass_from_dict(_StreamContainer, data, lazy=True)
+    for obj2 in (
+        copy.deepcopy(lazyobj),
+        pickle.loads(pickle.dumps(lazyobj)),
+    ):
+        assert obj2.__class__ is _StreamContainer
+        assert obj2 == obj
+        assert dataclass_to_dict(obj2) == data
+
+    # Frozen classes should stay frozen (and hashable).
+    fobj = dataclass_from_dict(
+        _FrozenClass, {'ival': 1, 'lval': [1, 2]}, lazy=True
+    )
+    with pytest.raises(AttributeError):
+        fobj.lval = []  # type: ignore
+    assert fobj.lval == [1, 2]
+
+    # Top-level multi-types and failures on simple fields should work
+    # as usual.
+    mtobj = dataclass_from_dict(
+        MTTestBase, dataclass_to_dict(MTTestClass1(ival=2)), lazy=True
+    )
+    assert mtobj == MTTestClass1(ival=2)
+    with pytest.raises(TypeError):
+        dataclass_from_dict(
+            _FrozenClass, {'ival': 'foo', 'lval': []}, lazy=True
+        )
+    with pytest.raises(ValueError):
+        dataclass_from_dict(_FrozenClass, {'lval': []}, lazy=True)
+    with pytest.raises(AttributeError):
+        dataclass_from_dict(
+            _FrozenClass,
+            {'ival': 1, 'lval': [], 'foo': 1},
+            lazy=True,
+            allow_unknown_attrs=False,
+        )
+
+
+def test_batch() -> None:
+    """Test batch encoding/decoding."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from efro.dataclassio import dataclasses_to_dicts, dataclasses_from_dicts
+
+    objs = [
+        _StreamEntry(name=f'entry{i}', val=i * 0.5, when=utc_now())
+        for i in range(50)
+    ]
+    dicts = [dataclass_to_dict(o) for o in objs]
+    assert dataclasses_to_dicts(objs) == dicts
+    assert dataclasses_to_dicts(iter(objs)) == dicts
+    assert dataclasses_from_dicts(_StreamEntry, dicts) == objs
+    assert dataclasses_to_dicts([]) == []
+
+    # Results should be identical (and in order) through an executor.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        assert (
+            dataclasses_to_dicts(objs, executor=executor, chunk_size=7) == dicts
+        )
+        assert (
+            dataclasses_from_dicts(
+                _StreamEntry, dicts, executor=executor, chunk_size=7
+            )
+            == objs
+        )
+    with pytest.raises(ValueError):
+        dataclasses_to_dicts(objs, chunk_size=0)
+
+    # Mixed types should work, as should multi-type base classes.
+    mtobjs: list[MTTestBase] = [MTTestClass1(ival=1), MTTestClass2(sval='2')]
+    mtdicts = dataclasses_to_dicts(mtobjs)
+    assert mtdicts == [dataclass_to_dict(o) for o in mtobjs]
+    assert dataclasses_from_dicts(MTTestBase, mtdicts) == mtobjs
+
+    # Errors should match their single-object counterparts.
+    with pytest.raises(TypeError):
+        dataclasses_to_dicts([objs[0], 'foo'])
+    dicts[3]['n'] = 123
+    with pytest.raises(TypeError):
+        dataclasses_from_dicts(_StreamEntry, dicts)
+    dicts[3]['n'] = 'foo'
+    dicts[3]['foo'] = 1
+    with pytest.raises(AttributeError):
+        dataclasses_from_dicts(_StreamEntry, dicts, allow_unknown_attrs=False)
+    lossy = dataclasses_from_dicts(_StreamEntry, dicts[:2], lossy=True)
+    with pytest.raises(ValueError):
+        dataclasses_to_dicts(lossy)
+
+
+def test_dict_codec_calls() -> None:
+    """Test prebuilt single-object encode/decode calls."""
+    from efro.dataclassio import dataclass_dict_encoder, dataclass_dict_decoder
+
+    obj = _StreamEntry(name='foo', val=1.5, when=utc_now())
+    encode = dataclass_dict_encoder(_StreamEntry)
+    decode = dataclass_dict_decoder(_StreamEntry)
+    assert encode(obj) == dataclass_to_dict(obj)
+    assert decode(encode(obj)) == obj
+
+    # Lossy results should be flagged as such.
+    lossy = dataclass_dict_decoder(_StreamEntry, lossy=True)(encode(obj))
+    assert lossy == obj
+    with pytest.raises(ValueError):
+        encode(lossy)
+
+    # Multi-type base classes should work too.
+    mtobj = MTTestClass2(sval='2')
+    mtdict = dataclass_dict_encoder(MTTestClass2)(mtobj)
+    assert mtdict == dataclass_to_dict(mtobj)
+    assert dataclass_dict_decoder(MTTestBase)(mtdict) == mtobj
+
+    with pytest.raises(ValueError):
+        dataclass_dict_decoder(
+            _StreamEntry, allow_unknown_attrs=False, discard_unknown_attrs=True
+        )
@@ -0,0 +1,272 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Testing logging functionality."""
+
+from __future__ import annotations
+
+import io
+import os
+import logging
+import datetime
+import threading
+from typing import TYPE_CHECKING
+
+from efro.util import utc_now
+from efro.logging import (
+    LogEntry,
+    LogLevel,
+    LogHandler,
+    FileLogEcho,
+    FILE_WRITE_FLUSH_SIZE,
+    _LogCache,
+)
+from efro.logsink import (
+    SegmentedLogSink,
+    get_log_segments,
+    read_log_segments,
+)
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    import pytest
+
+
+def _drain(handler: LogHandler) -> None:
+    """Wait for a handler's thread to process everything submitted."""
+    handler.file_flush('stdout')
+    handler.file_flush('stderr')
+    done = threading.Event()
+    handler.call_in_thread(done.set)
+    assert done.wait(timeout=5.0)
+
+
+def test_file_write_coalescing() -> None:
+    """Test accumulation of raw stdout/stderr writes."""
+    handler = LogHandler(
+        path=None,
+        echofile=None,
+        cache_size_limit=1024 * 1024,
+        cache_time_limit=None,
+    )
+    out = io.StringIO()
+    echo = FileLogEcho(out, 'stdout', handler)
+    errecho = FileLogEcho(io.StringIO(), 'stderr', handler)
+
+    # Prints should come through as one entry each, even when they
+    # arrive one character at a time.
+    print('first', 'print', file=echo)
+    for _i in range(20):
+        echo.write('^')
+    echo.write('\n')
+    print('third', file=errecho)
+    print('fourth\nfifth', file=echo)
+
+    # Big writes with no newlines should still get handed over.
+    echo.write('x' * (FILE_WRITE_FLUSH_SIZE + 1))
+    _drain(handler)
+
+    entries = handler.get_cached().entries
+    assert [(e.name, e.message) for e in entries] == [
+        ('stdout', 'first print'),
+        ('stdout', '^' * 20),
+        ('stderr', 'third'),
+        ('stdout', 'fourth\nfifth'),
+        ('stdout', 'x' * (FILE_WRITE_FLUSH_SIZE + 1)),
+    ]
+
+    # Everything should have been echoed immediately as is.
+    assert out.getvalue() == (
+        'first print\n'
+        + '^' * 20
+        + '\nfourth\nfifth\n'
+        + 'x' * (FILE_WRITE_FLUSH_SIZE + 1)
+    )
+
+    # Partial lines should get shipped after a short delay even with
+    # no newline or flush.
+    echo.write('partial')
+    shipped = threading.Event()
+    handler.add_callback(
+        lambda entry: shipped.set() if entry.message == 'partial' else None,
+        feed_existing_logs=True,
+    )
+    assert shipped.wait(timeout=5.0)
+
+
+def test_log_cache() -> None:
+    """Test our ring-buffer log cache."""
+    cache = _LogCache()
+    now = utc_now()
+    entries = [
+        LogEntry(name='test', message=str(i), level=LogLevel.INFO, time=now)
+        for i in range(2000)
+    ]
+
+    # Grow, wrap, and shrink while checking against a plain list.
+    start = 0
+    end = 0
+    for step in range(20):
+        for _i in range(150 if step < 10 else 20):
+            cache.append(entries[end], 10)
+            end += 1
+        for _i in range(100 if step % 3 else 7):
+            if start < end:
+                assert cache.oldest() is entries[start]
+                cache.pop_oldest()
+                start += 1
+        assert cache.size == (end - start) * 10
+        assert cache.read(0, None) == (end, start, entries[start:end])
+        mid = (start + end) // 2
+        assert cache.read(mid, 5) == (
+            end,
+            mid,
+            entries[mid : min(mid + 5, end)],
+        )
+        assert cache.read(end + 10, None) == (end, end, [])
+
+    # Readers holding stale state should never get the wrong entries.
+    cache = _LogCache()
+    for entry in entries[:64]:
+        cache.append(entry, 1)
+    stale = cache.state
+    for entry in entries[64:96]:
+        cache.pop_oldest()
+        cache.append(entry, 1)
+    current = cache.state
+    cache.state = stale
+    assert cache.read(0, None) == (64, 32, entries[32:64])
+    cache.state = current
+    assert cache.read(0, None) == (96, 32, entries[32:96])
+
+
+def test_log_handler_cache() -> None:
+    """Test log caching in LogHandler."""
+    handler = LogHandler(
+        path=None,
+        echofile=None,
+        cache_size_limit=50000,
+        cache_time_limit=None,
+    )
+    logger = logging.Logger('test')
+    logger.addHandler(handler)
+    for i in range(1000):
+        logger.info('Entry %d', i)
+    _drain(handler)
+
+    # We should have pruned the oldest stuff to stay under our limit.
+    archive = handler.get_cached()
+    assert archive.log_size == 1000
+    assert 0 < len(archive.entries) < 1000
+    assert archive.start_index + len(archive.entries) == 1000
+    assert archive.entries[-1].message == 'Entry 999'
+
+    assert handler.get_cached(0, 0).start_index == archive.start_index
+    assert handler.get_cached(990, 3).entries == archive.entries[-10:-7]
+    assert not handler.get_cached(5000).entries
+    assert handler.get_cached_entry(0) is None
+    entry = handler.get_cached_entry(998)
+    assert entry is not None and entry.message == 'Entry 998'
+    assert handler.get_cached_entry(1000) is None
+
+
+def test_segmented_log_sink(tmp_path: Path) -> None:
+    """Test writing and reading back rolling log segments."""
+    start = utc_now()
+    levels = [LogLevel.DEBUG, LogLevel.INFO, LogLevel.WARNING, LogLevel.ERROR]
+    entries = [
+        LogEntry(
+            name='test',
+            message=f'Entry {i}',
+            level=LogLevel.ERROR if i == 321 else levels[i % 3],
+            time=start + datetime.timedelta(seconds=i),
+        )
+        for i in range(1000)
+    ]
+    sink = SegmentedLogSink(tmp_path, max_segment_size=20000, block_size=2000)
+    for entry in entries[:900]:
+        sink.write(entry)
+    sink.close()
+
+    # Everything should be compressed and indexed.
+    segments = get_log_segments(tmp_path)
+    assert len(segments) > 2
+    names = set(os.listdir(tmp_path))
+    for segment in segments:
+        assert f'{segment}.jsonl.gz' in names
+        assert f'{segment}.idx.json' in names
+        assert f'{segment}.jsonl' not in names
+
+    # New sinks should pick up where old ones left off; leave this one's
+    # segment uncompressed to test reading raw data.
+    sink = SegmentedLogSink(tmp_path, max_segment_size=10**9)
+    for entry in entries[900:]:
+        sink.write(entry)
+    sink.flush()
+    assert get_log_segments(tmp_path)[-1] == segments[-1] + 1
+
+    archive = read_log_segments(tmp_path)
+    assert archive.entries == entries
+    assert (archive.log_size, archive.start_index) == (1000, 0)
+
+    archive = read_log_segments(
+        tmp_path,
+        start_time=entries[100].time,
+        end_time=entries[950].time,
+    )
+    assert archive.entries == entries[100:950]
+    assert (archive.log_size, archive.start_index) == (1000, 100)
+
+    archive = read_log_segments(tmp_path, min_level=LogLevel.ERROR)
+    assert archive.entries == [entries[321]]
+    assert (archive.log_size, archive.start_index) == (1000, 321)
+
+    archive = read_log_segments(
+        tmp_path, start_time=entries[-1].time + datetime.timedelta(hours=1)
+    )
+    assert not archive.entries
+    assert (archive.log_size, archive.start_index) == (1000, 1000)
+    sink.close()
+
+    # Restricting segment count should prune the oldest (the new
+    # sink's not-yet-written segment counts as one).
+    sink = SegmentedLogSink(tmp_path, max_segments=3)
+    sink.close()
+    assert get_log_segments(tmp_path) == [segments[-1], segments[-1] + 1]
+    assert read_log_segments(tmp_path).entries[-1] == entries[-1]
+
+
+def test_log_handler_sink(tmp_path: Path) -> None:
+    """Test LogHandler writing to a SegmentedLogSink."""
+    sink = SegmentedLogSink(tmp_path)
+    handler = LogHandler(
+        path=None,
+        echofile=None,
+        cache_size_limit=0,
+        cache_time_limit=None,
+        sink=sink,
+    )
+    logger = logging.Logger('test')
+    logger.addHandler(handler)
+    for i in range(100):
+        logger.warning('Entry %d', i)
+    handler.shutdown()
+
+    # Shutting down should have closed out (and compressed) the sink.
+    assert set(os.listdir(tmp_path)) == {'0.jsonl.gz', '0.idx.json'}
+    entries = read_log_segments(tmp_path).entries
+    assert [e.message for e in entries] == [f'Entry {i}' for i in range(100)]
+    assert all(e.level is LogLevel.WARNING for e in entries)
+
+
+def test_log_sink_errors(
+    tmp_path: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """Test that background sink errors get reported."""
+    # A 'raw segment' we can't read; compressing it will fail.
+    os.mkdir(tmp_path / '0.jsonl')
+    sink = SegmentedLogSink(tmp_path)
+    sink.close()
+    err = capsys.readouterr().err
+    assert 'Error in SegmentedLogSink background task' in err
+    assert 'IsADirectoryError' in err
@@ -1,6 +1,7 @@
 # Released under the MIT License. See LICENSE for details.
 #
 """Testing message functionality."""
+
 # pylint: disable=too-many-lines
 
 from __future__ import annotations
@@ -13,7 +14,7 @@ from dataclasses import dataclass
 
 import pytest
 from efro.error import CleanError, RemoteError, CommunicationError
-from efro.dataclassio import ioprepped
+from efro.dataclassio import ioprepped, dataclass_to_json, dataclass_from_json
 from efro.message import (
     Message,
     Response,
@@ -24,6 +25,9 @@ from efro.message import (
     BoundMessageReceiver,
     UnregisteredMessageIDError,
     EmptySysResponse,
+    MessageMetrics,
+    MessageMetricsSnapshot,
+    MessageHistogram,
 )
 
 if TYPE_CHECKING:
@@ -289,7 +293,9 @@ class _BoundTestSingleMessageReceiver(BoundMessageReceiver):
     """Protocol-specific bound receiver."""
 
     def handle_raw_message(
-        self, message: str, raise_unregistered: bool = False
+        self,
+        message: str | bytes | memoryview,
+        raise_unregistered: bool = False,
     ) -> str:
         """Synchronously handle a raw incoming message."""
         return self._receiver.handle_raw_message(
@@ -347,7 +353,9 @@ class _BoundTestSyncMessageReceiver(BoundMessageReceiver):
     """Protocol-specific bound receiver."""
 
     def handle_raw_message(
-        self, message: str, raise_unregistered: bool = False
+        self,
+        message: str | bytes | memoryview,
+        raise_unregistered: bool = False,
     ) -> str:
         """Synchronously handle a raw incoming message."""
         return self._receiver.handle_raw_message(
@@ -405,7 +413,9 @@ class _BoundTestAsyncMessageReceiver(BoundMessageReceiver):
     """Protocol-specific bound receiver."""
 
     def handle_raw_message(
-        self, message: str, raise_unregistered: bool = False
+        self,
+        message: str | bytes | memoryview,
+        raise_unregistered: bool = False,
     ) -> Awaitable[str]:
         """Asynchronously handle a raw incoming message."""
         return self._receiver.handle_raw_message_async(
@@ -1132,3 +1142,328 @@ def test_full_pipeline(caplog: pytest.LogCaptureFixture) -> None:
         response4 = asyncio.run(obj.msg.send_async(_TMsg1(ival=0)))
 
     obj.test_send_method_exceptions = False
+
+
+def test_compiled_dispatch() -> None:
+    """Test compiled protocols/receivers and raw bytes input."""
+
+    rcv = _TestSyncMessageReceiver()
+
+    class _TestClassR:
+        """Test class incorporating synchronous receive functionality."""
+
+        receiver = rcv
+
+        @receiver.handler
+        def handle_test_message_1(self, msg: _TMsg1) -> _TResp1:
+            """Test."""
+            return _TResp1(bval=msg.ival > 0)
+
+        @receiver.handler
+        def handle_test_message_2(self, msg: _TMsg2) -> _TResp1 | _TResp2:
+            """Test."""
+            return _TResp2(fval=float(len(msg.sval)))
+
+    obj = _TestClassR()
+    protocol = TEST_PROTOCOL
+    protocol.compile()
+    protocol.compile()  # Should be harmless.
+
+    # Codecs should give the same results as a plain round trip.
+    msgdict = protocol.message_to_dict(_TMsg2(sval='foo'))
+    assert msgdict == {'t': 1, 'm': {'sval': 'foo'}}
+    assert protocol.message_from_dict(msgdict) == _TMsg2(sval='foo')
+    with pytest.raises(UnregisteredMessageIDError):
+        protocol.get_message_decoder(99)
+    with pytest.raises(TypeError):
+        protocol.message_to_dict(_TMsg4(sval2='foo'))
+
+    # Raw messages can come in as str, bytes, or memoryviews.
+    raw = protocol.encode_dict(msgdict)
+    for rawval in (raw, raw.encode(), memoryview(raw.encode())):
+        rsp = protocol.response_from_dict(
+            protocol.decode_dict(obj.receiver.handle_raw_message(rawval))
+        )
+        assert rsp == _TResp2(fval=3.0)
+
+    # _TMsg3 is in the protocol but has no handler here; should get an
+    # error response.
+    rspstr = obj.receiver.handle_raw_message(
+        protocol.encode_dict(protocol.message_to_dict(_TMsg3(sval='x')))
+    )
+    assert protocol.decode_dict(rspstr)['t'] == -1
+
+    # Registering a handler should update an already-built dispatch
+    # table.
+    def handle_test_message_3(self: object, msg: _TMsg3) -> None:
+        """Test."""
+        del self, msg  # Unused.
+
+    rcv.handler(handle_test_message_3)
+    rspstr = obj.receiver.handle_raw_message(
+        protocol.encode_dict(protocol.message_to_dict(_TMsg3(sval='x')))
+    )
+    assert protocol.decode_dict(rspstr)['t'] == -2
+
+    # Generated modules can opt in to compiling up front.
+    for smod in (
+        protocol.do_create_receiver_module(
+            'Foo', 'protocol = TEST_PROTOCOL', is_async=False, precompile=True
+        ),
+        protocol.do_create_sender_module(
+            'Foo',
+            'protocol = TEST_PROTOCOL',
+            enable_sync_sends=True,
+            enable_async_sends=False,
+            precompile=True,
+        ),
+    ):
+        assert '        self.protocol.compile()\n' in smod
+
+
+def test_batch_send() -> None:
+    """Test sending batches of messages in single raw sends."""
+
+    raw_sends: list[str] = []
+
+    class _TestClassRSync:
+        """Test class incorporating synchronous receive functionality."""
+
+        receiver = _TestSyncMessageReceiver()
+
+        @receiver.handler
+        def handle_test_message_1(self, msg: _TMsg1) -> _TResp1:
+            """Test."""
+            if msg.ival == 1:
+                raise CleanError('Testing Clean Error')
+            return _TResp1(bval=True)
+
+        @receiver.handler
+        def handle_test_message_2(self, msg: _TMsg2) -> _TResp1 | _TResp2:
+            """Test."""
+            return _TResp2(fval=float(len(msg.sval)))
+
+    class _TestClassRAsync:
+        """Test class incorporating asynchronous receive functionality."""
+
+        receiver = _TestAsyncMessageReceiver()
+
+        def __init__(self) -> None:
+            self.event = asyncio.Event()
+
+        @receiver.handler
+        async def handle_test_message_1(self, msg: _TMsg1) -> _TResp1:
+            """Test."""
+            # This won't finish until a later message in the batch
+            # sets our event, so this only works if handlers are run
+            # concurrently.
+            await asyncio.wait_for(self.event.wait(), timeout=5.0)
+            return _TResp1(bval=msg.ival == 0)
+
+        @receiver.handler
+        async def handle_test_message_2(self, msg: _TMsg2) -> _TResp1 | _TResp2:
+            """Test."""
+            self.event.set()
+            return _TResp2(fval=float(len(msg.sval)))
+
+        @receiver.handler
+        async def handle_test_message_3(self, msg: _TMsg3) -> None:
+            """Test."""
+            raise CleanError(msg.sval)
+
+    class _TestClassS:
+        """Test class incorporating send functionality."""
+
+        msg = _TestMessageSenderBBoth()
+
+        def __init__(self, target: _TestClassRSync | _TestClassRAsync) -> None:
+            self.fail_sends = False
+            self._target = target
+
+        @msg.send_async_method
+        def _send_raw_message_async(self, data: str) -> Awaitable[str]:
+            """Handle asynchronous sending of raw json message data."""
+            if self.fail_sends:
+                raise CommunicationError('Testing send error')
+            raw_sends.append(data)
+            if isinstance(self._target, _TestClassRSync):
+                return self._finish(
+                    self._target.receiver.handle_raw_message(data)
+                )
+            return self._target.receiver.handle_raw_message(data)
+
+        async def _finish(self, response: str) -> str:
+            return response
+
+    async def _run() -> None:
+        # Sync receiver; each message should get its own response or
+        # error.
+        obj = _TestClassS(target=_TestClassRSync())
+        results = await obj.msg.send_batch_async(
+            [
+                _TMsg1(ival=0),
+                _TMsg1(ival=1),
+                _TMsg2(sval='abc'),
+                _TMsg3(sval='unhandled'),
+                _TMsg4(sval2='unregistered'),
+            ]
+        )
+        assert len(raw_sends) == 1
+        assert results[0] == _TResp1(bval=True)
+        assert isinstance(results[1], CleanError)
+        assert str(results[1]) == 'Testing Clean Error'
+        assert results[2] == _TResp2(fval=3.0)
+        assert isinstance(results[3], RemoteError)
+        assert isinstance(results[4], RemoteError)
+        assert await obj.msg.send_batch_async([]) == []
+
+        # Async receiver; handlers should run concurrently.
+        obj = _TestClassS(target=_TestClassRAsync())
+        results = await obj.msg.send_batch_async(
+            [_TMsg1(ival=0), _TMsg3(sval='foo'), _TMsg2(sval='ab')]
+        )
+        assert results[0] == _TResp1(bval=True)
+        assert isinstance(results[1], CleanError) and str(results[1]) == 'foo'
+        assert results[2] == _TResp2(fval=2.0)
+
+        # Errors in the raw send should apply to all messages.
+        obj.fail_sends = True
+        results = await obj.msg.send_batch_async(
+            [_TMsg1(ival=0), _TMsg2(sval='ab')]
+        )
+        assert all(isinstance(r, CommunicationError) for r in results)
+
+        # Errors encoding messages should be raised before anything
+        # goes out.
+        obj.fail_sends = False
+        sendcount = len(raw_sends)
+        with pytest.raises(TypeError):
+            await obj.msg.send_batch_async(
+                [_TMsg2(sval='ab'), _TMsg1(ival='nope')]  # type: ignore
+            )
+        assert len(raw_sends) == sendcount
+
+    asyncio.run(_run())
+
+
+def test_metrics(caplog: pytest.LogCaptureFixture) -> None:
+    """Test per-message-type metrics."""
+    # pylint: disable=too-many-locals
+    # pylint: disable=too-many-statements
+
+    hist = MessageHistogram()
+    assert hist.percentile(0.5) == 0
+    for val in (0, 1, 5, 6, 7, 100):
+        hist.add(val)
+    assert hist.count == 6 and hist.total == 119 and hist.max == 100
+    assert hist.buckets[:4] == [1, 1, 0, 3]
+    assert hist.percentile(0.5) == 7
+    assert hist.percentile(1.0) == 100
+    with pytest.raises(ValueError):
+        hist.percentile(2.0)
+
+    sender = _TestMessageSenderBBoth()
+    rcv = _TestSyncMessageReceiver()
+
+    class _TestClassR:
+        """Test class incorporating synchronous receive functionality."""
+
+        receiver = rcv
+
+        @receiver.handler
+        def handle_test_message_1(self, msg: _TMsg1) -> _TResp1:
+            """Test."""
+            if msg.ival == 1:
+                raise CleanError('Testing Clean Error')
+            return _TResp1(bval=True)
+
+        @receiver.handler
+        def handle_test_message_2(self, msg: _TMsg2) -> _TResp1 | _TResp2:
+            """Test."""
+            return _TResp2(fval=float(len(msg.sval)))
+
+    class _TestClassS:
+        """Test class incorporating send functionality."""
+
+        msg = sender
+
+        def __init__(self) -> None:
+            self._target = _TestClassR()
+
+        @msg.send_method
+        def _send_raw_message(self, data: str) -> str:
+            """Handle synchronous sending of raw json message data."""
+            return self._target.receiver.handle_raw_message(data)
+
+        @msg.send_async_method
+        def _send_raw_message_async(self, data: str) -> Awaitable[str]:
+            """Handle asynchronous sending of raw json message data."""
+            return self._finish(self._target.receiver.handle_raw_message(data))
+
+        async def _finish(self, response: str) -> str:
+            return response
+
+    obj = _TestClassS()
+
+    # Nothing should be recorded by default.
+    assert sender.metrics is None and TEST_PROTOCOL.metrics is None
+    obj.msg.send(_TMsg1(ival=0))
+
+    smetrics = sender.metrics = MessageMetrics()
+    rmetrics = MessageMetrics()
+    TEST_PROTOCOL.metrics = rmetrics
+    try:
+        obj.msg.send(_TMsg1(ival=0))
+        with pytest.raises(CleanError):
+            obj.msg.send(_TMsg1(ival=1))
+        obj.msg.send(_TMsg2(sval='abc'))
+
+        async def _send_batch() -> None:
+            await obj.msg.send_batch_async([_TMsg1(ival=0), _TMsg2(sval='ab')])
+
+        asyncio.run(_send_batch())
+        _TestClassR().receiver.handle_raw_message('invalid')
+    finally:
+        TEST_PROTOCOL.metrics = None
+        sender.metrics = None
+
+    name1 = f'{_TMsg1.__module__}.{_TMsg1.__qualname__}'
+    name2 = f'{_TMsg2.__module__}.{_TMsg2.__qualname__}'
+
+    # Our sender had its own metrics so nothing sent should have gone to
+    # the protocol's.
+    ssnap = smetrics.get_snapshot()
+    rsnap = rmetrics.get_snapshot()
+    assert not ssnap.received and not rsnap.sent
+    assert set(ssnap.sent) == {name1, name2}
+    assert set(rsnap.received) == {name1, name2, '<unknown>'}
+
+    sent1 = ssnap.sent[name1]
+    assert sent1.count == 3 and sent1.errors == 1
+    assert sent1.handle_time.count == 3
+    # Sizes are not recorded for batched messages.
+    assert sent1.message_bytes.count == 2
+    assert sent1.message_bytes.max == len(
+        TEST_PROTOCOL.encode_dict(TEST_PROTOCOL.message_to_dict(_TMsg1(ival=0)))
+    )
+    assert ssnap.sent[name2].count == 2 and ssnap.sent[name2].errors == 0
+
+    recv1 = rsnap.received[name1]
+    assert recv1.count == 3 and recv1.errors == 1
+    assert recv1.response_bytes.count == 2
+    assert rsnap.received['<unknown>'].errors == 1
+
+    # Snapshots should survive a round trip through dataclassio.
+    assert (
+        dataclass_from_json(MessageMetricsSnapshot, dataclass_to_json(ssnap))
+        == ssnap
+    )
+
+    # Logged snapshots should be labeled and reset things.
+    with caplog.at_level(logging.INFO):
+        smetrics.log_snapshot()
+    record = caplog.records[-1]
+    assert getattr(record, 'labels') == {'type': 'efro.message.metrics'}
+    logged = dataclass_from_json(MessageMetricsSnapshot, record.getMessage())
+    assert logged.sent[name1].count == 3
+    assert not smetrics.get_snapshot().sent
@@ -5,7 +5,9 @@
 from __future__ import annotations
 
 import os
+import json
 import time
+import zlib
 import random
 import asyncio
 import weakref
@@ -15,12 +17,13 @@ from dataclasses import dataclass
 
 import pytest
 
-from efro.rpc import RPCEndpoint
+import efro.rpc
+from efro.rpc import RPCEndpoint, RPCBusyError
 from efro.error import CommunicationError
 from efro.dataclassio import ioprepped, dataclass_from_json, dataclass_to_json
 
 if TYPE_CHECKING:
-    from typing import Awaitable
+    from typing import Any, Awaitable
 
 FAST_MODE = os.environ.get('BA_TEST_FAST_MODE') == '1'
 
@@ -58,11 +61,15 @@ class _ServerClientCommon:
         keepalive_interval: float,
         keepalive_timeout: float,
         debug_print: bool,
+        endpoint_kwargs: dict[str, Any] | None = None,
     ) -> None:
         self._endpoint: RPCEndpoint | None = None
         self._keepalive_interval = keepalive_interval
         self._keepalive_timeout = keepalive_timeout
         self._debug_print = debug_print
+        self._endpoint_kwargs = (
+            {} if endpoint_kwargs is None else endpoint_kwargs
+        )
 
     def has_endpoint(self) -> bool:
         """Is our endpoint up yet?"""
@@ -80,10 +87,16 @@ class _ServerClientCommon:
         message: _Message,
         timeout: float | None = None,
         close_on_error: bool = True,
+        when_writable: bool = False,
     ) -> _Message:
         """Send high level messages."""
         assert self._endpoint is not None
-        response = await self._endpoint.send_message(
+        send = (
+            self._endpoint.send_message_when_writable
+            if when_writable
+            else self._endpoint.send_message
+        )
+        response = await send(
             dataclass_to_json(message).encode(),
             timeout=timeout,
             close_on_error=close_on_error,
@@ -124,11 +137,13 @@ class _Server(_ServerClientCommon):
         keepalive_interval: float,
         keepalive_timeout: float,
         debug_print: bool,
+        endpoint_kwargs: dict[str, Any] | None = None,
     ) -> None:
         super().__init__(
             keepalive_interval=keepalive_interval,
             keepalive_timeout=keepalive_timeout,
             debug_print=debug_print,
+            endpoint_kwargs=endpoint_kwargs,
         )
         self.listener: asyncio.base_events.Server | None = None
 
@@ -165,6 +180,7 @@ class _Server(_ServerClientCommon):
             keepalive_timeout=self._keepalive_timeout,
             debug_print=self._debug_print,
             label='test_rpc_server',
+            **self._endpoint_kwargs,
         )
 
         await self._endpoint.run()
@@ -176,11 +192,13 @@ class _Client(_ServerClientCommon):
         keepalive_interval: float,
         keepalive_timeout: float,
         debug_print: bool,
+        endpoint_kwargs: dict[str, Any] | None = None,
     ) -> None:
         super().__init__(
             keepalive_interval=keepalive_interval,
             keepalive_timeout=keepalive_timeout,
             debug_print=debug_print,
+            endpoint_kwargs=endpoint_kwargs,
         )
 
     async def run(self) -> None:
@@ -197,6 +215,7 @@ class _Client(_ServerClientCommon):
             keepalive_timeout=self._keepalive_timeout,
             debug_print=self._debug_print,
             label='test_rpc_client',
+            **self._endpoint_kwargs,
         )
         await self._endpoint.run()
 
@@ -208,16 +227,23 @@ class _Tester:
         keepalive_timeout: float = RPCEndpoint.DEFAULT_KEEPALIVE_TIMEOUT,
         server_debug_print: bool = True,
         client_debug_print: bool = True,
+        *,
+        endpoint_kwargs: dict[str, Any] | None = None,
+        client_endpoint_kwargs: dict[str, Any] | None = None,
     ) -> None:
+        # Client-specific kwargs override general ones.
         self.client = _Client(
             keepalive_interval=keepalive_interval,
             keepalive_timeout=keepalive_timeout,
             debug_print=client_debug_print,
+            endpoint_kwargs=(endpoint_kwargs or {})
+            | (client_endpoint_kwargs or {}),
         )
         self.server = _Server(
             keepalive_interval=keepalive_interval,
             keepalive_timeout=keepalive_timeout,
             debug_print=server_debug_print,
+            endpoint_kwargs=endpoint_kwargs,
         )
 
     # noinspection PyProtectedMember
@@ -457,3 +483,338 @@ def test_client_interrupt() -> None:
             await tester.server.send_message(_Message(_MessageType.TEST_SLOW))
 
     tester.run(_do_it())
+
+
+@pytest.mark.skipif(FAST_MODE, reason='fast mode')
+def test_backpressure() -> None:
+    """Test out-queue water marks and in-flight limits."""
+    tester = _Tester(
+        endpoint_kwargs={
+            'out_high_water_bytes': 64 * 1024,
+            'max_in_flight_messages': 4,
+        },
+    )
+
+    async def _do_it() -> None:
+        endpoint = tester.client.endpoint
+        assert endpoint.is_writable()
+
+        # Enqueueing a few big messages at once should push us past our
+        # high water mark (using random data so compression doesn't
+        # shrink them).
+        message = dataclass_to_json(
+            _Message(_MessageType.TEST1, extradata=os.urandom(32 * 1024))
+        ).encode()
+        sends = [endpoint.send_message(message) for _ in range(4)]
+        stats = endpoint.get_stats()
+        assert stats.throttled
+        assert stats.out_bytes > 64 * 1024
+        assert stats.in_flight_messages == 4
+        assert not endpoint.is_writable()
+
+        # We're at our in-flight limit, so plain sends should get
+        # rejected (without killing the connection).
+        with pytest.raises(RPCBusyError):
+            _rsp = endpoint.send_message(b'')
+        assert not endpoint.is_closing()
+
+        responses = await asyncio.gather(*sends)
+        assert all(
+            dataclass_from_json(_Message, r.decode()).messagetype
+            is _MessageType.RESPONSE1
+            for r in responses
+        )
+        stats = endpoint.get_stats()
+        assert not stats.throttled
+        assert stats.in_flight_messages == 0
+        assert stats.throttle_count == 1
+        assert stats.busy_reject_count == 1
+
+        # Sends that wait for capacity should never exceed our limit.
+        results = await asyncio.gather(
+            *[
+                tester.client.send_message(
+                    _Message(_MessageType.TEST1), when_writable=True
+                )
+                for _ in range(20)
+            ]
+        )
+        assert all(r.messagetype is _MessageType.RESPONSE1 for r in results)
+        stats = endpoint.get_stats()
+        assert stats.peak_in_flight_messages == 4
+        assert stats.send_wait_count > 0
+        assert stats.in_flight_messages == 0
+
+    tester.run(_do_it())
+
+
+@pytest.mark.skipif(FAST_MODE, reason='fast mode')
+def test_write_batching() -> None:
+    """Test coalescing of outgoing packets."""
+    tester = _Tester(
+        endpoint_kwargs={
+            'write_batch_max_bytes': 1024,
+            'write_batch_delay': 0.001,
+        },
+    )
+
+    async def _do_it() -> None:
+        endpoint = tester.client.endpoint
+        message = dataclass_to_json(_Message(_MessageType.TEST1)).encode()
+
+        # Lots of small messages enqueued at once should go out in a
+        # few big writes (limited by our max batch size).
+        sends = [endpoint.send_message(message) for _ in range(200)]
+        responses = await asyncio.gather(*sends)
+        assert all(
+            dataclass_from_json(_Message, r.decode()).messagetype
+            is _MessageType.RESPONSE1
+            for r in responses
+        )
+        stats = endpoint.get_stats()
+        assert stats.packets_written == 200
+        assert stats.write_calls < 50
+        assert stats.write_calls >= 200 * (len(message) + 5) // 1024
+
+        # A message bigger than our batch limit still goes through.
+        resp = await tester.client.send_message(
+            _Message(_MessageType.TEST_BIG, extradata=bytes(4096))
+        )
+        assert resp.messagetype is _MessageType.RESPONSE_BIG
+
+    tester.run(_do_it())
+
+
+@pytest.mark.skipif(FAST_MODE, reason='fast mode')
+def test_compression() -> None:
+    """Test compressed messages and responses."""
+    tester = _Tester()
+
+    async def _do_it() -> None:
+        # Big messages and responses should get compressed both ways.
+        resp = await tester.client.send_message(
+            _Message(_MessageType.TEST_BIG, extradata=bytes(1024 * 1024))
+        )
+        assert resp.messagetype is _MessageType.RESPONSE_BIG
+        assert resp.extradata == bytes(1024 * 1024 * 5)
+        for endpoint in (tester.client.endpoint, tester.server.endpoint):
+            stats = endpoint.get_stats()
+            assert stats.compressed_packets_sent == 1
+            assert stats.decompress_count == 1
+            assert stats.compression_ratio < 0.1
+
+        # Small ones should not.
+        resp = await tester.client.send_message(_Message(_MessageType.TEST1))
+        assert resp.messagetype is _MessageType.RESPONSE1
+        assert tester.client.endpoint.get_stats().compress_count == 1
+
+    tester.run(_do_it())
+
+
+@pytest.mark.skipif(FAST_MODE, reason='fast mode')
+def test_compression_unsupported() -> None:
+    """Test talking to a peer that doesn't support compression."""
+    tester = _Tester(client_endpoint_kwargs={'compression': False})
+
+    async def _do_it() -> None:
+        for sender in (tester.client, tester.server):
+            resp = await sender.send_message(
+                _Message(_MessageType.TEST_BIG, extradata=bytes(1024 * 1024))
+            )
+            assert resp.messagetype is _MessageType.RESPONSE_BIG
+        for endpoint in (tester.client.endpoint, tester.server.endpoint):
+            stats = endpoint.get_stats()
+            assert stats.compress_count == 0
+            assert stats.decompress_count == 0
+
+    tester.run(_do_it())
+
+
+def test_compression_bomb(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that payloads expanding too much get rejected."""
+    monkeypatch.setattr(efro.rpc, '_MAX_DECOMPRESSED_SIZE', 1024 * 1024)
+    received: list[bytes] = []
+
+    async def _handle_raw_message(message: bytes) -> bytes:
+        received.append(message)
+        return message
+
+    async def _do_it() -> None:
+        server_tasks: list[asyncio.Task] = []
+
+        async def _handle_client(
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            task = asyncio.current_task()
+            assert task is not None
+            server_tasks.append(task)
+            await RPCEndpoint(
+                _handle_raw_message, reader, writer, 'test_rpc_bomb_server'
+            ).run()
+
+        server = await asyncio.start_server(_handle_client, ADDR, 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection(ADDR, port)
+
+        # Speak the protocol by hand so we can send whatever we want.
+        handshake = json.dumps({'p': 4, 'k': 10.0, 'c': ['zlib']}).encode()
+        bomb = zlib.compress(bytes(2 * 1024 * 1024))
+        writer.write(
+            len(handshake).to_bytes(4, 'big')
+            + handshake
+            + (2 | 0x80).to_bytes(1, 'big')  # Compressed message.
+            + (0).to_bytes(4, 'big')
+            + len(bomb).to_bytes(2, 'big')
+            + bomb
+        )
+        await writer.drain()
+
+        # The server should hang up on us without handling anything.
+        await asyncio.wait_for(reader.read(), timeout=5.0)
+        await asyncio.wait_for(asyncio.gather(*server_tasks), timeout=5.0)
+        assert not received
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(_do_it())
+
+
+@pytest.mark.skipif(FAST_MODE, reason='fast mode')
+def test_wait_ready() -> None:
+    """Test waiting for connections to be established."""
+    tester = _Tester()
+
+    async def _do_it() -> None:
+        await tester.client.endpoint.wait_ready()
+        await tester.server.endpoint.wait_ready()
+        assert tester.client.endpoint.is_ready()
+        assert tester.server.endpoint.is_ready()
+
+    tester.run(_do_it())
+
+
+@pytest.mark.skipif(FAST_MODE, reason='fast mode')
+def test_close_before_handshake() -> None:
+    """Test closing while waiting on a peer that never says hello."""
+
+    async def _handle_raw_message(message: bytes) -> bytes:
+        return message
+
+    async def _do_it() -> None:
+        # A server that accepts connections but never talks.
+        connected = asyncio.Event()
+
+        async def _handle_client(
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            del reader  # Unused.
+            connected.set()
+            await asyncio.sleep(1.0)
+            writer.close()
+
+        server = await asyncio.start_server(_handle_client, ADDR, 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection(ADDR, port)
+        endpoint = RPCEndpoint(
+            _handle_raw_message, reader, writer, 'test_rpc_lonely'
+        )
+        run_task = asyncio.create_task(endpoint.run())
+        await connected.wait()
+
+        async def _send() -> None:
+            await endpoint.send_message(b'hello')
+
+        ready_task = asyncio.create_task(endpoint.wait_ready())
+        send_task = asyncio.create_task(_send())
+        await asyncio.sleep(0.1)
+        assert not endpoint.is_ready()
+        assert not ready_task.done()
+        assert not send_task.done()
+
+        # Both should error out promptly when we close.
+        endpoint.close()
+        with pytest.raises(CommunicationError):
+            await ready_task
+        with pytest.raises(CommunicationError):
+            await send_task
+        await run_task
+
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(_do_it(), debug=True)
+
+
+async def _run_gated_pair(
+    message_count: int, client_protocol: int | None = None
+) -> None:
+    """Send lots of messages that all get held until the last arrives.
+
+    This ensures they're all simultaneously in flight.
+    """
+    # pylint: disable=protected-access
+    gate = asyncio.Event()
+    received = 0
+
+    async def _handle_raw_message(message: bytes) -> bytes:
+        nonlocal received
+        received += 1
+        if received == message_count:
+            gate.set()
+        await gate.wait()
+        return message
+
+    server_tasks: list[asyncio.Task] = []
+
+    async def _handle_client(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        server_tasks.append(task)
+        await RPCEndpoint(
+            _handle_raw_message, reader, writer, 'test_rpc_gated_server'
+        ).run()
+
+    server = await asyncio.start_server(_handle_client, ADDR, 0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection(ADDR, port)
+    client = RPCEndpoint(
+        _handle_raw_message, reader, writer, 'test_rpc_gated_client'
+    )
+    if client_protocol is not None:
+        client._protocol = client_protocol
+    client_task = asyncio.create_task(client.run())
+
+    responses = await asyncio.gather(
+        *[
+            client.send_message(i.to_bytes(4, 'big'))
+            for i in range(message_count)
+        ]
+    )
+    assert responses == [i.to_bytes(4, 'big') for i in range(message_count)]
+    stats = client.get_stats()
+    assert stats.peak_in_flight_messages == message_count
+    assert stats.in_flight_messages == 0
+
+    # Our timeout heap shouldn't be holding on to everything.
+    assert len(client._timeout_heap) <= 1024
+
+    client.close()
+    await client_task
+    await asyncio.gather(*server_tasks)
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.skipif(FAST_MODE, reason='fast mode')
+def test_many_in_flight() -> None:
+    """Test having more messages in flight than 16 bit ids allow."""
+    asyncio.run(_run_gated_pair(100000))
+
+
+@pytest.mark.skipif(FAST_MODE, reason='fast mode')
+def test_old_protocol() -> None:
+    """Test talking to a peer using 16 bit message ids."""
+    asyncio.run(_run_gated_pair(1000, client_protocol=2))
@@ -0,0 +1,33 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Shared efrotools test setup."""
+
+from __future__ import annotations
+
+import os
+import time
+from typing import TYPE_CHECKING
+
+import pytest
+
+if TYPE_CHECKING:
+    from typing import Callable
+    from pathlib import Path
+
+
+def _write_old_file(path: Path, data: str | bytes, age: float = 100.0) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(data, str):
+        path.write_text(data)
+    else:
+        path.write_bytes(data)
+
+    # Backdate files so they are outside of the racy window.
+    mtime_ns = time.time_ns() - int(age * 1e9)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.fixture(name='write_old_file')
+def fixture_write_old_file() -> Callable[..., None]:
+    """Write files with mtimes safely in the past (age in seconds)."""
+    return _write_old_file
@@ -0,0 +1,166 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Testing efrocache functionality."""
+
+from __future__ import annotations
+
+import os
+import json
+from typing import TYPE_CHECKING
+
+import pytest
+
+from efro.error import CleanError
+from efro.terminal import Clr
+from efrotools.efrocache import (
+    CACHE_MAP_NAME,
+    get_cache_map,
+    get_targets,
+    extract_cache_file,
+    _write_cache_file,
+)
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def _make_project(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> dict[str, str]:
+    """Set up a project and repository; returns target contents."""
+    proj = tmp_path / 'proj'
+    (proj / 'src').mkdir(parents=True)
+    monkeypatch.chdir(proj)
+    monkeypatch.setenv('EFROCACHE_REPOSITORY_URL', f'file://{tmp_path}/repo')
+    monkeypatch.setenv('EFROCACHE_DIR', str(tmp_path / 'local'))
+
+    contents = {
+        'out/tool': '#!/bin/sh\necho hi\n',
+        'out/sub/data.txt': 'data ' * 1000,
+    }
+    cachemap: dict[str, str] = {}
+    for target, data in contents.items():
+        src = f'src/{os.path.basename(target)}'
+        with open(src, 'w', encoding='utf-8') as outfile:
+            outfile.write(data)
+        if target == 'out/tool':
+            os.chmod(src, 0o755)
+        _fname, hashval, _path = _write_cache_file(str(tmp_path / 'repo'), src)
+        cachemap[target] = hashval
+    with open(CACHE_MAP_NAME, 'w', encoding='utf-8') as outfile:
+        outfile.write(json.dumps(cachemap))
+    return contents
+
+
+def _tmp_files(path: Path) -> list[str]:
+    return [
+        name
+        for _dirpath, _dirnames, fnames in os.walk(path)
+        for name in fnames
+        if name.endswith('.tmp')
+    ]
+
+
+def test_get_targets(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test fetching and extracting targets."""
+    contents = _make_project(tmp_path, monkeypatch)
+
+    output = get_targets(list(contents), batch=True, clr=Clr)
+    assert output.count('Downloading:') == 2
+    assert output.count('Extracting:') == 2
+    for target, data in contents.items():
+        with open(target, encoding='utf-8') as infile:
+            assert infile.read() == data
+    assert os.stat('out/tool').st_mode & 0o111
+    assert not os.stat('out/sub/data.txt').st_mode & 0o111
+    assert not _tmp_files(tmp_path)
+
+    # Targets in place should just get refreshed.
+    output = get_targets(list(contents), batch=True, clr=Clr)
+    assert output.count('Refreshing from cache:') == 2
+
+    # Modified targets should get extracted again (but not downloaded).
+    with open('out/tool', 'w', encoding='utf-8') as outfile:
+        outfile.write('broken')
+    output = get_targets(list(contents), batch=True, clr=Clr)
+    assert 'Downloading:' not in output
+    assert output.count('Extracting:') == 1
+    with open('out/tool', encoding='utf-8') as infile:
+        assert infile.read() == contents['out/tool']
+    assert os.stat('out/tool').st_mode & 0o111
+
+
+def test_get_targets_errors(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test failures fetching and extracting targets."""
+    contents = _make_project(tmp_path, monkeypatch)
+    with open(CACHE_MAP_NAME, encoding='utf-8') as infile:
+        cachemap = json.loads(infile.read())
+
+    # Truncated cache files should fail to extract and leave nothing
+    # behind.
+    get_targets(['out/tool'], batch=True, clr=Clr)
+    localpath = str(tmp_path / 'local' / 'truncated')
+    hashval = cachemap['out/sub/data.txt']
+    repopath = tmp_path / 'repo' / hashval[:2] / hashval[2:4] / hashval[4:]
+    with open(repopath, 'rb') as infile:
+        data = infile.read()
+    with open(localpath, 'wb') as outfile:
+        outfile.write(data[:-10])
+    with pytest.raises(RuntimeError):
+        extract_cache_file(localpath, 'out/sub/data.txt')
+    assert not os.path.exists('out/sub/data.txt')
+    assert not _tmp_files(tmp_path)
+
+    # Files missing from the repository should give clean errors
+    # (without affecting other targets).
+    os.unlink('out/tool')
+    os.unlink(repopath)
+    with pytest.raises(CleanError):
+        get_targets(list(contents), batch=True, clr=Clr)
+    assert os.path.exists('out/tool')
+    assert not os.path.exists('out/sub/data.txt')
+    assert not _tmp_files(tmp_path)
+
+
+def test_get_cache_map(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that cache maps are reloaded only when they change."""
+    loads: list[str] = []
+    real_loads = json.loads
+
+    def _counting_loads(data: str) -> object:
+        loads.append(data)
+        return real_loads(data)
+
+    monkeypatch.setattr(json, 'loads', _counting_loads)
+    path = str(tmp_path / 'map.json')
+
+    def _write_map(contents: dict[str, str], mtime_ns: int) -> None:
+        with open(path, 'w', encoding='utf-8') as outfile:
+            outfile.write(json.dumps(contents))
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    _write_map({'a': '1'}, 1_000_000_000)
+    cachemap = get_cache_map(path)
+    assert cachemap == {'a': '1'}
+    assert get_cache_map(path) is cachemap
+    assert len(loads) == 1
+
+    # Same size but a new mtime.
+    _write_map({'a': '2'}, 2_000_000_000)
+    assert get_cache_map(path) == {'a': '2'}
+
+    # Same mtime but a new size.
+    _write_map({'a': '22'}, 2_000_000_000)
+    assert get_cache_map(path) == {'a': '22'}
+    assert len(loads) == 3
+
+    # Nothing changed; nothing re-read.
+    assert get_cache_map(path) == {'a': '22'}
+    assert len(loads) == 3
+
+    with open(path, 'w', encoding='utf-8') as outfile:
+        outfile.write('[]')
+    with pytest.raises(RuntimeError, match='Invalid cache map'):
+        get_cache_map(path)
@@ -0,0 +1,116 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Testing file cache functionality."""
+
+from __future__ import annotations
+
+import json
+from typing import TYPE_CHECKING
+
+from efrotools.util import get_files_hash
+from efrotools.filecache import FileCache
+from efrotools.hashcache import PARANOID_ENV_VAR
+
+if TYPE_CHECKING:
+    from typing import Callable
+    from pathlib import Path
+
+    import pytest
+
+
+def _run(
+    cachepath: Path, files: list[str], extrahash: str = 'x'
+) -> tuple[list[str], set[str]]:
+    """Do a lint-style run; return dirty files and changed dirs."""
+    cache = FileCache(cachepath)
+    cache.update(files, extrahash)
+    dirty = list(cache.get_dirty_files())
+    changed = cache.get_changed_dirs()
+    cache.mark_clean(dirty)
+    cache.write()
+    return dirty, changed
+
+
+def test_file_cache(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    write_old_file: Callable[..., None],
+) -> None:
+    """Test dirty files and changed dirs across runs."""
+    monkeypatch.delenv(PARANOID_ENV_VAR, raising=False)
+    cachepath = tmp_path / 'cache'
+    dir1 = str(tmp_path / 'd1')
+    dir2 = str(tmp_path / 'd2')
+    files = [f'{dir1}/a.py', f'{dir1}/b.py', f'{dir2}/c.py', f'{dir2}/d.py']
+    for fname in files:
+        write_old_file(tmp_path / fname, fname)
+
+    # Everything is new at first.
+    dirty, changed = _run(cachepath, files)
+    assert sorted(dirty) == sorted(files)
+    assert changed == {dir1, dir2}
+
+    # Nothing should change on a no-op rerun.
+    assert _run(cachepath, files) == ([], set())
+
+    # Edits should only flag the dir they're in.
+    write_old_file(tmp_path / files[0], 'changed', age=50.0)
+    assert _run(cachepath, files) == ([files[0]], {dir1})
+    assert _run(cachepath, files) == ([], set())
+
+    # A new mtime without new contents flags the dir but not the file.
+    write_old_file(tmp_path / files[2], files[2], age=40.0)
+    assert _run(cachepath, files) == ([], {dir2})
+
+    # Dropping files should flag their dirs.
+    assert _run(cachepath, files[:3]) == ([], {dir2})
+    assert _run(cachepath, files[:2]) == ([], {dir2})
+    dirty, changed = _run(cachepath, files)
+    assert sorted(dirty) == files[2:]
+    assert changed == {dir2}
+
+    # Changing extrahash should dirty everything.
+    dirty, changed = _run(cachepath, files, extrahash='y')
+    assert sorted(dirty) == sorted(files)
+    assert changed == {dir1, dir2}
+    assert _run(cachepath, files, extrahash='y') == ([], set())
+
+
+def test_file_cache_racy(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that dirs with very recent changes are always rechecked."""
+    monkeypatch.delenv(PARANOID_ENV_VAR, raising=False)
+    cachepath = tmp_path / 'cache'
+    fpath = tmp_path / 'd' / 'a.py'
+    fpath.parent.mkdir()
+    fpath.write_text('hello')
+    files = [str(fpath)]
+    assert _run(cachepath, files) == (files, {str(fpath.parent)})
+    assert _run(cachepath, files) == ([], {str(fpath.parent)})
+
+
+def test_file_cache_legacy(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    write_old_file: Callable[..., None],
+) -> None:
+    """Test loading old-style cache files."""
+    monkeypatch.delenv(PARANOID_ENV_VAR, raising=False)
+    cachepath = tmp_path / 'cache'
+    files = [str(tmp_path / 'd' / 'a.py'), str(tmp_path / 'd' / 'b.py')]
+    for fname in files:
+        write_old_file(tmp_path / fname, fname)
+
+    # Old caches were just entries. Clean files should stay clean.
+    cachepath.write_text(
+        json.dumps(
+            {
+                files[0]: {'hash': get_files_hash([files[0]], 'x')},
+                files[1]: {'hash': 'outdated'},
+            }
+        )
+    )
+    assert _run(cachepath, files) == ([files[1]], {str(tmp_path / 'd')})
+    assert json.loads(cachepath.read_text())['version'] == 2
+    assert _run(cachepath, files) == ([], set())
@@ -0,0 +1,139 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Testing file hash cache functionality."""
+
+from __future__ import annotations
+
+import os
+import hashlib
+from typing import TYPE_CHECKING
+
+from efrotools.hashcache import FileHashCache
+
+if TYPE_CHECKING:
+    from typing import Callable
+    from pathlib import Path
+
+    import pytest
+
+
+class _Hasher:
+    """Hashes files and counts how many times it did so."""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, fname: str) -> str:
+        self.count += 1
+        with open(fname, 'rb') as infile:
+            return hashlib.md5(infile.read()).hexdigest()
+
+
+def test_hash_cache(
+    tmp_path: Path, write_old_file: Callable[..., None]
+) -> None:
+    """Test basic caching and invalidation."""
+    fpath = tmp_path / 'file'
+    fname = str(fpath)
+    cachepath = tmp_path / 'cache'
+    write_old_file(fpath, b'hello')
+    calc = _Hasher()
+
+    cache = FileHashCache(cachepath, paranoid=False)
+    value = cache.get_hash(fname, 'md5', calc)
+    assert cache.get_hash(fname, 'md5', calc) == value
+    assert calc.count == 1
+    assert cache.get_cached_hash(fname, 'md5', os.stat(fname)) == value
+
+    # Different kinds don't share hashes.
+    assert cache.get_cached_hash(fname, 'other', os.stat(fname)) is None
+
+    # Caches should persist.
+    cache.close()
+    cache = FileHashCache(cachepath, paranoid=False)
+    assert cache.get_hash(fname, 'md5', calc) == value
+    assert calc.count == 1
+
+    # Changes should be noticed.
+    write_old_file(fpath, b'hello there')
+    assert cache.get_cached_hash(fname, 'md5', os.stat(fname)) is None
+    assert cache.get_hash(fname, 'md5', calc) != value
+    assert calc.count == 2
+    cache.close()
+
+
+def test_hash_cache_racy_window(tmp_path: Path) -> None:
+    """Test that recently modified files don't get cached."""
+    fpath = tmp_path / 'file'
+    fname = str(fpath)
+    fpath.write_bytes(b'hello')
+    calc = _Hasher()
+
+    cache = FileHashCache(tmp_path / 'cache', paranoid=False)
+    cache.get_hash(fname, 'md5', calc)
+    cache.get_hash(fname, 'md5', calc)
+    assert calc.count == 2
+    assert cache.get_cached_hash(fname, 'md5', os.stat(fname)) is None
+    cache.close()
+
+
+def test_hash_cache_touch(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    write_old_file: Callable[..., None],
+) -> None:
+    """Test touching files while keeping their hashes."""
+    fpath = tmp_path / 'file'
+    fname = str(fpath)
+    write_old_file(fpath, b'hello')
+    calc = _Hasher()
+
+    cache = FileHashCache(tmp_path / 'cache', paranoid=False)
+    value = cache.get_hash(fname, 'md5', calc)
+    oldmtime = os.stat(fname).st_mtime_ns
+    cache.touch(fname, 'md5', value)
+    assert os.stat(fname).st_mtime_ns > oldmtime
+    assert cache.get_cached_hash(fname, 'md5', os.stat(fname)) == value
+
+    # If the filesystem can't store our exact time, we shouldn't cache
+    # anything (a later write could land in the same tick).
+    utime = os.utime
+
+    def _coarse_utime(path: str, ns: tuple[int, int]) -> None:
+        utime(path, ns=(ns[0] // 10**9 * 10**9, ns[1] // 10**9 * 10**9))
+
+    monkeypatch.setattr(os, 'utime', _coarse_utime)
+    cache.touch(fname, 'md5', value)
+    assert cache.get_cached_hash(fname, 'md5', os.stat(fname)) is None
+    cache.close()
+
+
+def test_hash_cache_paranoid(
+    tmp_path: Path, write_old_file: Callable[..., None]
+) -> None:
+    """Test that paranoid mode catches stale hashes."""
+    fpath = tmp_path / 'file'
+    fname = str(fpath)
+    cachepath = tmp_path / 'cache'
+    write_old_file(fpath, b'hello')
+    calc = _Hasher()
+
+    cache = FileHashCache(cachepath, paranoid=False)
+    value = cache.get_hash(fname, 'md5', calc)
+    cache.close()
+
+    # Sneak in a same-size change with the same mtime.
+    stat = os.stat(fname)
+    fpath.write_bytes(b'jello')
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    cache = FileHashCache(cachepath, paranoid=False)
+    assert cache.get_hash(fname, 'md5', calc) == value
+    assert not cache.mismatches
+    cache.close()
+
+    cache = FileHashCache(cachepath, paranoid=True)
+    assert cache.get_cached_hash(fname, 'md5', os.stat(fname)) is None
+    assert cache.get_hash(fname, 'md5', calc) != value
+    assert cache.mismatches == [fname]
+    cache.close()
@@ -4,14 +4,51 @@
 from __future__ import annotations
 
 from enum import Enum
+from functools import cache
 from dataclasses import field, dataclass
-from typing import TYPE_CHECKING, Any
+from typing import TYPE_CHECKING, Annotated, Any, override
 
-from efro.dataclassio import ioprepped
+from efro.message import Message, Response, MessageProtocol
+from efro.dataclassio import ioprepped, IOAttrs
 
 if TYPE_CHECKING:
     pass
 
+# How often servers send status snapshots to their server-manager when
+# metrics are enabled, in seconds.
+STATUS_SNAPSHOT_INTERVAL = 5.0
+
+
+@ioprepped
+@dataclass
+class ServerInstanceConfig:
+    """Overrides for one of multiple server instances (see ServerConfig).
+
+    Values left unset use those from the main config.
+    """
+
+    # UDP port this instance hosts on. Each instance needs its own.
+    port: int
+
+    # Name used to label this instance's output and to control it
+    # through the server manager. Also used in this instance's ba_root
+    # dir name. Defaults to the port number.
+    name: str | None = None
+
+    party_name: str | None = None
+    party_is_public: bool | None = None
+    max_party_size: int | None = None
+    session_type: str | None = None
+    playlist_code: int | None = None
+    stats_url: str | None = None
+
+    # CPUs this instance's server binary is allowed to run on.
+    cpu_affinity: list[int] | None = None
+
+    def get_name(self) -> str:
+        """Return the name for this instance."""
+        return str(self.port) if self.name is None else self.name
+
 
 @ioprepped
 @dataclass
@@ -186,19 +223,48 @@ class ServerConfig:
     # involving leaving and rejoining or switching teams rapidly.
     player_rejoin_cooldown: float = 10.0
 
+    # CPUs the server binary is allowed to run on (Linux only). When
+    # running multiple instances (see 'instances'), each instance
+    # without its own cpu_affinity gets pinned to a single one of
+    # these, assigned round-robin.
+    cpu_affinity: list[int] | None = None
+
+    # If present, the server manager serves metrics for its server
+    # binaries (player counts, uptime, restarts, cpu and memory use,
+    # etc.) in Prometheus text format over http on this port at
+    # /metrics, along with a health check at /health. Only local
+    # connections are accepted. Changes take effect when the server
+    # manager restarts.
+    metrics_port: int | None = None
+
+    # Like metrics_port, but serves through a unix socket at this path
+    # (not available on Windows). Both can be used at once.
+    metrics_socket_path: str | None = None
+
     # Log levels for particular loggers, overriding the engine's
     # defaults. Valid values are NOTSET, DEBUG, INFO, WARNING, ERROR, or
     # CRITICAL.
     log_levels: dict[str, str] | None = None
 
+    # If present, the server manager runs one server binary for each
+    # entry here instead of just one, each using this config with that
+    # entry's overrides applied. Output from all instances is combined,
+    # with each line labeled by instance name, and clean_exit_minutes
+    # and unclean_exit_minutes are staggered so instances don't all
+    # restart at once. Config file edits only restart the instances
+    # whose effective config they change. Adding or removing instances
+    # requires restarting the server manager.
+    instances: list[ServerInstanceConfig] | None = None
+
 
 # NOTE: as much as possible, communication from the server-manager to
 # the child-process should go through these and not ad-hoc Python string
 # commands since this way is type safe.
-class ServerCommand:
+class ServerCommand(Message):
     """Base class for commands that can be sent to the server."""
 
 
+@ioprepped
 @dataclass
 class StartServerModeCommand(ServerCommand):
     """Tells the app to switch into 'server' mode."""
@@ -213,6 +279,7 @@ class ShutdownReason(Enum):
     RESTARTING = 'restarting'
 
 
+@ioprepped
 @dataclass
 class ShutdownCommand(ServerCommand):
     """Tells the server to shut down."""
@@ -221,6 +288,7 @@ class ShutdownCommand(ServerCommand):
     immediate: bool
 
 
+@ioprepped
 @dataclass
 class ChatMessageCommand(ServerCommand):
     """Chat message from the server."""
@@ -229,6 +297,7 @@ class ChatMessageCommand(ServerCommand):
     clients: list[int] | None
 
 
+@ioprepped
 @dataclass
 class ScreenMessageCommand(ServerCommand):
     """Screen-message from the server."""
@@ -238,14 +307,142 @@ class ScreenMessageCommand(ServerCommand):
     clients: list[int] | None
 
 
+@ioprepped
 @dataclass
 class ClientListCommand(ServerCommand):
-    """Print a list of clients."""
+    """Ask for a list of clients."""
+
+    @override
+    @classmethod
+    def get_response_types(cls) -> list[type[Response] | None]:
+        return [ClientListResponse]
 
 
+@ioprepped
 @dataclass
 class KickCommand(ServerCommand):
     """Kick a client."""
 
     client_id: int
     ban_time: int | None
+
+
+@ioprepped
+@dataclass
+class ExecCommand(ServerCommand):
+    """Run arbitrary Python code in the server."""
+
+    statement: str
+
+
+@ioprepped
+@dataclass
+class StatusQueryCommand(ServerCommand):
+    """Ask for the server's current state."""
+
+    @override
+    @classmethod
+    def get_response_types(cls) -> list[type[Response] | None]:
+        return [ServerStatusResponse]
+
+
+@ioprepped
+@dataclass
+class ServerHelloMessage(Message):
+    """Sent by the server when it connects to its server-manager.
+
+    The manager ignores connections until it gets one of these with the
+    token it gave the server at launch.
+    """
+
+    token: Annotated[str, IOAttrs('t')]
+
+
+@ioprepped
+@dataclass
+class ServerClientInfo:
+    """Info about a client connected to a server."""
+
+    client_id: Annotated[int, IOAttrs('i')]
+    account_name: Annotated[str, IOAttrs('n')]
+    players: Annotated[list[str], IOAttrs('p')]
+
+
+@ioprepped
+@dataclass
+class ClientListResponse(Response):
+    """Clients connected to a server."""
+
+    clients: Annotated[list[ServerClientInfo], IOAttrs('c')]
+
+
+@ioprepped
+@dataclass
+class ServerStatusResponse(Response):
+    """A server's current state."""
+
+    # Name of the current host-session class, if any.
+    session_type: Annotated[str | None, IOAttrs('s')]
+
+    client_count: Annotated[int, IOAttrs('c')]
+    player_count: Annotated[int, IOAttrs('p')]
+
+    # Seconds since the server app launched.
+    app_time: Annotated[float, IOAttrs('t')]
+
+    # How late the logic thread has been running timers over the last
+    # few seconds, in seconds. Only measured once metrics are enabled or
+    # status is first queried; zero until then.
+    tick_lag_mean: Annotated[float, IOAttrs('lm')]
+    tick_lag_max: Annotated[float, IOAttrs('lx')]
+
+    # Set if a shutdown or restart has been requested.
+    shutdown_reason: Annotated[ShutdownReason | None, IOAttrs('r')]
+
+    # CPU time used by the server process so far, in seconds.
+    cpu_time: Annotated[float, IOAttrs('ct')]
+
+    # Resident memory used by the server process in bytes, if known.
+    memory_rss: Annotated[int | None, IOAttrs('rss')]
+
+
+@ioprepped
+@dataclass
+class ServerStatusSnapshotMessage(Message):
+    """Sent periodically by the server to its server-manager.
+
+    Only sent when the server config enables metrics.
+    """
+
+    status: Annotated[ServerStatusResponse, IOAttrs('s')]
+
+
+@cache
+def get_server_protocol() -> MessageProtocol:
+    """Return the protocol used between a server-manager and its server.
+
+    The two talk over a local efro.rpc connection; the manager sends
+    ServerCommands and the server sends a ServerHelloMessage when it
+    first connects (and ServerStatusSnapshotMessages if metrics are
+    enabled).
+    """
+    return MessageProtocol(
+        message_types={
+            0: StartServerModeCommand,
+            1: ShutdownCommand,
+            2: ChatMessageCommand,
+            3: ScreenMessageCommand,
+            4: ClientListCommand,
+            5: KickCommand,
+            6: ExecCommand,
+            7: StatusQueryCommand,
+            8: ServerHelloMessage,
+            9: ServerStatusSnapshotMessage,
+        },
+        response_types={
+            0: ClientListResponse,
+            1: ServerStatusResponse,
+        },
+        # Both ends are us; no need to hide anything.
+        remote_errors_include_stack_traces=True,
+    )
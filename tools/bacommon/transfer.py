@@ -5,14 +5,55 @@
 from __future__ import annotations
 
 import os
+import time
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import TYPE_CHECKING, Annotated
 
-from efro.dataclassio import ioprepped, IOAttrs
+from efro.dataclassio import (
+    ioprepped,
+    IOAttrs,
+    dataclass_to_json,
+    dataclass_from_json,
+)
 
 if TYPE_CHECKING:
-    pass
+    from typing import IO, Iterator
+
+# Files are hashed in chunks of this size so memory use stays flat no
+# matter how big they are.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Stat fingerprints aren't recorded for files modified within this
+# many seconds of being hashed; a further modification landing in the
+# same mtime tick could otherwise go unnoticed.
+STAT_CACHE_RACY_WINDOW = 2.0
+
+# Content-defined chunk size limits and target average. Chunk
+# boundaries are placed based on a rolling hash of file contents, so an
+# edit only changes the chunks it touches (plus maybe a neighbor)
+# instead of shifting every chunk after it.
+CHUNK_MIN_SIZE = 4 * 1024
+CHUNK_AVG_SIZE = 16 * 1024
+CHUNK_MAX_SIZE = 64 * 1024
+
+# Gear-hash masks (FastCDC-style 'normalized' chunking); we look for
+# cuts with a stricter mask before the average size and a looser one
+# after so chunk sizes cluster around the average. These use the top
+# hash bits, which depend on the last 64 bytes seen.
+_CHUNK_MASK_STRICT = ((1 << 16) - 1) << 48
+_CHUNK_MASK_LOOSE = ((1 << 12) - 1) << 52
+
+_g_gear_table: list[int] | None = None
+
+
+@ioprepped
+@dataclass
+class FileChunk:
+    """A content-defined chunk of a file."""
+
+    hash_sha256: Annotated[str, IOAttrs('h')]
+    size: Annotated[int, IOAttrs('s')]
 
 
 @ioprepped
@@ -23,6 +64,66 @@ class DirectoryManifestFile:
     hash_sha256: Annotated[str, IOAttrs('h')]
     size: Annotated[int, IOAttrs('s')]
 
+    # Content-defined chunks; only present in chunked manifests and only
+    # for files larger than CHUNK_MIN_SIZE (see get_chunks()).
+    chunks: Annotated[
+        list[FileChunk] | None, IOAttrs('c', store_default=False)
+    ] = None
+
+    def get_chunks(self) -> list[FileChunk]:
+        """Return the file's chunks (which may be just the whole file)."""
+        if self.chunks is not None:
+            return self.chunks
+        if self.size == 0:
+            return []
+        return [FileChunk(hash_sha256=self.hash_sha256, size=self.size)]
+
+
+@ioprepped
+@dataclass
+class DirectoryManifestStatCache:
+    """Stat fingerprints for files in a manifest.
+
+    Pass one to DirectoryManifest.create_from_disk() along with the
+    previous manifest to skip re-hashing unchanged files. Values are
+    [size, mtime_ns, inode] lists keyed by manifest path.
+    """
+
+    files: Annotated[dict[str, list[int]], IOAttrs('f')] = field(
+        default_factory=dict
+    )
+
+    @classmethod
+    def load(cls, path: Path) -> DirectoryManifestStatCache:
+        """Load from a file, returning an empty cache on any error."""
+        try:
+            with open(path, encoding='utf-8') as infile:
+                return dataclass_from_json(cls, infile.read())
+        except Exception:
+            return cls()
+
+    def save(self, path: Path) -> None:
+        """Save to a file."""
+        tmppath = Path(f'{path}.tmp')
+        with open(tmppath, 'w', encoding='utf-8') as outfile:
+            outfile.write(dataclass_to_json(self))
+        os.replace(tmppath, path)
+
+
+@ioprepped
+@dataclass
+class DirectoryManifestDiff:
+    """Differences between two DirectoryManifests."""
+
+    added: Annotated[list[str], IOAttrs('a')] = field(default_factory=list)
+    removed: Annotated[list[str], IOAttrs('r')] = field(default_factory=list)
+    changed: Annotated[list[str], IOAttrs('c')] = field(default_factory=list)
+
+    @property
+    def empty(self) -> bool:
+        """Whether there are no differences."""
+        return not (self.added or self.removed or self.changed)
+
 
 @ioprepped
 @dataclass
@@ -36,8 +137,26 @@ class DirectoryManifest:
     exists: Annotated[bool, IOAttrs('e', soft_default=True)]
 
     @classmethod
-    def create_from_disk(cls, path: Path) -> DirectoryManifest:
-        """Create a manifest from a directory on disk."""
+    def create_from_disk(
+        cls,
+        path: Path,
+        previous: DirectoryManifest | None = None,
+        stat_cache: DirectoryManifestStatCache | None = None,
+        chunked: bool = False,
+    ) -> DirectoryManifest:
+        """Create a manifest from a directory on disk.
+
+        If a previous manifest of the same directory and a stat cache
+        are passed, files whose stats match the cache reuse their
+        previous entries instead of being hashed again. The stat cache
+        is updated in place to match the new manifest; persist the two
+        together for use next time.
+
+        If 'chunked' is True, files also get content-defined chunk lists
+        which can be used to transfer only changed parts of them (see
+        make_file_delta()).
+        """
+        # pylint: disable=too-many-locals
         import hashlib
         from concurrent.futures import ThreadPoolExecutor
 
@@ -59,19 +178,57 @@ class DirectoryManifest:
             # Just return a single file entry if path is not a dir.
             paths.append(path.as_posix())
 
+        oldstats = {} if stat_cache is None else stat_cache.files
+        newstats: dict[str, list[int]] = {}
+        racy_cutoff = time.time_ns() - int(STAT_CACHE_RACY_WINDOW * 1e9)
+
         def _get_file_info(filepath: str) -> tuple[str, DirectoryManifestFile]:
-            sha = hashlib.sha256()
             fullfilepath = os.path.join(pathstr, filepath)
             if not os.path.isfile(fullfilepath):
                 raise RuntimeError(f'File not found: "{fullfilepath}".')
+            stat = os.stat(fullfilepath)
+            fingerprint = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+            if stat.st_mtime_ns < racy_cutoff:
+                newstats[filepath] = fingerprint
+
+            # Reuse our previous entry if nothing seems to have changed.
+            if previous is not None and oldstats.get(filepath) == fingerprint:
+                prevfile = previous.files.get(filepath)
+                if prevfile is not None and prevfile.size == stat.st_size:
+                    if not chunked:
+                        return filepath, DirectoryManifestFile(
+                            hash_sha256=prevfile.hash_sha256,
+                            size=prevfile.size,
+                        )
+                    if (
+                        prevfile.chunks is not None
+                        or prevfile.size <= CHUNK_MIN_SIZE
+                    ):
+                        return filepath, prevfile
+
+            sha = hashlib.sha256()
+            filesize = 0
+            chunks: list[FileChunk] | None = None
             with open(fullfilepath, 'rb') as infile:
-                filebytes = infile.read()
-                filesize = len(filebytes)
-                sha.update(filebytes)
+                if chunked and stat.st_size > CHUNK_MIN_SIZE:
+                    chunks = []
+                    for chunk in iter_file_chunks(infile):
+                        filesize += len(chunk)
+                        sha.update(chunk)
+                        chunks.append(
+                            FileChunk(
+                                hash_sha256=hashlib.sha256(chunk).hexdigest(),
+                                size=len(chunk),
+                            )
+                        )
+                else:
+                    while chunk := infile.read(HASH_CHUNK_SIZE):
+                        filesize += len(chunk)
+                        sha.update(chunk)
             return (
                 filepath,
                 DirectoryManifestFile(
-                    hash_sha256=sha.hexdigest(), size=filesize
+                    hash_sha256=sha.hexdigest(), size=filesize, chunks=chunks
                 ),
             )
 
@@ -80,9 +237,35 @@ class DirectoryManifest:
         if cpus is None:
             cpus = 4
         with ThreadPoolExecutor(max_workers=cpus) as executor:
-            return cls(
+            manifest = cls(
                 files=dict(executor.map(_get_file_info, paths)), exists=exists
             )
+        if stat_cache is not None:
+            stat_cache.files = newstats
+        return manifest
+
+    def diff(self, other: DirectoryManifest) -> DirectoryManifestDiff:
+        """Return what changes going from this manifest to another.
+
+        Files count as changed when their hashes or sizes differ.
+        """
+        files = self.files
+        otherfiles = other.files
+        out = DirectoryManifestDiff()
+        for fpath, fentry in otherfiles.items():
+            existing = files.get(fpath)
+            if existing is None:
+                out.added.append(fpath)
+            elif (
+                existing.hash_sha256 != fentry.hash_sha256
+                or existing.size != fentry.size
+            ):
+                out.changed.append(fpath)
+        out.removed = [fpath for fpath in files if fpath not in otherfiles]
+        out.added.sort()
+        out.changed.sort()
+        out.removed.sort()
+        return out
 
     def validate(self) -> None:
         """Log any odd data in the manifest; for debugging."""
@@ -107,3 +290,165 @@ class DirectoryManifest:
     #         sha = hashlib.sha256()
     #         cls._empty_hash = sha.hexdigest()
     #     return cls._empty_hash
+
+
+@ioprepped
+@dataclass
+class FileDelta:
+    """Data needed to build a new version of a file from an old one.
+
+    Contains the new version's full chunk list but only the data for
+    chunks missing from the old version.
+    """
+
+    hash_sha256: Annotated[str, IOAttrs('h')]
+    chunks: Annotated[list[FileChunk], IOAttrs('c')]
+    data: Annotated[dict[str, bytes], IOAttrs('d')]
+
+    @property
+    def data_size(self) -> int:
+        """Total size of included chunk data."""
+        return sum(len(val) for val in self.data.values())
+
+
+def iter_file_chunks(infile: IO[bytes]) -> Iterator[bytes]:
+    """Split a file's contents into content-defined chunks.
+
+    Only about CHUNK_MAX_SIZE + HASH_CHUNK_SIZE bytes are held in
+    memory at once.
+    """
+    buf = b''
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < CHUNK_MAX_SIZE:
+            data = infile.read(HASH_CHUNK_SIZE)
+            if data:
+                buf = buf[pos:] + data
+                pos = 0
+                continue
+            eof = True
+        if pos >= len(buf):
+            return
+        cut = _find_chunk_cut(buf, pos, min(len(buf), pos + CHUNK_MAX_SIZE))
+        yield buf[pos:cut]
+        pos = cut
+
+
+def make_file_delta(
+    old: DirectoryManifestFile | None,
+    new: DirectoryManifestFile,
+    path: Path,
+) -> FileDelta:
+    """Create a delta to turn an old version of a file into a new one.
+
+    'new' should be a chunked manifest entry for the file at 'path'
+    and 'old' an entry for the version the receiver has (or None if it
+    has nothing). Chunks present in the old version are not included.
+    Raises RuntimeError if the file no longer matches 'new'.
+    """
+    import hashlib
+
+    have = set() if old is None else {c.hash_sha256 for c in old.get_chunks()}
+    data: dict[str, bytes] = {}
+    with open(path, 'rb') as infile:
+        for chunk in new.get_chunks():
+            if chunk.hash_sha256 in have or chunk.hash_sha256 in data:
+                infile.seek(chunk.size, os.SEEK_CUR)
+                continue
+            chunkdata = infile.read(chunk.size)
+            if hashlib.sha256(chunkdata).hexdigest() != chunk.hash_sha256:
+                raise RuntimeError(f'File has changed: "{path}".')
+            data[chunk.hash_sha256] = chunkdata
+    return FileDelta(
+        hash_sha256=new.hash_sha256, chunks=new.get_chunks(), data=data
+    )
+
+
+def apply_file_delta(
+    old: DirectoryManifestFile | None,
+    oldpath: Path | None,
+    delta: FileDelta,
+    path: Path,
+) -> None:
+    """Write the new version of a file described by a delta.
+
+    Chunks not included in the delta are read from the old version at
+    'oldpath' (described by 'old'). The result is verified against the
+    delta's hash and then moved into place atomically, so 'oldpath' and
+    'path' may be the same. Raises RuntimeError on any mismatch.
+    """
+    import hashlib
+
+    offsets: dict[str, tuple[int, int]] = {}
+    if old is not None:
+        offset = 0
+        for chunk in old.get_chunks():
+            offsets.setdefault(chunk.hash_sha256, (offset, chunk.size))
+            offset += chunk.size
+
+    sha = hashlib.sha256()
+    tmppath = Path(f'{path}.{os.getpid()}.tmp')
+    try:
+        with open(tmppath, 'wb') as outfile:
+            # pylint: disable=consider-using-with
+            infile = (
+                None if oldpath is None or not offsets else open(oldpath, 'rb')
+            )
+            try:
+                for chunk in delta.chunks:
+                    chunkdata = delta.data.get(chunk.hash_sha256)
+                    if chunkdata is None:
+                        location = offsets.get(chunk.hash_sha256)
+                        if location is None or infile is None:
+                            raise RuntimeError(
+                                f'No data for chunk {chunk.hash_sha256}.'
+                            )
+                        infile.seek(location[0])
+                        chunkdata = infile.read(location[1])
+                    sha.update(chunkdata)
+                    outfile.write(chunkdata)
+            finally:
+                if infile is not None:
+                    infile.close()
+        if sha.hexdigest() != delta.hash_sha256:
+            raise RuntimeError(f'Hash mismatch applying delta to "{path}".')
+        os.replace(tmppath, path)
+    except BaseException:
+        tmppath.unlink(missing_ok=True)
+        raise
+
+
+def _get_gear_table() -> list[int]:
+    # pylint: disable=global-statement
+    global _g_gear_table
+
+    if _g_gear_table is None:
+        import hashlib
+
+        _g_gear_table = [
+            int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big')
+            for i in range(256)
+        ]
+    return _g_gear_table
+
+
+def _find_chunk_cut(data: bytes, start: int, end: int) -> int:
+    """Return where the chunk starting at data[start] should end."""
+    if end - start <= CHUNK_MIN_SIZE:
+        return end
+    gear = _get_gear_table()
+    strict = _CHUNK_MASK_STRICT
+    loose = _CHUNK_MASK_LOOSE
+    mask64 = 0xFFFFFFFFFFFFFFFF
+    hval = 0
+    normal = min(start + CHUNK_AVG_SIZE, end)
+    for i in range(start + CHUNK_MIN_SIZE, normal):
+        hval = ((hval << 1) + gear[data[i]]) & mask64
+        if not hval & strict:
+            return i + 1
+    for i in range(normal, end):
+        hval = ((hval << 1) + gear[data[i]]) & mask64
+        if not hval & loose:
+            return i + 1
+    return end
@@ -488,8 +488,10 @@ def _get_server_config_raw_contents(projroot: str) -> str:
 
 
 def _get_server_config_template_toml(projroot: str) -> str:
+    # pylint: disable=too-many-locals
     from tomlkit import document, dumps
-    from bacommon.servermanager import ServerConfig
+    from efro.dataclassio import dataclass_to_dict
+    from bacommon.servermanager import ServerConfig, ServerInstanceConfig
 
     cfg = ServerConfig()
 
@@ -509,6 +511,13 @@ def _get_server_config_template_toml(projroot: str) -> str:
     cfg.public_ipv4_address = '123.123.123.123'
     cfg.public_ipv6_address = '123A::A123:23A1:A312:12A3:A213:2A13'
     cfg.log_levels = {'ba.lifecycle': 'INFO', 'ba.assets': 'INFO'}
+    cfg.cpu_affinity = [0, 1, 2, 3]
+    cfg.metrics_port = 9640
+    cfg.metrics_socket_path = '/run/ballisticakit/metrics.sock'
+    cfg.instances = [
+        ServerInstanceConfig(port=43211, party_name='FFA 1'),
+        ServerInstanceConfig(port=43212, party_name='FFA 2'),
+    ]
 
     lines_in = _get_server_config_raw_contents(projroot).splitlines()
 
@@ -539,6 +548,16 @@ def _get_server_config_template_toml(projroot: str) -> str:
                     f' please provide a dummy value.'
                 )
             assert vval is not None
+            if vname == 'instances':
+                # Leave out unset overrides (toml has no null).
+                vval = [
+                    {
+                        key: val
+                        for key, val in dataclass_to_dict(inst).items()
+                        if val is not None
+                    }
+                    for inst in vval
+                ]
             doc[vname] = vval
             lines_out += ['#' + l for l in dumps(doc).strip().splitlines()]
 
@@ -66,6 +66,12 @@ from efrotools.pcommands2 import (
     build_pcommandbatch,
     batchserver,
     pcommandbatch_speed_test,
+    dataclassio_speed_test,
+    rpc_speed_test,
+    message_speed_test,
+    log_speed_test,
+    efrocache_speed_test,
+    manifest_delta_speed_test,
     null,
 )
 from batools.pcommands import (
@@ -28,9 +28,17 @@ from efro.dataclassio._pathcapture import DataclassFieldLookup
 from efro.dataclassio._api import (
     JsonStyle,
     dataclass_to_dict,
+    dataclasses_to_dicts,
+    dataclass_dict_encoder,
     dataclass_to_json,
+    dataclass_to_json_stream,
+    dataclass_to_binary,
     dataclass_from_dict,
+    dataclasses_from_dicts,
+    dataclass_dict_decoder,
     dataclass_from_json,
+    dataclass_from_json_stream,
+    dataclass_from_binary,
     dataclass_validate,
     dataclass_hash,
 )
@@ -43,12 +51,20 @@ __all__ = [
     'IOExtendedData',
     'IOMultiType',
     'JsonStyle',
+    'dataclass_dict_decoder',
+    'dataclass_dict_encoder',
+    'dataclass_from_binary',
     'dataclass_from_dict',
     'dataclass_from_json',
+    'dataclass_from_json_stream',
+    'dataclass_to_binary',
     'dataclass_to_dict',
     'dataclass_to_json',
+    'dataclass_to_json_stream',
     'dataclass_validate',
     'dataclass_hash',
+    'dataclasses_from_dicts',
+    'dataclasses_to_dicts',
     'ioprep',
     'ioprepped',
     'is_ioprepped_dataclass',
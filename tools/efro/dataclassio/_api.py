@@ -11,6 +11,7 @@ data formats in a nondestructive manner.
 from __future__ import annotations
 
 import json
+import functools
 from enum import Enum
 from typing import TYPE_CHECKING, TypeVar
 
@@ -19,7 +20,8 @@ from efro.dataclassio._inputter import _Inputter
 from efro.dataclassio._base import Codec
 
 if TYPE_CHECKING:
-    from typing import Any
+    from typing import Any, IO, Callable, Iterable
+    from concurrent.futures import Executor
 
 T = TypeVar('T')
 
@@ -73,6 +75,73 @@ def dataclass_to_dict(
     return out
 
 
+def dataclasses_to_dicts(
+    objs: Iterable[Any],
+    codec: Codec = Codec.JSON,
+    coerce_to_float: bool = True,
+    discard_extra_attrs: bool = False,
+    *,
+    executor: Executor | None = None,
+    chunk_size: int = 10000,
+) -> list[dict]:
+    """Given a number of dataclass objects, return json-friendly dicts.
+
+    Output is the same as calling dataclass_to_dict() on each object,
+    but per-object setup is skipped, making this considerably cheaper
+    for large numbers of small objects.
+
+    If an executor is passed, inputs larger than `chunk_size` are split
+    into chunks of that size which are processed through it. Note that
+    with a thread-pool this is only useful on free-threaded Python
+    builds, and with a process-pool objects and results must pass
+    through pickle so this only pays off for very large batches.
+    """
+    from efro.dataclassio._batch import encode_batch, run_batch
+    from efro.dataclassio._compiler import EncoderKey
+
+    return run_batch(
+        functools.partial(
+            encode_batch,
+            key=EncoderKey(
+                codec=codec,
+                create=True,
+                coerce_to_float=coerce_to_float,
+                discard_extra_attrs=discard_extra_attrs,
+            ),
+        ),
+        objs if isinstance(objs, (list, tuple)) else list(objs),
+        executor,
+        chunk_size,
+    )
+
+
+def dataclass_dict_encoder(
+    cls: type,
+    codec: Codec = Codec.JSON,
+    coerce_to_float: bool = True,
+    discard_extra_attrs: bool = False,
+) -> Callable[[Any], dict]:
+    """Return a call converting instances of a dataclass type to dicts.
+
+    Calling the result on an object gives the same output as
+    dataclass_to_dict(), but per-call setup is done once here instead
+    of on every call. Useful for hot paths that repeatedly output a
+    known type (messaging, etc).
+    """
+    from efro.dataclassio._batch import make_encode_call
+    from efro.dataclassio._compiler import EncoderKey
+
+    return make_encode_call(
+        cls,
+        EncoderKey(
+            codec=codec,
+            create=True,
+            coerce_to_float=coerce_to_float,
+            discard_extra_attrs=discard_extra_attrs,
+        ),
+    )
+
+
 def dataclass_to_json(
     obj: Any,
     coerce_to_float: bool = True,
@@ -96,6 +165,49 @@ def dataclass_to_json(
     return json.dumps(jdict, separators=(',', ':'), sort_keys=sort_keys)
 
 
+def dataclass_to_json_stream(
+    obj: Any,
+    fp: IO[str],
+    *,
+    coerce_to_float: bool = True,
+) -> None:
+    """Incrementally write json for a dataclass instance to a file.
+
+    Output matches that of dataclass_to_json() (with default args), but
+    rather than building a full intermediate dict, this walks the
+    object and writes as it goes. Nested dataclasses, lists of them,
+    and str-keyed dicts of them are streamed; other values are
+    converted and written individually. This keeps peak memory use low
+    for large objects such as big log archives or directory manifests.
+
+    All values are validated as they are written. Note that on failure
+    partial output may have already been written to the file.
+    """
+    from efro.dataclassio._jsonstream import _JsonStreamWriter
+
+    _JsonStreamWriter(fp, coerce_to_float=coerce_to_float).run(obj)
+
+
+def dataclass_to_binary(obj: Any, coerce_to_float: bool = True) -> bytes:
+    """Return compact binary data for a dataclass instance.
+
+    This is dataclass_to_dict() with Codec.BINARY, packed into a compact
+    self-describing binary form. Ints are stored as varints, bytes are
+    stored raw instead of base64, datetimes are stored natively, and
+    each distinct attr storage name is written only once per blob and
+    referred to by an integer tag from then on. Everything that can
+    round-trip through json can round-trip through this (multi-types,
+    soft defaults, unknown attrs, etc).
+    """
+    from efro.dataclassio._binary import pack
+
+    return pack(
+        dataclass_to_dict(
+            obj=obj, coerce_to_float=coerce_to_float, codec=Codec.BINARY
+        )
+    )
+
+
 def dataclass_from_dict(
     cls: type[T],
     values: dict,
@@ -105,6 +217,7 @@ def dataclass_from_dict(
     allow_unknown_attrs: bool = True,
     discard_unknown_attrs: bool = False,
     lossy: bool = False,
+    lazy: bool = False,
 ) -> T:
     """Given a dict, return a dataclass of a given type.
 
@@ -138,6 +251,16 @@ def dataclass_from_dict(
     successfully load newer data, but this can fundamentally modify the
     data, so the resulting object is flagged as 'lossy' and prevented
     from being serialized back out by default.
+
+    If `lazy` is True, only simple top level fields are converted up
+    front; nested dataclass, container, and Any fields are converted
+    and validated when first accessed (so errors for those will be
+    raised at that point). Fields that are never accessed or assigned
+    are passed along as-is if the instance is output again with the
+    same codec, making this useful for code that forwards data after
+    inspecting only a field or two. The returned instance is a
+    subclass of `cls` and `values` should not be modified after the
+    call. IOExtendedData classes are always converted fully.
     """
     val = _Inputter(
         cls,
@@ -146,11 +269,96 @@ def dataclass_from_dict(
         allow_unknown_attrs=allow_unknown_attrs,
         discard_unknown_attrs=discard_unknown_attrs,
         lossy=lossy,
+        lazy=lazy,
     ).run(values)
     assert isinstance(val, cls)
     return val
 
 
+def dataclasses_from_dicts(
+    cls: type[T],
+    values_list: Iterable[dict],
+    *,
+    codec: Codec = Codec.JSON,
+    coerce_to_float: bool = True,
+    allow_unknown_attrs: bool = True,
+    discard_unknown_attrs: bool = False,
+    lossy: bool = False,
+    executor: Executor | None = None,
+    chunk_size: int = 10000,
+) -> list[T]:
+    """Given a number of dicts, return dataclasses of a given type.
+
+    Output is the same as calling dataclass_from_dict() on each dict,
+    but per-object setup is skipped, making this considerably cheaper
+    for large numbers of small objects. See dataclasses_to_dicts() for
+    info on `executor` and `chunk_size`.
+    """
+    from efro.dataclassio._batch import decode_batch, run_batch
+    from efro.dataclassio._compiler import DecoderKey
+
+    if not allow_unknown_attrs and discard_unknown_attrs:
+        raise ValueError(
+            'discard_unknown_attrs cannot be True'
+            ' when allow_unknown_attrs is False.'
+        )
+    return run_batch(
+        functools.partial(
+            decode_batch,
+            cls,
+            key=DecoderKey(
+                codec=codec,
+                coerce_to_float=coerce_to_float,
+                allow_unknown_attrs=allow_unknown_attrs,
+                discard_unknown_attrs=discard_unknown_attrs,
+                lossy=lossy,
+            ),
+        ),
+        (
+            values_list
+            if isinstance(values_list, (list, tuple))
+            else list(values_list)
+        ),
+        executor,
+        chunk_size,
+    )
+
+
+def dataclass_dict_decoder(
+    cls: type[T],
+    *,
+    codec: Codec = Codec.JSON,
+    coerce_to_float: bool = True,
+    allow_unknown_attrs: bool = True,
+    discard_unknown_attrs: bool = False,
+    lossy: bool = False,
+) -> Callable[[dict], T]:
+    """Return a call converting dicts to instances of a dataclass type.
+
+    Calling the result on a dict gives the same output as
+    dataclass_from_dict(), but per-call setup is done once here instead
+    of on every call. See dataclass_dict_encoder().
+    """
+    from efro.dataclassio._batch import make_decode_call
+    from efro.dataclassio._compiler import DecoderKey
+
+    if not allow_unknown_attrs and discard_unknown_attrs:
+        raise ValueError(
+            'discard_unknown_attrs cannot be True'
+            ' when allow_unknown_attrs is False.'
+        )
+    return make_decode_call(
+        cls,
+        DecoderKey(
+            codec=codec,
+            coerce_to_float=coerce_to_float,
+            allow_unknown_attrs=allow_unknown_attrs,
+            discard_unknown_attrs=discard_unknown_attrs,
+            lossy=lossy,
+        ),
+    )
+
+
 def dataclass_from_json(
     cls: type[T],
     json_str: str,
@@ -159,6 +367,7 @@ def dataclass_from_json(
     allow_unknown_attrs: bool = True,
     discard_unknown_attrs: bool = False,
     lossy: bool = False,
+    lazy: bool = False,
 ) -> T:
     """Return a dataclass instance given a json string.
 
@@ -172,9 +381,71 @@ def dataclass_from_json(
         allow_unknown_attrs=allow_unknown_attrs,
         discard_unknown_attrs=discard_unknown_attrs,
         lossy=lossy,
+        lazy=lazy,
+    )
+
+
+def dataclass_from_binary(
+    cls: type[T],
+    data: bytes | bytearray | memoryview,
+    *,
+    coerce_to_float: bool = True,
+    allow_unknown_attrs: bool = True,
+    discard_unknown_attrs: bool = False,
+    lossy: bool = False,
+) -> T:
+    """Return a dataclass instance given data from dataclass_to_binary().
+
+    Args behave as in dataclass_from_dict(). Raises ValueError if the
+    data itself is malformed.
+    """
+    from efro.dataclassio._binary import unpack
+
+    values = unpack(data)
+    if not isinstance(values, dict):
+        raise TypeError(
+            f'Expected a dict in binary data; got a {type(values)}.'
+        )
+    return dataclass_from_dict(
+        cls=cls,
+        values=values,
+        codec=Codec.BINARY,
+        coerce_to_float=coerce_to_float,
+        allow_unknown_attrs=allow_unknown_attrs,
+        discard_unknown_attrs=discard_unknown_attrs,
+        lossy=lossy,
     )
 
 
+def dataclass_from_json_stream(
+    cls: type[T],
+    fp: IO[str],
+    *,
+    coerce_to_float: bool = True,
+    allow_unknown_attrs: bool = True,
+    discard_unknown_attrs: bool = False,
+    lossy: bool = False,
+) -> T:
+    """Incrementally read a dataclass instance from a json file.
+
+    This is the counterpart to dataclass_to_json_stream(); data is
+    parsed and validated a piece at a time instead of first loading a
+    full intermediate dict, so peak memory use stays close to the size
+    of the final object. Args behave as in dataclass_from_dict().
+    """
+    from efro.dataclassio._jsonstream import _JsonStreamReader
+
+    val = _JsonStreamReader(
+        cls,
+        coerce_to_float=coerce_to_float,
+        allow_unknown_attrs=allow_unknown_attrs,
+        discard_unknown_attrs=discard_unknown_attrs,
+        lossy=lossy,
+    ).run(fp)
+    assert isinstance(val, cls)
+    return val
+
+
 def dataclass_validate(
     obj: Any,
     coerce_to_float: bool = True,
@@ -29,6 +29,11 @@ EXTRA_ATTRS_ATTR = '_DCIOEXATTRS'
 # be written back out.
 LOSSY_ATTR = '_DCIOLOSSY'
 
+# Attr name for the base class on lazy-decoded dataclass proxy types,
+# and for the pending state on instances of them.
+LAZY_BASE_ATTR = '_DCIOLAZYBASE'
+LAZY_STATE_ATTR = '_DCIOLAZYSTATE'
+
 
 class Codec(Enum):
     """Specifies expected data format exported to or imported from."""
@@ -41,6 +46,12 @@ class Codec(Enum):
     # as-is instead of converting them to json-friendly types.
     FIRESTORE = 'firestore'
 
+    # Like FIRESTORE at the dict level (bytes and datetime objects pass
+    # through as-is); used by dataclass_to_binary() and
+    # dataclass_from_binary() which pack such dicts into a compact
+    # binary form.
+    BINARY = 'binary'
+
 
 class IOExtendedData:
     """A class that data types can inherit from for extra functionality."""
@@ -344,9 +355,9 @@ def _is_valid_for_codec(obj: Any, codec: Codec) -> bool:
     if objtype is list:
         return all(_is_valid_for_codec(elem, codec) for elem in obj)
 
-    # A few things are valid in firestore but not json.
+    # A few things are valid in firestore/binary but not json.
     if issubclass(objtype, datetime.datetime) or objtype is bytes:
-        return codec is Codec.FIRESTORE
+        return codec is Codec.FIRESTORE or codec is Codec.BINARY
 
     return False
 
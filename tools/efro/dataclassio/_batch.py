@@ -0,0 +1,177 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Functionality for dataclassio related to batch conversion."""
+
+from __future__ import annotations
+
+import dataclasses
+from typing import TYPE_CHECKING
+
+from efro.dataclassio._base import (
+    LOSSY_ATTR,
+    IOExtendedData,
+    IOMultiType,
+)
+from efro.dataclassio._inputter import _Inputter
+from efro.dataclassio._outputter import _Outputter
+from efro.dataclassio._compiler import (
+    get_dataclass_encoder,
+    get_dataclass_decoder,
+)
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Sequence
+    from concurrent.futures import Executor
+
+    from efro.dataclassio._compiler import (
+        ValueEncoder,
+        EncoderKey,
+        DecoderKey,
+    )
+
+
+def encode_batch(objs: Sequence[Any], key: EncoderKey) -> list[Any]:
+    """Encode a batch of dataclass instances.
+
+    Does the equivalent of running an _Outputter on each object, but
+    looks up encoders once per type instead of once per object.
+    """
+    encoders: dict[type, ValueEncoder] = {}
+    out: list[Any] = []
+    append = out.append
+    for obj in objs:
+        objtype = type(obj)
+        encoder = encoders.get(objtype)
+        if encoder is None:
+            if not dataclasses.is_dataclass(objtype):
+                raise TypeError(f'Passed obj {obj} is not a dataclass.')
+            encoder = encoders[objtype] = get_dataclass_encoder(objtype, key)
+
+        # Same checks _Outputter does per object.
+        if getattr(obj, LOSSY_ATTR, False):
+            raise ValueError(
+                'Object has been flagged as lossy; output is disallowed.'
+            )
+        if isinstance(obj, IOExtendedData):
+            obj.will_output()
+
+        append(encoder(obj, ''))
+    return out
+
+
+def make_encode_call(cls: type, key: EncoderKey) -> Callable[[Any], Any]:
+    """Return a call encoding single instances of a dataclass type.
+
+    This does everything an _Outputter would for instances of exactly
+    `cls`, but with all lookups done up front. Instances of other types
+    (subclasses, lazy proxies, etc.) go through a regular _Outputter.
+    """
+    encoder = get_dataclass_encoder(cls, key)
+    is_ext = issubclass(cls, IOExtendedData)
+
+    def _encode(obj: Any) -> Any:
+        # pylint: disable=unidiomatic-typecheck
+        if type(obj) is not cls:
+            return _Outputter(
+                obj,
+                create=key.create,
+                codec=key.codec,
+                coerce_to_float=key.coerce_to_float,
+                discard_extra_attrs=key.discard_extra_attrs,
+            ).run()
+        if getattr(obj, LOSSY_ATTR, False):
+            raise ValueError(
+                'Object has been flagged as lossy; output is disallowed.'
+            )
+        if is_ext:
+            assert isinstance(obj, IOExtendedData)
+            obj.will_output()
+        return encoder(obj, '')
+
+    return _encode
+
+
+def make_decode_call(cls: type, key: DecoderKey) -> Callable[[Any], Any]:
+    """Return a call decoding single dicts to a dataclass type.
+
+    This does everything an _Inputter would, but with all lookups done
+    up front.
+    """
+    # Same special cases as decode_batch().
+    if issubclass(cls, IOExtendedData) or (
+        issubclass(cls, IOMultiType) and not dataclasses.is_dataclass(cls)
+    ):
+        return _Inputter(
+            cls,
+            codec=key.codec,
+            coerce_to_float=key.coerce_to_float,
+            allow_unknown_attrs=key.allow_unknown_attrs,
+            discard_unknown_attrs=key.discard_unknown_attrs,
+            lossy=key.lossy,
+        ).run
+
+    decoder = get_dataclass_decoder(cls, key)
+    if not key.lossy:
+
+        def _decode(values: Any) -> Any:
+            return decoder(values, '')
+
+        return _decode
+
+    def _decode_lossy(values: Any) -> Any:
+        out = decoder(values, '')
+        setattr(out, LOSSY_ATTR, True)
+        return out
+
+    return _decode_lossy
+
+
+def decode_batch(
+    cls: type, values_list: Sequence[Any], key: DecoderKey
+) -> list[Any]:
+    """Decode a batch of dicts to instances of a dataclass type.
+
+    Does the equivalent of running an _Inputter on each dict, but sets
+    things up only once for the whole batch.
+    """
+    # Multi-type base classes, extended data, and lossy loads need the
+    # extra per-object handling _Inputter provides (a single one of
+    # which can be reused). Otherwise we can just run the decoder
+    # directly.
+    if (
+        key.lossy
+        or issubclass(cls, IOExtendedData)
+        or (issubclass(cls, IOMultiType) and not dataclasses.is_dataclass(cls))
+    ):
+        run = _Inputter(
+            cls,
+            codec=key.codec,
+            coerce_to_float=key.coerce_to_float,
+            allow_unknown_attrs=key.allow_unknown_attrs,
+            discard_unknown_attrs=key.discard_unknown_attrs,
+            lossy=key.lossy,
+        ).run
+        return [run(values) for values in values_list]
+
+    decoder = get_dataclass_decoder(cls, key)
+    return [decoder(values, '') for values in values_list]
+
+
+def run_batch(
+    call: Callable[[Sequence[Any]], list[Any]],
+    items: Sequence[Any],
+    executor: Executor | None,
+    chunk_size: int,
+) -> list[Any]:
+    """Run a batch call on items, optionally split across an executor."""
+    if chunk_size < 1:
+        raise ValueError(f'Invalid chunk_size {chunk_size}.')
+    if executor is None or len(items) <= chunk_size:
+        return call(items)
+    out: list[Any] = []
+    for result in executor.map(
+        call,
+        [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)],
+    ):
+        out += result
+    return out
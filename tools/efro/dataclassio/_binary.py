@@ -0,0 +1,261 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Compact binary packing for dataclassio data (see Codec.BINARY).
+
+This packs the dicts produced by dataclassio with Codec.BINARY (and
+unpacks them again). The format is self-describing, so unpacking does
+not require any type information; all type validation happens in the
+regular dict conversion step.
+
+Layout: a single format-version byte followed by one packed value.
+Each value starts with a type byte:
+
+  0x00: None
+  0x01: False
+  0x02: True
+  0x03: int; zigzag varint.
+  0x04: float; 8 byte little-endian double.
+  0x05: str; varint byte-length followed by utf-8 data.
+  0x06: bytes; varint length followed by raw data.
+  0x07: datetime; zigzag varint of microseconds since the unix epoch
+        (utc).
+  0x08: list; varint count followed by values.
+  0x09: dict; varint count followed by key/value pairs.
+  0x80-0xFF: int 0-127 stored directly in the type byte.
+
+Dict keys (generally attr storage names) are assigned integer tags in
+order of first appearance. A key is written as a varint: odd values
+introduce a new key (value >> 1 is the utf-8 byte-length, followed by
+the key data) and even values refer to a previously introduced key
+(value >> 1 is its tag). So storage names are only written once per
+blob no matter how many objects use them.
+"""
+
+from __future__ import annotations
+
+import struct
+import datetime
+from typing import TYPE_CHECKING
+
+from efro.util import check_utc
+
+if TYPE_CHECKING:
+    from typing import Any
+
+FORMAT_VERSION = 1
+
+_T_NONE = 0x00
+_T_FALSE = 0x01
+_T_TRUE = 0x02
+_T_INT = 0x03
+_T_FLOAT = 0x04
+_T_STR = 0x05
+_T_BYTES = 0x06
+_T_DATETIME = 0x07
+_T_LIST = 0x08
+_T_DICT = 0x09
+_T_SMALLINT = 0x80
+
+_DOUBLE = struct.Struct('<d')
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class _Truncated(Exception):
+    """Internal signal that we ran out of data."""
+
+
+def pack(value: Any) -> bytes:
+    """Pack a value into binary form.
+
+    Supports None, bool, int, float, str, bytes, utc datetimes, lists,
+    and dicts with str keys.
+    """
+    # pylint: disable=too-many-statements
+    out = bytearray((FORMAT_VERSION,))
+    append = out.append
+    extend = out.extend
+    pack_double = _DOUBLE.pack
+    keys: dict[str, int] = {}
+
+    def _uvarint(val: int) -> None:
+        while val > 0x7F:
+            append((val & 0x7F) | 0x80)
+            val >>= 7
+        append(val)
+
+    def _pack(val: Any) -> None:
+        # pylint: disable=too-many-branches
+        vtype = type(val)
+        if vtype is str:
+            data = val.encode()
+            size = len(data)
+            append(_T_STR)
+            if size < 0x80:
+                append(size)
+            else:
+                _uvarint(size)
+            extend(data)
+        elif vtype is int:
+            if 0 <= val < 0x80:
+                append(_T_SMALLINT | val)
+            else:
+                append(_T_INT)
+                _uvarint(val << 1 if val >= 0 else ((-val) << 1) - 1)
+        elif vtype is dict:
+            append(_T_DICT)
+            _uvarint(len(val))
+            for key, subval in val.items():
+                tag = keys.get(key)
+                if tag is None:
+                    if not isinstance(key, str):
+                        raise TypeError(
+                            f'Dict keys must be str; got {type(key)}.'
+                        )
+                    keys[key] = len(keys)
+                    data = key.encode()
+                    _uvarint((len(data) << 1) | 1)
+                    extend(data)
+                elif tag < 0x40:
+                    append(tag << 1)
+                else:
+                    _uvarint(tag << 1)
+                _pack(subval)
+        elif vtype is list:
+            append(_T_LIST)
+            _uvarint(len(val))
+            for subval in val:
+                _pack(subval)
+        elif vtype is float:
+            append(_T_FLOAT)
+            extend(pack_double(val))
+        elif vtype is bool:
+            append(_T_TRUE if val else _T_FALSE)
+        elif val is None:
+            append(_T_NONE)
+        elif vtype is bytes:
+            append(_T_BYTES)
+            _uvarint(len(val))
+            extend(val)
+        elif isinstance(val, datetime.datetime):
+            check_utc(val)
+            delta = val - _EPOCH
+            micros = (
+                delta.days * 86400 + delta.seconds
+            ) * 1000000 + delta.microseconds
+            append(_T_DATETIME)
+            _uvarint(micros << 1 if micros >= 0 else ((-micros) << 1) - 1)
+        else:
+            raise TypeError(f'Unsupported type for binary packing: {vtype}.')
+
+    _pack(value)
+    return bytes(out)
+
+
+def unpack(data: bytes | bytearray | memoryview) -> Any:
+    """Unpack a value packed by pack().
+
+    Raises ValueError on malformed data.
+    """
+    # pylint: disable=too-many-statements
+    buf = bytes(data)
+    buflen = len(buf)
+    unpack_double = _DOUBLE.unpack_from
+    keys: list[str] = []
+    pos = 0
+
+    if not buf or buf[0] != FORMAT_VERSION:
+        raise ValueError(
+            'Unrecognized binary data'
+            f' (expected format version {FORMAT_VERSION}).'
+        )
+    pos = 1
+
+    def _uvarint() -> int:
+        nonlocal pos
+        result = 0
+        shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def _take(size: int) -> bytes:
+        nonlocal pos
+        end = pos + size
+        if end > buflen:
+            raise _Truncated()
+        chunk = buf[pos:end]
+        pos = end
+        return chunk
+
+    def _unpack() -> Any:
+        # pylint: disable=too-many-return-statements
+        # pylint: disable=too-many-branches
+        nonlocal pos
+        vtype = buf[pos]
+        pos += 1
+        if vtype >= _T_SMALLINT:
+            return vtype & 0x7F
+        if vtype == _T_DICT:
+            out: dict[str, Any] = {}
+            for _i in range(_uvarint()):
+                keyval = buf[pos]
+                if keyval < 0x80:
+                    pos += 1
+                else:
+                    keyval = _uvarint()
+                if keyval & 1:
+                    key = _take(keyval >> 1).decode()
+                    keys.append(key)
+                else:
+                    tag = keyval >> 1
+                    if tag >= len(keys):
+                        raise ValueError(f'Invalid key tag {tag}.')
+                    key = keys[tag]
+                out[key] = _unpack()
+            return out
+        if vtype == _T_STR:
+            size = buf[pos]
+            if size < 0x80:
+                pos += 1
+            else:
+                size = _uvarint()
+            return _take(size).decode()
+        if vtype == _T_INT:
+            val = _uvarint()
+            return -((val + 1) >> 1) if val & 1 else val >> 1
+        if vtype == _T_LIST:
+            return [_unpack() for _i in range(_uvarint())]
+        if vtype == _T_FLOAT:
+            if pos + 8 > buflen:
+                raise _Truncated()
+            pos += 8
+            return unpack_double(buf, pos - 8)[0]
+        if vtype == _T_TRUE:
+            return True
+        if vtype == _T_FALSE:
+            return False
+        if vtype == _T_NONE:
+            return None
+        if vtype == _T_BYTES:
+            return _take(_uvarint())
+        if vtype == _T_DATETIME:
+            val = _uvarint()
+            micros = -((val + 1) >> 1) if val & 1 else val >> 1
+            return _EPOCH + datetime.timedelta(microseconds=micros)
+        raise ValueError(f'Invalid type byte {vtype} at offset {pos - 1}.')
+
+    try:
+        value = _unpack()
+    except (_Truncated, IndexError) as exc:
+        raise ValueError('Binary data is truncated.') from exc
+    except OverflowError as exc:
+        raise ValueError('Binary datetime value out of range.') from exc
+    if pos != buflen:
+        raise ValueError(
+            f'Extra data after binary value ({buflen - pos} bytes).'
+        )
+    return value
@@ -0,0 +1,1551 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Compiled per-class encoders/decoders for dataclassio.
+
+The classic _Outputter/_Inputter classes walk type annotations for every
+value they process. Here we instead walk annotations once per
+(class, codec, flags) combination and build a tree of small closures
+that can then be called directly for each object. The resulting
+functions are cached on the class' PrepData so the hot path becomes a
+single precompiled call per object.
+
+Behavior (including error types) is intended to exactly mirror that of
+_Outputter and _Inputter; tests verify the two produce matching output.
+"""
+
+# Note: We do lots of comparing of exact types here which is normally
+# frowned upon (stuff like isinstance() is usually encouraged).
+# pylint: disable=unidiomatic-typecheck
+# pylint: disable=too-many-lines
+
+from __future__ import annotations
+
+import json
+import types
+import typing
+import datetime
+import dataclasses
+from enum import Enum
+from typing import TYPE_CHECKING, cast, Any
+
+from efro.util import check_utc
+from efro.dataclassio._base import (
+    Codec,
+    _parse_annotated,
+    EXTRA_ATTRS_ATTR,
+    LAZY_BASE_ATTR,
+    _is_valid_for_codec,
+    _get_origin,
+    SIMPLE_TYPES,
+    _raise_type_error,
+    IOExtendedData,
+    _get_multitype_type,
+    IOMultiType,
+)
+from efro.dataclassio._prep import PrepSession, PREP_ATTR
+
+if TYPE_CHECKING:
+    from typing import Callable
+
+    from efro.dataclassio._base import IOAttrs
+    from efro.dataclassio._prep import PrepData
+
+    # Takes a value and a field-path (for error messages); returns an
+    # output value (or None when only validating).
+    ValueEncoder = Callable[[Any, str], Any]
+
+    # Takes an input value and a field-path; returns a final value.
+    ValueDecoder = Callable[[Any, str], Any]
+
+
+@dataclasses.dataclass(frozen=True)
+class EncoderKey:
+    """Options an encoder is compiled for."""
+
+    codec: Codec
+    create: bool
+    coerce_to_float: bool
+    discard_extra_attrs: bool
+
+
+@dataclasses.dataclass(frozen=True)
+class DecoderKey:
+    """Options a decoder is compiled for."""
+
+    codec: Codec
+    coerce_to_float: bool
+    allow_unknown_attrs: bool
+    discard_unknown_attrs: bool
+    lossy: bool
+
+
+def _get_prep(cls: type) -> PrepData:
+    prep = getattr(cls, PREP_ATTR, None)
+    if prep is None:
+        prep = PrepSession(explicit=False).prep_dataclass(
+            cls, recursion_level=0
+        )
+        assert prep is not None
+    return prep
+
+
+def get_dataclass_encoder(cls: type, key: EncoderKey) -> ValueEncoder:
+    """Return a compiled encoder for a dataclass type.
+
+    The encoder is compiled on first request and cached from then on.
+    """
+    prep = _get_prep(cls)
+
+    # Note: we include the class in our cache key since subclasses of
+    # prepped classes can wind up sharing the parent's PrepData.
+    cachekey = (cls, key)
+    encoder = prep.compiled.get(cachekey)
+    if encoder is None:
+        encoder = _compile_dataclass_encoder(cls, prep, key)
+        prep.compiled[cachekey] = encoder
+    return encoder
+
+
+def get_dataclass_decoder(cls: type, key: DecoderKey) -> ValueDecoder:
+    """Return a compiled decoder for a dataclass type.
+
+    The decoder is compiled on first request and cached from then on.
+    """
+    # Make sure we pass a proper error along for non-dataclass types
+    # (prep will do this for us).
+    prep = _get_prep(cls)
+    cachekey = (cls, key)
+    decoder = prep.compiled.get(cachekey)
+    if decoder is None:
+        decoder = _compile_dataclass_decoder(cls, prep, key)
+        prep.compiled[cachekey] = decoder
+    return decoder
+
+
+def _compile_default_check(
+    cls: type, field: dataclasses.Field, ioattrs: IOAttrs | None
+) -> Callable[[Any], bool] | None:
+    """Return a call to test whether a value can be skipped on output."""
+
+    # Only relevant if we're *not* storing default values.
+    if ioattrs is None or ioattrs.store_default:
+        return None
+
+    # If both soft_defaults and regular field defaults are present we
+    # want to go with soft_defaults since those same values would be
+    # re-injected when reading the same data back in if we've omitted
+    # the field.
+    default_factory: Any = field.default_factory
+    if ioattrs.soft_default is not ioattrs.MISSING:
+        soft_default = ioattrs.soft_default
+        return lambda value: bool(soft_default == value)
+    if ioattrs.soft_default_factory is not ioattrs.MISSING:
+        soft_default_factory = ioattrs.soft_default_factory
+        assert callable(soft_default_factory)
+        return lambda value: bool(soft_default_factory() == value)
+    if field.default is not dataclasses.MISSING:
+        default = field.default
+        return lambda value: bool(default == value)
+    if default_factory is not dataclasses.MISSING:
+        return lambda value: bool(default_factory() == value)
+    raise RuntimeError(
+        f'Field {field.name} of {cls.__name__} has'
+        f' no source of default values; store_default=False'
+        f' cannot be set for it. (AND THIS SHOULD HAVE BEEN'
+        f' CAUGHT IN PREP!)'
+    )
+
+
+@dataclasses.dataclass
+class EncodeField:
+    """Compiled output info for a single dataclass field."""
+
+    name: str
+    storagename: str
+    anntype: Any
+    ioattrs: IOAttrs | None
+
+    # If not None, returns whether a value can be skipped on output.
+    is_default: Callable[[Any], bool] | None
+
+    encoder: ValueEncoder
+
+
+@dataclasses.dataclass
+class DataclassEncodeParts:
+    """Compiled pieces used to output a dataclass.
+
+    These are exposed separately from the final encoder so that
+    alternate output paths (such as streaming) can share them.
+    """
+
+    fields: list[EncodeField]
+
+    # Storage name and value for our type-id if we are a multi-type.
+    type_id_storage: tuple[str, str] | None
+
+
+def get_dataclass_encode_parts(
+    cls: type, key: EncoderKey
+) -> DataclassEncodeParts:
+    """Return compiled encode parts for a dataclass type."""
+    prep = _get_prep(cls)
+    cachekey = (DataclassEncodeParts, cls, key)
+    parts = prep.compiled.get(cachekey)
+    if parts is None:
+        parts = _compile_dataclass_encode_parts(cls, prep, key)
+        prep.compiled[cachekey] = parts
+    assert isinstance(parts, DataclassEncodeParts)
+    return parts
+
+
+def get_extra_attrs(obj: Any, codec: Codec, fieldpath: str) -> dict | None:
+    """Return validated extra-attrs stored on an object (if any)."""
+    extra_attrs = getattr(obj, EXTRA_ATTRS_ATTR, None)
+    if not isinstance(extra_attrs, dict):
+        return None
+    if not _is_valid_for_codec(extra_attrs, codec):
+        raise TypeError(
+            f'Extra attrs on \'{fieldpath}\' contains data type(s)'
+            f' not supported by \'{codec.value}\' codec:'
+            f' {extra_attrs}.'
+        )
+    return extra_attrs
+
+
+def _compile_dataclass_encode_parts(
+    cls: type, prep: PrepData, key: EncoderKey
+) -> DataclassEncodeParts:
+    fields = dataclasses.fields(cls)
+    encfields: list[EncodeField] = []
+    for field in fields:
+        anntype, ioattrs = _parse_annotated(prep.annotations[field.name])
+        encfields.append(
+            EncodeField(
+                name=field.name,
+                storagename=(
+                    field.name
+                    if (ioattrs is None or ioattrs.storagename is None)
+                    else ioattrs.storagename
+                ),
+                anntype=anntype,
+                ioattrs=ioattrs,
+                is_default=_compile_default_check(cls, field, ioattrs),
+                encoder=_compile_value_encoder(cls, anntype, ioattrs, key),
+            )
+        )
+
+    # If this class inherits from multi-type, we store its type id.
+    type_id_storage: tuple[str, str] | None = None
+    if issubclass(cls, IOMultiType):
+        type_id = cls.get_type_id()
+
+        # Sanity checks; make sure looking up this id gets us this
+        # type.
+        assert isinstance(type_id.value, str)
+        if cls.get_type(type_id) is not cls:
+            raise RuntimeError(
+                f'dataclassio: object of type {cls}'
+                f' gives type-id {type_id} but that id gives type'
+                f' {cls.get_type(type_id)}. Something is out of sync.'
+            )
+        if key.create:
+            storagename = cls.get_type_id_storage_name()
+            if any(f.name == storagename for f in fields):
+                raise RuntimeError(
+                    f'dataclassio: {cls} contains a'
+                    f" '{storagename}' field which clashes with"
+                    f' the type-id-storage-name of the IOMulticlass'
+                    f' it inherits from.'
+                )
+            type_id_storage = (storagename, type_id.value)
+
+    return DataclassEncodeParts(
+        fields=encfields, type_id_storage=type_id_storage
+    )
+
+
+def _compile_dataclass_encoder(
+    cls: type, prep: PrepData, key: EncoderKey
+) -> ValueEncoder:
+    # Lazy-decoded instances get their own encoder which can pass
+    # along untouched input data as-is.
+    lazybase = cls.__dict__.get(LAZY_BASE_ATTR)
+    if lazybase is not None:
+        # pylint: disable=cyclic-import
+        from efro.dataclassio._lazy import compile_lazy_encoder
+
+        return compile_lazy_encoder(lazybase, key)
+
+    create = key.create
+    codec = key.codec
+    parts = _compile_dataclass_encode_parts(cls, prep, key)
+    plans = [
+        (f.name, f.storagename, f.is_default, f.encoder) for f in parts.fields
+    ]
+    type_id_storage = parts.type_id_storage
+    check_extra_attrs = not key.discard_extra_attrs
+
+    def _encode(obj: Any, fieldpath: str) -> Any:
+        out: dict[str, Any] | None = {} if create else None
+        for fieldname, storagename, is_default, encoder in plans:
+            value = getattr(obj, fieldname)
+
+            # If we're not storing default values for this fella, we can
+            # skip all output processing if we've got a default value.
+            if is_default is not None and is_default(value):
+                continue
+
+            outvalue = encoder(
+                value, f'{fieldpath}.{fieldname}' if fieldpath else fieldname
+            )
+            if out is not None:
+                out[storagename] = outvalue
+
+        # If there's extra-attrs stored on us, check/include them.
+        if check_extra_attrs:
+            extra_attrs = get_extra_attrs(obj, codec, fieldpath)
+            if extra_attrs is not None and out is not None:
+                out.update(extra_attrs)
+
+        if type_id_storage is not None:
+            assert out is not None
+            out[type_id_storage[0]] = type_id_storage[1]
+
+        return out
+
+    return _encode
+
+
+def _compile_dynamic_dataclass_encoder(
+    basetype: type, key: EncoderKey
+) -> ValueEncoder:
+    """Encode dataclass values based on their actual runtime type.
+
+    Values may be subclasses of their annotated type (multi-types,
+    etc.) so we look up encoders per value. We also can't compile
+    nested encoders up front since types can be recursive.
+    """
+    basecodec: list[ValueEncoder] = []
+
+    def _encode(value: Any, fieldpath: str) -> Any:
+        valtype = type(value)
+        if valtype is basetype:
+            # Fast path: cache the encoder for our exact type locally.
+            if not basecodec:
+                basecodec.append(get_dataclass_encoder(basetype, key))
+            return basecodec[0](value, fieldpath)
+        return get_dataclass_encoder(valtype, key)(value, fieldpath)
+
+    return _encode
+
+
+def _compile_value_encoder(
+    cls: type, anntype: Any, ioattrs: IOAttrs | None, key: EncoderKey
+) -> ValueEncoder:
+    # pylint: disable=too-many-return-statements
+    # pylint: disable=too-many-branches
+    # pylint: disable=too-many-locals
+    create = key.create
+    codec = key.codec
+
+    origin = _get_origin(anntype)
+
+    if origin is typing.Any:
+
+        def _encode_any(value: Any, fieldpath: str) -> Any:
+            if not _is_valid_for_codec(value, codec):
+                raise TypeError(
+                    f'Invalid value type for \'{fieldpath}\';'
+                    f" 'Any' typed values must contain types directly"
+                    f' supported by the specified codec ({codec.name});'
+                    f' found \'{type(value).__name__}\' which is not.'
+                )
+            return value if create else None
+
+        return _encode_any
+
+    if origin is typing.Union or origin is types.UnionType:
+        # Currently, the only unions we support are None/Value
+        # (translated from Optional), which we verified on prep.
+        # So let's treat this as a simple optional case.
+        childanntypes_l = [
+            c for c in typing.get_args(anntype) if c is not type(None)
+        ]  # noqa (pycodestyle complains about *is* with type)
+        assert len(childanntypes_l) == 1
+        childenc = _compile_value_encoder(cls, childanntypes_l[0], ioattrs, key)
+
+        def _encode_optional(value: Any, fieldpath: str) -> Any:
+            if value is None:
+                return None
+            return childenc(value, fieldpath)
+
+        return _encode_optional
+
+    # Everything below this point assumes the annotation type resolves
+    # to a concrete type. (This should have been verified at prep time).
+    assert isinstance(origin, type)
+
+    # For simple flat types, look for exact matches:
+    if origin in SIMPLE_TYPES:
+        coerce = key.coerce_to_float and origin is float
+
+        def _encode_simple(value: Any, fieldpath: str) -> Any:
+            if type(value) is not origin:
+                # Special case: if they want to coerce ints to floats,
+                # do so.
+                if coerce and type(value) is int:
+                    return float(value) if create else None
+                _raise_type_error(fieldpath, type(value), (origin,))
+            return value if create else None
+
+        return _encode_simple
+
+    if origin is tuple:
+        childanntypes = typing.get_args(anntype)
+
+        # We should have verified this was non-zero at prep-time
+        assert childanntypes
+        childencs = [
+            _compile_value_encoder(cls, c, ioattrs, key) for c in childanntypes
+        ]
+        childcount = len(childencs)
+
+        def _encode_tuple(value: Any, fieldpath: str) -> Any:
+            if not isinstance(value, tuple):
+                raise TypeError(
+                    f'Expected a tuple for {fieldpath};'
+                    f' found a {type(value)}'
+                )
+            if len(value) != childcount:
+                raise TypeError(
+                    f'Tuple at {fieldpath} contains'
+                    f' {len(value)} values; type specifies'
+                    f' {childcount}.'
+                )
+            if create:
+                return [
+                    enc(x, fieldpath)
+                    for enc, x in zip(childencs, value, strict=True)
+                ]
+            for enc, x in zip(childencs, value, strict=True):
+                enc(x, fieldpath)
+            return None
+
+        return _encode_tuple
+
+    if origin is list:
+        return _compile_list_encoder(cls, anntype, ioattrs, key)
+
+    if origin is set:
+        return _compile_set_encoder(cls, anntype, ioattrs, key)
+
+    if origin is dict:
+        return _compile_dict_encoder(cls, anntype, ioattrs, key)
+
+    if dataclasses.is_dataclass(origin):
+        dcenc = _compile_dynamic_dataclass_encoder(origin, key)
+        origin_any = cast(Any, origin)
+
+        def _encode_dataclass(value: Any, fieldpath: str) -> Any:
+            if not isinstance(value, origin_any):
+                raise TypeError(
+                    f'Expected a {origin} for {fieldpath};'
+                    f' found a {type(value)}.'
+                )
+            return dcenc(value, fieldpath)
+
+        return _encode_dataclass
+
+    # ONLY consider something as a multi-type when it's not a
+    # dataclass (all dataclasses inheriting from the multi-type should
+    # just be processed as dataclasses).
+    if issubclass(origin, IOMultiType):
+        mtenc = _compile_dynamic_dataclass_encoder(origin, key)
+
+        def _encode_multitype(value: Any, fieldpath: str) -> Any:
+            # In the multi-type case, we use each object's own type to
+            # do its conversion, but lets at least make sure each of
+            # those types inherits from the annotated multi-type class.
+            if not isinstance(value, origin):
+                raise ValueError(
+                    f"Found a {type(value)} value at '{fieldpath}'."
+                    f' It is expected to inherit from {origin}.'
+                )
+            return mtenc(value, fieldpath)
+
+        return _encode_multitype
+
+    if issubclass(origin, Enum):
+
+        def _encode_enum(value: Any, fieldpath: str) -> Any:
+            if not isinstance(value, origin):
+                raise TypeError(
+                    f'Expected a {origin} for {fieldpath};'
+                    f' found a {type(value)}.'
+                )
+            # At prep-time we verified that these enums had valid value
+            # types, so we can blindly return it here.
+            return value.value if create else None
+
+        return _encode_enum
+
+    if issubclass(origin, datetime.datetime):
+        return _compile_datetime_encoder(origin, ioattrs, key)
+
+    if issubclass(origin, datetime.timedelta):
+
+        def _encode_timedelta(value: Any, fieldpath: str) -> Any:
+            if not isinstance(value, origin):
+                raise TypeError(
+                    f'Expected a {origin} for {fieldpath};'
+                    f' found a {type(value)}.'
+                )
+            return (
+                [value.days, value.seconds, value.microseconds]
+                if create
+                else None
+            )
+
+        return _encode_timedelta
+
+    if origin is bytes:
+        return _compile_bytes_encoder(cls, key)
+
+    def _encode_unsupported(value: Any, fieldpath: str) -> Any:
+        raise TypeError(
+            f"Field '{fieldpath}' of type '{anntype}' is unsupported here."
+        )
+
+    return _encode_unsupported
+
+
+def _compile_list_encoder(
+    cls: type, anntype: Any, ioattrs: IOAttrs | None, key: EncoderKey
+) -> ValueEncoder:
+    create = key.create
+    codec = key.codec
+
+    childanntypes = typing.get_args(anntype)
+
+    # 'Any' type children; make sure they are valid values for the
+    # specified codec.
+    if len(childanntypes) == 0 or childanntypes[0] is typing.Any:
+
+        def _encode_any_list(value: Any, fieldpath: str) -> Any:
+            if not isinstance(value, list):
+                raise TypeError(
+                    f'Expected a list for {fieldpath};'
+                    f' found a {type(value)}'
+                )
+            for i, child in enumerate(value):
+                if not _is_valid_for_codec(child, codec):
+                    raise TypeError(
+                        f'Item {i} of {fieldpath} contains'
+                        f' data type(s) not supported by the specified'
+                        f' codec ({codec.name}).'
+                    )
+            # Hmm; should we do a copy here?
+            return value if create else None
+
+        return _encode_any_list
+
+    # We contain elements of some single specified type.
+    assert len(childanntypes) == 1
+    childanntype = childanntypes[0]
+
+    # If that type is a multi-type, we determine our type per-object.
+    if issubclass(childanntype, IOMultiType):
+        mtenc = _compile_dynamic_dataclass_encoder(childanntype, key)
+
+        def _encode_multitype_list(value: Any, fieldpath: str) -> Any:
+            if not isinstance(value, list):
+                raise TypeError(
+                    f'Expected a list for {fieldpath};'
+                    f' found a {type(value)}'
+                )
+            # In the multi-type case, we use each object's own type to
+            # do its conversion, but lets at least make sure each of
+            # those types inherits from the annotated multi-type class.
+            for x in value:
+                if not isinstance(x, childanntype):
+                    raise ValueError(
+                        f"Found a {type(x)} value under '{fieldpath}'."
+                        f' Everything must inherit from'
+                        f' {childanntype}.'
+                    )
+            if create:
+                return [mtenc(x, fieldpath) for x in value]
+            for x in value:
+                mtenc(x, fieldpath)
+            return None
+
+        return _encode_multitype_list
+
+    # Normal non-multitype case; everything's got the same type.
+    childenc = _compile_value_encoder(cls, childanntype, ioattrs, key)
+
+    def _encode_list(value: Any, fieldpath: str) -> Any:
+        if not isinstance(value, list):
+            raise TypeError(
+                f'Expected a list for {fieldpath};' f' found a {type(value)}'
+            )
+        if create:
+            return [childenc(x, fieldpath) for x in value]
+        for x in value:
+            childenc(x, fieldpath)
+        return None
+
+    return _encode_list
+
+
+def _compile_set_encoder(
+    cls: type, anntype: Any, ioattrs: IOAttrs | None, key: EncoderKey
+) -> ValueEncoder:
+    create = key.create
+    codec = key.codec
+
+    childanntypes = typing.get_args(anntype)
+
+    # 'Any' type children; make sure they are valid Any values.
+    if len(childanntypes) == 0 or childanntypes[0] is typing.Any:
+
+        def _encode_any_set(value: Any, fieldpath: str) -> Any:
+            if not isinstance(value, set):
+                raise TypeError(
+                    f'Expected a set for {fieldpath};' f' found a {type(value)}'
+                )
+            for child in value:
+                if not _is_valid_for_codec(child, codec):
+                    raise TypeError(
+                        f'Set at {fieldpath} contains'
+                        f' data type(s) not supported by the'
+                        f' specified codec ({codec.name}).'
+                    )
+            # See _Outputter for notes on why we sort this way.
+            return (
+                sorted(value, key=lambda v: json.dumps(v, sort_keys=True))
+                if create
+                else None
+            )
+
+        return _encode_any_set
+
+    # We contain elements of some specified type.
+    assert len(childanntypes) == 1
+    childenc = _compile_value_encoder(cls, childanntypes[0], ioattrs, key)
+
+    # Simple types we can sort directly; otherwise we sort by json
+    # strings (see _Outputter for more notes on this).
+    sortkey: Callable[[Any], Any] | None = (
+        None
+        if childanntypes[0] in [str, int, float, bool, datetime.datetime]
+        else lambda v: json.dumps(v, sort_keys=True)
+    )
+
+    def _encode_set(value: Any, fieldpath: str) -> Any:
+        if not isinstance(value, set):
+            raise TypeError(
+                f'Expected a set for {fieldpath};' f' found a {type(value)}'
+            )
+        if create:
+            return sorted((childenc(x, fieldpath) for x in value), key=sortkey)
+        for x in value:
+            childenc(x, fieldpath)
+        return None
+
+    return _encode_set
+
+
+def _compile_dict_encoder(
+    cls: type, anntype: Any, ioattrs: IOAttrs | None, key: EncoderKey
+) -> ValueEncoder:
+    create = key.create
+    codec = key.codec
+
+    childtypes = typing.get_args(anntype)
+    assert len(childtypes) in (0, 2)
+
+    # We treat 'Any' dicts simply as json; we don't do any translating.
+    if not childtypes or childtypes[0] is typing.Any:
+
+        def _encode_any_dict(value: Any, fieldpath: str) -> Any:
+            if not isinstance(value, dict) or not _is_valid_for_codec(
+                value, codec
+            ):
+                raise TypeError(
+                    f'Invalid value for Dict[Any, Any]'
+                    f' at \'{fieldpath}\' on {cls.__name__};'
+                    f' all keys and values must be directly compatible'
+                    f' with the specified codec ({codec.name})'
+                    f' when dict type is Any.'
+                )
+            return value if create else None
+
+        return _encode_any_dict
+
+    # Ok; we've got a definite key type (which we verified as valid
+    # during prep).
+    keyanntype, valanntype = childtypes
+    valenc = _compile_value_encoder(cls, valanntype, ioattrs, key)
+
+    # str keys we just export directly since that's supported by json;
+    # int keys are stored as str versions of themselves; enum keys
+    # are stored as str versions of their values.
+    keyconv: Callable[[Any], str]
+    if keyanntype is str:
+        keycheck: type = str
+        keydesc = str(keyanntype)
+        keyconv = _identity
+    elif keyanntype is int:
+        keycheck = int
+        keydesc = 'an int'
+        keyconv = str
+    elif issubclass(keyanntype, Enum):
+        keycheck = keyanntype
+        keydesc = f'a {keyanntype}'
+        keyconv = _enum_value_str
+    else:
+        raise RuntimeError(f'Unhandled dict out-key-type {keyanntype}')
+
+    def _encode_dict(value: Any, fieldpath: str) -> Any:
+        if not isinstance(value, dict):
+            raise TypeError(
+                f'Expected a dict for {fieldpath};' f' found a {type(value)}.'
+            )
+        out: dict | None = {} if create else None
+        for dkey, val in value.items():
+            if not isinstance(dkey, keycheck):
+                raise TypeError(
+                    f'Got invalid key type {type(dkey)} for'
+                    f' dict key at \'{fieldpath}\' on {cls.__name__};'
+                    f' expected {keydesc}.'
+                )
+            outval = valenc(val, fieldpath)
+            if out is not None:
+                out[keyconv(dkey)] = outval
+        return out
+
+    return _encode_dict
+
+
+def _identity(val: Any) -> Any:
+    return val
+
+
+def _enum_value_str(val: Enum) -> str:
+    return str(val.value)
+
+
+def _compile_datetime_encoder(
+    origin: type[datetime.datetime], ioattrs: IOAttrs | None, key: EncoderKey
+) -> ValueEncoder:
+    create = key.create
+    codec = key.codec
+    native = codec is Codec.FIRESTORE or codec is Codec.BINARY
+
+    def _encode_datetime(value: Any, fieldpath: str) -> Any:
+        if not isinstance(value, origin):
+            raise TypeError(
+                f'Expected a {origin} for {fieldpath};'
+                f' found a {type(value)}.'
+            )
+        check_utc(value)
+        if ioattrs is not None:
+            ioattrs.validate_datetime(value, fieldpath)
+        if native:
+            return value
+        assert codec is Codec.JSON
+        return (
+            [
+                value.year,
+                value.month,
+                value.day,
+                value.hour,
+                value.minute,
+                value.second,
+                value.microsecond,
+            ]
+            if create
+            else None
+        )
+
+    return _encode_datetime
+
+
+def _compile_bytes_encoder(cls: type, key: EncoderKey) -> ValueEncoder:
+    import base64
+
+    create = key.create
+    codec = key.codec
+
+    def _encode_bytes(value: Any, fieldpath: str) -> Any:
+        if not isinstance(value, bytes):
+            raise TypeError(
+                f'Expected bytes for {fieldpath} on {cls.__name__};'
+                f' found a {type(value)}.'
+            )
+
+        if not create:
+            return None
+
+        # In JSON we convert to base64, but firestore/binary directly
+        # support bytes.
+        if codec is Codec.JSON:
+            return base64.b64encode(value).decode()
+
+        assert codec is Codec.FIRESTORE or codec is Codec.BINARY
+        return value
+
+    return _encode_bytes
+
+
+@dataclasses.dataclass
+class DecodeField:
+    """Compiled input info for a single dataclass field."""
+
+    name: str
+    anntype: Any
+    ioattrs: IOAttrs | None
+    decoder: ValueDecoder
+
+
+@dataclasses.dataclass
+class DataclassDecodeParts:
+    """Compiled pieces used to input a dataclass.
+
+    These are exposed separately from the final decoder so that
+    alternate input paths (such as streaming) can share them.
+    """
+
+    # Fields keyed by both attr-names and storage-names (storage names
+    # taking precedence where they collide).
+    fields_by_key: dict[str, DecodeField]
+
+    # Key to ignore in input data (type-id for multi-types).
+    type_id_store_name: str | None
+
+    # Call with (key, value, extra_attrs, fieldpath) for unrecognized
+    # input keys; stores or discards values (or raises errors).
+    handle_unknown: Callable[[str, Any, dict, str], None]
+
+    # Call with (args, fieldpath) to fill in soft-defaults for any
+    # fields not present in args (finish() does this itself).
+    fill_soft_defaults: Callable[[dict[str, Any], str], None]
+
+    # Call with (args, extra_attrs, fieldpath) once all input has been
+    # processed; fills in soft-defaults and instantiates the class.
+    finish: Callable[[dict[str, Any], dict, str], Any]
+
+
+def get_dataclass_decode_parts(
+    cls: type, key: DecoderKey
+) -> DataclassDecodeParts:
+    """Return compiled decode parts for a dataclass type."""
+    prep = _get_prep(cls)
+    cachekey = (DataclassDecodeParts, cls, key)
+    parts = prep.compiled.get(cachekey)
+    if parts is None:
+        parts = _compile_dataclass_decode_parts(cls, prep, key)
+        prep.compiled[cachekey] = parts
+    assert isinstance(parts, DataclassDecodeParts)
+    return parts
+
+
+def _compile_dataclass_decode_parts(
+    cls: type, prep: PrepData, key: DecoderKey
+) -> DataclassDecodeParts:
+    # pylint: disable=too-many-locals
+    codec = key.codec
+    allow_unknown_attrs = key.allow_unknown_attrs
+    discard_unknown_attrs = key.discard_unknown_attrs
+
+    fields = dataclasses.fields(cls)
+
+    # Map both attr-names and storage-names to field info (storage
+    # names taking precedence; this mirrors how _Inputter resolves
+    # keys).
+    fields_by_key: dict[str, DecodeField] = {}
+    soft_defaults: list[tuple[str, Callable[[], Any], ValueEncoder]] = []
+    storage_fields: list[tuple[str, DecodeField]] = []
+    for field in fields:
+        anntype, ioattrs = _parse_annotated(prep.annotations[field.name])
+        decfield = DecodeField(
+            name=field.name,
+            anntype=anntype,
+            ioattrs=ioattrs,
+            decoder=_compile_value_decoder(cls, anntype, ioattrs, key),
+        )
+        fields_by_key[field.name] = decfield
+        if ioattrs is not None and ioattrs.storagename is not None:
+            storage_fields.append((ioattrs.storagename, decfield))
+
+        if ioattrs is not None and (
+            ioattrs.soft_default is not ioattrs.MISSING
+            or ioattrs.soft_default_factory is not ioattrs.MISSING
+        ):
+            soft_default_call: Callable[[], Any]
+            if ioattrs.soft_default is not ioattrs.MISSING:
+                soft_default_call = _const_call(ioattrs.soft_default)
+            else:
+                assert callable(ioattrs.soft_default_factory)
+                soft_default_call = ioattrs.soft_default_factory
+
+            # Counter-intuitively, we validate soft-defaults using an
+            # encoder. Soft-default values are already internal types;
+            # we need to make sure they can go out from there.
+            validator = _compile_value_encoder(
+                cls,
+                anntype,
+                None,
+                EncoderKey(
+                    codec=codec,
+                    create=False,
+                    coerce_to_float=key.coerce_to_float,
+                    discard_extra_attrs=False,
+                ),
+            )
+            soft_defaults.append((field.name, soft_default_call, validator))
+
+    for storagename, decfield in storage_fields:
+        fields_by_key[storagename] = decfield
+
+    # Special case: if this is a multi-type class it probably has a
+    # type attr. Ignore that while parsing since we already have a
+    # definite type and it will just pollute extra-attrs otherwise.
+    type_id_store_name: str | None
+    if issubclass(cls, IOMultiType):
+        type_id_store_name = cls.get_type_id_storage_name()
+
+        # However we do want to make sure the class we're loading
+        # doesn't itself use this same name, as this could lead to
+        # tricky breakage. We can't verify this for types at prep
+        # time because IOMultiTypes are lazy-loaded, so this is the
+        # best we can do.
+        if any(f.name == type_id_store_name for f in fields):
+            raise RuntimeError(
+                f"{cls} contains a '{type_id_store_name}' field"
+                ' which clashes with the type-id-storage-name of'
+                ' the IOMultiType it inherits from.'
+            )
+    else:
+        type_id_store_name = None
+
+    def _handle_unknown(
+        rawkey: str, value: Any, extra_attrs: dict, fieldpath: str
+    ) -> None:
+        # Store unknown attrs off to the side (or error if desired).
+        if not allow_unknown_attrs:
+            raise AttributeError(f"'{cls.__name__}' has no '{rawkey}' field.")
+        if discard_unknown_attrs:
+            return
+
+        # Treat this like 'Any' data; ensure that it is valid raw json.
+        if not _is_valid_for_codec(value, codec):
+            raise TypeError(
+                f'Unknown attr \'{rawkey}\''
+                f' on {fieldpath} contains data type(s)'
+                f' not supported by the specified codec'
+                f' ({codec.name}).'
+            )
+        extra_attrs[rawkey] = value
+
+    def _fill_soft_defaults(args: dict[str, Any], fieldpath: str) -> None:
+        # Go through all fields looking for any not yet present in our
+        # data. If we find any such fields with a soft-default value or
+        # factory defined, inject that soft value into our args.
+        for fieldname, soft_default_call, validator in soft_defaults:
+            if fieldname in args:
+                continue
+            soft_default = soft_default_call()
+            args[fieldname] = soft_default
+
+            # Make sure these values are valid since we didn't run
+            # them through our normal input type checking.
+            validator(
+                soft_default,
+                f'{fieldpath}.{fieldname}' if fieldpath else fieldname,
+            )
+
+    def _finish(args: dict[str, Any], extra_attrs: dict, fieldpath: str) -> Any:
+        _fill_soft_defaults(args, fieldpath)
+        try:
+            out = cls(**args)
+        except Exception as exc:
+            raise ValueError(
+                f'Error instantiating class {cls.__name__}'
+                f' at {fieldpath}: {exc}'
+            ) from exc
+        if extra_attrs:
+            setattr(out, EXTRA_ATTRS_ATTR, extra_attrs)
+        return out
+
+    return DataclassDecodeParts(
+        fields_by_key=fields_by_key,
+        type_id_store_name=type_id_store_name,
+        handle_unknown=_handle_unknown,
+        fill_soft_defaults=_fill_soft_defaults,
+        finish=_finish,
+    )
+
+
+def wrap_extended_decoder(cls: type, decoder: ValueDecoder) -> ValueDecoder:
+    """Wrap a decoder to support IOExtendedData input error handling."""
+    if not issubclass(cls, IOExtendedData):
+        return decoder
+
+    def _decode_extended(values: Any, fieldpath: str) -> Any:
+        try:
+            return decoder(values, fieldpath)
+        except Exception as exc:
+            # Extended data types can choose to substitute default data
+            # in case of failures (generally not a good idea but
+            # occasionally useful).
+            assert issubclass(cls, IOExtendedData)
+            fallback = cls.handle_input_error(exc)
+            if fallback is None:
+                raise
+            # Make sure fallback gave us the right type.
+            if not isinstance(fallback, cls):
+                raise RuntimeError(
+                    f'handle_input_error() was expected to return a {cls}'
+                    f' but returned a {type(fallback)}.'
+                ) from exc
+            return fallback
+
+    return _decode_extended
+
+
+def _compile_dataclass_decoder(
+    cls: type, prep: PrepData, key: DecoderKey
+) -> ValueDecoder:
+    parts = _compile_dataclass_decode_parts(cls, prep, key)
+    plans_by_key = {
+        k: (f.name, f.decoder) for k, f in parts.fields_by_key.items()
+    }
+    type_id_store_name = parts.type_id_store_name
+    handle_unknown = parts.handle_unknown
+    finish = parts.finish
+
+    def _decode(values: Any, fieldpath: str) -> Any:
+        if not isinstance(values, dict):
+            raise TypeError(
+                f'Expected a dict for {fieldpath} on {cls.__name__};'
+                f' got a {type(values)}.'
+            )
+
+        extra_attrs: dict = {}
+
+        # Go through all data in the input, converting it to either
+        # dataclass args or extra data.
+        args: dict[str, Any] = {}
+        for rawkey, value in values.items():
+
+            # Ignore _dciotype or whatnot.
+            if rawkey == type_id_store_name:
+                continue
+
+            plan = plans_by_key.get(rawkey)
+            if plan is None:
+                handle_unknown(rawkey, value, extra_attrs, fieldpath)
+            else:
+                fieldname, decoder = plan
+                args[fieldname] = decoder(
+                    value,
+                    f'{fieldpath}.{fieldname}' if fieldpath else fieldname,
+                )
+
+        return finish(args, extra_attrs, fieldpath)
+
+    return wrap_extended_decoder(cls, _decode)
+
+
+def _const_call(value: Any) -> Callable[[], Any]:
+    return lambda: value
+
+
+def _compile_lazy_dataclass_decoder(cls: type, key: DecoderKey) -> ValueDecoder:
+    """Decode into a dataclass type, compiling on first use.
+
+    Types can be recursive so we can't compile nested decoders
+    up front.
+    """
+    compiled: list[ValueDecoder] = []
+
+    def _decode(value: Any, fieldpath: str) -> Any:
+        if not compiled:
+            compiled.append(get_dataclass_decoder(cls, key))
+        return compiled[0](value, fieldpath)
+
+    return _decode
+
+
+def _compile_multitype_decoder(anntype: Any, key: DecoderKey) -> ValueDecoder:
+    lossy = key.lossy
+
+    def _decode_multitype(value: Any, fieldpath: str) -> Any:
+        try:
+            mttype = _get_multitype_type(anntype, fieldpath, value)
+        except ValueError:
+            if lossy:
+                out = anntype.get_unknown_type_fallback()
+                if out is not None:
+                    # Ok; they provided a fallback. Make sure its of our
+                    # expected type and return it.
+                    assert isinstance(out, anntype)
+                    return out
+            raise
+        return get_dataclass_decoder(mttype, key)(value, fieldpath)
+
+    return _decode_multitype
+
+
+def _compile_value_decoder(
+    cls: type, anntype: Any, ioattrs: IOAttrs | None, key: DecoderKey
+) -> ValueDecoder:
+    # pylint: disable=too-many-return-statements
+    codec = key.codec
+
+    origin = _get_origin(anntype)
+
+    if origin is typing.Any:
+
+        def _decode_any(value: Any, fieldpath: str) -> Any:
+            if not _is_valid_for_codec(value, codec):
+                raise TypeError(
+                    f'Invalid value type for \'{fieldpath}\';'
+                    f' \'Any\' typed values must contain only'
+                    f' types directly supported by the specified'
+                    f' codec ({codec.name}); found'
+                    f' \'{type(value).__name__}\' which is not.'
+                )
+            return value
+
+        return _decode_any
+
+    # noinspection PyPep8
+    if origin is typing.Union or origin is types.UnionType:
+        # Currently, the only unions we support are None/Value
+        # (translated from Optional), which we verified on prep. So
+        # let's treat this as a simple optional case.
+        childanntypes_l = [
+            c for c in typing.get_args(anntype) if c is not type(None)
+        ]  # noqa (pycodestyle complains about *is* with type)
+        assert len(childanntypes_l) == 1
+        childdec = _compile_value_decoder(cls, childanntypes_l[0], ioattrs, key)
+
+        def _decode_optional(value: Any, fieldpath: str) -> Any:
+            if value is None:
+                return None
+            return childdec(value, fieldpath)
+
+        return _decode_optional
+
+    # Everything below this point assumes the annotation type resolves
+    # to a concrete type. (This should have been verified at prep
+    # time).
+    assert isinstance(origin, type)
+
+    if origin in SIMPLE_TYPES:
+        coerce = key.coerce_to_float and origin is float
+
+        def _decode_simple(value: Any, fieldpath: str) -> Any:
+            if type(value) is not origin:
+                # Special case: if they want to coerce ints to floats,
+                # do so.
+                if coerce and type(value) is int:
+                    return float(value)
+                _raise_type_error(fieldpath, type(value), (origin,))
+            return value
+
+        return _decode_simple
+
+    if origin in {list, set}:
+        return _compile_sequence_decoder(cls, anntype, origin, ioattrs, key)
+
+    if origin is tuple:
+        return _compile_tuple_decoder(cls, anntype, ioattrs, key)
+
+    if origin is dict:
+        return _compile_dict_decoder(cls, anntype, ioattrs, key)
+
+    if dataclasses.is_dataclass(origin):
+        return _compile_lazy_dataclass_decoder(origin, key)
+
+    # ONLY consider something as a multi-type when it's not a
+    # dataclass (all dataclasses inheriting from the multi-type
+    # should just be processed as dataclasses).
+    if issubclass(origin, IOMultiType):
+        return _compile_multitype_decoder(anntype, key)
+
+    if issubclass(origin, Enum):
+        return _compile_enum_decoder(origin, ioattrs, key)
+
+    if issubclass(origin, datetime.datetime):
+        return _compile_datetime_decoder(cls, ioattrs, key)
+
+    if issubclass(origin, datetime.timedelta):
+        return _compile_timedelta_decoder(cls)
+
+    if origin is bytes:
+        return _compile_bytes_decoder(origin, key)
+
+    def _decode_unsupported(value: Any, fieldpath: str) -> Any:
+        raise TypeError(
+            f"Field '{fieldpath}' of type '{anntype}' is unsupported here."
+        )
+
+    return _decode_unsupported
+
+
+def _compile_enum_decoder(
+    origin: type[Enum], ioattrs: IOAttrs | None, key: DecoderKey
+) -> ValueDecoder:
+    lossy = key.lossy
+    fallback = None if ioattrs is None else ioattrs.enum_fallback
+
+    def _decode_enum(value: Any, fieldpath: str) -> Any:
+        del fieldpath  # Unused.
+        try:
+            return origin(value)
+        except ValueError as exc:
+            # If a fallback enum was provided in ioattrs AND we're in
+            # lossy mode, return that for unrecognized values. If one
+            # was provided but we're *not* in lossy mode, note that we
+            # could have loaded it if lossy mode was enabled.
+            if fallback is not None:
+                # Sanity check; make sure fallback is valid.
+                assert type(fallback) is origin
+                if lossy:
+                    return fallback
+                raise ValueError(
+                    'Failed to load Enum.  Note that it has a fallback'
+                    ' value and thus would succeed in lossy mode.'
+                ) from exc
+
+            # Otherwise the error stands as-is.
+            raise
+
+    return _decode_enum
+
+
+def _compile_sequence_decoder(
+    cls: type,
+    anntype: Any,
+    seqtype: type,
+    ioattrs: IOAttrs | None,
+    key: DecoderKey,
+) -> ValueDecoder:
+    codec = key.codec
+    childanntypes = typing.get_args(anntype)
+
+    # 'Any' type children; make sure they are valid json values and
+    # then just grab them.
+    if len(childanntypes) == 0 or childanntypes[0] is typing.Any:
+
+        def _decode_any_seq(value: Any, fieldpath: str) -> Any:
+            # Because we are json-centric, we expect a list for all
+            # sequences.
+            if type(value) is not list:
+                raise TypeError(
+                    f'Invalid input value for "{fieldpath}";'
+                    f' expected a list, got a {type(value).__name__}'
+                )
+            for i, child in enumerate(value):
+                if not _is_valid_for_codec(child, codec):
+                    raise TypeError(
+                        f'Item {i} of {fieldpath} contains'
+                        f' data type(s) not supported by json.'
+                    )
+            return value if type(value) is seqtype else seqtype(value)
+
+        return _decode_any_seq
+
+    # We contain elements of some specified type.
+    assert len(childanntypes) == 1
+    childanntype = childanntypes[0]
+
+    # If our annotation type inherits from IOMultiType, use type-id
+    # values to determine which type to load for each element.
+    childdec = (
+        _compile_multitype_decoder(childanntype, key)
+        if issubclass(childanntype, IOMultiType)
+        else _compile_value_decoder(cls, childanntype, ioattrs, key)
+    )
+
+    def _decode_seq(value: Any, fieldpath: str) -> Any:
+        if type(value) is not list:
+            raise TypeError(
+                f'Invalid input value for "{fieldpath}";'
+                f' expected a list, got a {type(value).__name__}'
+            )
+        return seqtype(childdec(i, fieldpath) for i in value)
+
+    return _decode_seq
+
+
+def _compile_tuple_decoder(
+    cls: type, anntype: Any, ioattrs: IOAttrs | None, key: DecoderKey
+) -> ValueDecoder:
+    codec = key.codec
+    childanntypes = typing.get_args(anntype)
+
+    # We should have verified this to be non-zero at prep-time.
+    assert childanntypes
+    childcount = len(childanntypes)
+
+    # 'Any' type children are checked for validity and then passed
+    # through as-is.
+    childdecs: list[ValueDecoder | None] = [
+        (
+            None
+            if c is typing.Any
+            else _compile_value_decoder(cls, c, ioattrs, key)
+        )
+        for c in childanntypes
+    ]
+
+    def _decode_tuple(value: Any, fieldpath: str) -> Any:
+        # Because we are json-centric, we expect a list for all
+        # sequences.
+        if type(value) is not list:
+            raise TypeError(
+                f'Invalid input value for "{fieldpath}";'
+                f' expected a list, got a {type(value).__name__}'
+            )
+        if len(value) != childcount:
+            raise ValueError(
+                f'Invalid tuple input for "{fieldpath}";'
+                f' expected {childcount} values,'
+                f' found {len(value)}.'
+            )
+        out: list = []
+        for i, childdec in enumerate(childdecs):
+            childval = value[i]
+            if childdec is None:
+                if not _is_valid_for_codec(childval, codec):
+                    raise TypeError(
+                        f'Item {i} of {fieldpath} contains'
+                        f' data type(s) not supported by json.'
+                    )
+                out.append(childval)
+            else:
+                out.append(childdec(childval, fieldpath))
+        return tuple(out)
+
+    return _decode_tuple
+
+
+def _compile_dict_decoder(
+    cls: type, anntype: Any, ioattrs: IOAttrs | None, key: DecoderKey
+) -> ValueDecoder:
+    # pylint: disable=too-many-locals
+    codec = key.codec
+    childtypes = typing.get_args(anntype)
+    assert len(childtypes) in (0, 2)
+
+    # We treat 'Any' dicts simply as json; we don't do any translating.
+    if not childtypes or childtypes[0] is typing.Any:
+
+        def _decode_any_dict(value: Any, fieldpath: str) -> Any:
+            if not isinstance(value, dict):
+                raise TypeError(
+                    f'Expected a dict for \'{fieldpath}\' on {cls.__name__};'
+                    f' got a {type(value)}.'
+                )
+            if not _is_valid_for_codec(value, codec):
+                raise TypeError(
+                    f'Got invalid value for Dict[Any, Any]'
+                    f' at \'{fieldpath}\' on {cls.__name__};'
+                    f' all keys and values must be'
+                    f' compatible with the specified codec'
+                    f' ({codec.name}).'
+                )
+            return value
+
+        return _decode_any_dict
+
+    keyanntype, valanntype = childtypes
+    valdec = _compile_value_decoder(cls, valanntype, ioattrs, key)
+
+    # Ok; we've got definite key/value types (which we verified as
+    # valid during prep). Build a key converter for our type.
+    keyconv: Callable[[Any, str], Any]
+    if keyanntype is str:
+
+        # str keys we just take directly since that's supported by
+        # json.
+        def _keyconv_str(dkey: Any, fieldpath: str) -> Any:
+            if not isinstance(dkey, str):
+                raise TypeError(
+                    f'Got invalid key type {type(dkey)} for'
+                    f' dict key at \'{fieldpath}\' on {cls.__name__};'
+                    f' expected a str.'
+                )
+            return dkey
+
+        keyconv = _keyconv_str
+
+    elif keyanntype is int:
+
+        # int keys are stored in json as str versions of themselves.
+        def _keyconv_int(dkey: Any, fieldpath: str) -> Any:
+            if not isinstance(dkey, str):
+                raise TypeError(
+                    f'Got invalid key type {type(dkey)} for'
+                    f' dict key at \'{fieldpath}\' on {cls.__name__};'
+                    f' expected a str.'
+                )
+            try:
+                return int(dkey)
+            except ValueError as exc:
+                raise TypeError(
+                    f'Got invalid key value {dkey} for'
+                    f' dict key at \'{fieldpath}\' on {cls.__name__};'
+                    f' expected an int in string form.'
+                ) from exc
+
+        keyconv = _keyconv_int
+
+    elif issubclass(keyanntype, Enum):
+        # In prep, we verified that all these enums' values have the
+        # same type, so we can just look at the first to see if this
+        # is a string enum or an int enum.
+        enumvaltype = type(next(iter(keyanntype)).value)
+        assert enumvaltype in (int, str)
+        if enumvaltype is str:
+
+            def _keyconv_strenum(dkey: Any, fieldpath: str) -> Any:
+                try:
+                    return keyanntype(dkey)
+                except ValueError as exc:
+                    raise ValueError(
+                        f'Got invalid key value {dkey} for'
+                        f' dict key at \'{fieldpath}\''
+                        f' on {cls.__name__};'
+                        f' expected a value corresponding to'
+                        f' a {keyanntype}.'
+                    ) from exc
+
+            keyconv = _keyconv_strenum
+        else:
+
+            def _keyconv_intenum(dkey: Any, fieldpath: str) -> Any:
+                try:
+                    return keyanntype(int(dkey))
+                except (ValueError, TypeError) as exc:
+                    raise ValueError(
+                        f'Got invalid key value {dkey} for'
+                        f' dict key at \'{fieldpath}\''
+                        f' on {cls.__name__};'
+                        f' expected {keyanntype} value (though'
+                        f' in string form).'
+                    ) from exc
+
+            keyconv = _keyconv_intenum
+    else:
+        raise RuntimeError(f'Unhandled dict in-key-type {keyanntype}')
+
+    def _decode_dict(value: Any, fieldpath: str) -> Any:
+        if not isinstance(value, dict):
+            raise TypeError(
+                f'Expected a dict for \'{fieldpath}\' on {cls.__name__};'
+                f' got a {type(value)}.'
+            )
+        return {
+            keyconv(dkey, fieldpath): valdec(val, fieldpath)
+            for dkey, val in value.items()
+        }
+
+    return _decode_dict
+
+
+def _compile_datetime_decoder(
+    cls: type, ioattrs: IOAttrs | None, key: DecoderKey
+) -> ValueDecoder:
+    codec = key.codec
+    native = codec is Codec.FIRESTORE or codec is Codec.BINARY
+
+    def _decode_datetime(value: Any, fieldpath: str) -> Any:
+        # For firestore/binary we expect a datetime object.
+        if native:
+            # Don't compare exact type here, as firestore can give us a
+            # subclass with extended precision.
+            if not isinstance(value, datetime.datetime):
+                raise TypeError(
+                    f'Invalid input value for "{fieldpath}" on'
+                    f' "{cls.__name__}";'
+                    f' expected a datetime, got a {type(value).__name__}'
+                )
+            check_utc(value)
+            return value
+
+        assert codec is Codec.JSON
+
+        # We expect a list of 7 ints.
+        if type(value) is not list:
+            raise TypeError(
+                f'Invalid input value for "{fieldpath}" on "{cls.__name__}";'
+                f' expected a list, got a {type(value).__name__}'
+            )
+        if len(value) != 7 or not all(isinstance(x, int) for x in value):
+            raise ValueError(
+                f'Invalid input value for "{fieldpath}" on "{cls.__name__}";'
+                f' expected a list of 7 ints, got {[type(v) for v in value]}.'
+            )
+        out = datetime.datetime(  # type: ignore
+            *value, tzinfo=datetime.timezone.utc
+        )
+        if ioattrs is not None:
+            ioattrs.validate_datetime(out, fieldpath)
+        return out
+
+    return _decode_datetime
+
+
+def _compile_timedelta_decoder(cls: type) -> ValueDecoder:
+    def _decode_timedelta(value: Any, fieldpath: str) -> Any:
+        # We expect a list of 3 ints.
+        if type(value) is not list:
+            raise TypeError(
+                f'Invalid input value for "{fieldpath}" on "{cls.__name__}";'
+                f' expected a list, got a {type(value).__name__}'
+            )
+        if len(value) != 3 or not all(isinstance(x, int) for x in value):
+            raise ValueError(
+                f'Invalid input value for "{fieldpath}" on "{cls.__name__}";'
+                f' expected a list of 3 ints, got {[type(v) for v in value]}.'
+            )
+        return datetime.timedelta(
+            days=value[0], seconds=value[1], microseconds=value[2]
+        )
+
+    return _decode_timedelta
+
+
+def _compile_bytes_decoder(cls: type, key: DecoderKey) -> ValueDecoder:
+    import base64
+
+    codec = key.codec
+    native = codec is Codec.FIRESTORE or codec is Codec.BINARY
+
+    def _decode_bytes(value: Any, fieldpath: str) -> Any:
+        # For firestore/binary, bytes are passed as-is. Otherwise,
+        # they're encoded as base64.
+        if native:
+            if not isinstance(value, bytes):
+                raise TypeError(
+                    f'Expected a bytes object for {fieldpath}'
+                    f' on {cls.__name__}; got a {type(value)}.'
+                )
+            return value
+
+        assert codec is Codec.JSON
+        if not isinstance(value, str):
+            raise TypeError(
+                f'Expected a string object for {fieldpath}'
+                f' on {cls.__name__}; got a {type(value)}.'
+            )
+        return base64.b64decode(value)
+
+    return _decode_bytes
@@ -30,6 +30,8 @@ from efro.dataclassio._base import (
     IOMultiType,
 )
 from efro.dataclassio._prep import PrepSession
+from efro.dataclassio._compiler import get_dataclass_decoder, DecoderKey
+from efro.dataclassio._lazy import get_lazy_dataclass_decoder
 
 if TYPE_CHECKING:
     from typing import Any
@@ -48,6 +50,8 @@ class _Inputter:
         allow_unknown_attrs: bool = True,
         discard_unknown_attrs: bool = False,
         lossy: bool = False,
+        compiled: bool = True,
+        lazy: bool = False,
     ):
         self._cls = cls
         self._codec = codec
@@ -56,6 +60,8 @@ class _Inputter:
         self._discard_unknown_attrs = discard_unknown_attrs
         self._soft_default_validator: _Outputter | None = None
         self._lossy = lossy
+        self._compiled = compiled
+        self._lazy = lazy
 
         if not allow_unknown_attrs and discard_unknown_attrs:
             raise ValueError(
@@ -65,6 +71,7 @@ class _Inputter:
 
     def run(self, values: dict) -> Any:
         """Do the thing."""
+        # pylint: disable=too-many-branches
 
         outcls: type[Any]
 
@@ -131,7 +138,25 @@ class _Inputter:
         else:
             is_ext = False
 
-        out = self._dataclass_from_input(outcls, '', values)
+        # Normally we run our precompiled per-class decoder, but we can
+        # also walk the dataclass directly (mostly useful for testing
+        # and benchmarking the compiled path against).
+        if self._compiled:
+            key = DecoderKey(
+                codec=self._codec,
+                coerce_to_float=self._coerce_to_float,
+                allow_unknown_attrs=self._allow_unknown_attrs,
+                discard_unknown_attrs=self._discard_unknown_attrs,
+                lossy=self._lossy,
+            )
+            # Extended data classes expect to see complete instances
+            # in did_input()/will_output(), so we don't do them lazily.
+            if self._lazy and not is_ext:
+                out = get_lazy_dataclass_decoder(outcls, key)(values, '')
+            else:
+                out = get_dataclass_decoder(outcls, key)(values, '')
+        else:
+            out = self._dataclass_from_input(outcls, '', values)
         assert isinstance(out, outcls)
 
         if is_ext:
@@ -272,9 +297,9 @@ class _Inputter:
         """Given input data, returns bytes."""
         import base64
 
-        # For firestore, bytes are passed as-is. Otherwise, they're encoded
-        # as base64.
-        if self._codec is Codec.FIRESTORE:
+        # For firestore/binary, bytes are passed as-is. Otherwise,
+        # they're encoded as base64.
+        if self._codec is Codec.FIRESTORE or self._codec is Codec.BINARY:
             if not isinstance(value, bytes):
                 raise TypeError(
                     f'Expected a bytes object for {fieldpath}'
@@ -707,8 +732,8 @@ class _Inputter:
     def _datetime_from_input(
         self, cls: type, fieldpath: str, value: Any, ioattrs: IOAttrs | None
     ) -> Any:
-        # For firestore we expect a datetime object.
-        if self._codec is Codec.FIRESTORE:
+        # For firestore/binary we expect a datetime object.
+        if self._codec is Codec.FIRESTORE or self._codec is Codec.BINARY:
             # Don't compare exact type here, as firestore can give us
             # a subclass with extended precision.
             if not isinstance(value, datetime.datetime):
@@ -0,0 +1,698 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Incremental json reading/writing for dataclassio.
+
+The standard dataclass_to_json()/dataclass_from_json() calls build a
+full intermediate dict for an object and then convert that to or from
+json in one go, meaning peak memory use is roughly double the payload
+size. The classes here instead walk the structure of a dataclass and
+write or read a file-like object as they go. Only 'leaf' values (and
+small self-contained dataclasses) are ever fully materialized, so
+memory use is bounded by the size of individual entries rather than
+the whole payload.
+
+Structural values that get streamed are nested dataclasses, lists of
+dataclasses, and str-keyed dicts of dataclasses. Everything else is
+converted with the standard compiled codecs a value at a time.
+"""
+
+from __future__ import annotations
+
+import json
+import types
+import typing
+import dataclasses
+from typing import TYPE_CHECKING, cast, Any
+
+from efro.dataclassio._base import (
+    Codec,
+    _get_origin,
+    LOSSY_ATTR,
+    IOExtendedData,
+    IOMultiType,
+)
+from efro.dataclassio._compiler import (
+    EncoderKey,
+    DecoderKey,
+    get_extra_attrs,
+    get_dataclass_encoder,
+    get_dataclass_decoder,
+    get_dataclass_encode_parts,
+    get_dataclass_decode_parts,
+    _compile_value_encoder,
+    _compile_value_decoder,
+    _get_prep,
+)
+
+if TYPE_CHECKING:
+    from typing import Callable, IO
+
+    from efro.dataclassio._base import IOAttrs
+
+    # Takes a value and a field-path and writes it out.
+    ValueWriter = Callable[[Any, str], None]
+
+    # Takes a field-path and reads a value in.
+    ValueReader = Callable[[str], Any]
+
+# How much data we buffer up before writing or read at a time.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+
+def _streams_type(anntype: Any) -> bool:
+    """Return whether a type should be streamed (vs. dumped whole)."""
+    origin = _get_origin(anntype)
+    if origin is typing.Union or origin is types.UnionType:
+        return any(
+            _streams_type(c)
+            for c in typing.get_args(anntype)
+            if c is not type(None)
+        )
+    if not isinstance(origin, type):
+        return False
+    if dataclasses.is_dataclass(origin) or issubclass(origin, IOMultiType):
+        return True
+    childtypes = typing.get_args(anntype)
+    if origin in (list, set) and len(childtypes) == 1:
+        return _streams_type(childtypes[0])
+    if origin is dict and len(childtypes) == 2 and childtypes[0] is str:
+        return _streams_type(childtypes[1])
+    return False
+
+
+def _has_streamed_fields(cls: type) -> bool:
+    """Return whether any fields of a dataclass are worth streaming."""
+    parts = get_dataclass_encode_parts(
+        cls,
+        EncoderKey(
+            codec=Codec.JSON,
+            create=True,
+            coerce_to_float=True,
+            discard_extra_attrs=False,
+        ),
+    )
+    return any(_streams_type(f.anntype) for f in parts.fields)
+
+
+class _JsonStreamWriter:
+    """Incrementally writes a dataclass instance to a json file."""
+
+    def __init__(
+        self,
+        fp: IO[str],
+        *,
+        coerce_to_float: bool,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> None:
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._pending: list[str] = []
+        self._pending_size = 0
+        self._key = EncoderKey(
+            codec=Codec.JSON,
+            create=True,
+            coerce_to_float=coerce_to_float,
+            discard_extra_attrs=False,
+        )
+        self._dumps = json.JSONEncoder(separators=(',', ':')).encode
+        self._dataclass_writers: dict[type, ValueWriter] = {}
+
+    def run(self, obj: Any) -> None:
+        """Do the thing."""
+
+        # mypy workaround - if we check 'obj' here it assumes the
+        # isinstance call below fails.
+        obj_any: Any = obj
+        assert dataclasses.is_dataclass(obj_any)
+
+        # If this data has been flagged as lossy, don't allow outputting
+        # it. This hopefully helps avoid unintentional data
+        # modification/loss.
+        if getattr(obj, LOSSY_ATTR, False):
+            raise ValueError(
+                'Object has been flagged as lossy; output is disallowed.'
+            )
+
+        if isinstance(obj, IOExtendedData):
+            obj.will_output()
+
+        self._write_dataclass(obj, '')
+        self._flush()
+
+    def _write(self, text: str) -> None:
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= self._chunk_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._pending:
+            self._fp.write(''.join(self._pending))
+            self._pending.clear()
+            self._pending_size = 0
+
+    def _write_dataclass(self, obj: Any, fieldpath: str) -> None:
+        cls = type(obj)
+        writer = self._dataclass_writers.get(cls)
+        if writer is None:
+            writer = self._compile_dataclass_writer(cls)
+            self._dataclass_writers[cls] = writer
+        writer(obj, fieldpath)
+
+    def _compile_dataclass_writer(self, cls: type) -> ValueWriter:
+        write = self._write
+        dumps = self._dumps
+
+        # Small self-contained classes we just convert and dump whole.
+        if not _has_streamed_fields(cls):
+            encoder = get_dataclass_encoder(cls, self._key)
+
+            def _write_whole(obj: Any, fieldpath: str) -> None:
+                write(dumps(encoder(obj, fieldpath)))
+
+            return _write_whole
+
+        parts = get_dataclass_encode_parts(cls, self._key)
+        plans = [
+            (
+                f.name,
+                dumps(f.storagename) + ':',
+                f.is_default,
+                self._compile_value_writer(cls, f.anntype, f.ioattrs),
+            )
+            for f in parts.fields
+        ]
+        type_id_storage = parts.type_id_storage
+
+        def _write_dataclass(obj: Any, fieldpath: str) -> None:
+            write('{')
+            first = True
+            for fieldname, keystr, is_default, writer in plans:
+                value = getattr(obj, fieldname)
+                if is_default is not None and is_default(value):
+                    continue
+                write(keystr if first else ',' + keystr)
+                first = False
+                writer(
+                    value,
+                    f'{fieldpath}.{fieldname}' if fieldpath else fieldname,
+                )
+
+            extra_attrs = get_extra_attrs(obj, Codec.JSON, fieldpath)
+            if extra_attrs:
+                extra = dumps(extra_attrs)[1:-1]
+                write(extra if first else ',' + extra)
+                first = False
+
+            if type_id_storage is not None:
+                entry = dumps(type_id_storage[0]) + ':'
+                entry += dumps(type_id_storage[1])
+                write(entry if first else ',' + entry)
+            write('}')
+
+        return _write_dataclass
+
+    def _compile_value_writer(
+        self, cls: type, anntype: Any, ioattrs: IOAttrs | None
+    ) -> ValueWriter:
+        # pylint: disable=too-many-return-statements
+        # pylint: disable=too-many-locals
+        write = self._write
+        dumps = self._dumps
+        origin = _get_origin(anntype)
+
+        # Anything that doesn't contain dataclasses we simply convert
+        # and dump in one go.
+        if not _streams_type(anntype):
+            encoder = _compile_value_encoder(cls, anntype, ioattrs, self._key)
+
+            def _write_leaf(value: Any, fieldpath: str) -> None:
+                write(dumps(encoder(value, fieldpath)))
+
+            return _write_leaf
+
+        if origin is typing.Union or origin is types.UnionType:
+            childanntypes_l = [
+                c for c in typing.get_args(anntype) if c is not type(None)
+            ]  # noqa (pycodestyle complains about *is* with type)
+            assert len(childanntypes_l) == 1
+            childwriter = self._compile_value_writer(
+                cls, childanntypes_l[0], ioattrs
+            )
+
+            def _write_optional(value: Any, fieldpath: str) -> None:
+                if value is None:
+                    write('null')
+                else:
+                    childwriter(value, fieldpath)
+
+            return _write_optional
+
+        if dataclasses.is_dataclass(origin):
+            origin_any = cast(Any, origin)
+
+            def _write_dc(value: Any, fieldpath: str) -> None:
+                if not isinstance(value, origin_any):
+                    raise TypeError(
+                        f'Expected a {origin} for {fieldpath};'
+                        f' found a {type(value)}.'
+                    )
+                self._write_dataclass(value, fieldpath)
+
+            return _write_dc
+
+        if issubclass(origin, IOMultiType):
+
+            def _write_multitype(value: Any, fieldpath: str) -> None:
+                if not isinstance(value, origin):
+                    raise ValueError(
+                        f"Found a {type(value)} value at '{fieldpath}'."
+                        f' It is expected to inherit from {origin}.'
+                    )
+                self._write_dataclass(value, fieldpath)
+
+            return _write_multitype
+
+        childtypes = typing.get_args(anntype)
+        if origin is list:
+            return self._compile_list_writer(cls, childtypes[0], ioattrs)
+        if origin is set:
+            # Sets get sorted on output which requires us to convert
+            # everything up front; just go the normal route for those.
+            encoder = _compile_value_encoder(cls, anntype, ioattrs, self._key)
+
+            def _write_set(value: Any, fieldpath: str) -> None:
+                write(dumps(encoder(value, fieldpath)))
+
+            return _write_set
+
+        assert origin is dict
+        return self._compile_dict_writer(cls, childtypes[1], ioattrs)
+
+    def _compile_list_writer(
+        self, cls: type, childanntype: Any, ioattrs: IOAttrs | None
+    ) -> ValueWriter:
+        write = self._write
+        childwriter = self._compile_value_writer(cls, childanntype, ioattrs)
+        is_multitype = issubclass(_get_origin(childanntype), IOMultiType)
+
+        def _write_list(value: Any, fieldpath: str) -> None:
+            if not isinstance(value, list):
+                raise TypeError(
+                    f'Expected a list for {fieldpath};'
+                    f' found a {type(value)}'
+                )
+            write('[')
+            for i, x in enumerate(value):
+                if is_multitype and not isinstance(x, childanntype):
+                    raise ValueError(
+                        f"Found a {type(x)} value under '{fieldpath}'."
+                        f' Everything must inherit from'
+                        f' {childanntype}.'
+                    )
+                if i:
+                    write(',')
+                childwriter(x, fieldpath)
+            write(']')
+
+        return _write_list
+
+    def _compile_dict_writer(
+        self, cls: type, valanntype: Any, ioattrs: IOAttrs | None
+    ) -> ValueWriter:
+        write = self._write
+        dumps = self._dumps
+        valwriter = self._compile_value_writer(cls, valanntype, ioattrs)
+
+        def _write_dict(value: Any, fieldpath: str) -> None:
+            if not isinstance(value, dict):
+                raise TypeError(
+                    f'Expected a dict for {fieldpath};'
+                    f' found a {type(value)}.'
+                )
+            write('{')
+            first = True
+            for dkey, val in value.items():
+                if not isinstance(dkey, str):
+                    raise TypeError(
+                        f'Got invalid key type {type(dkey)} for'
+                        f' dict key at \'{fieldpath}\' on {cls.__name__};'
+                        f' expected {str}.'
+                    )
+                write(dumps(dkey) + ':' if first else ',' + dumps(dkey) + ':')
+                first = False
+                valwriter(val, fieldpath)
+            write('}')
+
+        return _write_dict
+
+
+class _JsonTokenizer:
+    """Pulls json tokens and values from a file-like object."""
+
+    def __init__(self, fp: IO[str], chunk_size: int) -> None:
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._raw_decode = json.JSONDecoder().raw_decode
+
+    def _fill(self, size: int) -> None:
+        """Read more data into our buffer, dropping consumed data."""
+        chunk = self._fp.read(size)
+        if not chunk:
+            self._eof = True
+        self._buf = self._buf[self._pos :] + chunk
+        self._pos = 0
+
+    def peek(self) -> str:
+        """Skip whitespace and return the next char ('' at end)."""
+        while True:
+            buf = self._buf
+            pos = self._pos
+            buflen = len(buf)
+            while pos < buflen and buf[pos] in _WHITESPACE:
+                pos += 1
+            self._pos = pos
+            if pos < buflen:
+                return buf[pos]
+            if self._eof:
+                return ''
+            self._fill(self._chunk_size)
+
+    def next_char(self) -> str:
+        """Consume and return the next non-whitespace char."""
+        char = self.peek()
+        if not char:
+            raise ValueError('Unexpected end of json data.')
+        self._pos += 1
+        return char
+
+    def expect(self, char: str) -> None:
+        """Consume an exact structural char or raise an error."""
+        found = self.next_char()
+        if found != char:
+            raise ValueError(
+                f"Invalid json data; expected '{char}', found '{found}'."
+            )
+
+    def value(self) -> Any:
+        """Read a complete json value."""
+        self.peek()
+        readsize = self._chunk_size
+        while True:
+            try:
+                val, end = self._raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+                # Value is spread beyond our buffer; read more and
+                # try again. Grow our read size as we go so huge
+                # values don't become quadratic.
+                self._fill(readsize)
+                readsize *= 2
+                continue
+
+            # If a value ends exactly at our buffer end it may be
+            # truncated (a number split across chunks, etc.); read
+            # more to be sure.
+            if end == len(self._buf) and not self._eof:
+                self._fill(readsize)
+                continue
+            self._pos = end
+            return val
+
+    def finish(self) -> None:
+        """Ensure there is no remaining data."""
+        if self.peek():
+            raise ValueError('Extra data found after json value.')
+
+
+class _JsonStreamReader:
+    """Incrementally reads a dataclass instance from a json file."""
+
+    def __init__(
+        self,
+        cls: type[Any],
+        *,
+        coerce_to_float: bool,
+        allow_unknown_attrs: bool = True,
+        discard_unknown_attrs: bool = False,
+        lossy: bool = False,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> None:
+        if not allow_unknown_attrs and discard_unknown_attrs:
+            raise ValueError(
+                'discard_unknown_attrs cannot be True'
+                ' when allow_unknown_attrs is False.'
+            )
+        self._cls = cls
+        self._coerce_to_float = coerce_to_float
+        self._allow_unknown_attrs = allow_unknown_attrs
+        self._discard_unknown_attrs = discard_unknown_attrs
+        self._lossy = lossy
+        self._chunk_size = chunk_size
+        self._key = DecoderKey(
+            codec=Codec.JSON,
+            coerce_to_float=coerce_to_float,
+            allow_unknown_attrs=allow_unknown_attrs,
+            discard_unknown_attrs=discard_unknown_attrs,
+            lossy=lossy,
+        )
+        self._dataclass_readers: dict[type, ValueReader] = {}
+        self._tok: _JsonTokenizer | None = None
+
+    def run(self, fp: IO[str]) -> Any:
+        """Do the thing."""
+        from efro.dataclassio._inputter import _Inputter
+
+        self._tok = tok = _JsonTokenizer(fp, self._chunk_size)
+
+        # Multi-type base classes need their type-id before we know
+        # what we're creating and extended-data classes want to see
+        # the full raw input, so in those cases we simply read the
+        # top level object whole.
+        cls = self._cls
+        if (
+            issubclass(cls, IOMultiType) and not dataclasses.is_dataclass(cls)
+        ) or issubclass(cls, IOExtendedData):
+            values = tok.value()
+            tok.finish()
+            return _Inputter(
+                cls,
+                codec=Codec.JSON,
+                coerce_to_float=self._coerce_to_float,
+                allow_unknown_attrs=self._allow_unknown_attrs,
+                discard_unknown_attrs=self._discard_unknown_attrs,
+                lossy=self._lossy,
+            ).run(values)
+
+        out = self._read_dataclass(cls, '')
+        tok.finish()
+        assert isinstance(out, cls)
+
+        # If we're running in lossy mode, flag the object as such so we
+        # don't allow writing it back out (see _Inputter).
+        if self._lossy:
+            setattr(out, LOSSY_ATTR, True)
+        return out
+
+    def _read_dataclass(self, cls: type, fieldpath: str) -> Any:
+        reader = self._dataclass_readers.get(cls)
+        if reader is None:
+            reader = self._compile_dataclass_reader(cls)
+            self._dataclass_readers[cls] = reader
+        return reader(fieldpath)
+
+    def _compile_dataclass_reader(self, cls: type) -> ValueReader:
+        tok = self._tok
+        assert tok is not None
+
+        # Make sure we're working with a prepped dataclass (this also
+        # gives us standard errors for non-dataclasses).
+        _get_prep(cls)
+
+        # Small self-contained classes (and those with custom input
+        # error handling) we just read whole and decode normally.
+        if issubclass(cls, IOExtendedData) or not _has_streamed_fields(cls):
+            decoder = get_dataclass_decoder(cls, self._key)
+
+            def _read_whole(fieldpath: str) -> Any:
+                return decoder(tok.value(), fieldpath)
+
+            return _read_whole
+
+        parts = get_dataclass_decode_parts(cls, self._key)
+        readers = {
+            key: (f.name, self._compile_value_reader(cls, f.anntype, f.ioattrs))
+            for key, f in parts.fields_by_key.items()
+        }
+        type_id_store_name = parts.type_id_store_name
+        handle_unknown = parts.handle_unknown
+        finish = parts.finish
+
+        def _read_dataclass(fieldpath: str) -> Any:
+            if tok.peek() != '{':
+                # Let the standard decoder generate an appropriate error.
+                return get_dataclass_decoder(cls, self._key)(
+                    tok.value(), fieldpath
+                )
+            tok.expect('{')
+            args: dict[str, Any] = {}
+            extra_attrs: dict = {}
+            if tok.peek() == '}':
+                tok.expect('}')
+                return finish(args, extra_attrs, fieldpath)
+            while True:
+                rawkey = tok.value()
+                if not isinstance(rawkey, str):
+                    raise ValueError('Invalid json data; expected a key.')
+                tok.expect(':')
+                entry = readers.get(rawkey)
+                if rawkey == type_id_store_name:
+                    tok.value()
+                elif entry is None:
+                    handle_unknown(rawkey, tok.value(), extra_attrs, fieldpath)
+                else:
+                    fieldname, reader = entry
+                    args[fieldname] = reader(
+                        f'{fieldpath}.{fieldname}' if fieldpath else fieldname
+                    )
+                char = tok.next_char()
+                if char == '}':
+                    break
+                if char != ',':
+                    raise ValueError(
+                        f"Invalid json data; expected ',' or '}}',"
+                        f" found '{char}'."
+                    )
+            return finish(args, extra_attrs, fieldpath)
+
+        return _read_dataclass
+
+    def _compile_value_reader(
+        self, cls: type, anntype: Any, ioattrs: IOAttrs | None
+    ) -> ValueReader:
+        tok = self._tok
+        assert tok is not None
+        origin = _get_origin(anntype)
+
+        # Anything not worth streaming we just read whole and decode.
+        # This is also our fallback for mismatched input types, as the
+        # decoder will give us standard errors for those.
+        decoder = _compile_value_decoder(cls, anntype, ioattrs, self._key)
+
+        def _read_leaf(fieldpath: str) -> Any:
+            return decoder(tok.value(), fieldpath)
+
+        if not _streams_type(anntype) or (
+            isinstance(origin, type)
+            and issubclass(origin, IOMultiType)
+            and not dataclasses.is_dataclass(origin)
+        ):
+            return _read_leaf
+
+        if origin is typing.Union or origin is types.UnionType:
+            childanntypes_l = [
+                c for c in typing.get_args(anntype) if c is not type(None)
+            ]  # noqa (pycodestyle complains about *is* with type)
+            assert len(childanntypes_l) == 1
+            childreader = self._compile_value_reader(
+                cls, childanntypes_l[0], ioattrs
+            )
+
+            def _read_optional(fieldpath: str) -> Any:
+                if tok.peek() == 'n':
+                    return _read_leaf(fieldpath)
+                return childreader(fieldpath)
+
+            return _read_optional
+
+        if dataclasses.is_dataclass(origin):
+            dctype = cast(type, origin)
+            return lambda fieldpath: self._read_dataclass(dctype, fieldpath)
+
+        childtypes = typing.get_args(anntype)
+        if origin in (list, set):
+            return self._compile_sequence_reader(
+                cls, childtypes[0], origin, ioattrs, _read_leaf
+            )
+        assert origin is dict
+        return self._compile_dict_reader(
+            cls, childtypes[1], ioattrs, _read_leaf
+        )
+
+    def _compile_sequence_reader(
+        self,
+        cls: type,
+        childanntype: Any,
+        seqtype: type,
+        ioattrs: IOAttrs | None,
+        fallback: ValueReader,
+    ) -> ValueReader:
+        # pylint: disable=too-many-positional-arguments
+        tok = self._tok
+        assert tok is not None
+        childreader = self._compile_value_reader(cls, childanntype, ioattrs)
+
+        def _read_sequence(fieldpath: str) -> Any:
+            if tok.peek() != '[':
+                return fallback(fieldpath)
+            tok.expect('[')
+            out: list = []
+            if tok.peek() == ']':
+                tok.expect(']')
+                return seqtype(out)
+            while True:
+                out.append(childreader(fieldpath))
+                char = tok.next_char()
+                if char == ']':
+                    break
+                if char != ',':
+                    raise ValueError(
+                        f"Invalid json data; expected ',' or ']',"
+                        f" found '{char}'."
+                    )
+            return out if seqtype is list else seqtype(out)
+
+        return _read_sequence
+
+    def _compile_dict_reader(
+        self,
+        cls: type,
+        valanntype: Any,
+        ioattrs: IOAttrs | None,
+        fallback: ValueReader,
+    ) -> ValueReader:
+        tok = self._tok
+        assert tok is not None
+        valreader = self._compile_value_reader(cls, valanntype, ioattrs)
+
+        def _read_dict(fieldpath: str) -> Any:
+            if tok.peek() != '{':
+                return fallback(fieldpath)
+            tok.expect('{')
+            out: dict = {}
+            if tok.peek() == '}':
+                tok.expect('}')
+                return out
+            while True:
+                dkey = tok.value()
+                if not isinstance(dkey, str):
+                    raise ValueError('Invalid json data; expected a key.')
+                tok.expect(':')
+                out[dkey] = valreader(fieldpath)
+                char = tok.next_char()
+                if char == '}':
+                    break
+                if char != ',':
+                    raise ValueError(
+                        f"Invalid json data; expected ',' or '}}',"
+                        f" found '{char}'."
+                    )
+            return out
+
+        return _read_dict
@@ -0,0 +1,373 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Lazy decoding support for dataclassio.
+
+Lazy-decoded instances are instances of a dynamically created proxy
+subclass of the requested dataclass. Simple fields are decoded up front
+but container, dataclass, and Any fields are left undecoded and stored
+in a pending dict alongside their raw input data. Descriptors on the
+proxy type decode and validate those values on first access. When
+encoding, any values still pending are passed along in their raw form
+instead of being decoded and re-encoded.
+"""
+
+from __future__ import annotations
+
+import types
+import typing
+import dataclasses
+from typing import TYPE_CHECKING
+
+from efro.dataclassio._base import (
+    _get_origin,
+    _parse_annotated,
+    IOMultiType,
+    EXTRA_ATTRS_ATTR,
+    LAZY_BASE_ATTR,
+    LAZY_STATE_ATTR,
+)
+from efro.dataclassio._compiler import (
+    _get_prep,
+    get_extra_attrs,
+    get_dataclass_encoder,
+    get_dataclass_decoder,
+    get_dataclass_encode_parts,
+    get_dataclass_decode_parts,
+)
+
+if TYPE_CHECKING:
+    from typing import Any
+
+    from efro.dataclassio._base import Codec
+    from efro.dataclassio._compiler import (
+        ValueEncoder,
+        ValueDecoder,
+        EncoderKey,
+        DecoderKey,
+    )
+
+
+class _LazyState:
+    """Pending data for a lazy-decoded instance."""
+
+    def __init__(
+        self,
+        codec: Codec,
+        fieldpath: str,
+        pending: dict[str, tuple[Any, ValueDecoder]],
+    ):
+        self.codec = codec
+        self.fieldpath = fieldpath
+
+        # Raw input values and decoders keyed by field name.
+        self.pending = pending
+
+
+# Stand-in for pending values when filling in soft defaults.
+_PENDING = object()
+
+
+def _is_lazy_type(anntype: Any) -> bool:
+    """Should values of a type be decoded lazily?
+
+    We defer anything potentially expensive to decode (containers,
+    dataclasses, and Any values, which need to be walked for
+    validation) and decode simple stuff up front.
+    """
+    origin = _get_origin(anntype)
+    if origin is typing.Union or origin is types.UnionType:
+        return any(
+            _is_lazy_type(c)
+            for c in typing.get_args(anntype)
+            if c is not type(None)
+        )  # noqa (pycodestyle complains about *is* with type)
+    if origin is typing.Any or origin in {list, set, tuple, dict}:
+        return True
+    return dataclasses.is_dataclass(origin) or (
+        isinstance(origin, type) and issubclass(origin, IOMultiType)
+    )
+
+
+def get_lazy_proxy_type(cls: type) -> type:
+    """Return the lazy proxy type for a dataclass type."""
+    prep = _get_prep(cls)
+    cachekey = (_LazyState, cls)
+    proxytype = prep.compiled.get(cachekey)
+    if proxytype is None:
+        proxytype = _make_lazy_proxy_type(cls)
+        prep.compiled[cachekey] = proxytype
+    assert isinstance(proxytype, type)
+    return proxytype
+
+
+class _LazyField:
+    """Descriptor for a field which may be pending on lazy instances.
+
+    Values live in the instance dict under the field name; this just
+    fills them in from pending data on first access.
+    """
+
+    def __init__(self, name: str, classval: Any):
+        self._name = name
+        self._classval = classval
+
+    def __get__(self, obj: Any, objtype: Any = None) -> Any:
+        name = self._name
+        if obj is None:
+            if self._classval is dataclasses.MISSING:
+                raise AttributeError(name)
+            return self._classval
+        objdict = obj.__dict__
+        try:
+            return objdict[name]
+        except KeyError:
+            pass
+        state = objdict.get(LAZY_STATE_ATTR)
+        entry = None if state is None else state.pending.get(name)
+        if entry is None:
+            raise AttributeError(
+                f"'{type(obj).__name__}' object has no attribute '{name}'"
+            )
+        value = entry[1](
+            entry[0], f'{state.fieldpath}.{name}' if state.fieldpath else name
+        )
+        objdict[name] = value
+
+        # Once it has been handed out, a value may be modified, so from
+        # here on we need to encode it like any other.
+        state.pending.pop(name, None)
+        return value
+
+    def __set__(self, obj: Any, value: Any) -> None:
+        objdict = obj.__dict__
+        objdict[self._name] = value
+        state = objdict.get(LAZY_STATE_ATTR)
+        if state is not None:
+            state.pending.pop(self._name, None)
+
+    def __delete__(self, obj: Any) -> None:
+        objdict = obj.__dict__
+        state = objdict.get(LAZY_STATE_ATTR)
+        found = state is not None and self._name in state.pending
+        if found:
+            del state.pending[self._name]
+        if self._name in objdict:
+            del objdict[self._name]
+        elif not found:
+            raise AttributeError(self._name)
+
+
+def _new_instance(cls: type) -> Any:
+    return object.__new__(cls)
+
+
+def _make_lazy_proxy_type(cls: type) -> type:
+    prep = _get_prep(cls)
+    fields = dataclasses.fields(cls)
+    compare_names = [f.name for f in fields if f.compare]
+
+    def __eq__(self: Any, other: Any) -> Any:
+        # Standard dataclass comparisons require exact type matches, so
+        # we need to allow comparing against our base type explicitly.
+        othertype = type(other)
+        if othertype is not cls and othertype is not proxytype:
+            return NotImplemented
+        return tuple(getattr(self, n) for n in compare_names) == tuple(
+            getattr(other, n) for n in compare_names
+        )
+
+    def __reduce_ex__(self: Any, protocol: Any) -> Any:
+        # Copy/pickle as a fully decoded regular instance.
+        del protocol  # Unused.
+        state = self.__dict__.get(LAZY_STATE_ATTR)
+        if state is not None:
+            for name in list(state.pending):
+                getattr(self, name)
+        attrs = dict(self.__dict__)
+        attrs.pop(LAZY_STATE_ATTR, None)
+        return _new_instance, (cls,), attrs
+
+    namespace: dict[str, Any] = {
+        '__module__': cls.__module__,
+        '__qualname__': cls.__qualname__,
+        '__doc__': cls.__doc__,
+        '__reduce_ex__': __reduce_ex__,
+        LAZY_BASE_ATTR: cls,
+    }
+
+    # Fields which may be pending get descriptors. Note that these
+    # need to override any class attrs (simple default values live
+    # there).
+    for field in fields:
+        if _is_lazy_type(_parse_annotated(prep.annotations[field.name])[0]):
+            namespace[field.name] = _LazyField(
+                field.name, getattr(cls, field.name, dataclasses.MISSING)
+            )
+
+    if cls.__dataclass_params__.eq:  # type: ignore[attr-defined]
+        namespace['__eq__'] = __eq__
+
+        # Defining __eq__ implicitly clears __hash__ so carry it over.
+        namespace['__hash__'] = cls.__hash__
+
+    proxytype = type(cls.__name__, (cls,), namespace)
+    return proxytype
+
+
+def get_lazy_dataclass_decoder(cls: type, key: DecoderKey) -> ValueDecoder:
+    """Return a lazy decoder for a dataclass type.
+
+    The decoder is compiled on first request and cached from then on.
+    """
+    prep = _get_prep(cls)
+    cachekey = (_LazyState, cls, key)
+    decoder = prep.compiled.get(cachekey)
+    if decoder is None:
+        decoder = _compile_lazy_decoder(cls, key)
+        prep.compiled[cachekey] = decoder
+    return decoder
+
+
+def _compile_lazy_decoder(cls: type, key: DecoderKey) -> ValueDecoder:
+    parts = get_dataclass_decode_parts(cls, key)
+
+    # Note: which fields we defer must line up with the fields given
+    # descriptors in our proxy type.
+    plans_by_key = {
+        k: (f.name, f.decoder, _is_lazy_type(f.anntype))
+        for k, f in parts.fields_by_key.items()
+    }
+
+    # If there's nothing to defer, or if we'd skip something
+    # important by not running __init__, just decode normally.
+    if not any(p[2] for p in plans_by_key.values()) or hasattr(
+        cls, '__post_init__'
+    ):
+        return get_dataclass_decoder(cls, key)
+
+    proxytype = get_lazy_proxy_type(cls)
+    codec = key.codec
+    type_id_store_name = parts.type_id_store_name
+    handle_unknown = parts.handle_unknown
+    fill_soft_defaults = parts.fill_soft_defaults
+    field_inits = [
+        (f.name, f.default, f.default_factory) for f in dataclasses.fields(cls)
+    ]
+    missing = dataclasses.MISSING
+
+    def _decode(values: Any, fieldpath: str) -> Any:
+        # pylint: disable=too-many-branches
+        if not isinstance(values, dict):
+            raise TypeError(
+                f'Expected a dict for {fieldpath} on {cls.__name__};'
+                f' got a {type(values)}.'
+            )
+
+        extra_attrs: dict = {}
+        args: dict[str, Any] = {}
+        pending: dict[str, tuple[Any, ValueDecoder]] = {}
+        for rawkey, value in values.items():
+
+            # Ignore _dciotype or whatnot.
+            if rawkey == type_id_store_name:
+                continue
+
+            plan = plans_by_key.get(rawkey)
+            if plan is None:
+                handle_unknown(rawkey, value, extra_attrs, fieldpath)
+                continue
+            fieldname, decoder, lazy = plan
+            if lazy:
+                pending[fieldname] = (value, decoder)
+                args[fieldname] = _PENDING
+            else:
+                args[fieldname] = decoder(
+                    value,
+                    f'{fieldpath}.{fieldname}' if fieldpath else fieldname,
+                )
+
+        fill_soft_defaults(args, fieldpath)
+
+        # Assign everything that's not pending, doing the equivalent of
+        # what the dataclass __init__ would.
+        out: Any = object.__new__(proxytype)
+        for fieldname, default, default_factory in field_inits:
+            value = args.get(fieldname, missing)
+            if value is _PENDING:
+                continue
+            if value is missing:
+                if default is not missing:
+                    value = default
+                elif default_factory is not missing:
+                    value = default_factory()
+                else:
+                    raise ValueError(
+                        f'Error instantiating class {cls.__name__}'
+                        f' at {fieldpath}: missing required'
+                        f" argument '{fieldname}'."
+                    )
+            object.__setattr__(out, fieldname, value)
+
+        object.__setattr__(
+            out, LAZY_STATE_ATTR, _LazyState(codec, fieldpath, pending)
+        )
+        if extra_attrs:
+            object.__setattr__(out, EXTRA_ATTRS_ATTR, extra_attrs)
+        return out
+
+    return _decode
+
+
+def compile_lazy_encoder(cls: type, key: EncoderKey) -> ValueEncoder:
+    """Compile an encoder for lazy proxies of a dataclass type.
+
+    Values still pending on an instance are output as the raw data they
+    were created from (assuming the codec matches), so encoding an
+    instance that has not been touched costs little more than a dict
+    copy.
+    """
+    encoder = get_dataclass_encoder(cls, key)
+
+    # If we're not creating output (validating) we need to look at
+    # everything.
+    if not key.create:
+        return encoder
+
+    codec = key.codec
+    parts = get_dataclass_encode_parts(cls, key)
+    plans = [
+        (f.name, f.storagename, f.is_default, f.encoder) for f in parts.fields
+    ]
+    type_id_storage = parts.type_id_storage
+    check_extra_attrs = not key.discard_extra_attrs
+
+    def _encode(obj: Any, fieldpath: str) -> Any:
+        state = obj.__dict__.get(LAZY_STATE_ATTR)
+        if state is None or not state.pending or state.codec is not codec:
+            return encoder(obj, fieldpath)
+
+        pending = state.pending
+        out: dict[str, Any] = {}
+        for fieldname, storagename, is_default, fencoder in plans:
+            entry = pending.get(fieldname)
+            if entry is not None:
+                out[storagename] = entry[0]
+                continue
+            value = getattr(obj, fieldname)
+            if is_default is not None and is_default(value):
+                continue
+            out[storagename] = fencoder(
+                value, f'{fieldpath}.{fieldname}' if fieldpath else fieldname
+            )
+
+        if check_extra_attrs:
+            extra_attrs = get_extra_attrs(obj, codec, fieldpath)
+            if extra_attrs is not None:
+                out.update(extra_attrs)
+
+        if type_id_storage is not None:
+            out[type_id_storage[0]] = type_id_storage[1]
+
+        return out
+
+    return _encode
@@ -30,6 +30,7 @@ from efro.dataclassio._base import (
     IOMultiType,
 )
 from efro.dataclassio._prep import PrepSession
+from efro.dataclassio._compiler import get_dataclass_encoder, EncoderKey
 
 if TYPE_CHECKING:
     from efro.dataclassio._base import IOAttrs
@@ -46,12 +47,14 @@ class _Outputter:
         codec: Codec,
         coerce_to_float: bool,
         discard_extra_attrs: bool,
+        compiled: bool = True,
     ) -> None:
         self._obj = obj
         self._create = create
         self._codec = codec
         self._coerce_to_float = coerce_to_float
         self._discard_extra_attrs = discard_extra_attrs
+        self._compiled = compiled
 
     def run(self) -> Any:
         """Do the thing."""
@@ -76,6 +79,20 @@ class _Outputter:
         if isinstance(obj, IOExtendedData):
             obj.will_output()
 
+        # Normally we run our precompiled per-class encoder, but we can
+        # also walk the dataclass directly (mostly useful for testing
+        # and benchmarking the compiled path against).
+        if self._compiled:
+            return get_dataclass_encoder(
+                type(obj),
+                EncoderKey(
+                    codec=self._codec,
+                    create=self._create,
+                    coerce_to_float=self._coerce_to_float,
+                    discard_extra_attrs=self._discard_extra_attrs,
+                ),
+            )(obj, '')
+
         return self._process_dataclass(type(obj), obj, '')
 
     def soft_default_check(
@@ -461,7 +478,7 @@ class _Outputter:
             check_utc(value)
             if ioattrs is not None:
                 ioattrs.validate_datetime(value, fieldpath)
-            if self._codec is Codec.FIRESTORE:
+            if self._codec is Codec.FIRESTORE or self._codec is Codec.BINARY:
                 return value
             assert self._codec is Codec.JSON
             return (
@@ -508,11 +525,12 @@ class _Outputter:
         if not self._create:
             return None
 
-        # In JSON we convert to base64, but firestore directly supports bytes.
+        # In JSON we convert to base64, but firestore/binary directly
+        # support bytes.
         if self._codec is Codec.JSON:
             return base64.b64encode(value).decode()
 
-        assert self._codec is Codec.FIRESTORE
+        assert self._codec is Codec.FIRESTORE or self._codec is Codec.BINARY
         return value
 
     def _process_dict(
@@ -117,6 +117,10 @@ class PrepData:
     # Map of storage names to attr names.
     storage_names_to_attr_names: dict[str, str]
 
+    # Compiled encoders/decoders for this class, keyed by options.
+    # These are generated lazily on first use (see _compiler.py).
+    compiled: dict[Any, Any] = dataclasses.field(default_factory=dict)
+
 
 class PrepSession:
     """Context for a prep."""
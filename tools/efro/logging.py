@@ -8,10 +8,8 @@ import time
 import asyncio
 import logging
 import datetime
-import itertools
 from enum import Enum
 from functools import partial
-from collections import deque
 from dataclasses import dataclass, field
 from typing import TYPE_CHECKING, Annotated, override
 from threading import Thread, current_thread, Lock
@@ -68,6 +66,16 @@ LEVELNO_LOG_LEVELS = {
     logging.CRITICAL: LogLevel.CRITICAL,
 }
 
+# Raw stdout/stderr writes are accumulated at the call site and handed
+# to the logging thread once they reach a newline, this many characters,
+# or after this many seconds.
+FILE_WRITE_FLUSH_SIZE = 4096
+FILE_WRITE_FLUSH_DELAY = 0.01
+
+# Writes to a LogSink are flushed this many seconds after the
+# first unflushed one.
+SINK_FLUSH_DELAY = 1.0
+
 LEVELNO_COLOR_CODES: dict[int, tuple[str, str]] = {
     logging.DEBUG: (Clr.CYN, Clr.RST),
     logging.INFO: ('', ''),
@@ -111,11 +119,161 @@ class LogArchive:
     entries: Annotated[list[LogEntry], IOAttrs('e')]
 
 
+class LogSink:
+    """Something a LogHandler can write structured entries to.
+
+    All calls come from the LogHandler's background thread. See
+    efro.logsink.SegmentedLogSink for a concrete implementation.
+    """
+
+    def write(self, entry: LogEntry) -> None:
+        """Write an entry (which may be buffered)."""
+        raise NotImplementedError()
+
+    def flush(self) -> None:
+        """Push any buffered writes to their destination."""
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        """Flush and release any resources."""
+        raise NotImplementedError()
+
+
+class _LogCache:
+    """Ring buffer of log entries keyed by absolute log index.
+
+    Only the logging thread modifies this, but it can be read from any
+    thread without locking. Each modification publishes a new state
+    tuple and each slot's absolute index is stored alongside it, so
+    readers can tell when entries get evicted (and their slots reused)
+    out from under them.
+    """
+
+    _MIN_CAPACITY = 64
+
+    def __init__(self) -> None:
+        # Parallel entry/index/size slot lists; capacity is always a
+        # power of two. Index -1 marks a slot as empty.
+        self._sizes = [0] * self._MIN_CAPACITY
+        entries: list[LogEntry | None] = [None] * self._MIN_CAPACITY
+
+        # Entry slots, index slots, start index, end index. Entries in
+        # [start, end) are present.
+        self.state = (entries, [-1] * self._MIN_CAPACITY, 0, 0)
+
+        # Total size of cached entries in bytes (roughly).
+        self.size = 0
+
+    def append(self, entry: LogEntry, entry_size: int) -> None:
+        """Add an entry to the end (logging thread only)."""
+        entries, indexes, start, end = self.state
+        if end - start == len(entries):
+            entries, indexes = self._resize(len(entries) * 2)
+        pos = end & (len(entries) - 1)
+
+        # Note: order matters here and in pop_oldest() for readers; an
+        # index slot is only ever valid while its entry slot holds the
+        # entry for that index.
+        entries[pos] = entry
+        indexes[pos] = end
+        self._sizes[pos] = entry_size
+        self.size += entry_size
+        self.state = (entries, indexes, start, end + 1)
+
+    def oldest(self) -> LogEntry | None:
+        """Return the oldest entry (logging thread only)."""
+        entries, _indexes, start, end = self.state
+        if start == end:
+            return None
+        return entries[start & (len(entries) - 1)]
+
+    def pop_oldest(self) -> None:
+        """Evict the oldest entry (logging thread only)."""
+        entries, indexes, start, end = self.state
+        assert end > start
+        pos = start & (len(entries) - 1)
+        indexes[pos] = -1
+        entries[pos] = None
+        self.size -= self._sizes[pos]
+        self.state = (entries, indexes, start + 1, end)
+
+        # Give back memory if we've shrunk a lot.
+        if (
+            len(entries) > self._MIN_CAPACITY
+            and end - start <= len(entries) // 4
+        ):
+            self._resize(len(entries) // 2)
+
+    def _resize(self, capacity: int) -> tuple[list[LogEntry | None], list[int]]:
+        entries, indexes, start, end = self.state
+        mask = len(entries) - 1
+        newmask = capacity - 1
+        newentries: list[LogEntry | None] = [None] * capacity
+        newindexes = [-1] * capacity
+        newsizes = [0] * capacity
+        for i in range(start, end):
+            pos = i & mask
+            newpos = i & newmask
+            newentries[newpos] = entries[pos]
+            newindexes[newpos] = indexes[pos]
+            newsizes[newpos] = self._sizes[pos]
+
+        # Note: we never modify the old lists after this, so readers
+        # still working with them are fine.
+        self._sizes = newsizes
+        self.state = (newentries, newindexes, start, end)
+        return newentries, newindexes
+
+    def read(
+        self, start_index: int, max_entries: int | None
+    ) -> tuple[int, int, list[LogEntry]]:
+        """Return (log size, start index, entries) for a range.
+
+        This is safe to call from any thread. The range is clamped to
+        what is present.
+        """
+        # pylint: disable=too-many-locals
+        while True:
+            entries, indexes, start, end = self.state
+            first = max(start, min(start_index, end))
+            last = end if max_entries is None else min(end, first + max_entries)
+            if last <= first:
+                return end, first, []
+            capacity = len(entries)
+            pos = first & (capacity - 1)
+            endpos = pos + (last - first)
+
+            # Under the GIL each slice is an atomic snapshot, but
+            # entries may have been evicted since we grabbed our state.
+            # We grab entries and then indexes; any entry whose index is
+            # still valid after that is the right one. Eviction happens
+            # in index order so anything that's gone is at the front.
+            found = entries[pos:endpos]
+            found_indexes = indexes[pos:endpos]
+            if endpos > capacity:
+                wrapped = entries[: endpos - capacity]
+                if indexes[0] != first + len(found):
+                    # Everything we've got is gone; try again.
+                    continue
+                found += wrapped
+            if found_indexes[0] == first:
+                skip = 0
+            else:
+                skip = 1
+                while skip < len(found_indexes) and (
+                    found_indexes[skip] != first + skip
+                ):
+                    skip += 1
+                del found[:skip]
+            return end, first + skip, found  # type: ignore[return-value]
+
+
 class LogHandler(logging.Handler):
     """Fancy-pants handler for logging output.
 
     Writes logs to disk in structured json format and echoes them
-    to stdout/stderr with pretty colors.
+    to stdout/stderr with pretty colors. If given a LogSink, writes
+    entries to that too and closes it on shutdown.
     """
 
     _event_loop: asyncio.AbstractEventLoop
@@ -133,10 +291,13 @@ class LogHandler(logging.Handler):
         cache_time_limit: datetime.timedelta | None,
         echofile_timestamp_format: Literal['default', 'relative'] = 'default',
         launch_time: float | None = None,
+        sink: LogSink | None = None,
     ):
         super().__init__()
         # pylint: disable=consider-using-with
         self._file = None if path is None else open(path, 'w', encoding='utf-8')
+        self._sink = sink
+        self._sink_flush_pending = False
         self._echofile = echofile
         self._echofile_timestamp_format = echofile_timestamp_format
         self._callbacks: list[Callable[[LogEntry], None]] = []
@@ -145,14 +306,25 @@ class LogHandler(logging.Handler):
             'stdout': None,
             'stderr': None,
         }
+
+        # Call-site accumulation for raw stdout/stderr writes (see
+        # file_write()). Completed chunks go into a single queue so they
+        # are always processed in order; the logging thread is only
+        # woken when that queue goes from empty to non-empty.
+        self._file_write_lock = Lock()
+        self._file_write_pending: dict[str, list[str]] = {
+            'stdout': [],
+            'stderr': [],
+        }
+        self._file_write_pending_size = {'stdout': 0, 'stderr': 0}
+        self._file_write_timer_pending = {'stdout': False, 'stderr': False}
+        self._file_write_queue: list[tuple[str, str, bool]] = []
+
         self._launch_time = time.time() if launch_time is None else launch_time
-        self._cache_size = 0
         assert cache_size_limit >= 0
         self._cache_size_limit = cache_size_limit
         self._cache_time_limit = cache_time_limit
-        self._cache = deque[tuple[int, LogEntry]]()
-        self._cache_index_offset = 0
-        self._cache_lock = Lock()
+        self._cache = _LogCache()
         self._printed_callback_error = False
         self._thread_bootstrapped = False
         self._thread = Thread(target=self._log_thread_main, daemon=True)
@@ -199,9 +371,8 @@ class LogHandler(logging.Handler):
 
         # Run all of our cached entries through the new callback if desired.
         if feed_existing_logs and self._cache_size_limit > 0:
-            with self._cache_lock:
-                for _id, entry in self._cache:
-                    self._run_callback_on_entry(call, entry)
+            for entry in self._cache.read(0, None)[2]:
+                self._run_callback_on_entry(call, entry)
 
     def _log_thread_main(self) -> None:
         self._event_loop = asyncio.new_event_loop()
@@ -236,16 +407,14 @@ class LogHandler(logging.Handler):
         while bool(True):
             await asyncio.sleep(61.27)
             now = utc_now()
-            with self._cache_lock:
-                # Prune the oldest entry as long as there is a first one
-                # that is too old.
-                while (
-                    self._cache
-                    and (now - self._cache[0][1].time) >= self._cache_time_limit
-                ):
-                    popped = self._cache.popleft()
-                    self._cache_size -= popped[0]
-                    self._cache_index_offset += 1
+
+            # Prune the oldest entry as long as there is a first one
+            # that is too old.
+            while True:
+                oldest = self._cache.oldest()
+                if oldest is None or now - oldest.time < self._cache_time_limit:
+                    break
+                self._cache.pop_oldest()
 
     def get_cached(
         self, start_index: int = 0, max_entries: int | None = None
@@ -262,40 +431,23 @@ class LogHandler(logging.Handler):
         assert start_index >= 0
         if max_entries is not None:
             assert max_entries >= 0
-        with self._cache_lock:
-            # Transform start_index to our present cache space.
-            start_index -= self._cache_index_offset
-            # Calc end-index in our present cache space.
-            end_index = (
-                len(self._cache)
-                if max_entries is None
-                else start_index + max_entries
-            )
 
-            # Clamp both indexes to both ends of our present space.
-            start_index = max(0, min(start_index, len(self._cache)))
-            end_index = max(0, min(end_index, len(self._cache)))
+        # Note: this doesn't need to lock anything so won't hold up
+        # logging no matter how much is being read.
+        log_size, start_index, entries = self._cache.read(
+            start_index, max_entries
+        )
+        return LogArchive(
+            log_size=log_size, start_index=start_index, entries=entries
+        )
 
-            return LogArchive(
-                log_size=self._cache_index_offset + len(self._cache),
-                start_index=start_index + self._cache_index_offset,
-                entries=self._cache_slice(start_index, end_index),
-            )
+    def get_cached_entry(self, index: int) -> LogEntry | None:
+        """Return a single cached log entry by index.
 
-    def _cache_slice(
-        self, start: int, end: int, step: int = 1
-    ) -> list[LogEntry]:
-        # Deque doesn't natively support slicing but we can do it
-        # manually. It sounds like rotating the deque and pulling from
-        # the beginning is the most efficient way to do this. The
-        # downside is the deque gets temporarily modified in the process
-        # so we need to make sure we're holding the lock.
-        assert self._cache_lock.locked()
-        cache = self._cache
-        cache.rotate(-start)
-        slc = [e[1] for e in itertools.islice(cache, 0, end - start, step)]
-        cache.rotate(start)
-        return slc
+        Returns None if the entry is not (or no longer) in the cache.
+        """
+        _log_size, start_index, entries = self._cache.read(index, 1)
+        return entries[0] if entries and start_index == index else None
 
     @classmethod
     def _is_immutable_log_data(cls, data: Any) -> bool:
@@ -470,16 +622,61 @@ class LogHandler(logging.Handler):
     def file_write(self, name: str, output: str) -> None:
         """Send raw stdout/stderr output to the logger to be collated."""
 
-        # Note to self: it turns out that things like '^^^^^^^^^^^^^^'
-        # lines in stack traces get written as lots of individual '^'
-        # writes. It feels a bit dirty to be pushing a deferred call to
-        # another thread for each character. Perhaps should do some sort
-        # of basic accumulation here?
-        self._event_loop.call_soon_threadsafe(
-            partial(self._file_write_in_thread, name, output)
-        )
+        # Things like '^^^^^^^^^^^^^^' lines in stack traces get written
+        # as lots of individual '^' writes and a single print is
+        # generally several writes, so rather than pushing a call to our
+        # thread for each of those we accumulate them here and hand them
+        # over at line ends (or when things get big or a bit of time
+        # passes).
+        with self._file_write_lock:
+            self._file_write_pending[name].append(output)
+            size = self._file_write_pending_size[name] + len(output)
+            if output.endswith('\n') or size >= FILE_WRITE_FLUSH_SIZE:
+                # The end of a print will be a standalone '\n' by
+                # default; the logging thread uses that as a hint to
+                # ship a log entry.
+                self._queue_file_write(name, ship=output == '\n')
+            else:
+                self._file_write_pending_size[name] = size
+                if not self._file_write_timer_pending[name]:
+                    self._file_write_timer_pending[name] = True
+                    self._event_loop.call_soon_threadsafe(
+                        partial(
+                            self._event_loop.call_later,
+                            FILE_WRITE_FLUSH_DELAY,
+                            self._file_write_timer_in_thread,
+                            name,
+                        )
+                    )
+
+    def _queue_file_write(self, name: str, ship: bool) -> None:
+        """Move a stream's pending writes to the queue."""
+        assert self._file_write_lock.locked()
+        pending = self._file_write_pending[name]
+        if not self._file_write_queue:
+            self._event_loop.call_soon_threadsafe(
+                self._process_file_write_queue
+            )
+        self._file_write_queue.append((name, ''.join(pending), ship))
+        pending.clear()
+        self._file_write_pending_size[name] = 0
+
+    def _file_write_timer_in_thread(self, name: str) -> None:
+        with self._file_write_lock:
+            self._file_write_timer_pending[name] = False
+            if self._file_write_pending[name]:
+                self._queue_file_write(name, ship=False)
+        self._process_file_write_queue()
+
+    def _process_file_write_queue(self) -> None:
+        assert current_thread() is self._thread
+        with self._file_write_lock:
+            queue = self._file_write_queue
+            self._file_write_queue = []
+        for name, output, ship in queue:
+            self._file_write_in_thread(name, output, ship)
 
-    def _file_write_in_thread(self, name: str, output: str) -> None:
+    def _file_write_in_thread(self, name: str, output: str, ship: bool) -> None:
         try:
             assert name in ('stdout', 'stderr')
 
@@ -490,9 +687,10 @@ class LogHandler(logging.Handler):
 
             # Individual parts of a print come across as separate
             # writes, and the end of a print will be a standalone '\n'
-            # by default. Let's use that as a hint that we're likely at
-            # the end of a full print statement and ship what we've got.
-            if output == '\n':
+            # by default. We get told when output ended with such a
+            # write; let's use that as a hint that we're likely at the
+            # end of a full print statement and ship what we've got.
+            if ship:
                 self._ship_file_chunks(name, cancel_ship_task=True)
             else:
                 # By default just keep adding chunks. However we keep a
@@ -521,6 +719,16 @@ class LogHandler(logging.Handler):
 
         def _set_done() -> None:
             nonlocal done
+            # We own our sink, so close it out here; this lets it finish
+            # off its active segment/etc.
+            if self._sink is not None:
+                try:
+                    self._sink.close()
+                except Exception:
+                    import traceback
+
+                    traceback.print_exc(file=self._echofile)
+                self._sink = None
             done = True
 
         self._event_loop.call_soon_threadsafe(_set_done)
@@ -535,6 +743,9 @@ class LogHandler(logging.Handler):
     def file_flush(self, name: str) -> None:
         """Send raw stdout/stderr flush to the logger to be collated."""
 
+        with self._file_write_lock:
+            if self._file_write_pending[name]:
+                self._queue_file_write(name, ship=False)
         self._event_loop.call_soon_threadsafe(
             partial(self._file_flush_in_thread, name)
         )
@@ -543,7 +754,9 @@ class LogHandler(logging.Handler):
         try:
             assert name in ('stdout', 'stderr')
 
-            # Immediately ship whatever chunks we've got.
+            # Make sure any queued writes have landed and then
+            # immediately ship whatever chunks we've got.
+            self._process_file_write_queue()
             if self._file_chunks[name]:
                 self._ship_file_chunks(name, cancel_ship_task=True)
 
@@ -583,26 +796,22 @@ class LogHandler(logging.Handler):
 
         # Store to our cache.
         if self._cache_size_limit > 0:
-            with self._cache_lock:
-                # Do a rough calc of how many bytes this entry consumes.
-                entry_size = sum(
-                    sys.getsizeof(x)
-                    for x in (
-                        entry,
-                        entry.name,
-                        entry.message,
-                        entry.level,
-                        entry.time,
-                    )
+            # Do a rough calc of how many bytes this entry consumes.
+            entry_size = sum(
+                sys.getsizeof(x)
+                for x in (
+                    entry,
+                    entry.name,
+                    entry.message,
+                    entry.level,
+                    entry.time,
                 )
-                self._cache.append((entry_size, entry))
-                self._cache_size += entry_size
+            )
+            self._cache.append(entry, entry_size)
 
-                # Prune old until we are back at or under our limit.
-                while self._cache_size > self._cache_size_limit:
-                    popped = self._cache.popleft()
-                    self._cache_size -= popped[0]
-                    self._cache_index_offset += 1
+            # Prune old until we are back at or under our limit.
+            while self._cache.size > self._cache_size_limit:
+                self._cache.pop_oldest()
 
         # Pass to callbacks.
         for call in self._callbacks:
@@ -616,6 +825,28 @@ class LogHandler(logging.Handler):
             assert '\n' not in entry_s  # Make sure its a single line.
             print(entry_s, file=self._file, flush=True)
 
+        # Write to our segmented sink. This is buffered; we flush it
+        # shortly after the first write instead of on every entry.
+        if self._sink is not None:
+            self._sink.write(entry)
+            if not self._sink_flush_pending:
+                self._sink_flush_pending = True
+                self._event_loop.call_later(
+                    SINK_FLUSH_DELAY, self._flush_sink_in_thread
+                )
+
+    def _flush_sink_in_thread(self) -> None:
+        self._sink_flush_pending = False
+        if self._sink is None:
+            # We've been shut down since this was scheduled.
+            return
+        try:
+            self._sink.flush()
+        except Exception:
+            import traceback
+
+            traceback.print_exc(file=self._echofile)
+
     def _run_callback_on_entry(
         self, callback: Callable[[LogEntry], None], entry: LogEntry
     ) -> None:
@@ -670,11 +901,16 @@ def setup_logging(
     cache_size_limit: int = 0,
     cache_time_limit: datetime.timedelta | None = None,
     launch_time: float | None = None,
+    sink: LogSink | None = None,
 ) -> LogHandler:
     """Set up our logging environment.
 
     Returns the custom handler which can be used to fetch information
     about logs that have passed through it. (worst log-levels, caches, etc.).
+
+    If a sink is passed (such as an efro.logsink.SegmentedLogSink),
+    structured logs are also written to it. The handler takes ownership
+    of the sink and closes it on shutdown.
     """
 
     lmap = {
@@ -704,6 +940,7 @@ def setup_logging(
         cache_size_limit=cache_size_limit,
         cache_time_limit=cache_time_limit,
         launch_time=launch_time,
+        sink=sink,
     )
 
     # Note: going ahead with force=True here so that we replace any
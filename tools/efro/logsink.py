@@ -0,0 +1,395 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Segmented on-disk storage for structured logs.
+
+Logs are written as json lines (one efro.logging.LogEntry per line) to
+numbered segment files in a directory. Segments are rolled when they
+get too big or too old; closed segments are then compressed in the
+background and given a sidecar index so time ranges and level filters
+can be read back without decompressing everything.
+
+Layout for a segment numbered N:
+
+  N.jsonl: Raw json lines; present for the active segment (and for
+      closed ones until they have been compressed).
+  N.jsonl.gz: Compressed json lines. This is a sequence of gzip members,
+      one per index block, so each block can be decompressed on its own.
+  N.idx.json: A LogSegmentIndex for N.jsonl.gz.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import gzip
+import time
+import datetime
+from pathlib import Path
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Annotated, override
+from concurrent.futures import ThreadPoolExecutor
+
+from efro.logging import LogEntry, LogLevel, LogArchive, LogSink
+from efro.dataclassio import (
+    ioprepped,
+    IOAttrs,
+    dataclass_to_json,
+    dataclass_from_json,
+)
+
+if TYPE_CHECKING:
+    from typing import IO, Any
+    from concurrent.futures import Future
+
+_RAW_SUFFIX = '.jsonl'
+_COMPRESSED_SUFFIX = '.jsonl.gz'
+_INDEX_SUFFIX = '.idx.json'
+
+
+@ioprepped
+@dataclass
+class LogSegmentBlock:
+    """A range of entries in a compressed log segment."""
+
+    start_time: Annotated[datetime.datetime, IOAttrs('s')]
+    end_time: Annotated[datetime.datetime, IOAttrs('e')]
+
+    # Byte range of this block's gzip member in the segment file.
+    offset: Annotated[int, IOAttrs('o')]
+    size: Annotated[int, IOAttrs('z')]
+
+    # Entry counts indexed by LogLevel value.
+    level_counts: Annotated[list[int], IOAttrs('l')]
+
+    @property
+    def entry_count(self) -> int:
+        """Total entries in the block."""
+        return sum(self.level_counts)
+
+
+@ioprepped
+@dataclass
+class LogSegmentIndex:
+    """Sidecar index for a compressed log segment."""
+
+    blocks: Annotated[list[LogSegmentBlock], IOAttrs('b')]
+
+    @property
+    def entry_count(self) -> int:
+        """Total entries in the segment."""
+        return sum(b.entry_count for b in self.blocks)
+
+
+class SegmentedLogSink(LogSink):
+    """Writes log entries to rolling, compressed segment files.
+
+    All calls except for construction should come from a single thread
+    (generally the efro.logging.LogHandler background thread). Writes
+    are buffered; call flush() to push them to disk.
+
+    Segments are rolled once they exceed 'max_segment_size' bytes or
+    are older than 'max_segment_age'. If 'max_segments' is given, the
+    oldest segments beyond that count (including the active one) are
+    deleted. Compressed segments are split into independently readable
+    blocks of roughly 'block_size' uncompressed bytes.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        *,
+        max_segment_size: int = 16 * 1024 * 1024,
+        max_segment_age: datetime.timedelta | None = datetime.timedelta(days=1),
+        max_segments: int | None = None,
+        block_size: int = 64 * 1024,
+    ) -> None:
+        assert max_segment_size > 0
+        assert max_segments is None or max_segments > 0
+        assert block_size > 0
+        self._path = Path(path)
+        self._max_segment_size = max_segment_size
+        self._max_segment_age = (
+            None if max_segment_age is None else max_segment_age.total_seconds()
+        )
+        self._max_segments = max_segments
+        self._block_size = block_size
+
+        # Closed segments are compressed/pruned here one at a time.
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='logsink'
+        )
+        self._pending: list[Future] = []
+
+        self._file: IO[bytes] | None = None
+        self._segment = 0
+        self._segment_size = 0
+        self._segment_start_time = 0.0
+
+        self._path.mkdir(parents=True, exist_ok=True)
+        segments = get_log_segments(self._path)
+        if segments:
+            self._segment = segments[-1] + 1
+
+        # Finish off anything left from earlier runs (crashes/etc.).
+        for segment in segments:
+            if (self._path / f'{segment}{_RAW_SUFFIX}').exists():
+                self._submit(
+                    _compress_segment, self._path, segment, self._block_size
+                )
+        self._submit_prune()
+
+    @override
+    def write(self, entry: LogEntry) -> None:
+        data = (dataclass_to_json(entry) + '\n').encode()
+        if self._file is not None and (
+            self._segment_size >= self._max_segment_size
+            or (
+                self._max_segment_age is not None
+                and time.monotonic() - self._segment_start_time
+                >= self._max_segment_age
+            )
+        ):
+            self._close_segment()
+        if self._file is None:
+            # pylint: disable=consider-using-with
+            self._file = open(
+                self._path / f'{self._segment}{_RAW_SUFFIX}', 'ab'
+            )
+            self._segment_size = 0
+            self._segment_start_time = time.monotonic()
+        self._file.write(data)
+        self._segment_size += len(data)
+
+    @override
+    def flush(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+
+    @override
+    def close(self) -> None:
+        """Close the active segment and wait for background work.
+
+        Errors in background work are printed to stderr rather than
+        raised.
+        """
+        if self._file is not None:
+            self._close_segment()
+        self._executor.shutdown()
+        for future in self._pending:
+            _report_error(future)
+        self._pending.clear()
+
+    def _close_segment(self) -> None:
+        assert self._file is not None
+        self._file.close()
+        self._file = None
+        self._submit(
+            _compress_segment, self._path, self._segment, self._block_size
+        )
+        self._segment += 1
+        self._submit_prune()
+
+    def _submit_prune(self) -> None:
+        if self._max_segments is not None:
+            self._submit(
+                _prune_segments,
+                self._path,
+                self._max_segments,
+                self._segment,
+            )
+
+    def _submit(self, call: Any, *args: Any) -> None:
+        pending: list[Future] = []
+        for future in self._pending:
+            if future.done():
+                _report_error(future)
+            else:
+                pending.append(future)
+        pending.append(self._executor.submit(call, *args))
+        self._pending = pending
+
+
+def _report_error(future: Future) -> None:
+    """Print any error from a finished background task.
+
+    We can't go through logging for this since we're likely running as
+    part of it.
+    """
+    import traceback
+
+    exc = future.exception()
+    if exc is not None:
+        print('Error in SegmentedLogSink background task:', file=sys.stderr)
+        traceback.print_exception(exc, file=sys.stderr)
+
+
+def get_log_segments(path: str | Path) -> list[int]:
+    """Return the numbers of all segments present in a directory."""
+    segments: set[int] = set()
+    for name in os.listdir(path):
+        number = name.split('.', 1)[0]
+        if number.isdigit() and (
+            name.endswith(_RAW_SUFFIX) or name.endswith(_COMPRESSED_SUFFIX)
+        ):
+            segments.add(int(number))
+    return sorted(segments)
+
+
+def _prune_segments(path: Path, max_segments: int, active: int) -> None:
+    # Note: the active segment may not exist on disk yet, but it counts.
+    old = [s for s in get_log_segments(path) if s < active]
+    for segment in old[: max(0, len(old) - (max_segments - 1))]:
+        for suffix in (_INDEX_SUFFIX, _COMPRESSED_SUFFIX, _RAW_SUFFIX):
+            try:
+                os.unlink(path / f'{segment}{suffix}')
+            except FileNotFoundError:
+                pass
+
+
+def _compress_segment(path: Path, segment: int, block_size: int) -> None:
+    """Compress a closed raw segment and write its index."""
+    # pylint: disable=too-many-locals
+    rawpath = path / f'{segment}{_RAW_SUFFIX}'
+    gzpath = path / f'{segment}{_COMPRESSED_SUFFIX}'
+    indexpath = path / f'{segment}{_INDEX_SUFFIX}'
+    with open(rawpath, 'rb') as infile:
+        lines = infile.read().split(b'\n')
+
+    # Decode everything up front, skipping anything unreadable (such as
+    # a partial line at the end from a crash).
+    items: list[tuple[bytes, LogEntry]] = []
+    for line in lines:
+        if not line:
+            continue
+        try:
+            items.append((line, dataclass_from_json(LogEntry, line.decode())))
+        except Exception:
+            pass
+
+    blocks: list[LogSegmentBlock] = []
+    with open(f'{gzpath}.tmp', 'wb') as outfile:
+        start = 0
+        while start < len(items):
+            end = start
+            size = 0
+            while end < len(items) and size < block_size:
+                size += len(items[end][0]) + 1
+                end += 1
+            block = items[start:end]
+            level_counts = [0] * len(LogLevel)
+            for _line, entry in block:
+                level_counts[entry.level.value] += 1
+            data = gzip.compress(b''.join(line + b'\n' for line, _ in block))
+            blocks.append(
+                LogSegmentBlock(
+                    start_time=min(entry.time for _, entry in block),
+                    end_time=max(entry.time for _, entry in block),
+                    offset=outfile.tell(),
+                    size=len(data),
+                    level_counts=level_counts,
+                )
+            )
+            outfile.write(data)
+            start = end
+
+    # Order matters here for readers: compressed data lands before its
+    # index, and the raw file only goes away once both are in place.
+    os.replace(f'{gzpath}.tmp', gzpath)
+    with open(f'{indexpath}.tmp', 'w', encoding='utf-8') as outfile:
+        outfile.write(dataclass_to_json(LogSegmentIndex(blocks=blocks)))
+    os.replace(f'{indexpath}.tmp', indexpath)
+    os.unlink(rawpath)
+
+
+def read_log_segments(
+    path: str | Path,
+    *,
+    start_time: datetime.datetime | None = None,
+    end_time: datetime.datetime | None = None,
+    min_level: LogLevel | None = None,
+) -> LogArchive:
+    """Read entries from a directory written by a SegmentedLogSink.
+
+    Returns entries with times in the range [start_time, end_time) and
+    levels at or above min_level. Compressed blocks that can't contain
+    any such entries are skipped without being decompressed. In the
+    returned archive, 'log_size' is the total number of entries stored
+    and 'start_index' is the position of the first returned entry among
+    them.
+    """
+    path = Path(path)
+    minlevel = 0 if min_level is None else min_level.value
+    entries: list[LogEntry] = []
+    position = 0
+    start_index: int | None = None
+
+    def _add(entry: LogEntry) -> None:
+        nonlocal position, start_index
+        if (
+            entry.level.value >= minlevel
+            and (start_time is None or entry.time >= start_time)
+            and (end_time is None or entry.time < end_time)
+        ):
+            if start_index is None:
+                start_index = position
+            entries.append(entry)
+        position += 1
+
+    for segment in get_log_segments(path):
+        index = _load_segment_index(path, segment)
+        if index is None:
+            # Active or not-yet-compressed segment; just scan it.
+            for line in _read_raw_segment(path, segment):
+                _add(dataclass_from_json(LogEntry, line.decode()))
+            continue
+
+        with open(path / f'{segment}{_COMPRESSED_SUFFIX}', 'rb') as infile:
+            for block in index.blocks:
+                if (
+                    sum(block.level_counts[minlevel:]) == 0
+                    or (start_time is not None and block.end_time < start_time)
+                    or (end_time is not None and block.start_time >= end_time)
+                ):
+                    position += block.entry_count
+                    continue
+                infile.seek(block.offset)
+                for line in gzip.decompress(infile.read(block.size)).split(
+                    b'\n'
+                ):
+                    if line:
+                        _add(dataclass_from_json(LogEntry, line.decode()))
+
+    return LogArchive(
+        log_size=position,
+        start_index=position if start_index is None else start_index,
+        entries=entries,
+    )
+
+
+def _load_segment_index(path: Path, segment: int) -> LogSegmentIndex | None:
+    try:
+        with open(
+            path / f'{segment}{_INDEX_SUFFIX}', encoding='utf-8'
+        ) as infile:
+            return dataclass_from_json(LogSegmentIndex, infile.read())
+    except FileNotFoundError:
+        return None
+
+
+def _read_raw_segment(path: Path, segment: int) -> list[bytes]:
+    try:
+        with open(path / f'{segment}{_RAW_SUFFIX}', 'rb') as infile:
+            data = infile.read()
+    except FileNotFoundError:
+        # It may have just been compressed (or pruned).
+        index = _load_segment_index(path, segment)
+        if index is None:
+            return []
+        with open(path / f'{segment}{_COMPRESSED_SUFFIX}', 'rb') as infile:
+            data = b''.join(
+                gzip.decompress(infile.read(block.size))
+                for block in index.blocks
+            )
+
+    # Ignore any partially written line at the end.
+    return data.split(b'\n')[:-1]
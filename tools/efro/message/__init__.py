@@ -11,12 +11,21 @@ from efro.message._protocol import MessageProtocol
 from efro.message._sender import MessageSender, BoundMessageSender
 from efro.message._receiver import MessageReceiver, BoundMessageReceiver
 from efro.message._module import create_sender_module, create_receiver_module
+from efro.message._metrics import (
+    MessageMetrics,
+    MessageMetricsSnapshot,
+    MessageTypeMetrics,
+    MessageHistogram,
+)
 from efro.message._message import (
     Message,
     Response,
+    SysMessage,
     SysResponse,
     EmptySysResponse,
     ErrorSysResponse,
+    BatchSysMessage,
+    BatchSysResponse,
     StringResponse,
     BoolResponse,
     UnregisteredMessageIDError,
@@ -25,9 +34,12 @@ from efro.message._message import (
 __all__ = [
     'Message',
     'Response',
+    'SysMessage',
     'SysResponse',
     'EmptySysResponse',
     'ErrorSysResponse',
+    'BatchSysMessage',
+    'BatchSysResponse',
     'StringResponse',
     'BoolResponse',
     'MessageProtocol',
@@ -37,6 +49,10 @@ __all__ = [
     'BoundMessageReceiver',
     'create_sender_module',
     'create_receiver_module',
+    'MessageMetrics',
+    'MessageMetricsSnapshot',
+    'MessageTypeMetrics',
+    'MessageHistogram',
     'UnregisteredMessageIDError',
 ]
 
@@ -36,6 +36,14 @@ class Response:
     """Base class for responses to messages."""
 
 
+class SysMessage:
+    """Base class for system-messages.
+
+    These are only sent/handled by the messaging system itself;
+    users of the api never see them.
+    """
+
+
 class SysResponse:
     """Base class for system-responses to messages.
 
@@ -88,6 +96,30 @@ class EmptySysResponse(SysResponse):
     """The response equivalent of None."""
 
 
+@ioprepped
+@dataclass
+class BatchSysMessage(SysMessage):
+    """SysMessage carrying a number of encoded messages in one send.
+
+    Each entry is the full dict for a message (type id included) and
+    each gets its own entry in the resulting BatchSysResponse.
+    """
+
+    messages: Annotated[list[dict], IOAttrs('m')]
+
+
+@ioprepped
+@dataclass
+class BatchSysResponse(SysResponse):
+    """SysResponse for a BatchSysMessage.
+
+    Contains one encoded response dict (a regular response or a
+    SysResponse such as an error) per message, in order.
+    """
+
+    responses: Annotated[list[dict], IOAttrs('r')]
+
+
 # TODO: could allow handlers to deal in raw values for these
 # types similar to how we allow None in place of EmptySysResponse.
 # Though not sure if they are widely used enough to warrant the
@@ -0,0 +1,291 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Per-message-type metrics for efro.message."""
+
+from __future__ import annotations
+
+import copy
+import time
+import logging
+import datetime
+import threading
+from dataclasses import dataclass, field
+from typing import Annotated
+
+from efro.util import utc_now
+from efro.dataclassio import ioprepped, IOAttrs, dataclass_to_json
+
+# Histograms use power-of-two buckets; bucket n holds values in the
+# range [2**(n-1), 2**n) and bucket 0 holds zero values. Anything past
+# the last bucket gets lumped into it.
+HISTOGRAM_BUCKET_COUNT = 40
+
+# Log label applied to snapshots sent through logging.
+METRICS_LOG_LABEL = 'efro.message.metrics'
+
+# Key used for messages that could not be decoded at all.
+UNKNOWN_TYPE_NAME = '<unknown>'
+
+
+def _empty_buckets() -> list[int]:
+    return [0] * HISTOGRAM_BUCKET_COUNT
+
+
+@ioprepped
+@dataclass
+class MessageHistogram:
+    """A fixed-size log-bucketed histogram of int values.
+
+    Used for byte sizes and for times in microseconds.
+    """
+
+    count: Annotated[int, IOAttrs('c')] = 0
+    total: Annotated[int, IOAttrs('t')] = 0
+    max: Annotated[int, IOAttrs('x')] = 0
+    buckets: Annotated[list[int], IOAttrs('b')] = field(
+        default_factory=_empty_buckets
+    )
+
+    def add(self, value: int) -> None:
+        """Add a value to the histogram."""
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.buckets[min(value.bit_length(), HISTOGRAM_BUCKET_COUNT - 1)] += 1
+
+    def merge(self, other: MessageHistogram) -> None:
+        """Add all values from another histogram to this one."""
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for i, val in enumerate(other.buckets):
+            self.buckets[i] += val
+
+    @property
+    def mean(self) -> float:
+        """The mean value (0.0 for empty histograms)."""
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction: float) -> int:
+        """Return an upper bound for a percentile value (0.0-1.0).
+
+        This is the top of the bucket containing the value, so it is
+        accurate to within a factor of two (and never above max).
+        """
+        if not 0.0 <= fraction <= 1.0:
+            raise ValueError(f'Invalid fraction {fraction}.')
+        if not self.count:
+            return 0
+        target = max(1, round(self.count * fraction))
+        seen = 0
+        for i, val in enumerate(self.buckets):
+            seen += val
+            if seen >= target:
+                return min((1 << i) - 1, self.max)
+        return self.max
+
+
+@ioprepped
+@dataclass
+class MessageTypeMetrics:
+    """Metrics for a single message type in one direction.
+
+    Byte sizes are for encoded messages and responses; they are not
+    recorded for messages within batches. Times are in microseconds.
+    For sent messages, 'handle_time' is the time spent waiting for a
+    response (so includes transport and remote handling); for received
+    messages it is the time spent in the handler.
+    """
+
+    count: Annotated[int, IOAttrs('c')] = 0
+    errors: Annotated[int, IOAttrs('e')] = 0
+    message_bytes: Annotated[MessageHistogram, IOAttrs('mb')] = field(
+        default_factory=MessageHistogram
+    )
+    response_bytes: Annotated[MessageHistogram, IOAttrs('rb')] = field(
+        default_factory=MessageHistogram
+    )
+    encode_time: Annotated[MessageHistogram, IOAttrs('et')] = field(
+        default_factory=MessageHistogram
+    )
+    decode_time: Annotated[MessageHistogram, IOAttrs('dt')] = field(
+        default_factory=MessageHistogram
+    )
+    handle_time: Annotated[MessageHistogram, IOAttrs('ht')] = field(
+        default_factory=MessageHistogram
+    )
+
+    def merge(self, other: MessageTypeMetrics) -> None:
+        """Add all values from another instance to this one."""
+        self.count += other.count
+        self.errors += other.errors
+        self.message_bytes.merge(other.message_bytes)
+        self.response_bytes.merge(other.response_bytes)
+        self.encode_time.merge(other.encode_time)
+        self.decode_time.merge(other.decode_time)
+        self.handle_time.merge(other.handle_time)
+
+
+@ioprepped
+@dataclass
+class MessageMetricsSnapshot:
+    """Metrics for all message types over a span of time.
+
+    Types are keyed by their full module/qualname.
+    """
+
+    start_time: Annotated[datetime.datetime, IOAttrs('s')]
+    end_time: Annotated[datetime.datetime, IOAttrs('e')]
+    sent: Annotated[
+        dict[str, MessageTypeMetrics], IOAttrs('sn', store_default=False)
+    ] = field(default_factory=dict)
+    received: Annotated[
+        dict[str, MessageTypeMetrics], IOAttrs('rc', store_default=False)
+    ] = field(default_factory=dict)
+
+
+class MetricsRecord:
+    """Measurements for a single message as it is sent or received.
+
+    These are created by senders/receivers only when metrics are
+    enabled and submitted to a MessageMetrics instance when done. Times
+    are measured in laps; each call to lap() returns the time since the
+    previous one (or since creation).
+    """
+
+    __slots__ = [
+        'metrics',
+        'msgtype',
+        'message_bytes',
+        'response_bytes',
+        'encode_time',
+        'decode_time',
+        'handle_time',
+        'error',
+        '_mark',
+    ]
+
+    def __init__(self, metrics: MessageMetrics) -> None:
+        self.metrics = metrics
+        self.msgtype: type | None = None
+        self.message_bytes: int | None = None
+        self.response_bytes: int | None = None
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+        self.handle_time = 0.0
+        self.error = False
+        self._mark = time.perf_counter()
+
+    def lap(self) -> float:
+        """Return the time since the last lap and start a new one."""
+        now = time.perf_counter()
+        elapsed = now - self._mark
+        self._mark = now
+        return elapsed
+
+
+class MessageMetrics:
+    """Collects per-message-type metrics.
+
+    An instance can be assigned to a MessageProtocol's 'metrics'
+    attribute to collect metrics for all senders and receivers using
+    that protocol, or to individual MessageSender/MessageReceiver
+    'metrics' attributes. Memory use is fixed per message type no
+    matter how many messages are recorded. This is thread-safe.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._start_time = utc_now()
+        self._sent: dict[type | None, MessageTypeMetrics] = {}
+        self._received: dict[type | None, MessageTypeMetrics] = {}
+
+    def record_sent(self, record: MetricsRecord) -> None:
+        """Add measurements for a sent message."""
+        self._record(True, record)
+
+    def record_received(self, record: MetricsRecord) -> None:
+        """Add measurements for a received message."""
+        self._record(False, record)
+
+    def _record(self, sent: bool, rec: MetricsRecord) -> None:
+        with self._lock:
+            stats = self._sent if sent else self._received
+            entry = stats.get(rec.msgtype)
+            if entry is None:
+                entry = stats[rec.msgtype] = MessageTypeMetrics()
+            entry.count += 1
+            if rec.error:
+                entry.errors += 1
+            if rec.message_bytes is not None:
+                entry.message_bytes.add(rec.message_bytes)
+            if rec.response_bytes is not None:
+                entry.response_bytes.add(rec.response_bytes)
+            entry.encode_time.add(round(rec.encode_time * 1000000.0))
+            entry.decode_time.add(round(rec.decode_time * 1000000.0))
+            entry.handle_time.add(round(rec.handle_time * 1000000.0))
+
+    def get_snapshot(self, reset: bool = False) -> MessageMetricsSnapshot:
+        """Return the metrics recorded so far.
+
+        If 'reset' is True, metrics are cleared and the next snapshot
+        will cover only the time after this one.
+        """
+        with self._lock:
+            now = utc_now()
+            snapshot = MessageMetricsSnapshot(
+                start_time=self._start_time,
+                end_time=now,
+                sent=_by_name(self._sent),
+                received=_by_name(self._received),
+            )
+            if reset:
+                self._start_time = now
+                self._sent = {}
+                self._received = {}
+            else:
+                snapshot = copy.deepcopy(snapshot)
+        return snapshot
+
+    def log_snapshot(
+        self,
+        logger: logging.Logger | None = None,
+        level: int = logging.INFO,
+        reset: bool = True,
+    ) -> None:
+        """Log a snapshot as json.
+
+        The log entry is labeled for easy filtering (see
+        efro.logging.LogEntry.labels) so that metrics can be shipped
+        wherever logs go and pulled back out later with
+        dataclass_from_json(MessageMetricsSnapshot, entry.message).
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        if not logger.isEnabledFor(level):
+            return
+        logger.log(
+            level,
+            dataclass_to_json(self.get_snapshot(reset=reset)),
+            extra={'labels': {'type': METRICS_LOG_LABEL}},
+        )
+
+
+def _by_name(
+    stats: dict[type | None, MessageTypeMetrics],
+) -> dict[str, MessageTypeMetrics]:
+    out: dict[str, MessageTypeMetrics] = {}
+    for msgtype, entry in stats.items():
+        name = (
+            UNKNOWN_TYPE_NAME
+            if msgtype is None
+            else f'{msgtype.__module__}.{msgtype.__qualname__}'
+        )
+        # Types with matching names (reloaded modules, etc.) get merged.
+        existing = out.get(name)
+        if existing is None:
+            out[name] = entry
+        else:
+            existing = out[name] = copy.deepcopy(existing)
+            existing.merge(entry)
+    return out
@@ -23,6 +23,7 @@ def create_sender_module(
     private: bool = False,
     protocol_module_level_import_code: str | None = None,
     build_time_protocol_create_code: str | None = None,
+    precompile: bool = False,
 ) -> str:
     """Create a Python module defining a MessageSender subclass.
 
@@ -39,6 +40,10 @@ def create_sender_module(
 
     If 'private' is True, class-names will be prefixed with an '_'.
 
+    If 'precompile' is True, the sender will compile its protocol's
+    encoders/decoders when instantiated instead of as each type is
+    first used (see MessageProtocol.compile()).
+
     Note: output code may have long lines and should generally be run
     through a formatter. We should perhaps move this functionality to
     efrotools so we can include that functionality inline.
@@ -55,6 +60,7 @@ def create_sender_module(
         enable_async_sends=enable_async_sends,
         private=private,
         protocol_module_level_import_code=protocol_module_level_import_code,
+        precompile=precompile,
     )
 
 
@@ -66,6 +72,7 @@ def create_receiver_module(
     private: bool = False,
     protocol_module_level_import_code: str | None = None,
     build_time_protocol_create_code: str | None = None,
+    precompile: bool = False,
 ) -> str:
     """ "Create a Python module defining a MessageReceiver subclass.
 
@@ -81,6 +88,12 @@ def create_receiver_module(
 
     If 'private' is True, class-names will be prefixed with an '_'.
 
+    If 'precompile' is True, the receiver will compile its protocol's
+    encoders/decoders when instantiated instead of as each type is
+    first used (see MessageProtocol.compile()). Its handler dispatch
+    table is still built when the first message arrives, since
+    handlers are registered after instantiation.
+
     Note that line lengths are not clipped, so output may need to be
     run through a formatter to prevent lint warnings about excessive
     line lengths.
@@ -96,6 +109,7 @@ def create_receiver_module(
         is_async=is_async,
         private=private,
         protocol_module_level_import_code=protocol_module_level_import_code,
+        precompile=precompile,
     )
 
 
@@ -13,20 +13,25 @@ import json
 from efro.error import CleanError, CommunicationError
 from efro.dataclassio import (
     is_ioprepped_dataclass,
-    dataclass_to_dict,
-    dataclass_from_dict,
+    dataclass_dict_encoder,
+    dataclass_dict_decoder,
 )
 from efro.message._message import (
     Message,
     Response,
+    SysMessage,
     SysResponse,
     ErrorSysResponse,
     EmptySysResponse,
+    BatchSysMessage,
+    BatchSysResponse,
     UnregisteredMessageIDError,
 )
 
 if TYPE_CHECKING:
-    from typing import Any, Literal
+    from typing import Any, Literal, Callable
+
+    from efro.message._metrics import MessageMetrics
 
 
 class MessageProtocol:
@@ -48,6 +53,7 @@ class MessageProtocol:
         remote_errors_include_stack_traces: bool = False,
         log_errors_on_receiver: bool = True,
         log_response_decode_errors: bool = True,
+        metrics: MessageMetrics | None = None,
     ) -> None:
         """Create a protocol with a given configuration.
 
@@ -95,8 +101,15 @@ class MessageProtocol:
         meaning serious protocol breakage could go unnoticed. To avoid
         this, a log message is also printed in such cases. Pass
         'log_response_decode_errors' as False to disable this logging.
+
+        If 'metrics' is passed (or assigned to the 'metrics' attr later),
+        all senders and receivers using this protocol will record
+        per-message-type counts, sizes, and timings to it. Senders and
+        receivers can also be given their own metrics instances which
+        take precedence.
         """
         # pylint: disable=too-many-locals
+        # pylint: disable=too-many-statements
         self.message_types_by_id: dict[int, type[Message]] = {}
         self.message_ids_by_type: dict[type[Message], int] = {}
         self.response_types_by_id: dict[
@@ -136,6 +149,16 @@ class MessageProtocol:
 
         _reg_sys(ErrorSysResponse, -1)
         _reg_sys(EmptySysResponse, -2)
+        _reg_sys(BatchSysResponse, -3)
+
+        # SysMessage types get negative IDs too (though they don't
+        # live in message_types_by_id since users never see them).
+        self.sys_message_types_by_id: dict[int, type[SysMessage]] = {
+            -1: BatchSysMessage
+        }
+        self.sys_message_ids_by_type: dict[type[SysMessage], int] = {
+            BatchSysMessage: -1
+        }
 
         # Some extra-thorough validation in debug mode.
         if __debug__:
@@ -180,19 +203,115 @@ class MessageProtocol:
         )
         self.log_errors_on_receiver = log_errors_on_receiver
         self.log_response_decode_errors = log_response_decode_errors
+        self.metrics = metrics
+
+        # Per-type encode calls and per-id decode calls; filled in on
+        # first use or all at once by compile().
+        self._message_encoders: dict[type, Callable[[Any], dict]] = {}
+        self._response_encoders: dict[type, Callable[[Any], dict]] = {}
+        self._message_decoders: dict[int, Callable[[dict], Any]] = {}
+        self._response_decoders: dict[int, Callable[[dict], Any]] = {}
+        self._sys_message_encoders: dict[type, Callable[[Any], dict]] = {}
+        self._sys_message_decoders: dict[int, Callable[[dict], Any]] = {}
+        self._compiled = False
+
+    def compile(self) -> None:
+        """Build encoders and decoders for all registered types.
+
+        These are otherwise built as each type is first encountered.
+        Compiling up front avoids that cost on first messages and
+        surfaces any problems with types at startup. This is safe to
+        call multiple times.
+        """
+        if self._compiled:
+            return
+        for m_type in self.message_ids_by_type:
+            self._get_encoder(
+                m_type, self.message_ids_by_type, self._message_encoders, ''
+            )
+        for r_type in self.response_ids_by_type:
+            self._get_encoder(
+                r_type, self.response_ids_by_type, self._response_encoders, ''
+            )
+        for m_id in self.message_types_by_id:
+            self.get_message_decoder(m_id)
+        for r_id in self.response_types_by_id:
+            self._get_decoder(
+                r_id, self.response_types_by_id, self._response_decoders, ''
+            )
+        for s_type, s_id in self.sys_message_ids_by_type.items():
+            self._get_encoder(
+                s_type,
+                self.sys_message_ids_by_type,
+                self._sys_message_encoders,
+                '',
+            )
+            self._get_decoder(
+                s_id,
+                self.sys_message_types_by_id,
+                self._sys_message_decoders,
+                '',
+            )
+        self._compiled = True
+
+    def get_message_decoder(self, message_id: int) -> Callable[[dict], Any]:
+        """Return a call decoding a message's 'm' dict for an id.
+
+        Raises UnregisteredMessageIDError for ids not in the protocol.
+        """
+        decoder = self._message_decoders.get(message_id)
+        if decoder is None:
+            decoder = self._get_decoder(
+                message_id,
+                self.message_types_by_id,
+                self._message_decoders,
+                'message',
+            )
+        return decoder
+
+    # Skip per-call arg processing in json.dumps().
+    _json_encode = json.JSONEncoder(separators=(',', ':')).encode
 
     @staticmethod
     def encode_dict(obj: dict) -> str:
         """Json-encode a provided dict."""
-        return json.dumps(obj, separators=(',', ':'))
+        return MessageProtocol._json_encode(obj)
 
     def message_to_dict(self, message: Message) -> dict:
         """Encode a message to a json ready dict."""
-        return self._to_dict(message, self.message_ids_by_type, 'message')
+        encoder = self._message_encoders.get(type(message))
+        if encoder is None:
+            encoder = self._get_encoder(
+                type(message),
+                self.message_ids_by_type,
+                self._message_encoders,
+                'message',
+            )
+        return encoder(message)
 
     def response_to_dict(self, response: Response | SysResponse) -> dict:
         """Encode a response to a json ready dict."""
-        return self._to_dict(response, self.response_ids_by_type, 'response')
+        encoder = self._response_encoders.get(type(response))
+        if encoder is None:
+            encoder = self._get_encoder(
+                type(response),
+                self.response_ids_by_type,
+                self._response_encoders,
+                'response',
+            )
+        return encoder(response)
+
+    def sys_message_to_dict(self, message: SysMessage) -> dict:
+        """Encode a system-message to a json ready dict."""
+        encoder = self._sys_message_encoders.get(type(message))
+        if encoder is None:
+            encoder = self._get_encoder(
+                type(message),
+                self.sys_message_ids_by_type,
+                self._sys_message_encoders,
+                'sys-message',
+            )
+        return encoder(message)
 
     def error_to_response(self, exc: Exception) -> tuple[SysResponse, bool]:
         """Translate an Exception to a SysResponse.
@@ -240,43 +359,78 @@ class MessageProtocol:
             self.log_errors_on_receiver,
         )
 
-    def _to_dict(
-        self, message: Any, ids_by_type: dict[type, int], opname: str
-    ) -> dict:
-        """Encode a message to a json string for transport."""
-
-        m_id: int | None = ids_by_type.get(type(message))
+    @staticmethod
+    def _get_encoder(
+        tp: type,
+        ids_by_type: dict[type, int],
+        encoders: dict[type, Callable[[Any], dict]],
+        opname: str,
+    ) -> Callable[[Any], dict]:
+        m_id: int | None = ids_by_type.get(tp)
         if m_id is None:
             raise TypeError(
-                f'{opname} type is not registered in protocol:'
-                f' {type(message)}'
+                f'{opname} type is not registered in protocol: {tp}'
             )
-        out = {'t': m_id, 'm': dataclass_to_dict(message)}
-        return out
+        encode = dataclass_dict_encoder(tp)
+
+        def _encode(message: Any) -> dict:
+            return {'t': m_id, 'm': encode(message)}
+
+        encoders[tp] = _encode
+        return _encode
 
     @staticmethod
-    def decode_dict(data: str) -> dict:
-        """Decode data to a dict."""
+    def decode_dict(data: str | bytes | memoryview) -> dict:
+        """Decode data to a dict.
+
+        Bytes input is passed to the json decoder as-is (it handles
+        utf-8 itself) so callers holding raw data don't need to decode
+        it to a str first. Memoryviews need to be copied to bytes.
+        """
+        if isinstance(data, memoryview):
+            data = data.tobytes()
         out = json.loads(data)
         assert isinstance(out, dict)
         return out
 
     def message_from_dict(self, data: dict) -> Message:
         """Decode a message from a dict."""
-        out = self._from_dict(data, self.message_types_by_id, 'message')
+        out = self._from_dict(
+            data, self.message_types_by_id, self._message_decoders, 'message'
+        )
         assert isinstance(out, Message)
         return out
 
     def response_from_dict(self, data: dict) -> Response | SysResponse:
         """Decode a response from a json string."""
-        out = self._from_dict(data, self.response_types_by_id, 'response')
+        out = self._from_dict(
+            data,
+            self.response_types_by_id,
+            self._response_decoders,
+            'response',
+        )
         assert isinstance(out, Response | SysResponse)
         return out
 
+    def sys_message_from_dict(self, data: dict) -> SysMessage:
+        """Decode a system-message from a dict."""
+        out = self._from_dict(
+            data,
+            self.sys_message_types_by_id,
+            self._sys_message_decoders,
+            'sys-message',
+        )
+        assert isinstance(out, SysMessage)
+        return out
+
     # Weeeird; we get mypy errors returning dict[int, type] but
     # dict[int, typing.Type] or dict[int, type[Any]] works..
     def _from_dict(
-        self, data: dict, types_by_id: dict[int, type[Any]], opname: str
+        self,
+        data: dict,
+        types_by_id: dict[int, type[Any]],
+        decoders: dict[int, Callable[[dict], Any]],
+        opname: str,
     ) -> Any:
         """Decode a message from a json string."""
         msgdict: dict | None
@@ -288,7 +442,18 @@ class MessageProtocol:
         assert isinstance(m_id, int)
         assert isinstance(msgdict, dict)
 
-        # Decode this particular type.
+        decoder = decoders.get(m_id)
+        if decoder is None:
+            decoder = self._get_decoder(m_id, types_by_id, decoders, opname)
+        return decoder(msgdict)
+
+    @staticmethod
+    def _get_decoder(
+        m_id: int,
+        types_by_id: dict[int, type[Any]],
+        decoders: dict[int, Callable[[dict], Any]],
+        opname: str,
+    ) -> Callable[[dict], Any]:
         msgtype = types_by_id.get(m_id)
         if msgtype is None:
             raise UnregisteredMessageIDError(
@@ -301,7 +466,9 @@ class MessageProtocol:
         # enums/multitype data. Be aware that this flags the object as
         # 'lossy' however which prevents it from being reserialized by
         # default.
-        return dataclass_from_dict(msgtype, msgdict, lossy=True)
+        decoder = dataclass_dict_decoder(msgtype, lossy=True)
+        decoders[m_id] = decoder
+        return decoder
 
     def _get_module_header(
         self,
@@ -332,7 +499,7 @@ class MessageProtocol:
             rsptypes.append(Response)
         for rsp_tp in rsptypes:
             # Skip these as they don't actually show up in code.
-            if rsp_tp is EmptySysResponse or rsp_tp is ErrorSysResponse:
+            if issubclass(rsp_tp, SysResponse):
                 continue
             if (
                 single_message_type
@@ -430,6 +597,7 @@ class MessageProtocol:
         enable_async_sends: bool,
         private: bool = False,
         protocol_module_level_import_code: str | None = None,
+        precompile: bool = False,
     ) -> str:
         """Used by create_sender_module(); do not call directly."""
         # pylint: disable=too-many-positional-arguments
@@ -446,6 +614,7 @@ class MessageProtocol:
             enable_async_sends=enable_async_sends,
         )
         ccind = textwrap.indent(protocol_create_code, '        ')
+        compile_line = '        self.protocol.compile()\n' if precompile else ''
         out += (
             f'class {ppre}{basename}(MessageSender):\n'
             f'    """Protocol-specific sender."""\n'
@@ -453,6 +622,7 @@ class MessageProtocol:
             f'    def __init__(self) -> None:\n'
             f'{ccind}\n'
             f'        super().__init__(protocol)\n'
+            f'{compile_line}'
             f'\n'
             f'    def __get__(\n'
             f'        self, obj: Any, type_in: Any = None\n'
@@ -547,6 +717,7 @@ class MessageProtocol:
         is_async: bool,
         private: bool = False,
         protocol_module_level_import_code: str | None = None,
+        precompile: bool = False,
     ) -> str:
         """Used by create_receiver_module(); do not call directly."""
         # pylint: disable=too-many-locals
@@ -562,6 +733,7 @@ class MessageProtocol:
             enable_async_sends=False,
         )
         ccind = textwrap.indent(protocol_create_code, '        ')
+        compile_line = '        self.protocol.compile()\n' if precompile else ''
         out += (
             f'class {ppre}{basename}(MessageReceiver):\n'
             f'    """Protocol-specific {desc} receiver."""\n'
@@ -571,6 +743,7 @@ class MessageProtocol:
             f'    def __init__(self) -> None:\n'
             f'{ccind}\n'
             f'        super().__init__(protocol)\n'
+            f'{compile_line}'
             f'\n'
             f'    def __get__(\n'
             f'        self,\n'
@@ -652,7 +825,9 @@ class MessageProtocol:
             out += (
                 '\n'
                 '    def handle_raw_message(\n'
-                '        self, message: str, raise_unregistered: bool = False\n'
+                '        self,\n'
+                '        message: str | bytes | memoryview,\n'
+                '        raise_unregistered: bool = False,\n'
                 '    ) -> Awaitable[str]:\n'
                 '        """Asynchronously handle a raw incoming message."""\n'
                 '        return self._receiver.'
@@ -665,7 +840,9 @@ class MessageProtocol:
             out += (
                 '\n'
                 '    def handle_raw_message(\n'
-                '        self, message: str, raise_unregistered: bool = False\n'
+                '        self,\n'
+                '        message: str | bytes | memoryview,\n'
+                '        raise_unregistered: bool = False,\n'
                 '    ) -> str:\n'
                 '        """Synchronously handle a raw incoming message."""\n'
                 '        return self._receiver.handle_raw_message(\n'
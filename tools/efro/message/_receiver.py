@@ -7,6 +7,7 @@ Supports static typing for message types and possible return types.
 from __future__ import annotations
 
 import types
+import asyncio
 import inspect
 import logging
 from typing import TYPE_CHECKING
@@ -15,14 +16,18 @@ from efro.message._message import (
     Message,
     Response,
     EmptySysResponse,
+    BatchSysMessage,
+    BatchSysResponse,
     UnregisteredMessageIDError,
 )
+from efro.message._metrics import MetricsRecord
 
 if TYPE_CHECKING:
     from typing import Any, Callable, Awaitable
 
     from efro.message._protocol import MessageProtocol
     from efro.message._message import SysResponse
+    from efro.message._metrics import MessageMetrics
 
 
 class MessageReceiver:
@@ -64,6 +69,15 @@ class MessageReceiver:
             | None
         ) = None
 
+        # Message ids mapped to decoders and handlers; built on demand.
+        self._dispatch: (
+            dict[int, tuple[Callable[[dict], Any], Callable]] | None
+        ) = None
+
+        # If set, received messages are recorded here (instead of to
+        # our protocol's metrics, if any).
+        self.metrics: MessageMetrics | None = None
+
     # noinspection PyProtectedMember
     def register_handler(
         self, call: Callable[[Any, Message], Response | None]
@@ -161,6 +175,28 @@ class MessageReceiver:
 
         # Ok; we're good!
         self._handlers[msgtype] = call
+        self._dispatch = None
+
+    def compile(self) -> None:
+        """Build our dispatch table and compile our protocol.
+
+        This binds each handled message id directly to a prebuilt
+        decoder and its handler so incoming messages skip all per-type
+        lookups. It happens automatically when the first message comes
+        in; calling it explicitly (after registering handlers) just
+        moves that work up front.
+        """
+        protocol = self.protocol
+        protocol.compile()
+        self._dispatch = {
+            protocol.message_ids_by_type[msgtype]: (
+                protocol.get_message_decoder(
+                    protocol.message_ids_by_type[msgtype]
+                ),
+                handler,
+            )
+            for msgtype, handler in self._handlers.items()
+        }
 
     def decode_filter_method(
         self, call: Callable[[Any, dict, Message], None]
@@ -205,28 +241,52 @@ class MessageReceiver:
                 else:
                     raise TypeError(msg)
 
-    def _decode_incoming_message_base(
-        self, bound_obj: Any, msg: str
-    ) -> tuple[Any, dict, Message]:
-        # Decode the incoming message.
-        msg_dict = self.protocol.decode_dict(msg)
-        msg_decoded = self.protocol.message_from_dict(msg_dict)
-        assert isinstance(msg_decoded, Message)
+    def _dispatch_incoming_message(
+        self, bound_obj: Any, msg_dict: dict
+    ) -> tuple[Message, Callable | None]:
+        """Decode an incoming message dict and look up its handler."""
+        dispatch = self._dispatch
+        if dispatch is None:
+            self.compile()
+            dispatch = self._dispatch
+            assert dispatch is not None
+
+        entry = dispatch.get(msg_dict.get('t'))  # type: ignore[arg-type]
+        handler: Callable | None
+        if entry is None:
+            # Not something we handle. Go through the regular path so we
+            # get an UnregisteredMessageIDError or a decoded message to
+            # include in our error.
+            msg_decoded = self.protocol.message_from_dict(msg_dict)
+            handler = None
+        else:
+            decoder, handler = entry
+            # Allow omitting 'm' dict if its empty.
+            msgdict = msg_dict.get('m', {})
+            assert isinstance(msgdict, dict)
+            msg_decoded = decoder(msgdict)
+            assert isinstance(msg_decoded, Message)
         if self._decode_filter_call is not None:
             self._decode_filter_call(bound_obj, msg_dict, msg_decoded)
-        return bound_obj, msg_dict, msg_decoded
+        return msg_decoded, handler
 
-    def _decode_incoming_message(self, bound_obj: Any, msg: str) -> Message:
-        bound_obj, _msg_dict, msg_decoded = self._decode_incoming_message_base(
-            bound_obj=bound_obj, msg=msg
-        )
-        return msg_decoded
+    def _decode_batch(self, msg_dict: dict) -> BatchSysMessage:
+        sysmsg = self.protocol.sys_message_from_dict(msg_dict)
+        if not isinstance(sysmsg, BatchSysMessage):
+            raise TypeError(f'Unsupported sys-message: {type(sysmsg)}.')
+        return sysmsg
 
     def encode_user_response(
         self, bound_obj: Any, message: Message, response: Response | None
     ) -> str:
         """Encode a response provided by the user for sending."""
+        return self.protocol.encode_dict(
+            self._encode_user_response_dict(bound_obj, message, response)
+        )
 
+    def _encode_user_response_dict(
+        self, bound_obj: Any, message: Message, response: Response | None
+    ) -> dict:
         assert isinstance(response, Response | None)
         # (user should never explicitly return error-responses)
         assert (
@@ -245,72 +305,204 @@ class MessageReceiver:
             self._encode_filter_call(
                 bound_obj, message, out_response, response_dict
             )
-        return self.protocol.encode_dict(response_dict)
+        return response_dict
 
     def encode_error_response(
         self, bound_obj: Any, message: Message | None, exc: Exception
     ) -> tuple[str, bool]:
         """Given an error, return sysresponse str and whether to log."""
+        response_dict, dolog = self._encode_error_response_dict(
+            bound_obj, message, exc
+        )
+        return self.protocol.encode_dict(response_dict), dolog
+
+    def _encode_error_response_dict(
+        self, bound_obj: Any, message: Message | None, exc: Exception
+    ) -> tuple[dict, bool]:
         response, dolog = self.protocol.error_to_response(exc)
         response_dict = self.protocol.response_to_dict(response)
         if self._encode_filter_call is not None:
             self._encode_filter_call(
                 bound_obj, message, response, response_dict
             )
-        return self.protocol.encode_dict(response_dict), dolog
+        return response_dict, dolog
+
+    def _handle_error(
+        self,
+        bound_obj: Any,
+        msg_raw: Any,
+        msg_decoded: Message | None,
+        exc: Exception,
+    ) -> dict:
+        """Return an error response dict for an exception (and log it)."""
+        response_dict, dolog = self._encode_error_response_dict(
+            bound_obj, msg_decoded, exc
+        )
+        if dolog:
+            # Note: we need to explicitly provide the exception here
+            # since we may not be in its except clause (async stuff,
+            # etc.).
+            if msg_decoded is not None:
+                msgtype = type(msg_decoded)
+                logging.exception(
+                    'Error handling %s.%s message.',
+                    msgtype.__module__,
+                    msgtype.__qualname__,
+                    exc_info=exc,
+                )
+            else:
+                logging.exception(
+                    'Error handling raw %sefro.message'
+                    ' (likely a message format incompatibility): %s.',
+                    'async ' if self.is_async else '',
+                    msg_raw,
+                    exc_info=exc,
+                )
+        return response_dict
 
     def handle_raw_message(
-        self, bound_obj: Any, msg: str, raise_unregistered: bool = False
+        self,
+        bound_obj: Any,
+        msg: str | bytes | memoryview,
+        raise_unregistered: bool = False,
     ) -> str:
         """Decode, handle, and return an response for a message.
 
+        Raw messages can be passed as str or as utf-8 bytes.
+
         if 'raise_unregistered' is True, will raise an
         efro.message.UnregisteredMessageIDError for messages not handled by
         the protocol. In all other cases local errors will translate to
-        error responses returned to the sender.
+        error responses returned to the sender. Note that this does not
+        apply to individual messages within batches (see
+        MessageSender.send_batch_async()); those always get error
+        responses.
         """
         assert not self.is_async, "can't call sync handler on async receiver"
+        metrics = self._get_metrics()
+        rec = None if metrics is None else MetricsRecord(metrics)
+        try:
+            msg_dict = self.protocol.decode_dict(msg)
+            if msg_dict.get('t') in self.protocol.sys_message_types_by_id:
+                batch = self._decode_batch(msg_dict)
+                return self.protocol.encode_dict(
+                    self.protocol.response_to_dict(
+                        BatchSysResponse(
+                            responses=[
+                                (
+                                    self._handle_message_dict(
+                                        bound_obj, entry, entry, False, None
+                                    )
+                                    if metrics is None
+                                    else self._handle_batch_entry_metered(
+                                        bound_obj, entry, metrics
+                                    )
+                                )
+                                for entry in batch.messages
+                            ]
+                        )
+                    )
+                )
+        except Exception as exc:
+            response_encoded = self.protocol.encode_dict(
+                self._handle_error(bound_obj, msg, None, exc)
+            )
+            if rec is not None:
+                rec.decode_time = rec.lap()
+                rec.error = True
+                self._finish_record(rec, msg, response_encoded)
+            return response_encoded
+        response_encoded = self.protocol.encode_dict(
+            self._handle_message_dict(
+                bound_obj, msg_dict, msg, raise_unregistered, rec
+            )
+        )
+        if rec is not None:
+            self._finish_record(rec, msg, response_encoded)
+        return response_encoded
+
+    def _get_metrics(self) -> MessageMetrics | None:
+        return self.protocol.metrics if self.metrics is None else self.metrics
+
+    @staticmethod
+    def _finish_record(
+        rec: MetricsRecord, msg: str | bytes | memoryview, response_encoded: str
+    ) -> None:
+        rec.encode_time = rec.lap()
+        rec.message_bytes = (
+            msg.nbytes if isinstance(msg, memoryview) else len(msg)
+        )
+        # Note: our encoded json is ascii so str lengths are byte sizes.
+        rec.response_bytes = len(response_encoded)
+        rec.metrics.record_received(rec)
+
+    def _handle_batch_entry_metered(
+        self, bound_obj: Any, msg_dict: dict, metrics: MessageMetrics
+    ) -> dict:
+        rec = MetricsRecord(metrics)
+        response_dict = self._handle_message_dict(
+            bound_obj, msg_dict, msg_dict, False, rec
+        )
+        rec.encode_time = rec.lap()
+        metrics.record_received(rec)
+        return response_dict
+
+    def _handle_message_dict(
+        self,
+        bound_obj: Any,
+        msg_dict: dict,
+        msg_raw: Any,
+        raise_unregistered: bool,
+        rec: MetricsRecord | None,
+    ) -> dict:
+        # pylint: disable=too-many-positional-arguments
         msg_decoded: Message | None = None
         try:
-            msg_decoded = self._decode_incoming_message(bound_obj, msg)
-            msgtype = type(msg_decoded)
-            handler = self._handlers.get(msgtype)
+            msg_decoded, handler = self._dispatch_incoming_message(
+                bound_obj, msg_dict
+            )
+            if rec is not None:
+                rec.msgtype = type(msg_decoded)
+                rec.decode_time = rec.lap()
             if handler is None:
-                raise RuntimeError(f'Got unhandled message type: {msgtype}.')
+                raise RuntimeError(
+                    f'Got unhandled message type: {type(msg_decoded)}.'
+                )
             response = handler(bound_obj, msg_decoded)
+            if rec is not None:
+                rec.handle_time = rec.lap()
             assert isinstance(response, Response | None)
-            return self.encode_user_response(bound_obj, msg_decoded, response)
+            return self._encode_user_response_dict(
+                bound_obj, msg_decoded, response
+            )
 
         except Exception as exc:
             if raise_unregistered and isinstance(
                 exc, UnregisteredMessageIDError
             ):
                 raise
-            rstr, dolog = self.encode_error_response(
-                bound_obj, msg_decoded, exc
-            )
-            if dolog:
-                if msg_decoded is not None:
-                    msgtype = type(msg_decoded)
-                    logging.exception(
-                        'Error handling %s.%s message.',
-                        msgtype.__module__,
-                        msgtype.__qualname__,
-                    )
-                else:
-                    logging.exception(
-                        'Error handling raw efro.message'
-                        ' (likely a message format incompatibility): %s.',
-                        msg,
-                    )
-            return rstr
+            if rec is not None:
+                self._note_error(rec, msg_decoded)
+            return self._handle_error(bound_obj, msg_raw, msg_decoded, exc)
+
+    @staticmethod
+    def _note_error(rec: MetricsRecord, msg_decoded: Message | None) -> None:
+        rec.error = True
+        if msg_decoded is None:
+            rec.decode_time = rec.lap()
+        else:
+            rec.handle_time = rec.lap()
 
     def handle_raw_message_async(
-        self, bound_obj: Any, msg: str, raise_unregistered: bool = False
+        self,
+        bound_obj: Any,
+        msg: str | bytes | memoryview,
+        raise_unregistered: bool = False,
     ) -> Awaitable[str]:
         """Should be called when the receiver gets a message.
 
-        The return value is the raw response to the message.
+        The return value is the raw response to the message. Handlers
+        for messages within a batch run concurrently.
         """
 
         # Note: This call is synchronous so that the first part of it can
@@ -319,13 +511,81 @@ class MessageReceiver:
         # order the messages were received.
 
         assert self.is_async, "Can't call async handler on sync receiver."
+        metrics = self._get_metrics()
+        rec = None if metrics is None else MetricsRecord(metrics)
+        try:
+            msg_dict = self.protocol.decode_dict(msg)
+            if msg_dict.get('t') in self.protocol.sys_message_types_by_id:
+                batch = self._decode_batch(msg_dict)
+                return self._handle_batch_async(
+                    [
+                        (
+                            self._start_message_dict_async(
+                                bound_obj, entry, entry, False, None
+                            )
+                            if metrics is None
+                            else self._start_batch_entry_metered_async(
+                                bound_obj, entry, metrics
+                            )
+                        )
+                        for entry in batch.messages
+                    ]
+                )
+        except Exception as exc:
+            if rec is not None:
+                rec.decode_time = rec.lap()
+                rec.error = True
+            return self._encode_async(
+                self._handle_error_async(bound_obj, msg, None, exc), rec, msg
+            )
+        return self._encode_async(
+            self._start_message_dict_async(
+                bound_obj, msg_dict, msg, raise_unregistered, rec
+            ),
+            rec,
+            msg,
+        )
+
+    def _start_batch_entry_metered_async(
+        self, bound_obj: Any, msg_dict: dict, metrics: MessageMetrics
+    ) -> Awaitable[dict]:
+        rec = MetricsRecord(metrics)
+        return self._finish_batch_entry_metered_async(
+            self._start_message_dict_async(
+                bound_obj, msg_dict, msg_dict, False, rec
+            ),
+            rec,
+        )
+
+    async def _finish_batch_entry_metered_async(
+        self, response_awaitable: Awaitable[dict], rec: MetricsRecord
+    ) -> dict:
+        response_dict = await response_awaitable
+        rec.encode_time = rec.lap()
+        rec.metrics.record_received(rec)
+        return response_dict
+
+    def _start_message_dict_async(
+        self,
+        bound_obj: Any,
+        msg_dict: dict,
+        msg_raw: Any,
+        raise_unregistered: bool,
+        rec: MetricsRecord | None,
+    ) -> Awaitable[dict]:
+        # pylint: disable=too-many-positional-arguments
         msg_decoded: Message | None = None
         try:
-            msg_decoded = self._decode_incoming_message(bound_obj, msg)
-            msgtype = type(msg_decoded)
-            handler = self._handlers.get(msgtype)
+            msg_decoded, handler = self._dispatch_incoming_message(
+                bound_obj, msg_dict
+            )
+            if rec is not None:
+                rec.msgtype = type(msg_decoded)
+                rec.decode_time = rec.lap()
             if handler is None:
-                raise RuntimeError(f'Got unhandled message type: {msgtype}.')
+                raise RuntimeError(
+                    f'Got unhandled message type: {type(msg_decoded)}.'
+                )
             handler_awaitable = handler(bound_obj, msg_decoded)
 
         except Exception as exc:
@@ -333,67 +593,71 @@ class MessageReceiver:
                 exc, UnregisteredMessageIDError
             ):
                 raise
-            return self._handle_raw_message_async_error(
-                bound_obj, msg, msg_decoded, exc
+            if rec is not None:
+                self._note_error(rec, msg_decoded)
+            return self._handle_error_async(
+                bound_obj, msg_raw, msg_decoded, exc
             )
 
         # Return an awaitable to handle the rest asynchronously.
-        return self._handle_raw_message_async(
-            bound_obj, msg, msg_decoded, handler_awaitable
+        return self._finish_message_async(
+            bound_obj, msg_raw, msg_decoded, handler_awaitable, rec
         )
 
-    async def _handle_raw_message_async_error(
+    async def _handle_error_async(
         self,
         bound_obj: Any,
-        msg_raw: str,
+        msg_raw: Any,
         msg_decoded: Message | None,
         exc: Exception,
-    ) -> str:
-        rstr, dolog = self.encode_error_response(bound_obj, msg_decoded, exc)
-        if dolog:
-            if msg_decoded is not None:
-                msgtype = type(msg_decoded)
-                logging.exception(
-                    'Error handling %s.%s message.',
-                    msgtype.__module__,
-                    msgtype.__qualname__,
-                    # We need to explicitly provide the exception here,
-                    # otherwise it shows up at None. I assume related to
-                    # the fact that we're an async function.
-                    exc_info=exc,
-                )
-            else:
-                logging.exception(
-                    'Error handling raw async efro.message'
-                    ' (likely a message format incompatibility): %s.',
-                    msg_raw,
-                    # We need to explicitly provide the exception here,
-                    # otherwise it shows up at None. I assume related to
-                    # the fact that we're an async function.
-                    exc_info=exc,
-                )
-        return rstr
+    ) -> dict:
+        return self._handle_error(bound_obj, msg_raw, msg_decoded, exc)
 
-    async def _handle_raw_message_async(
+    async def _finish_message_async(
         self,
         bound_obj: Any,
-        msg_raw: str,
+        msg_raw: Any,
         msg_decoded: Message,
         handler_awaitable: Awaitable[Response | None],
-    ) -> str:
-        """Should be called when the receiver gets a message.
-
-        The return value is the raw response to the message.
-        """
+        rec: MetricsRecord | None,
+    ) -> dict:
+        # pylint: disable=too-many-positional-arguments
         try:
             response = await handler_awaitable
+            if rec is not None:
+                rec.handle_time = rec.lap()
             assert isinstance(response, Response | None)
-            return self.encode_user_response(bound_obj, msg_decoded, response)
+            return self._encode_user_response_dict(
+                bound_obj, msg_decoded, response
+            )
 
         except Exception as exc:
-            return await self._handle_raw_message_async_error(
-                bound_obj, msg_raw, msg_decoded, exc
+            if rec is not None:
+                self._note_error(rec, msg_decoded)
+            return self._handle_error(bound_obj, msg_raw, msg_decoded, exc)
+
+    async def _handle_batch_async(
+        self, response_awaitables: list[Awaitable[dict]]
+    ) -> str:
+        # Each of these handles its own errors, so this gives us one
+        # response per message.
+        responses = await asyncio.gather(*response_awaitables)
+        return self.protocol.encode_dict(
+            self.protocol.response_to_dict(
+                BatchSysResponse(responses=list(responses))
             )
+        )
+
+    async def _encode_async(
+        self,
+        response_awaitable: Awaitable[dict],
+        rec: MetricsRecord | None,
+        msg: str | bytes | memoryview,
+    ) -> str:
+        response_encoded = self.protocol.encode_dict(await response_awaitable)
+        if rec is not None:
+            self._finish_record(rec, msg, response_encoded)
+        return response_encoded
 
 
 class BoundMessageReceiver:
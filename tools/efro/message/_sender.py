@@ -10,13 +10,21 @@ import logging
 from typing import TYPE_CHECKING
 
 from efro.error import CleanError, RemoteError, CommunicationError
-from efro.message._message import EmptySysResponse, ErrorSysResponse, Response
+from efro.message._metrics import MetricsRecord
+from efro.message._message import (
+    EmptySysResponse,
+    ErrorSysResponse,
+    BatchSysMessage,
+    BatchSysResponse,
+    Response,
+)
 
 if TYPE_CHECKING:
-    from typing import Any, Callable, Awaitable
+    from typing import Any, Callable, Awaitable, Sequence
 
     from efro.message._message import Message, SysResponse
     from efro.message._protocol import MessageProtocol
+    from efro.message._metrics import MessageMetrics
 
 
 class MessageSender:
@@ -70,6 +78,10 @@ class MessageSender:
         ) = None
         self._peer_desc_call: Callable[[Any], str] | None = None
 
+        # If set, sent messages are recorded here (instead of to our
+        # protocol's metrics, if any).
+        self.metrics: MessageMetrics | None = None
+
     def send_method(
         self, call: Callable[[Any, str], str]
     ) -> Callable[[Any, str], str]:
@@ -196,6 +208,119 @@ class MessageSender:
             bound_obj, message, raw_response_awaitable
         )
 
+    def send_batch_async(
+        self, bound_obj: Any, messages: Sequence[Message]
+    ) -> Awaitable[list[Response | None | Exception]]:
+        """Send a number of messages asynchronously in one raw send.
+
+        The messages travel together as a single raw message and are
+        handled in order by the receiver (or concurrently in the case of
+        async receivers). Each message still gets its own result; the
+        returned list contains, in order, what send_async() would have
+        returned for each message or the Exception it would have raised.
+        As with send_async(), errors encoding messages are raised here
+        immediately and nothing gets sent.
+
+        Batches are sent through the @send_async_method (extended
+        send methods are not supported since there is no single
+        Message to pass them). The receiver must be using a version of
+        efro.message that supports batches.
+        """
+        # Note: This call is synchronous for the same reason send_async()
+        # is.
+        if self._send_async_raw_message_call is None:
+            raise RuntimeError(
+                'send_batch_async() requires a @send_async_method.'
+            )
+        metrics = self._get_metrics()
+        recs = (
+            None
+            if metrics is None
+            else [MetricsRecord(metrics) for _i in range(len(messages))]
+        )
+        if recs is None:
+            msg_dicts = [
+                self._encode_message_dict(bound_obj, message)
+                for message in messages
+            ]
+        else:
+            msg_dicts = []
+            for message, rec in zip(messages, recs):
+                msg_dicts.append(self._encode_message_dict(bound_obj, message))
+                rec.encode_time = rec.lap()
+        batch_encoded = self.protocol.encode_dict(
+            self.protocol.sys_message_to_dict(
+                BatchSysMessage(messages=msg_dicts)
+            )
+        )
+        try:
+            send_awaitable = self._send_async_raw_message_call(
+                bound_obj, batch_encoded
+            )
+        except Exception as exc:
+            return self._send_batch_error_awaitable(
+                bound_obj, messages, exc, recs
+            )
+        return self._send_batch_async_awaitable(
+            bound_obj, messages, send_awaitable, recs
+        )
+
+    async def _send_batch_error_awaitable(
+        self,
+        bound_obj: Any,
+        messages: Sequence[Message],
+        exc: Exception,
+        recs: list[MetricsRecord] | None,
+    ) -> list[Response | None | Exception]:
+        response = self._send_error_response(
+            exc, 'Error in MessageSender @send_async_method.'
+        )
+        raw_responses: list[Response | SysResponse] = [response] * len(messages)
+        if recs is not None:
+            for rec in recs:
+                rec.handle_time = rec.lap()
+            self._finish_batch_records(recs, messages, raw_responses)
+        return self._unpack_batch(bound_obj, messages, raw_responses)
+
+    async def _send_batch_async_awaitable(
+        self,
+        bound_obj: Any,
+        messages: Sequence[Message],
+        send_awaitable: Awaitable[str],
+        recs: list[MetricsRecord] | None,
+    ) -> list[Response | None | Exception]:
+        try:
+            response_encoded = await send_awaitable
+        except Exception as exc:
+            return await self._send_batch_error_awaitable(
+                bound_obj, messages, exc, recs
+            )
+        if recs is not None:
+            for rec in recs:
+                rec.handle_time = rec.lap()
+        raw_responses = self._decode_raw_batch_response(
+            bound_obj, messages, response_encoded
+        )
+        if recs is not None:
+            self._finish_batch_records(recs, messages, raw_responses)
+        return self._unpack_batch(bound_obj, messages, raw_responses)
+
+    def _unpack_batch(
+        self,
+        bound_obj: Any,
+        messages: Sequence[Message],
+        raw_responses: list[Response | SysResponse],
+    ) -> list[Response | None | Exception]:
+        out: list[Response | None | Exception] = []
+        for message, raw_response in zip(messages, raw_responses):
+            try:
+                out.append(
+                    self.unpack_raw_response(bound_obj, message, raw_response)
+                )
+            except Exception as exc:
+                out.append(exc)
+        return out
+
     async def _send_async_awaitable(
         self,
         bound_obj: Any,
@@ -223,7 +348,11 @@ class MessageSender:
         ):
             raise RuntimeError('send() is unimplemented for this type.')
 
+        metrics = self._get_metrics()
+        rec = None if metrics is None else MetricsRecord(metrics)
         msg_encoded = self._encode_message(bound_obj, message)
+        if rec is not None:
+            rec.encode_time = rec.lap()
         try:
             if self._send_raw_message_ex_call is not None:
                 response_encoded = self._send_raw_message_ex_call(
@@ -235,19 +364,27 @@ class MessageSender:
                     bound_obj, msg_encoded
                 )
         except Exception as exc:
-            response = ErrorSysResponse(
-                error_message='Error in MessageSender @send_method.',
-                error_type=(
-                    ErrorSysResponse.ErrorType.COMMUNICATION
-                    if isinstance(exc, CommunicationError)
-                    else ErrorSysResponse.ErrorType.LOCAL
-                ),
+            err_response = self._send_error_response(
+                exc, 'Error in MessageSender @send_method.'
             )
-            # Can include the actual exception since we'll be looking at
-            # this locally; might be helpful.
-            response.set_local_exception(exc)
-            return response
-        return self._decode_raw_response(bound_obj, message, response_encoded)
+            if rec is not None:
+                rec.handle_time = rec.lap()
+                self._finish_record(
+                    rec, message, msg_encoded, None, err_response
+                )
+            return err_response
+        if rec is None:
+            return self._decode_raw_response(
+                bound_obj, message, response_encoded
+            )
+        rec.handle_time = rec.lap()
+        response = self._decode_raw_response(
+            bound_obj, message, response_encoded
+        )
+        self._finish_record(
+            rec, message, msg_encoded, response_encoded, response
+        )
+        return response
 
     def fetch_raw_response_async(
         self, bound_obj: Any, message: Message
@@ -272,7 +409,11 @@ class MessageSender:
         ):
             raise RuntimeError('send_async() is unimplemented for this type.')
 
+        metrics = self._get_metrics()
+        rec = None if metrics is None else MetricsRecord(metrics)
         msg_encoded = self._encode_message(bound_obj, message)
+        if rec is not None:
+            rec.encode_time = rec.lap()
         try:
             if self._send_async_raw_message_ex_call is not None:
                 send_awaitable = self._send_async_raw_message_ex_call(
@@ -284,16 +425,69 @@ class MessageSender:
                     bound_obj, msg_encoded
                 )
         except Exception as exc:
-            return self._error_awaitable(exc)
+            return self._error_awaitable(exc, rec, message, msg_encoded)
 
         # Now return an awaitable to finish the job.
         return self._fetch_raw_response_awaitable(
-            bound_obj, message, send_awaitable
+            bound_obj, message, send_awaitable, rec, msg_encoded
         )
 
-    async def _error_awaitable(self, exc: Exception) -> SysResponse:
+    async def _error_awaitable(
+        self,
+        exc: Exception,
+        rec: MetricsRecord | None,
+        message: Message,
+        msg_encoded: str,
+    ) -> SysResponse:
+        response = self._send_error_response(
+            exc, 'Error in MessageSender @send_async_method.'
+        )
+        if rec is not None:
+            rec.handle_time = rec.lap()
+            self._finish_record(rec, message, msg_encoded, None, response)
+        return response
+
+    def _get_metrics(self) -> MessageMetrics | None:
+        return self.protocol.metrics if self.metrics is None else self.metrics
+
+    @staticmethod
+    def _finish_record(
+        rec: MetricsRecord,
+        message: Message,
+        msg_encoded: str,
+        response_encoded: str | None,
+        response: Response | SysResponse,
+    ) -> None:
+        rec.decode_time = rec.lap()
+        rec.msgtype = type(message)
+
+        # Note: our encoded json is ascii so str lengths are byte sizes.
+        rec.message_bytes = len(msg_encoded)
+        if response_encoded is not None:
+            rec.response_bytes = len(response_encoded)
+        rec.error = isinstance(response, ErrorSysResponse)
+        rec.metrics.record_sent(rec)
+
+    @staticmethod
+    def _finish_batch_records(
+        recs: list[MetricsRecord],
+        messages: Sequence[Message],
+        raw_responses: list[Response | SysResponse],
+    ) -> None:
+        # We decode batch responses all at once so we split that time
+        # evenly between messages.
+        decode_time = recs[-1].lap() / len(recs) if recs else 0.0
+        for rec, message, response in zip(recs, messages, raw_responses):
+            rec.decode_time = decode_time
+            rec.msgtype = type(message)
+            rec.error = isinstance(response, ErrorSysResponse)
+            rec.metrics.record_sent(rec)
+
+    @staticmethod
+    def _send_error_response(exc: Exception, desc: str) -> ErrorSysResponse:
+        """Wrap an error raised by a raw send method."""
         response = ErrorSysResponse(
-            error_message='Error in MessageSender @send_async_method.',
+            error_message=desc,
             error_type=(
                 ErrorSysResponse.ErrorType.COMMUNICATION
                 if isinstance(exc, CommunicationError)
@@ -306,24 +500,30 @@ class MessageSender:
         return response
 
     async def _fetch_raw_response_awaitable(
-        self, bound_obj: Any, message: Message, send_awaitable: Awaitable[str]
+        self,
+        bound_obj: Any,
+        message: Message,
+        send_awaitable: Awaitable[str],
+        rec: MetricsRecord | None,
+        msg_encoded: str,
     ) -> Response | SysResponse:
+        # pylint: disable=too-many-positional-arguments
         try:
             response_encoded = await send_awaitable
         except Exception as exc:
-            response = ErrorSysResponse(
-                error_message='Error in MessageSender @send_async_method.',
-                error_type=(
-                    ErrorSysResponse.ErrorType.COMMUNICATION
-                    if isinstance(exc, CommunicationError)
-                    else ErrorSysResponse.ErrorType.LOCAL
-                ),
+            return await self._error_awaitable(exc, rec, message, msg_encoded)
+        if rec is None:
+            return self._decode_raw_response(
+                bound_obj, message, response_encoded
             )
-            # Can include the actual exception since we'll be looking at
-            # this locally; might be helpful.
-            response.set_local_exception(exc)
-            return response
-        return self._decode_raw_response(bound_obj, message, response_encoded)
+        rec.handle_time = rec.lap()
+        response = self._decode_raw_response(
+            bound_obj, message, response_encoded
+        )
+        self._finish_record(
+            rec, message, msg_encoded, response_encoded, response
+        )
+        return response
 
     def unpack_raw_response(
         self,
@@ -346,10 +546,15 @@ class MessageSender:
 
     def _encode_message(self, bound_obj: Any, message: Message) -> str:
         """Encode a message for sending."""
+        return self.protocol.encode_dict(
+            self._encode_message_dict(bound_obj, message)
+        )
+
+    def _encode_message_dict(self, bound_obj: Any, message: Message) -> dict:
         msg_dict = self.protocol.message_to_dict(message)
         if self._encode_filter_call is not None:
             self._encode_filter_call(bound_obj, message, msg_dict)
-        return self.protocol.encode_dict(msg_dict)
+        return msg_dict
 
     def _decode_raw_response(
         self, bound_obj: Any, message: Message, response_encoded: str
@@ -361,35 +566,75 @@ class MessageSender:
         should be used to translate to special values like None or raise
         Exceptions. This function itself should never raise Exceptions.
         """
-        response: Response | SysResponse
         try:
             response_dict = self.protocol.decode_dict(response_encoded)
+        except Exception as exc:
+            return self._decode_error_response(exc)
+        return self._decode_response_dict(bound_obj, message, response_dict)
+
+    def _decode_raw_batch_response(
+        self,
+        bound_obj: Any,
+        messages: Sequence[Message],
+        response_encoded: str,
+    ) -> list[Response | SysResponse]:
+        """Create Responses for a batch send from returned data."""
+        try:
+            response_dict = self.protocol.decode_dict(response_encoded)
+            response = self.protocol.response_from_dict(response_dict)
+            if isinstance(response, BatchSysResponse) and len(
+                response.responses
+            ) != len(messages):
+                raise RuntimeError(
+                    f'Got {len(response.responses)} batch responses;'
+                    f' expected {len(messages)}.'
+                )
+        except Exception as exc:
+            return [self._decode_error_response(exc)] * len(messages)
+
+        # If the batch as a whole failed (an error from a receiver not
+        # supporting batches, etc.) each message gets that error.
+        if not isinstance(response, BatchSysResponse):
+            return [response] * len(messages)
+
+        return [
+            self._decode_response_dict(bound_obj, message, entry)
+            for message, entry in zip(messages, response.responses)
+        ]
+
+    def _decode_response_dict(
+        self, bound_obj: Any, message: Message, response_dict: dict
+    ) -> Response | SysResponse:
+        try:
             response = self.protocol.response_from_dict(response_dict)
             if self._decode_filter_call is not None:
                 self._decode_filter_call(
                     bound_obj, message, response_dict, response
                 )
         except Exception as exc:
+            return self._decode_error_response(exc)
+        return response
 
-            # We pragmatically log by default if decoding fails. This
-            # means a message type was likely changed in a way that
-            # breaks the protocol, but individual message handlers are
-            # likely to lump all errors together (communication and
-            # otherwise) which could cause such breakage to go
-            # unnoticed.
-            if self.protocol.log_response_decode_errors:
-                logging.exception(
-                    'Error decoding message response;'
-                    ' protocol might be broken.',
-                )
-
-            response = ErrorSysResponse(
-                error_message='Error decoding raw response.',
-                error_type=ErrorSysResponse.ErrorType.LOCAL,
+    def _decode_error_response(self, exc: Exception) -> ErrorSysResponse:
+        # We pragmatically log by default if decoding fails. This
+        # means a message type was likely changed in a way that
+        # breaks the protocol, but individual message handlers are
+        # likely to lump all errors together (communication and
+        # otherwise) which could cause such breakage to go
+        # unnoticed.
+        if self.protocol.log_response_decode_errors:
+            logging.exception(
+                'Error decoding message response; protocol might be broken.',
+                exc_info=exc,
             )
-            # Since we'll be looking at this locally, we can include
-            # extra info for logging/etc.
-            response.set_local_exception(exc)
+
+        response = ErrorSysResponse(
+            error_message='Error decoding raw response.',
+            error_type=ErrorSysResponse.ErrorType.LOCAL,
+        )
+        # Since we'll be looking at this locally, we can include
+        # extra info for logging/etc.
+        response.set_local_exception(exc)
         return response
 
     def _unpack_raw_response(
@@ -495,6 +740,18 @@ class BoundMessageSender:
         assert self._obj is not None
         return self._sender.send_async(bound_obj=self._obj, message=message)
 
+    def send_batch_async(
+        self, messages: Sequence[Message]
+    ) -> Awaitable[list[Response | None | Exception]]:
+        """Send a number of messages asynchronously in one raw send.
+
+        See MessageSender.send_batch_async() for details.
+        """
+        assert self._obj is not None
+        return self._sender.send_batch_async(
+            bound_obj=self._obj, messages=messages
+        )
+
     def fetch_raw_response_async_untyped(
         self, message: Message
     ) -> Awaitable[Response | SysResponse]:
@@ -1,17 +1,20 @@
 # Released under the MIT License. See LICENSE for details.
 #
+# pylint: disable=too-many-lines
 """Remote procedure call related functionality."""
 
 from __future__ import annotations
 
 import time
+import zlib
+import heapq
 import asyncio
 import logging
 import weakref
 from enum import Enum
 from functools import partial
 from collections import deque
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from threading import current_thread
 from typing import TYPE_CHECKING, Annotated, assert_never
 
@@ -45,6 +48,19 @@ class _PacketType(Enum):
     RESPONSE_BIG = 5
 
 
+# Set on the packet type byte for message/response packets whose
+# payload is compressed (protocol 3+; only sent to peers that
+# advertise support for it).
+_PACKET_COMPRESSED_FLAG = 0x80
+
+# Compression type names we can advertise in our handshake.
+_COMPRESSION_ZLIB = 'zlib'
+
+# Compressed payloads may not expand to more than this; anything bigger
+# is sent uncompressed. This keeps a tiny packet from a misbehaving peer
+# from expanding into gigabytes of memory on our end.
+_MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
 _BYTE_ORDER: Literal['big'] = 'big'
 
 
@@ -57,6 +73,11 @@ class _PeerInfo:
     # How often we'll be sending out keepalives (in seconds).
     keepalive_interval: Annotated[float, IOAttrs('k')]
 
+    # Compression types we can receive (older peers won't send this).
+    compression: Annotated[list[str], IOAttrs('c', store_default=False)] = (
+        field(default_factory=list)
+    )
+
 
 # Note: we are expected to be forward and backward compatible; we can
 # increment protocol freely and expect everyone else to still talk to us.
@@ -64,7 +85,11 @@ class _PeerInfo:
 # Protocol history:
 # 1 - initial release
 # 2 - gained big (32-bit len val) package/response packets
-OUR_PROTOCOL = 2
+# 3 - gained optional compressed message/response packets (negotiated
+#     via _PeerInfo.compression)
+# 4 - message ids are 32 bits when both sides are protocol 4+ (allowing
+#     more than 65536 messages in flight)
+OUR_PROTOCOL = 4
 
 
 def ssl_stream_writer_underlying_transport_info(
@@ -127,29 +152,97 @@ def _do_writer_force_close_check(transport_weak: weakref.ref) -> None:
 class _InFlightMessage:
     """Represents a message that is out on the wire."""
 
-    def __init__(self) -> None:
-        self._response: bytes | None = None
-        self._got_response = asyncio.Event()
-        self.wait_task = asyncio.create_task(
-            self._wait(), name='rpc in flight msg wait'
+    def __init__(self, message: bytes, deadline: float) -> None:
+        self.future: asyncio.Future[bytes] = (
+            asyncio.get_running_loop().create_future()
         )
 
-    async def _wait(self) -> bytes:
-        await self._got_response.wait()
-        assert self._response is not None
-        return self._response
+        # Event-loop time at which we give up on a response.
+        self.deadline = deadline
+
+        # We can't build a message's packet until we know our peer's
+        # protocol. Until then we hold on to its data and it has no id.
+        self.message: bytes | None = message
+        self.message_id: int | None = None
 
     def set_response(self, data: bytes) -> None:
         """Set response data."""
-        assert self._response is None
-        self._response = data
-        self._got_response.set()
+        if not self.future.done():
+            self.future.set_result(data)
+
+    def set_error(self, exc: BaseException) -> None:
+        """Fail the message with an error."""
+        if not self.future.done():
+            self.future.set_exception(exc)
 
 
 class _KeepaliveTimeoutError(Exception):
     """Raised if we time out due to not receiving keepalives."""
 
 
+class RPCBusyError(CommunicationError):
+    """Raised when a message can't be sent due to flow-control limits.
+
+    Unlike other communication errors, this does not mean anything is
+    wrong with the connection; callers can shed load or try again later.
+    """
+
+
+@dataclass
+class RPCEndpointStats:
+    """Flow-control related stats for an RPCEndpoint."""
+
+    # Packets/bytes currently waiting to be written.
+    out_packets: int
+    out_bytes: int
+
+    # Messages we've sent which are still awaiting responses.
+    in_flight_messages: int
+
+    # Whether our out-queue is currently past its high water mark (and
+    # has not yet drained back down to the low water mark).
+    throttled: bool
+
+    # Peak values over the lifetime of the endpoint.
+    peak_out_packets: int
+    peak_out_bytes: int
+    peak_in_flight_messages: int
+
+    # Number of times we've crossed into the throttled state.
+    throttle_count: int
+
+    # Number of sends that had to wait for capacity.
+    send_wait_count: int
+
+    # Number of sends rejected with RPCBusyError.
+    busy_reject_count: int
+
+    # Packets written and the number of write calls used to do so
+    # (these differ when write batching is enabled).
+    packets_written: int
+    write_calls: int
+
+    # Outgoing payloads we tried compressing, their total size before
+    # and after, how many actually went out compressed (we send the
+    # original if compressing doesn't help), and the cpu time spent.
+    compress_count: int
+    compress_bytes_in: int
+    compress_bytes_out: int
+    compressed_packets_sent: int
+    compress_cpu_time: float
+
+    # Incoming payloads we decompressed and the cpu time spent.
+    decompress_count: int
+    decompress_cpu_time: float
+
+    @property
+    def compression_ratio(self) -> float:
+        """Compressed size over original size for payloads we tried."""
+        if not self.compress_bytes_in:
+            return 1.0
+        return self.compress_bytes_out / self.compress_bytes_in
+
+
 class RPCEndpoint:
     """Facilitates asynchronous multiplexed remote procedure calls.
 
@@ -174,6 +267,21 @@ class RPCEndpoint:
     # disconnect.
     DEFAULT_KEEPALIVE_TIMEOUT = 30.0
 
+    # When our outgoing packet queue grows past either of these we
+    # consider ourself throttled until it drains back down to the
+    # corresponding low water marks (half of these by default).
+    DEFAULT_OUT_HIGH_WATER_BYTES = 4 * 1024 * 1024
+    DEFAULT_OUT_HIGH_WATER_PACKETS = 200
+
+    # When write batching is enabled, the most we'll try to send in a
+    # single write call (a single packet larger than this still gets
+    # sent on its own).
+    DEFAULT_WRITE_BATCH_MAX_BYTES = 256 * 1024
+
+    # Message/response payloads at least this big get compressed (when
+    # the peer supports it).
+    DEFAULT_COMPRESSION_THRESHOLD = 4096
+
     def __init__(
         self,
         handle_raw_message_call: Callable[[bytes], Awaitable[bytes]],
@@ -186,7 +294,44 @@ class RPCEndpoint:
         debug_print_call: Callable[[str], None] | None = None,
         keepalive_interval: float = DEFAULT_KEEPALIVE_INTERVAL,
         keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT,
+        out_high_water_bytes: int = DEFAULT_OUT_HIGH_WATER_BYTES,
+        out_low_water_bytes: int | None = None,
+        out_high_water_packets: int = DEFAULT_OUT_HIGH_WATER_PACKETS,
+        out_low_water_packets: int | None = None,
+        max_in_flight_messages: int | None = None,
+        write_batching: bool = True,
+        write_batch_max_bytes: int = DEFAULT_WRITE_BATCH_MAX_BYTES,
+        write_batch_delay: float = 0.0,
+        compression: bool = True,
+        compression_threshold: int = DEFAULT_COMPRESSION_THRESHOLD,
+        compression_level: int = 1,
     ) -> None:
+        # pylint: disable=too-many-locals
+        # pylint: disable=too-many-statements
+        if out_low_water_bytes is None:
+            out_low_water_bytes = out_high_water_bytes // 2
+        if out_low_water_packets is None:
+            out_low_water_packets = out_high_water_packets // 2
+        if not 0 <= out_low_water_bytes <= out_high_water_bytes:
+            raise ValueError(
+                f'Invalid out water marks (bytes):'
+                f' low={out_low_water_bytes} high={out_high_water_bytes}.'
+            )
+        if not 0 <= out_low_water_packets <= out_high_water_packets:
+            raise ValueError(
+                f'Invalid out water marks (packets):'
+                f' low={out_low_water_packets} high={out_high_water_packets}.'
+            )
+        if max_in_flight_messages is not None and max_in_flight_messages < 1:
+            raise ValueError(
+                f'Invalid max_in_flight_messages {max_in_flight_messages}.'
+            )
+        if write_batch_max_bytes < 1:
+            raise ValueError(
+                f'Invalid write_batch_max_bytes {write_batch_max_bytes}.'
+            )
+        if write_batch_delay < 0.0:
+            raise ValueError(f'Invalid write_batch_delay {write_batch_delay}.')
         self._handle_raw_message_call = handle_raw_message_call
         self._reader = reader
         self._writer = writer
@@ -204,6 +349,13 @@ class RPCEndpoint:
         self._have_out_packets = asyncio.Event()
         self._run_called = False
         self._peer_info: _PeerInfo | None = None
+        self._protocol = OUR_PROTOCOL
+
+        # Whether message ids are 32 bits (protocol 4+) instead of 16.
+        self._wide_message_ids = False
+
+        # Set once we've got our peer's handshake (or are closing).
+        self._peer_info_event = asyncio.Event()
         self._keepalive_interval = keepalive_interval
         self._keepalive_timeout = keepalive_timeout
         self._did_close_writer = False
@@ -212,18 +364,70 @@ class RPCEndpoint:
         self._total_bytes_read = 0
         self._create_time = time.monotonic()
 
+        # Flow control.
+        self._out_high_water_bytes = out_high_water_bytes
+        self._out_low_water_bytes = out_low_water_bytes
+        self._out_high_water_packets = out_high_water_packets
+        self._out_low_water_packets = out_low_water_packets
+        self._max_in_flight_messages = max_in_flight_messages
+        self._out_bytes = 0
+        self._throttled = False
+
+        # Set whenever send capacity may have opened up (or we're
+        # closing); waiters re-check their conditions when it fires.
+        self._send_capacity_changed = asyncio.Event()
+
+        self._peak_out_packets = 0
+        self._peak_out_bytes = 0
+        self._peak_in_flight_messages = 0
+        self._throttle_count = 0
+        self._send_wait_count = 0
+        self._busy_reject_count = 0
+
+        # Write batching.
+        self._write_batching = write_batching
+        self._write_batch_max_bytes = write_batch_max_bytes
+        self._write_batch_delay = write_batch_delay
+        self._packets_written = 0
+        self._write_calls = 0
+
+        # Compression.
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._compression_level = compression_level
+        self._compress_count = 0
+        self._compress_bytes_in = 0
+        self._compress_bytes_out = 0
+        self._compressed_packets_sent = 0
+        self._compress_cpu_time = 0.0
+        self._decompress_count = 0
+        self._decompress_cpu_time = 0.0
+
         # Need to hold weak-refs to these otherwise it creates dep-loops
         # which keeps us alive.
         self._tasks: list[asyncio.Task] = []
+        self._tasks_prune_size = 0
 
         # When we last got a keepalive or equivalent (time.monotonic value)
         self._last_keepalive_receive_time: float | None = None
 
-        # (Start near the end to make sure our looping logic is sound).
+        # (Start near the end of the 16 bit range to make sure our
+        # looping logic is sound).
         self._next_message_id = 65530
 
         self._in_flight_messages: dict[int, _InFlightMessage] = {}
 
+        # Messages sent before we got our peer's handshake.
+        self._pre_handshake_messages: list[_InFlightMessage] = []
+
+        # Message timeouts, as a heap of (deadline, seq, message) entries
+        # serviced by a single timer. Entries for messages that have
+        # already completed are left in place and skipped when they come
+        # up (or pruned if they start to pile up).
+        self._timeout_heap: list[tuple[float, int, _InFlightMessage]] = []
+        self._timeout_seq = 0
+        self._timeout_handle: asyncio.TimerHandle | None = None
+
         if self.debug_print:
             peername = self._writer.get_extra_info('peername')
             self.debug_print_call(
@@ -337,6 +541,16 @@ class RPCEndpoint:
         errors. This allows messages to be treated as 'reliable' with
         respect to a given endpoint. Pass close_on_error=False to
         override this for a particular message.
+
+        This call never waits for send capacity. If a
+        max_in_flight_messages limit was provided and has been reached,
+        raises an RPCBusyError (which does not close the endpoint). The
+        out-queue water marks are not enforced here; callers wanting
+        to respect them should use send_message_when_writable() or
+        check is_writable()/get_stats().
+
+        Messages of at least compression_threshold bytes are compressed
+        if the peer supports it.
         """
         # Note: This call is synchronous so that the first part of it
         # (enqueueing outgoing messages) happens synchronously. If it were
@@ -354,41 +568,44 @@ class RPCEndpoint:
         if self._closing:
             raise CommunicationError('Endpoint is closed.')
 
+        if (
+            self._max_in_flight_messages is not None
+            and self._in_flight_count() >= self._max_in_flight_messages
+        ):
+            self._busy_reject_count += 1
+            raise RPCBusyError(
+                f'Too many messages in flight'
+                f' ({self._max_in_flight_messages}).'
+            )
+
         if self.debug_print_io:
             self.debug_print_call(
                 f'{self._label}: have peerinfo? {self._peer_info is not None}.'
             )
 
-        # message_id is a 16 bit looping value.
-        message_id = self._next_message_id
-        self._next_message_id = (self._next_message_id + 1) % 65536
+        # Note: we always want to incorporate a timeout. Individual
+        # messages may hang or error on the other end and this ensures
+        # we won't build up lots of zombies waiting around for
+        # responses that will never arrive.
+        if timeout is None:
+            timeout = self.DEFAULT_MESSAGE_TIMEOUT
+        assert timeout is not None
+
+        msgobj = _InFlightMessage(message, self._event_loop.time() + timeout)
 
         if self.debug_print_io:
             self.debug_print_call(
                 f'{self._label}: will enqueue at {self._tm()}.'
             )
 
-        # FIXME - should handle backpressure (waiting here if there are
-        # enough packets already enqueued).
-
-        if len(message) > 65535:
-            # Payload consists of type (1b), message_id (2b),
-            # len (4b), and data.
-            self._enqueue_outgoing_packet(
-                _PacketType.MESSAGE_BIG.value.to_bytes(1, _BYTE_ORDER)
-                + message_id.to_bytes(2, _BYTE_ORDER)
-                + len(message).to_bytes(4, _BYTE_ORDER)
-                + message
-            )
+        if self._peer_info is None:
+            # Message ids and such depend on our peer's protocol, so
+            # just hold on to the message until we get their handshake.
+            self._pre_handshake_messages.append(msgobj)
+            self._out_bytes += len(message)
+            self._note_out_queue_growth()
         else:
-            # Payload consists of type (1b), message_id (2b),
-            # len (2b), and data.
-            self._enqueue_outgoing_packet(
-                _PacketType.MESSAGE.value.to_bytes(1, _BYTE_ORDER)
-                + message_id.to_bytes(2, _BYTE_ORDER)
-                + len(message).to_bytes(2, _BYTE_ORDER)
-                + message
-            )
+            self._enqueue_message_packet(msgobj)
 
         if self.debug_print_io:
             self.debug_print_call(
@@ -396,62 +613,126 @@ class RPCEndpoint:
                 f' at {self._tm()}.'
             )
 
-        # Make an entry so we know this message is out there.
-        assert message_id not in self._in_flight_messages
-        msgobj = self._in_flight_messages[message_id] = _InFlightMessage()
-
-        # Also add its task to our list so we properly cancel it if we die.
-        self._prune_tasks()  # Keep our list from filling with dead tasks.
-        self._tasks.append(msgobj.wait_task)
-
-        # Note: we always want to incorporate a timeout. Individual
-        # messages may hang or error on the other end and this ensures
-        # we won't build up lots of zombie tasks waiting around for
-        # responses that will never arrive.
-        if timeout is None:
-            timeout = self.DEFAULT_MESSAGE_TIMEOUT
-        assert timeout is not None
-
-        bytes_awaitable = msgobj.wait_task
+        self._peak_in_flight_messages = max(
+            self._peak_in_flight_messages, self._in_flight_count()
+        )
+        self._add_timeout(msgobj)
 
         # Now complete the send asynchronously.
-        return self._send_message(
-            message, timeout, close_on_error, bytes_awaitable, message_id
-        )
+        return self._send_message(msgobj, close_on_error)
 
-    async def _send_message(
+    async def send_message_when_writable(
         self,
         message: bytes,
-        timeout: float | None,
-        close_on_error: bool,
-        bytes_awaitable: asyncio.Task[bytes],
-        message_id: int,
+        timeout: float | None = None,
+        close_on_error: bool = True,
     ) -> bytes:
-        # pylint: disable=too-many-positional-arguments
-        # We need to know their protocol, so if we haven't gotten a handshake
-        # from them yet, just wait.
-        while self._peer_info is None:
-            await asyncio.sleep(0.01)
-        assert self._peer_info is not None
+        """Send a message, first waiting until we have capacity for it.
 
-        if self._peer_info.protocol == 1:
-            if len(message) > 65535:
-                raise RuntimeError('Message cannot be larger than 65535 bytes')
+        Like send_message(), but waits while our out-queue is throttled
+        or while we are at our max_in_flight_messages limit. Note that
+        timeout only applies to the message round trip and not to time
+        spent waiting for capacity; wrap this call in asyncio.wait_for()
+        to limit that.
+        """
+        await self.wait_writable()
+        return await self.send_message(
+            message, timeout=timeout, close_on_error=close_on_error
+        )
+
+    async def wait_ready(self) -> None:
+        """Wait until the connection is ready for communication.
+
+        That means we've received our peer's handshake. Note that
+        messages can be sent before this point (they simply wait); this
+        is for cases where it is useful to know when a connection is
+        fully established. Raises a CommunicationError if the endpoint
+        closes first.
+        """
+        self._check_env()
+        await self._peer_info_event.wait()
+        if self._peer_info is None:
+            raise CommunicationError('Endpoint closed before handshake.')
+
+    def is_ready(self) -> bool:
+        """Have we received our peer's handshake?"""
+        return self._peer_info is not None
+
+    async def wait_writable(self) -> None:
+        """Wait until we have capacity to send a message.
 
+        That means our out-queue is not throttled and we are below our
+        max_in_flight_messages limit (if any). Raises a
+        CommunicationError if the endpoint is closed.
+        """
+        self._check_env()
+        waited = False
+        while True:
+            if self._closing:
+                raise CommunicationError('Endpoint is closed.')
+            if self.is_writable():
+                return
+            if not waited:
+                waited = True
+                self._send_wait_count += 1
+            self._send_capacity_changed.clear()
+            await self._send_capacity_changed.wait()
+
+    def is_writable(self) -> bool:
+        """Do we currently have capacity to send a message?
+
+        Senders can use this to shed load without waiting.
+        """
+        return not self._throttled and (
+            self._max_in_flight_messages is None
+            or self._in_flight_count() < self._max_in_flight_messages
+        )
+
+    def get_stats(self) -> RPCEndpointStats:
+        """Return current flow-control stats for the endpoint."""
+        return RPCEndpointStats(
+            out_packets=self._out_packet_count(),
+            out_bytes=self._out_bytes,
+            in_flight_messages=self._in_flight_count(),
+            throttled=self._throttled,
+            peak_out_packets=self._peak_out_packets,
+            peak_out_bytes=self._peak_out_bytes,
+            peak_in_flight_messages=self._peak_in_flight_messages,
+            throttle_count=self._throttle_count,
+            send_wait_count=self._send_wait_count,
+            busy_reject_count=self._busy_reject_count,
+            packets_written=self._packets_written,
+            write_calls=self._write_calls,
+            compress_count=self._compress_count,
+            compress_bytes_in=self._compress_bytes_in,
+            compress_bytes_out=self._compress_bytes_out,
+            compressed_packets_sent=self._compressed_packets_sent,
+            compress_cpu_time=self._compress_cpu_time,
+            decompress_count=self._decompress_count,
+            decompress_cpu_time=self._decompress_cpu_time,
+        )
+
+    async def _send_message(
+        self, msgobj: _InFlightMessage, close_on_error: bool
+    ) -> bytes:
         try:
-            return await asyncio.wait_for(bytes_awaitable, timeout=timeout)
+            return await msgobj.future
         except asyncio.CancelledError as exc:
-            # Question: we assume this means the above wait_for() was
-            # cancelled; how do we distinguish between this and *us* being
-            # cancelled though?
+            # We only ever fail message futures with exceptions, so this
+            # should mean *we* were cancelled.
             if self.debug_print:
                 self.debug_print_call(
-                    f'{self._label}: message {message_id} was cancelled.'
+                    f'{self._label}: message {msgobj.message_id}'
+                    f' was cancelled.'
                 )
             if close_on_error:
                 self.close()
 
             raise CommunicationError() from exc
+        except CommunicationError:
+            # We're closing or otherwise can't send this; nothing more
+            # to do.
+            raise
         except Exception as exc:
             # If our timer timed-out or anything else went wrong with
             # the stream, lump it in as a communication error.
@@ -461,15 +742,9 @@ class RPCEndpoint:
                 if self.debug_print:
                     self.debug_print_call(
                         f'{self._label}: got {type(exc)} sending message'
-                        f' {message_id}; raising CommunicationError.'
+                        f' {msgobj.message_id}; raising CommunicationError.'
                     )
 
-                # Stop waiting on the response.
-                bytes_awaitable.cancel()
-
-                # Remove the record of this message.
-                del self._in_flight_messages[message_id]
-
                 if close_on_error:
                     self.close()
 
@@ -478,6 +753,10 @@ class RPCEndpoint:
 
             # Some unexpected error; let it bubble up.
             raise
+        finally:
+            # Remove the record of this message if it's still around.
+            self._remove_in_flight_message(msgobj)
+            self._prune_timeouts()
 
     def close(self) -> None:
         """I said seagulls; mmmm; stop it now."""
@@ -491,6 +770,22 @@ class RPCEndpoint:
 
         self._closing = True
 
+        # Wake anyone waiting for send capacity or a handshake so they
+        # can error out.
+        self._send_capacity_changed.set()
+        self._peer_info_event.set()
+
+        # Fail all messages awaiting responses.
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+        self._timeout_heap = []
+        for msgobj in [
+            *self._in_flight_messages.values(),
+            *self._pre_handshake_messages,
+        ]:
+            msgobj.set_error(CommunicationError('Endpoint is closed.'))
+
         # Kill all of our in-flight tasks.
         if self.debug_print:
             self.debug_print_call(f'{self._label}: cancelling tasks...')
@@ -623,6 +918,7 @@ class RPCEndpoint:
 
     async def _run_read_task(self) -> None:
         """Read from the peer."""
+        # pylint: disable=too-many-branches
         self._check_env()
         assert self._peer_info is None
 
@@ -636,6 +932,11 @@ class RPCEndpoint:
         message = await self._reader.readexactly(mlen)
         self._total_bytes_read += mlen
         self._peer_info = dataclass_from_json(_PeerInfo, message.decode())
+        self._wide_message_ids = (
+            min(self._protocol, self._peer_info.protocol) >= 4
+        )
+        self._peer_info_event.set()
+        self._flush_pre_handshake_messages()
         self._last_keepalive_receive_time = time.monotonic()
         if self.debug_print:
             self.debug_print_call(
@@ -648,7 +949,13 @@ class RPCEndpoint:
                 return
 
             # Read message type.
-            mtype = _PacketType(await self._read_int_8())
+            typeval = await self._read_int_8()
+            compressed = bool(typeval & _PACKET_COMPRESSED_FLAG)
+            if compressed:
+                if not self._compression:
+                    raise RuntimeError('Got unsupported compressed packet.')
+                typeval &= ~_PACKET_COMPRESSED_FLAG
+            mtype = _PacketType(typeval)
             if mtype is _PacketType.HANDSHAKE:
                 raise RuntimeError('Got multiple handshakes')
 
@@ -661,29 +968,39 @@ class RPCEndpoint:
                 self._last_keepalive_receive_time = time.monotonic()
 
             elif mtype is _PacketType.MESSAGE:
-                await self._handle_message_packet(big=False)
+                await self._handle_message_packet(
+                    big=False, compressed=compressed
+                )
 
             elif mtype is _PacketType.MESSAGE_BIG:
-                await self._handle_message_packet(big=True)
+                await self._handle_message_packet(
+                    big=True, compressed=compressed
+                )
 
             elif mtype is _PacketType.RESPONSE:
-                await self._handle_response_packet(big=False)
+                await self._handle_response_packet(
+                    big=False, compressed=compressed
+                )
 
             elif mtype is _PacketType.RESPONSE_BIG:
-                await self._handle_response_packet(big=True)
+                await self._handle_response_packet(
+                    big=True, compressed=compressed
+                )
 
             else:
                 assert_never(mtype)
 
-    async def _handle_message_packet(self, big: bool) -> None:
+    async def _handle_message_packet(self, big: bool, compressed: bool) -> None:
         assert self._peer_info is not None
-        msgid = await self._read_int_16()
+        msgid = await self._read_message_id()
         if big:
             msglen = await self._read_int_32()
         else:
             msglen = await self._read_int_16()
         msg = await self._reader.readexactly(msglen)
         self._total_bytes_read += msglen
+        if compressed:
+            msg = self._decompress(msg)
         if self.debug_print_io:
             self.debug_print_call(
                 f'{self._label}: received message {msgid}'
@@ -705,9 +1022,11 @@ class RPCEndpoint:
                 f'{self._label}: done handling message at {self._tm()}.'
             )
 
-    async def _handle_response_packet(self, big: bool) -> None:
+    async def _handle_response_packet(
+        self, big: bool, compressed: bool
+    ) -> None:
         assert self._peer_info is not None
-        msgid = await self._read_int_16()
+        msgid = await self._read_message_id()
         # Protocol 2 gained 32 bit data lengths.
         if big:
             rsplen = await self._read_int_32()
@@ -720,7 +1039,9 @@ class RPCEndpoint:
             )
         rsp = await self._reader.readexactly(rsplen)
         self._total_bytes_read += rsplen
-        msgobj = self._in_flight_messages.get(msgid)
+        if compressed:
+            rsp = self._decompress(rsp)
+        msgobj = self._pop_in_flight_message(msgid)
         if msgobj is None:
             # It's possible for us to get a response to a message
             # that has timed out. In this case we will have no local
@@ -741,8 +1062,9 @@ class RPCEndpoint:
         # Introduce ourself so our peer knows how it can talk to us.
         data = dataclass_to_json(
             _PeerInfo(
-                protocol=OUR_PROTOCOL,
+                protocol=self._protocol,
                 keepalive_interval=self._keepalive_interval,
+                compression=[_COMPRESSION_ZLIB] if self._compression else [],
             )
         ).encode()
         self._writer.write(len(data).to_bytes(4, _BYTE_ORDER) + data)
@@ -752,31 +1074,68 @@ class RPCEndpoint:
             # Wait until some data comes in.
             await self._have_out_packets.wait()
 
-            assert self._out_packets
-            data = self._out_packets.popleft()
+            if self._write_batching:
+                await self._write_packet_batch()
+            else:
+                assert self._out_packets
+                data = self._out_packets.popleft()
+                self._out_bytes -= len(data)
 
-            # Important: only clear this once all packets are sent.
-            if not self._out_packets:
-                self._have_out_packets.clear()
+                # Important: only clear this once all packets are sent.
+                if not self._out_packets:
+                    self._have_out_packets.clear()
 
-            self._writer.write(data)
+                self._writer.write(data)
+                self._packets_written += 1
+                self._write_calls += 1
 
             # This should keep our writer from buffering huge amounts
-            # of outgoing data. We must remember though that we also
-            # need to prevent _out_packets from growing too large and
-            # that part's on us.
+            # of outgoing data. Keeping _out_packets from growing too
+            # large is on us (see _update_throttled()).
             await self._writer.drain()
 
-            # For now we're not applying backpressure, but let's make
-            # noise if this gets out of hand.
-            if len(self._out_packets) > 200:
-                if not self._did_out_packets_buildup_warning:
-                    logging.warning(
-                        '_out_packets building up too'
-                        ' much on RPCEndpoint %s.',
-                        id(self),
-                    )
-                    self._did_out_packets_buildup_warning = True
+            if self._throttled:
+                self._update_throttled()
+
+    async def _write_packet_batch(self) -> None:
+        """Write as many queued packets as we can in a single call.
+
+        This saves a write call and a drain per packet when lots of
+        small packets are going out.
+        """
+        # Optionally give more packets a chance to pile up (unless we
+        # already have a full batch's worth).
+        if (
+            self._write_batch_delay > 0.0
+            and self._out_bytes < self._write_batch_max_bytes
+        ):
+            await asyncio.sleep(self._write_batch_delay)
+
+        out_packets = self._out_packets
+        assert out_packets
+        maxbytes = self._write_batch_max_bytes
+
+        # Always take at least one packet, even if it's bigger than our
+        # limit.
+        data = out_packets.popleft()
+        batch = [data]
+        batchbytes = len(data)
+        while out_packets and batchbytes + len(out_packets[0]) <= maxbytes:
+            data = out_packets.popleft()
+            batch.append(data)
+            batchbytes += len(data)
+        self._out_bytes -= batchbytes
+
+        # Important: only clear this once all packets are sent.
+        if not out_packets:
+            self._have_out_packets.clear()
+
+        if len(batch) == 1:
+            self._writer.write(batch[0])
+        else:
+            self._writer.writelines(batch)
+        self._packets_written += len(batch)
+        self._write_calls += 1
 
     async def _run_keepalive_task(self) -> None:
         """Send periodic keepalive packets."""
@@ -864,21 +1223,131 @@ class RPCEndpoint:
                 raise RuntimeError('Response cannot be larger than 65535 bytes')
 
         # Now send back our response.
-        # Payload consists of type (1b), msgid (2b), len (2b), and data.
-        if len(response) > 65535:
-            self._enqueue_outgoing_packet(
-                _PacketType.RESPONSE_BIG.value.to_bytes(1, _BYTE_ORDER)
-                + message_id.to_bytes(2, _BYTE_ORDER)
-                + len(response).to_bytes(4, _BYTE_ORDER)
-                + response
-            )
+        self._enqueue_payload_packet(
+            _PacketType.RESPONSE,
+            _PacketType.RESPONSE_BIG,
+            message_id,
+            response,
+        )
+
+    def _enqueue_payload_packet(
+        self,
+        ptype: _PacketType,
+        ptype_big: _PacketType,
+        message_id: int,
+        data: bytes,
+    ) -> None:
+        """Enqueue a message or response packet.
+
+        Payload consists of type (1b), message_id (2b, or 4b for
+        protocol 4+), len (2b, or 4b for big types), and data. Data may
+        be compressed if our peer supports it, in which case the type
+        byte gets _PACKET_COMPRESSED_FLAG set and len is the compressed
+        size.
+        """
+        typeval = ptype.value
+        if (
+            self._compression
+            and self._compression_threshold
+            <= len(data)
+            <= _MAX_DECOMPRESSED_SIZE
+            and self._peer_info is not None
+            and _COMPRESSION_ZLIB in self._peer_info.compression
+        ):
+            starttime = time.thread_time()
+            compressed = zlib.compress(data, self._compression_level)
+            self._compress_cpu_time += time.thread_time() - starttime
+            self._compress_count += 1
+            self._compress_bytes_in += len(data)
+            self._compress_bytes_out += len(compressed)
+
+            # Only use it if it actually helps.
+            if len(compressed) < len(data):
+                data = compressed
+                typeval |= _PACKET_COMPRESSED_FLAG
+                self._compressed_packets_sent += 1
+
+        if len(data) > 65535:
+            typeval = (typeval & _PACKET_COMPRESSED_FLAG) | ptype_big.value
+            lenbytes = 4
         else:
-            self._enqueue_outgoing_packet(
-                _PacketType.RESPONSE.value.to_bytes(1, _BYTE_ORDER)
-                + message_id.to_bytes(2, _BYTE_ORDER)
-                + len(response).to_bytes(2, _BYTE_ORDER)
-                + response
+            lenbytes = 2
+        self._enqueue_outgoing_packet(
+            typeval.to_bytes(1, _BYTE_ORDER)
+            + message_id.to_bytes(
+                4 if self._wide_message_ids else 2, _BYTE_ORDER
+            )
+            + len(data).to_bytes(lenbytes, _BYTE_ORDER)
+            + data
+        )
+
+    def _enqueue_message_packet(self, msgobj: _InFlightMessage) -> None:
+        """Assign an id to a message and enqueue its packet."""
+        assert self._peer_info is not None
+        message = msgobj.message
+        assert message is not None
+        msgobj.message = None
+
+        if self._peer_info.protocol == 1 and len(message) > 65535:
+            msgobj.set_error(
+                RuntimeError('Message cannot be larger than 65535 bytes')
             )
+            return
+
+        # Find the next id not in use.
+        idcount = 1 << 32 if self._wide_message_ids else 1 << 16
+        in_flight = self._in_flight_messages
+        if len(in_flight) >= idcount:
+            self._busy_reject_count += 1
+            msgobj.set_error(RPCBusyError('Out of message ids.'))
+            return
+        message_id = self._next_message_id % idcount
+        while message_id in in_flight:
+            message_id = (message_id + 1) % idcount
+        self._next_message_id = (message_id + 1) % idcount
+
+        msgobj.message_id = message_id
+        in_flight[message_id] = msgobj
+        self._enqueue_payload_packet(
+            _PacketType.MESSAGE, _PacketType.MESSAGE_BIG, message_id, message
+        )
+
+    def _flush_pre_handshake_messages(self) -> None:
+        """Send messages that were waiting on our peer's handshake."""
+        pending = self._pre_handshake_messages
+        self._pre_handshake_messages = []
+        for msgobj in pending:
+            assert msgobj.message is not None
+            self._out_bytes -= len(msgobj.message)
+            if msgobj.future.done():
+                # Timed out already.
+                msgobj.message = None
+                continue
+            self._enqueue_message_packet(msgobj)
+        if self._throttled:
+            self._update_throttled()
+
+    def _decompress(self, data: bytes) -> bytes:
+        starttime = time.thread_time()
+        decompressor = zlib.decompressobj()
+        out = decompressor.decompress(data, _MAX_DECOMPRESSED_SIZE)
+
+        # Erroring here brings down our read task and thus the endpoint.
+        if decompressor.unconsumed_tail:
+            raise RuntimeError(
+                f'Compressed payload expands beyond'
+                f' {_MAX_DECOMPRESSED_SIZE} bytes.'
+            )
+        if not decompressor.eof:
+            raise RuntimeError('Got incomplete compressed payload.')
+        self._decompress_cpu_time += time.thread_time() - starttime
+        self._decompress_count += 1
+        return out
+
+    async def _read_message_id(self) -> int:
+        if self._wide_message_ids:
+            return await self._read_int_32()
+        return await self._read_int_16()
 
     async def _read_int_8(self) -> int:
         out = int.from_bytes(await self._reader.readexactly(1), _BYTE_ORDER)
@@ -930,10 +1399,134 @@ class RPCEndpoint:
 
         # Add the data and let our write task know about it.
         self._out_packets.append(data)
+        self._out_bytes += len(data)
         self._have_out_packets.set()
+        self._note_out_queue_growth()
+
+    def _out_packet_count(self) -> int:
+        # Messages waiting on a handshake count as queued packets.
+        return len(self._out_packets) + len(self._pre_handshake_messages)
+
+    def _in_flight_count(self) -> int:
+        return len(self._in_flight_messages) + len(self._pre_handshake_messages)
+
+    def _note_out_queue_growth(self) -> None:
+        packet_count = self._out_packet_count()
+        self._peak_out_packets = max(self._peak_out_packets, packet_count)
+        self._peak_out_bytes = max(self._peak_out_bytes, self._out_bytes)
+        if not self._throttled:
+            self._update_throttled()
+        elif not self._did_out_packets_buildup_warning and (
+            self._out_bytes > 4 * self._out_high_water_bytes
+            or packet_count > 4 * self._out_high_water_packets
+        ):
+            # Senders that ignore backpressure can still grow our queue
+            # without limit; make some noise if that seems to be
+            # happening.
+            logging.warning(
+                '_out_packets building up too much on RPCEndpoint %s'
+                ' (%d packets, %d bytes).',
+                id(self),
+                packet_count,
+                self._out_bytes,
+            )
+            self._did_out_packets_buildup_warning = True
+
+    def _update_throttled(self) -> None:
+        """Update throttled state based on our out-queue size.
+
+        We go throttled when we pass either high water mark and stay
+        that way until we drop to or below both low water marks.
+        """
+        if self._throttled:
+            if (
+                self._out_bytes <= self._out_low_water_bytes
+                and self._out_packet_count() <= self._out_low_water_packets
+            ):
+                self._throttled = False
+                self._send_capacity_changed.set()
+            return
+
+        if (
+            self._out_bytes > self._out_high_water_bytes
+            or self._out_packet_count() > self._out_high_water_packets
+        ):
+            self._throttled = True
+            self._throttle_count += 1
+
+    def _pop_in_flight_message(
+        self, message_id: int
+    ) -> _InFlightMessage | None:
+        msgobj = self._in_flight_messages.pop(message_id, None)
+        if msgobj is not None and self._max_in_flight_messages is not None:
+            self._send_capacity_changed.set()
+        return msgobj
+
+    def _remove_in_flight_message(self, msgobj: _InFlightMessage) -> None:
+        """Remove a message from our records if it is still there."""
+        message_id = msgobj.message_id
+        if message_id is not None:
+            if self._in_flight_messages.get(message_id) is not msgobj:
+                return
+            del self._in_flight_messages[message_id]
+        elif msgobj.message is not None:
+            # Still waiting on a handshake.
+            self._pre_handshake_messages.remove(msgobj)
+            self._out_bytes -= len(msgobj.message)
+            msgobj.message = None
+            if self._throttled:
+                self._update_throttled()
+        else:
+            return
+        if self._max_in_flight_messages is not None:
+            self._send_capacity_changed.set()
+
+    def _add_timeout(self, msgobj: _InFlightMessage) -> None:
+        self._prune_timeouts()
+        heapq.heappush(
+            self._timeout_heap, (msgobj.deadline, self._timeout_seq, msgobj)
+        )
+        self._timeout_seq += 1
+
+        # Generally timeouts get added in order, so we only need to
+        # touch our timer if this is the first or an earlier one.
+        handle = self._timeout_handle
+        if handle is None or msgobj.deadline < handle.when():
+            if handle is not None:
+                handle.cancel()
+            self._timeout_handle = self._event_loop.call_at(
+                msgobj.deadline, self._expire_timeouts
+            )
+
+    def _prune_timeouts(self) -> None:
+        """Prune entries for completed messages if they're dominating.
+
+        Only happens once the heap is at least double the number of
+        messages in flight, so the cost is amortized O(1) per message.
+        """
+        heap = self._timeout_heap
+        if len(heap) > 1024 and len(heap) > 2 * self._in_flight_count():
+            heap = [e for e in heap if not e[2].future.done()]
+            heapq.heapify(heap)
+            self._timeout_heap = heap
+
+    def _expire_timeouts(self) -> None:
+        self._timeout_handle = None
+        heap = self._timeout_heap
+        now = self._event_loop.time()
+        while heap and heap[0][0] <= now:
+            heapq.heappop(heap)[2].set_error(asyncio.TimeoutError())
+        if heap:
+            self._timeout_handle = self._event_loop.call_at(
+                heap[0][0], self._expire_timeouts
+            )
 
     def _prune_tasks(self) -> None:
-        self._tasks = self._get_live_tasks()
+        # Only bother once our list has grown a fair bit since the last
+        # prune; otherwise this gets quadratic with lots of live tasks.
+        if len(self._tasks) >= self._tasks_prune_size:
+            self._tasks = self._get_live_tasks()
+            self._tasks_prune_size = max(64, 2 * len(self._tasks))
 
     def _get_live_tasks(self) -> list[asyncio.Task]:
         return [t for t in self._tasks if not t.done()]
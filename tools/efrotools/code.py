@@ -966,42 +966,32 @@ def _run_idea_inspections_cached(
     verbose: bool,
     inspectdir: Path | None = None,
 ) -> None:
-    # pylint: disable=too-many-locals
     # pylint: disable=too-many-positional-arguments
-    import hashlib
-    import json
-
     from efro.terminal import Clr
+    from efrotools.util import get_files_hash
 
-    md5 = hashlib.md5()
-
-    # Let's calc a single hash from the contents of all script files and only
-    # run checks when that changes.  Sadly there's not much else optimization
-    # wise that we can easily do, but this will at least prevent re-checks when
-    # nothing at all has changed.
-    for filename in filenames:
-        with open(filename, 'rb') as infile:
-            md5.update(infile.read())
-
-    # Also hash a few .idea files so we re-run inspections when they change.
+    # Inspections run on everything at once, so we can't do much
+    # per-file optimization, but we can at least skip them when nothing
+    # at all has changed since the last successful run. Also factor in a
+    # few .idea files so we re-run inspections when they change.
     extra_hash_paths = [
         Path(projroot, '.idea/inspectionProfiles/Default.xml'),
         Path(projroot, '.idea/inspectionProfiles/Project_Default.xml'),
         Path(projroot, '.idea/dictionaries/ericf.xml'),
     ]
-    for epath in extra_hash_paths:
-        if os.path.exists(epath):
-            with open(epath, 'rb') as infile:
-                md5.update(infile.read())
-
-    current_hash = md5.hexdigest()
-    existing_hash: str | None
-    try:
-        with open(cachepath, encoding='utf-8') as infile2:
-            existing_hash = json.loads(infile2.read())['hash']
-    except Exception:
-        existing_hash = None
-    if full or current_hash != existing_hash:
+    extrahash = get_files_hash([p for p in extra_hash_paths if p.exists()])
+    if full and cachepath.exists():
+        cachepath.unlink()
+    cache = FileCache(cachepath)
+    cache.update(filenames, extrahash)
+    changed_dirs = cache.get_changed_dirs()
+    if changed_dirs or cache.get_dirty_files():
+        if verbose:
+            print(
+                f'Changed dirs since last {displayname} run:'
+                f' {sorted(changed_dirs)}',
+                flush=True,
+            )
         _run_idea_inspections(
             projroot,
             filenames,
@@ -1010,9 +1000,8 @@ def _run_idea_inspections_cached(
             verbose=verbose,
             inspectdir=inspectdir,
         )
-        cachepath.parent.mkdir(parents=True, exist_ok=True)
-        with open(cachepath, 'w', encoding='utf-8') as outfile:
-            outfile.write(json.dumps({'hash': current_hash}))
+        cache.mark_clean(filenames)
+        cache.write()
     print(
         f'{Clr.GRN}{displayname}: all {len(filenames)}'
         f' files are passing.{Clr.RST}',
@@ -1,5 +1,6 @@
 # Released under the MIT License. See LICENSE for details.
 #
+# pylint: disable=too-many-lines
 """A simple cloud caching system for making built binaries & assets.
 
 The basic idea here is the ballistica-internal project can flag file
@@ -14,9 +15,11 @@ from __future__ import annotations
 import os
 import json
 import zlib
+import threading
 import subprocess
 from typing import TYPE_CHECKING, Annotated
 from dataclasses import dataclass
+from contextlib import contextmanager
 from multiprocessing import cpu_count
 from concurrent.futures import ThreadPoolExecutor
 
@@ -28,9 +31,12 @@ from efro.dataclassio import (
 )
 from efro.terminal import Clr
 
-
 if TYPE_CHECKING:
+    from typing import IO, Any, Iterator
+    import http.client
+
     import efro.terminal
+    from efrotools.hashcache import FileHashCache
 
 
 TARGET_TAG = '# __EFROCACHE_TARGET__'
@@ -39,6 +45,9 @@ CACHE_MAP_NAME = '.efrocachemap'
 
 UPLOAD_STATE_CACHE_FILE = '.cache/efrocache_upload_state'
 
+# Where we remember hashes of files extracted from the cache.
+HASH_CACHE_FILE = '.cache/efrocache_hashes'
+
 # Cache file consists of these header bytes, single metadata length byte,
 # metadata utf8 bytes, compressed data bytes.
 CACHE_HEADER = b'efca'
@@ -52,9 +61,36 @@ class CacheMetadata:
     executable: Annotated[bool, IOAttrs('e')]
 
 
+# Max simultaneous downloads per repository (see CacheFetcher).
+FETCH_MAX_CONCURRENT = 8
+
+# Chunk size used when streaming downloads and decompression.
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Default number of targets get_targets() works on at once. Most of the
+# time goes to waiting on downloads, so we can go past our cpu count.
+GET_TARGETS_MAX_WORKERS = 8
+
 g_cache_prefix_noexec: bytes | None = None
 g_cache_prefix_exec: bytes | None = None
 
+# Loaded cache maps keyed by abs path, along with the mtime/size they
+# were loaded at (see get_cache_map()).
+g_cache_maps: dict[str, tuple[int, int, dict[str, str]]] = {}
+g_cache_maps_lock = threading.Lock()
+
+# Shared FileHashCaches keyed by project root.
+g_hash_caches: dict[str, FileHashCache] = {}
+g_hash_caches_lock = threading.Lock()
+
+# Shared CacheFetchers keyed by base url (see get_cache_fetcher()).
+g_cache_fetchers: dict[str, CacheFetcher] = {}
+g_cache_fetchers_lock = threading.Lock()
+
+
+class CacheFileNotFoundError(Exception):
+    """A repository did not provide a requested cache file."""
+
 
 def get_local_cache_dir() -> str:
     """Where we store local efrocache files we've downloaded.
@@ -74,9 +110,21 @@ def get_local_cache_dir() -> str:
 
 
 def get_repository_base_url() -> str:
-    """Return the base repository url (assumes cwd is project root)."""
+    """Return the base repository url (assumes cwd is project root).
+
+    This can be overridden by setting the EFROCACHE_REPOSITORY_URL
+    environment variable. Along with http(s) urls, file:// urls and
+    plain directory paths are supported for working offline (see
+    CacheFetcher).
+    """
     from efrotools.project import getprojectconfig
 
+    envval = os.environ.get('EFROCACHE_REPOSITORY_URL')
+    if envval:
+        if envval.endswith('/'):
+            raise RuntimeError('Repository string should not end in a slash.')
+        return envval
+
     pconfig = getprojectconfig('.')
     name = 'efrocache_repository_url'
     val = pconfig.get(name)
@@ -87,14 +135,249 @@ def get_repository_base_url() -> str:
     return val
 
 
+class CacheFetcher:
+    """Fetches files from an efrocache repository.
+
+    For http(s) repositories, connections are kept alive and reused
+    between fetches, and at most 'max_concurrent' fetches run at once
+    no matter how many threads are fetching. Repositories can also be
+    file:// urls or plain directory paths laid out like the server;
+    this is handy for offline testing or benchmarking. This is
+    thread-safe.
+    """
+
+    def __init__(
+        self, base_url: str, max_concurrent: int = FETCH_MAX_CONCURRENT
+    ) -> None:
+        import urllib.parse
+
+        assert max_concurrent > 0
+        self.base_url = base_url
+        self._local_dir: str | None = None
+        parsed = urllib.parse.urlsplit(base_url)
+        if parsed.scheme in {'http', 'https'}:
+            self._scheme = parsed.scheme
+            self._netloc = parsed.netloc
+            self._url_path = parsed.path
+        elif parsed.scheme == 'file':
+            self._local_dir = urllib.parse.unquote(parsed.path)
+        elif not parsed.scheme or len(parsed.scheme) == 1:
+            # (single letter 'schemes' are windows drive letters)
+            self._local_dir = base_url
+        else:
+            raise ValueError(f'Unsupported repository url: {base_url}')
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._connections: list[http.client.HTTPConnection] = []
+        self._connections_lock = threading.Lock()
+
+    def fetch(self, subpath: str, path: str) -> None:
+        """Fetch a file from the repository to a local path.
+
+        Data is streamed to a temp file next to the path which is then
+        renamed into place, so the path never holds partial data.
+        Raises CacheFileNotFoundError if the repository does not have
+        the file; other errors generally mean communication failed.
+        """
+        with self._semaphore, _atomic_output(path) as outfile:
+            if self._local_dir is not None:
+                try:
+                    with open(
+                        os.path.join(self._local_dir, subpath), 'rb'
+                    ) as infile:
+                        _copy_stream(infile, outfile)
+                except FileNotFoundError:
+                    raise CacheFileNotFoundError(subpath) from None
+            else:
+                self._fetch_http(subpath, outfile)
+
+    def close(self) -> None:
+        """Close any idle connections."""
+        with self._connections_lock:
+            connections = self._connections
+            self._connections = []
+        for connection in connections:
+            connection.close()
+
+    def _fetch_http(self, subpath: str, outfile: IO[bytes]) -> None:
+        import http.client
+
+        # Idle connections may have been dropped by the server; if one
+        # fails before we get any data we just try again with a new one.
+        connection: http.client.HTTPConnection | None
+        with self._connections_lock:
+            connection = self._connections.pop() if self._connections else None
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = (
+                    http.client.HTTPSConnection(self._netloc, timeout=60.0)
+                    if self._scheme == 'https'
+                    else http.client.HTTPConnection(self._netloc, timeout=60.0)
+                )
+            try:
+                connection.request('GET', f'{self._url_path}/{subpath}')
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if not reused:
+                    raise
+                connection = None
+                reused = False
+                continue
+            break
+
+        try:
+            if response.status != 200:
+                response.read()
+                if response.status in {403, 404, 410}:
+                    raise CacheFileNotFoundError(subpath)
+                raise RuntimeError(
+                    f'Got unexpected status {response.status} for {subpath}.'
+                )
+            _copy_stream(response, outfile)
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            with self._connections_lock:
+                self._connections.append(connection)
+
+
+def get_cache_fetcher(base_url: str) -> CacheFetcher:
+    """Return a shared CacheFetcher for a repository url.
+
+    Sharing fetchers lets connections be reused across targets (and
+    across commands in pcommandbatch servers).
+    """
+    with g_cache_fetchers_lock:
+        fetcher = g_cache_fetchers.get(base_url)
+        if fetcher is None:
+            fetcher = g_cache_fetchers[base_url] = CacheFetcher(base_url)
+        return fetcher
+
+
+def extract_cache_file(cache_path: str, path: str) -> None:
+    """Expand a local cache file to a target path.
+
+    Data is decompressed as it is read and written to a temp file next
+    to the path, which is then renamed into place with the proper
+    permissions, so the path never holds partial data.
+    """
+    with open(cache_path, 'rb') as infile:
+        if infile.read(4) != CACHE_HEADER:
+            raise RuntimeError('Invalid cache header.')
+        metalen = infile.read(1)[0]
+        metadata = dataclass_from_json(
+            CacheMetadata, infile.read(metalen).decode()
+        )
+        with _atomic_output(path, metadata.executable) as outfile:
+            decompressor = zlib.decompressobj()
+            while chunk := infile.read(STREAM_CHUNK_SIZE):
+                outfile.write(decompressor.decompress(chunk))
+            outfile.write(decompressor.flush())
+            if not decompressor.eof:
+                raise RuntimeError(f'Truncated cache file: {cache_path}')
+
+
+@contextmanager
+def _atomic_output(path: str, executable: bool = False) -> Iterator[IO[bytes]]:
+    """Write a file in place only once everything succeeds."""
+    import uuid
+
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmppath = f'{path}.{uuid.uuid4().hex[:10]}.tmp'
+
+    # Going through os.open gives us regular umask-based permissions
+    # (unlike tempfile).
+    fd = os.open(
+        tmppath,
+        os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0),
+        0o777 if executable else 0o666,
+    )
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            yield outfile
+        os.replace(tmppath, path)
+    except BaseException:
+        try:
+            os.unlink(tmppath)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _copy_stream(infile: Any, outfile: IO[bytes]) -> None:
+    while chunk := infile.read(STREAM_CHUNK_SIZE):
+        outfile.write(chunk)
+
+
+def get_cache_map(path: str = CACHE_MAP_NAME) -> dict[str, str]:
+    """Return the contents of a cache map file.
+
+    Maps are kept in memory after the first load and only reloaded when
+    the file's mtime or size changes, so this is cheap to call for each
+    target in long-running processes such as pcommandbatch servers. The
+    returned dict is shared; do not modify it.
+    """
+    abspath = os.path.abspath(path)
+    stat = os.stat(abspath)
+    with g_cache_maps_lock:
+        existing = g_cache_maps.get(abspath)
+        if (
+            existing is not None
+            and existing[0] == stat.st_mtime_ns
+            and existing[1] == stat.st_size
+        ):
+            return existing[2]
+
+        with open(abspath, encoding='utf-8') as infile:
+            cachemap = json.loads(infile.read())
+        if not isinstance(cachemap, dict):
+            raise RuntimeError(f'Invalid cache map: {path}')
+        g_cache_maps[abspath] = (stat.st_mtime_ns, stat.st_size, cachemap)
+        return cachemap
+
+
 def get_existing_file_hash(path: str) -> str:
-    """Return the hash used for caching."""
+    """Return the hash used for caching.
+
+    Results are remembered based on file stats (see
+    efrotools.hashcache), so files only get re-read when they change.
+    """
+    return _get_hash_cache().get_hash(path, 'efrocache', _calc_file_hash)
+
+
+def _touch_existing_file(path: str, hashval: str) -> None:
+    """Update the mod time on a file known to have a hash."""
+    _get_hash_cache().touch(path, 'efrocache', hashval)
+
+
+def _get_hash_cache() -> FileHashCache:
+    from efrotools.hashcache import FileHashCache
+
+    projroot = os.getcwd()
+    with g_hash_caches_lock:
+        hashcache = g_hash_caches.get(projroot)
+        if hashcache is None:
+            hashcache = g_hash_caches[projroot] = FileHashCache(
+                os.path.join(projroot, HASH_CACHE_FILE)
+            )
+        return hashcache
+
+
+def _calc_file_hash(path: str) -> str:
     import hashlib
 
     prefix = _cache_prefix_for_file(path)
     md5 = hashlib.md5()
+    md5.update(prefix)
     with open(path, 'rb') as infile:
-        md5.update(prefix + infile.read())
+        while chunk := infile.read(STREAM_CHUNK_SIZE):
+            md5.update(chunk)
     return md5.hexdigest()
 
 
@@ -115,11 +398,7 @@ def _project_centric_path(path: str) -> str:
 
 def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
     """Fetch a target path from the cache, downloading if need be."""
-    # pylint: disable=too-many-locals
-    # pylint: disable=too-many-statements
     # pylint: disable=too-many-branches
-    import tempfile
-
     from efro.error import CleanError
 
     output_lines: list[str] = []
@@ -128,13 +407,10 @@ def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
 
     path = _project_centric_path(path)
 
-    with open(CACHE_MAP_NAME, encoding='utf-8') as infile:
-        efrocachemap = json.loads(infile.read())
-    if path not in efrocachemap:
+    hashval = get_cache_map().get(path)
+    if hashval is None:
         raise RuntimeError(f'Path not found in efrocache: {path}')
 
-    hashval = efrocachemap[path]
-
     # These used to be url paths but now they're just hashes.
     assert not hashval.startswith('https:')
     assert '/' not in hashval
@@ -143,8 +419,6 @@ def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
     subpath = '/'.join([hashval[:2], hashval[2:4], hashval[4:]])
 
     repo = get_repository_base_url()
-    url = f'{repo}/{subpath}'
-
     local_cache_path = os.path.join(local_cache_dir, subpath)
 
     # First off: if there's already a file in place, check its hash. If
@@ -153,7 +427,7 @@ def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
     if os.path.isfile(path):
         existing_hash = get_existing_file_hash(path)
         if existing_hash == hashval:
-            os.utime(path, None)
+            _touch_existing_file(path, hashval)
             msg = f'Refreshing from cache: {path}'
             if batch:
                 output_lines.append(msg)
@@ -161,56 +435,35 @@ def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
                 print(msg)
             return '\n'.join(output_lines)
 
-    # Ok we need to download the cache file.
-    # Ok there's not a valid file in place already. Clear out whatever
-    # is there to start with.
-    if os.path.exists(path):
-        os.remove(path)
-
-    # Now, if we don't have this entry in our local cache, download it.
+    # Ok there's not a valid file in place already; we'll need to
+    # extract one. If we don't have this entry in our local cache,
+    # download it.
     if not os.path.exists(local_cache_path):
-        with tempfile.TemporaryDirectory() as tmpdir:
-            local_cache_dl_path = os.path.join(tmpdir, 'dl')
-            msg = f'Downloading: {clr.BLU}{path}{clr.RST}'
-            if batch:
-                output_lines.append(msg)
-            else:
-                print(msg)
-            result = subprocess.run(
-                [
-                    'curl',
-                    '--fail',
-                    '--silent',
-                    url,
-                    '--output',
-                    local_cache_dl_path,
-                ],
-                check=False,
-            )
-
-            # We prune old cache files on the server, so its possible for
-            # one to be trying to build something the server can no longer
-            # provide. try to explain the situation.
-            if result.returncode == 22:
-                raise CleanError(
-                    'Server gave an error. Old build files may no longer'
-                    ' be available on the server; make sure you are using'
-                    ' a recent commit.\n'
-                    'Note that build files will remain available'
-                    ' indefinitely once downloaded, even if deleted by the'
-                    f' server. So as long as your {local_cache_dir} directory'
-                    ' stays intact you should be able to repeat any builds you'
-                    ' have run before.'
-                )
-            if result.returncode != 0:
-                raise CleanError('Download failed; is your internet working?')
-
-            # Ok; cache download finished. Lastly move it in place to be as
-            # atomic as possible.
-            os.makedirs(os.path.dirname(local_cache_path), exist_ok=True)
-            subprocess.run(
-                ['mv', local_cache_dl_path, local_cache_path], check=True
-            )
+        msg = f'Downloading: {clr.BLU}{path}{clr.RST}'
+        if batch:
+            output_lines.append(msg)
+        else:
+            print(msg)
+        try:
+            get_cache_fetcher(repo).fetch(subpath, local_cache_path)
+        except CacheFileNotFoundError:
+            # We prune old cache files on the server, so its possible
+            # for one to be trying to build something the server can no
+            # longer provide. try to explain the situation.
+            raise CleanError(
+                'Server gave an error. Old build files may no longer'
+                ' be available on the server; make sure you are using'
+                ' a recent commit.\n'
+                'Note that build files will remain available'
+                ' indefinitely once downloaded, even if deleted by the'
+                f' server. So as long as your {local_cache_dir} directory'
+                ' stays intact you should be able to repeat any builds you'
+                ' have run before.'
+            ) from None
+        except Exception as exc:
+            raise CleanError(
+                f'Download failed; is your internet working? ({exc})'
+            ) from exc
 
     # Ok we should have a valid file in our cache dir at this point.
     # Just expand it to the target path.
@@ -221,30 +474,7 @@ def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
     else:
         print(msg)
 
-    # Extract and stage the file in a temp dir before doing
-    # a final move to the target location to be as atomic as possible.
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with open(local_cache_path, 'rb') as infile:
-            data = infile.read()
-        header = data[:4]
-        if header != CACHE_HEADER:
-            raise RuntimeError('Invalid cache header.')
-        metalen = data[4]
-        metabytes = data[5 : 5 + metalen]
-        datac = data[5 + metalen :]
-        metajson = metabytes.decode()
-        metadata = dataclass_from_json(CacheMetadata, metajson)
-        data = zlib.decompress(datac)
-
-        tmppath = os.path.join(tmpdir, 'out')
-        with open(tmppath, 'wb') as outfile:
-            outfile.write(data)
-        if metadata.executable:
-            subprocess.run(['chmod', '+x', tmppath], check=True)
-
-        # Ok; we wrote the file. Now move it into its final place.
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        subprocess.run(['mv', tmppath, path], check=True)
+    extract_cache_file(local_cache_path, path)
 
     if not os.path.exists(path):
         raise RuntimeError(f'File {path} did not wind up as expected.')
@@ -252,6 +482,41 @@ def get_target(path: str, batch: bool, clr: type[efro.terminal.ClrBase]) -> str:
     return '\n'.join(output_lines)
 
 
+def get_targets(
+    paths: list[str],
+    batch: bool,
+    clr: type[efro.terminal.ClrBase],
+    max_workers: int = GET_TARGETS_MAX_WORKERS,
+) -> str:
+    """Fetch many target paths from the cache at once.
+
+    This is equivalent to calling get_target() for each path but works
+    on up to 'max_workers' of them in parallel. All targets are
+    attempted even if some fail; the first failure is then raised.
+    """
+    # Dedupe while keeping order so we never work on a path twice at
+    # once.
+    paths = list(dict.fromkeys(_project_centric_path(p) for p in paths))
+    if not paths:
+        return ''
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, len(paths)))
+    ) as executor:
+        futures = [
+            executor.submit(get_target, path, batch, clr) for path in paths
+        ]
+    output_lines: list[str] = []
+    for future in futures:
+        if future.exception() is None:
+            output = future.result()
+            if output:
+                output_lines.append(output)
+    for future in futures:
+        future.result()
+    return '\n'.join(output_lines)
+
+
 def filter_makefile(makefile_dir: str, contents: str) -> str:
     """Filter makefile contents to use efrocache lookups."""
 
@@ -711,7 +976,7 @@ def _check_warm_start_entry(entry: tuple[str, str]) -> None:
     # If the file still matches the hash value we have for it,
     # go ahead and update its timestamp.
     if get_existing_file_hash(fname) == filehash:
-        os.utime(fname, None)
+        _touch_existing_file(fname, filehash)
 
 
 def _check_warm_start_entries(entries: list[tuple[str, str]]) -> None:
@@ -726,6 +991,9 @@ def warm_start_cache(cachetype: str) -> None:
     This may fetch an initial cache archive, batch update mod times
     to reflect new cache maps, etc.
     """
+    # pylint: disable=too-many-locals
+    import shutil
+    import tarfile
     import tempfile
 
     if cachetype not in {'gui', 'server'}:
@@ -754,25 +1022,14 @@ def warm_start_cache(cachetype: str) -> None:
             starter_cache_file_path = os.path.join(
                 tmpdir, f'{cachefname}.tar.xz'
             )
-            subprocess.run(
-                [
-                    'curl',
-                    '--fail',
-                    f'{base_url}/{cachefname}.tar.xz',
-                    '--output',
-                    starter_cache_file_path,
-                ],
-                check=True,
+            get_cache_fetcher(base_url).fetch(
+                f'{cachefname}.tar.xz', starter_cache_file_path
             )
             print('Decompressing starter-cache...', flush=True)
-            subprocess.run(
-                ['tar', '-xf', starter_cache_file_path], cwd=tmpdir, check=True
-            )
+            with tarfile.open(starter_cache_file_path, 'r:xz') as archive:
+                archive.extractall(tmpdir, filter='data')
             os.makedirs(os.path.dirname(local_cache_dir), exist_ok=True)
-            subprocess.run(
-                ['mv', os.path.join(tmpdir, 'efrocache'), local_cache_dir],
-                check=True,
-            )
+            shutil.move(os.path.join(tmpdir, 'efrocache'), local_cache_dir)
             print(
                 'Starter-cache fetched successfully! (should speed up builds).'
             )
@@ -801,10 +1058,7 @@ def warm_start_cache(cachetype: str) -> None:
     # turning the back off again once asset builds have migrated to
     # the cloud asset-package system.
     if bool(True):
-        cachemap: dict[str, str]
-        with open(CACHE_MAP_NAME, encoding='utf-8') as infile:
-            cachemap = json.loads(infile.read())
-        assert isinstance(cachemap, dict)
+        cachemap = get_cache_map()
         cachemap_mtime = os.path.getmtime(CACHE_MAP_NAME)
         entries: list[tuple[str, str]] = []
         for fname, filehash in cachemap.items():
@@ -4,15 +4,16 @@
 
 from __future__ import annotations
 
-import json
 import os
+import json
+import time
 from typing import TYPE_CHECKING
 
 # Pylint's preferred import order here seems non-deterministic (as of 2.10.1).
 # pylint: disable=useless-suppression
 # pylint: disable=wrong-import-order
 from efro.terminal import Clr
-from efrotools.util import get_files_hash
+from efrotools.util import get_files_hash, get_string_hash
 
 # pylint: enable=wrong-import-order
 # pylint: enable=useless-suppression
@@ -23,18 +24,37 @@ if TYPE_CHECKING:
 
 
 class FileCache:
-    """A cache of file hashes/etc. used in linting/formatting/etc."""
+    """A cache of file hashes/etc. used in linting/formatting/etc.
+
+    File hashes are remembered alongside file stats in a sidecar
+    FileHashCache (see efrotools.hashcache) so unchanged files don't
+    need to be re-read each run. We also store a combined stat
+    fingerprint for each directory as of the last write(); see
+    get_changed_dirs().
+    """
 
     def __init__(self, path: Path):
+        from efrotools.hashcache import FileHashCache
+
         self._path = path
+        self._hashcache = FileHashCache(f'{path}_hashes')
         self.curhashes: dict[str, str | None] = {}
         self.mtimes: dict[str, float] = {}
         self.entries: dict[str, Any]
+        self._dirprints: dict[str, str] = {}
+        self._lastdirprints: dict[str, str] = {}
+        self._changed_dirs: set[str] = set()
         if not os.path.exists(path):
             self.entries = {}
         else:
             with open(path, 'r', encoding='utf-8') as infile:
-                self.entries = json.loads(infile.read())
+                data = json.loads(infile.read())
+            if 'version' in data:
+                self.entries = data['entries']
+                self._lastdirprints = data['dirs']
+            else:
+                # Old style; just entries.
+                self.entries = data
 
     def update(self, filenames: Sequence[str], extrahash: str) -> None:
         """Update the cache for the provided files and hash type.
@@ -43,34 +63,112 @@ class FileCache:
         and mismatched hash values cleared. Entries for no-longer-existing
         files will be cleared as well.
         """
+        # pylint: disable=too-many-locals
+        from multiprocessing import cpu_count
+        from concurrent.futures import ThreadPoolExecutor
 
-        # First, completely prune entries for nonexistent files.
-        self.entries = {
-            path: val
-            for path, val in self.entries.items()
-            if os.path.isfile(path)
-        }
+        from efrotools.hashcache import RACY_WINDOW
 
-        # Also remove any not in our passed list.
+        filenames = list(dict.fromkeys(filenames))
+        kind = f'files:{extrahash}'
+
+        # Completely prune entries for files not in our list (including
+        # ones that no longer exist).
+        fileset = set(filenames)
         self.entries = {
-            path: val for path, val in self.entries.items() if path in filenames
+            path: val for path, val in self.entries.items() if path in fileset
         }
 
-        # Add empty entries for files that lack them.
-        # Also check and store current hashes for all files and clear
-        # any entry hashes that differ so we know they're dirty.
-        for filename in filenames:
-            if filename not in self.entries:
-                self.entries[filename] = {}
-            self.curhashes[filename] = curhash = get_files_hash(
-                [filename], extrahash
+        # Calc stat fingerprints for each directory. We don't record
+        # any for directories with very recently modified files, since
+        # further modifications could go unnoticed.
+        stats = {fname: os.stat(fname) for fname in filenames}
+        racy_cutoff = time.time_ns() - int(RACY_WINDOW * 1e9)
+        dirfiles: dict[str, list[tuple[str, int, int, int, int]]] = {}
+        racy_dirs: set[str] = set()
+        for fname, stat in stats.items():
+            dirname = os.path.dirname(fname)
+            dirfiles.setdefault(dirname, []).append(
+                (
+                    os.path.basename(fname),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    stat.st_ino,
+                    stat.st_mode,
+                )
             )
+            if stat.st_mtime_ns > racy_cutoff:
+                racy_dirs.add(dirname)
+        self._dirprints = {
+            dirname: get_string_hash(json.dumps([extrahash, sorted(files)]))
+            for dirname, files in dirfiles.items()
+            if dirname not in racy_dirs
+        }
+        self._changed_dirs = {
+            dirname
+            for dirname in dirfiles
+            if self._dirprints.get(dirname) is None
+            or self._dirprints[dirname] != self._lastdirprints.get(dirname)
+        } | {d for d in self._lastdirprints if d not in dirfiles}
+
+        # Add empty entries for files that lack them. Also check and
+        # store current hashes for all files and clear any entry hashes
+        # that differ so we know they're dirty. Files in unchanged dirs
+        # are known to still match their stored hashes, and the hash
+        # cache covers most others; we only read files as a last resort
+        # (and do that in parallel).
+        tohash: list[str] = []
+        for fname in filenames:
+            entry = self.entries.setdefault(fname, {})
+            stat = stats[fname]
+
             # Also store modtimes; we'll abort cache writes if
             # anything changed.
-            self.mtimes[filename] = os.path.getmtime(filename)
-            entry = self.entries[filename]
-            if 'hash' in entry and entry['hash'] != curhash:
-                del entry['hash']
+            self.mtimes[fname] = stat.st_mtime
+            if (
+                'hash' in entry
+                and not self._hashcache.paranoid
+                and os.path.dirname(fname) not in self._changed_dirs
+            ):
+                self.curhashes[fname] = entry['hash']
+                continue
+            curhash = self._hashcache.get_cached_hash(fname, kind, stat)
+            if curhash is None:
+                tohash.append(fname)
+            else:
+                self._set_curhash(fname, curhash)
+
+        def _calc(fname: str) -> str:
+            return get_files_hash([fname], extrahash)
+
+        def _hash(fname: str) -> str:
+            return self._hashcache.get_hash(fname, kind, _calc)
+
+        if len(tohash) > 1:
+            with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
+                for fname, curhash in zip(tohash, executor.map(_hash, tohash)):
+                    self._set_curhash(fname, curhash)
+        else:
+            for fname in tohash:
+                self._set_curhash(fname, _hash(fname))
+
+    def _set_curhash(self, fname: str, curhash: str) -> None:
+        self.curhashes[fname] = curhash
+        entry = self.entries[fname]
+        if 'hash' in entry and entry['hash'] != curhash:
+            del entry['hash']
+
+    def get_changed_dirs(self) -> set[str]:
+        """Return dirs whose files changed since the last write().
+
+        This covers files being added, removed, or modified (as judged
+        by stat fingerprints) as well as changes to the extrahash passed
+        to update(). It is valid after a call to update(). Dirs not
+        returned here are guaranteed to have no files whose dirty state
+        changed since the last write, so callers can skip per-file work
+        for them.
+        """
+        return self._changed_dirs
 
     def get_dirty_files(self) -> Sequence[str]:
         """Return paths for all entries with no hash value."""
@@ -99,7 +197,9 @@ class FileCache:
                     f' "{fname}"; cache not updated.{Clr.RST}'
                 )
                 return
-        out = json.dumps(self.entries)
+        out = json.dumps(
+            {'version': 2, 'entries': self.entries, 'dirs': self._dirprints}
+        )
         self._path.parent.mkdir(parents=True, exist_ok=True)
         with self._path.open('w') as outfile:
             outfile.write(out)
@@ -0,0 +1,217 @@
+# Released under the MIT License. See LICENSE for details.
+#
+"""Persistent caching of file content hashes keyed by file stats.
+
+Checking whether a file has changed by hashing its contents means
+reading every byte of every file on every run. A FileHashCache instead
+remembers the hash it last calculated for each file along with the
+file's size, mtime, inode, and mode, and only calculates a new hash
+when any of those differ.
+
+Caches are stored as json lines appended to a single file, so updates
+are cheap and multiple processes can safely share one (worst case, an
+entry is lost and a hash gets recalculated). The file is compacted
+when loaded if it has grown well beyond its live entry count.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import threading
+from typing import TYPE_CHECKING
+
+from efro.terminal import Clr
+
+if TYPE_CHECKING:
+    from typing import IO, Callable
+    from pathlib import Path
+
+# Set this env var to 1 to enable paranoid mode by default (see
+# FileHashCache). Handy for CI.
+PARANOID_ENV_VAR = 'EFRO_HASH_CACHE_PARANOID'
+
+# Files modified more recently than this many seconds before hashing
+# don't get cached. Otherwise a modification landing in the same mtime
+# tick as our hash could go unnoticed.
+RACY_WINDOW = 2.0
+
+# Compact on load when there are more than this many lines per entry.
+_COMPACT_RATIO = 2
+
+
+class FileHashCache:
+    """Remembers file content hashes keyed by stat fingerprints.
+
+    Each entry also stores a 'kind' string; a hash is only reused when
+    its kind matches, so kinds should identify how a hash was
+    calculated (hash type, extra data mixed in, etc). Only one kind is
+    stored per file.
+
+    In paranoid mode, hashes are always calculated, and any cases where
+    a matching fingerprint would have returned a stale hash are printed
+    and recorded in 'mismatches'. This is thread-safe.
+    """
+
+    def __init__(self, path: str | Path, paranoid: bool | None = None):
+        self._path = str(path)
+        self.paranoid = (
+            os.environ.get(PARANOID_ENV_VAR) == '1'
+            if paranoid is None
+            else paranoid
+        )
+        self.mismatches: list[str] = []
+        self._lock = threading.Lock()
+        self._file: IO[str] | None = None
+
+        # Path -> (kind, size, mtime_ns, inode, mode, hash).
+        self._entries: dict[str, tuple[str, int, int, int, int, str]] = {}
+        self._load()
+
+    def get_hash(
+        self, fname: str, kind: str, calc: Callable[[str], str]
+    ) -> str:
+        """Return the hash of a file, calculating it only if needed.
+
+        'calc' is called with the file name to calculate a hash when
+        there is no valid cached one.
+        """
+        stat = os.stat(fname)
+        fingerprint = _fingerprint(kind, stat)
+        with self._lock:
+            entry = self._entries.get(fname)
+        cached = (
+            entry[5] if entry is not None and entry[:5] == fingerprint else None
+        )
+        if cached is not None and not self.paranoid:
+            return cached
+
+        value = calc(fname)
+        if cached is not None:
+            if cached != value:
+                print(
+                    f'{Clr.RED}FileHashCache mismatch for {fname}:'
+                    f' cached {cached}, actual {value}.{Clr.RST}',
+                    file=sys.stderr,
+                )
+                with self._lock:
+                    self.mismatches.append(fname)
+            else:
+                return value
+
+        # Don't cache anything modified too recently to trust.
+        if stat.st_mtime_ns > time.time_ns() - int(RACY_WINDOW * 1e9):
+            return value
+
+        self._store(fname, fingerprint, value)
+        return value
+
+    def get_cached_hash(
+        self, fname: str, kind: str, stat: os.stat_result
+    ) -> str | None:
+        """Return a file's cached hash without calculating anything.
+
+        'stat' should be the file's current stat result. Returns None if
+        there is no valid cached hash (or if we're in paranoid mode).
+        """
+        if self.paranoid:
+            return None
+        with self._lock:
+            entry = self._entries.get(fname)
+        if entry is not None and entry[:5] == _fingerprint(kind, stat):
+            return entry[5]
+        return None
+
+    def touch(self, fname: str, kind: str, value: str) -> None:
+        """Update a file's modification time, keeping its cached hash.
+
+        'value' must be the file's current hash. Plain os.utime() calls
+        change a file's fingerprint, which would force a rehash next
+        time.
+        """
+        # We set an exact nanosecond time here instead of letting the
+        # filesystem pick one, so if that time sticks there is
+        # effectively no chance of a later write landing on the same
+        # mtime and we don't need to wait out RACY_WINDOW. Filesystems
+        # with coarse timestamps will truncate it, however, in which
+        # case a later write could land in the same tick; we don't cache
+        # anything then.
+        now = time.time_ns()
+        os.utime(fname, ns=(now, now))
+        stat = os.stat(fname)
+        if stat.st_mtime_ns != now:
+            return
+        self._store(fname, _fingerprint(kind, stat), value)
+
+    def _store(
+        self,
+        fname: str,
+        fingerprint: tuple[str, int, int, int, int],
+        value: str,
+    ) -> None:
+        with self._lock:
+            self._entries[fname] = (*fingerprint, value)
+            try:
+                if self._file is None:
+                    dirname = os.path.dirname(self._path)
+                    if dirname:
+                        os.makedirs(dirname, exist_ok=True)
+                    # pylint: disable=consider-using-with
+                    self._file = open(self._path, 'a', encoding='utf-8')
+                self._file.write(
+                    json.dumps([fname, *fingerprint, value]) + '\n'
+                )
+                self._file.flush()
+            except OSError:
+                # The cache is only an optimization; never fail because
+                # of it.
+                pass
+
+    def close(self) -> None:
+        """Close our file (will be reopened if needed)."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _load(self) -> None:
+        try:
+            with open(self._path, encoding='utf-8') as infile:
+                lines = infile.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                fname, kind, size, mtime_ns, inode, mode, value = json.loads(
+                    line
+                )
+            except Exception:
+                # Most likely a partial write; no biggie.
+                continue
+            self._entries[fname] = (kind, size, mtime_ns, inode, mode, value)
+
+        if len(lines) > _COMPACT_RATIO * max(len(self._entries), 100):
+            self._compact()
+
+    def _compact(self) -> None:
+        tmppath = f'{self._path}.{os.getpid()}.tmp'
+        try:
+            with open(tmppath, 'w', encoding='utf-8') as outfile:
+                outfile.write(
+                    ''.join(
+                        json.dumps([fname, *entry]) + '\n'
+                        for fname, entry in self._entries.items()
+                        if os.path.exists(fname)
+                    )
+                )
+            os.replace(tmppath, self._path)
+        except OSError:
+            pass
+
+
+def _fingerprint(
+    kind: str, stat: os.stat_result
+) -> tuple[str, int, int, int, int]:
+    return (kind, stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_mode)
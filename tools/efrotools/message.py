@@ -23,6 +23,7 @@ def standard_message_sender_gen_pcommand(
     enable_async_sends: bool,
     get_protocol_call: str = 'get_protocol',
     embedded: bool = False,
+    precompile: bool = False,
 ) -> None:
     """Used by pcommands taking a single filename argument."""
     # pylint: disable=too-many-locals
@@ -75,6 +76,7 @@ def standard_message_sender_gen_pcommand(
         build_time_protocol_create_code=build_time_protocol_create_code,
         enable_sync_sends=enable_sync_sends,
         enable_async_sends=enable_async_sends,
+        precompile=precompile,
     )
     out = format_python_str(projroot, out)
 
@@ -92,6 +94,7 @@ def standard_message_receiver_gen_pcommand(
     is_async: bool,
     get_protocol_call: str = 'get_protocol',
     embedded: bool = False,
+    precompile: bool = False,
 ) -> None:
     """Used by pcommands generating efro.message receiver modules."""
     # pylint: disable=too-many-locals
@@ -145,6 +148,7 @@ def standard_message_receiver_gen_pcommand(
         protocol_module_level_import_code=protocol_module_level_import_code,
         build_time_protocol_create_code=build_time_protocol_create_code,
         is_async=is_async,
+        precompile=precompile,
     )
     out = format_python_str(projroot, out)
 
@@ -1,5 +1,6 @@
 # Released under the MIT License. See LICENSE for details.
 #
+# pylint: disable=too-many-lines
 """Standard snippets that can be pulled into project pcommand scripts.
 
 A snippet is a mini-program that directly takes input from stdin and does
@@ -14,7 +15,14 @@ from typing import TYPE_CHECKING
 from efrotools import pcommand
 
 if TYPE_CHECKING:
-    pass
+    from typing import Any, Callable
+
+    from efro.message import (
+        Message,
+        Response,
+        MessageProtocol,
+        MessageReceiver,
+    )
 
 
 def with_build_lock() -> None:
@@ -212,5 +220,1139 @@ def pcommandbatch_speed_test() -> None:
         )
 
 
+def dataclassio_speed_test() -> None:
+    """Compare compiled dataclassio codecs against interpreted ones."""
+    # pylint: disable=too-many-locals
+    import time
+    import functools
+    import datetime
+
+    from efro.terminal import Clr
+    from efro.logging import LogArchive, LogEntry, LogLevel
+    from efro.dataclassio import Codec, dataclass_from_dict, dataclass_to_dict
+    from efro.dataclassio._outputter import _Outputter
+    from efro.dataclassio._inputter import _Inputter
+
+    pcommand.disallow_in_batch()
+
+    now = datetime.datetime.now(datetime.UTC)
+    archive = LogArchive(
+        log_size=1000,
+        start_index=0,
+        entries=[
+            LogEntry(
+                name='ba.app',
+                message=f'Test message number {i}.',
+                level=LogLevel.INFO,
+                time=now,
+                labels={'foo': 'bar'} if i % 2 else {},
+            )
+            for i in range(1000)
+        ],
+    )
+    archive_dict = _Outputter(
+        archive,
+        create=True,
+        codec=Codec.JSON,
+        coerce_to_float=True,
+        discard_extra_attrs=False,
+    ).run()
+
+    def _time(call: Callable[[], Any]) -> float:
+        # Run once to warm things up (and compile codecs).
+        call()
+        count = 20
+        start = time.perf_counter()
+        for _i in range(count):
+            call()
+        return (time.perf_counter() - start) / count
+
+    def _encode(compiled: bool) -> None:
+        _Outputter(
+            archive,
+            create=True,
+            codec=Codec.JSON,
+            coerce_to_float=True,
+            discard_extra_attrs=False,
+            compiled=compiled,
+        ).run()
+
+    def _decode(compiled: bool) -> None:
+        _Inputter(
+            LogArchive,
+            codec=Codec.JSON,
+            coerce_to_float=True,
+            compiled=compiled,
+        ).run(archive_dict)
+
+    print(f'{Clr.BLU}LogArchive with 1000 entries:{Clr.RST}')
+    for name, compiled in [('interpreted', False), ('compiled', True)]:
+        enctime = _time(functools.partial(_encode, compiled))
+        dectime = _time(functools.partial(_decode, compiled))
+        print(
+            f'  {name:<12} encode {Clr.SMAG}{enctime*1000.0:.2f}ms{Clr.RST}'
+            f' decode {Clr.SMAG}{dectime*1000.0:.2f}ms{Clr.RST}'
+        )
+
+    # Decoding just to check a top level field and then passing things
+    # along is where lazy decoding should shine.
+    def _forward(lazy: bool) -> None:
+        archive2 = dataclass_from_dict(LogArchive, archive_dict, lazy=lazy)
+        assert archive2.start_index == 0
+        dataclass_to_dict(archive2)
+
+    for name, lazy in [('forward', False), ('lazy forward', True)]:
+        fwdtime = _time(functools.partial(_forward, lazy))
+        print(f'  {name:<12} {Clr.SMAG}{fwdtime*1000.0:.2f}ms{Clr.RST}')
+
+    _dataclassio_batch_speed_test()
+    _dataclassio_stream_speed_test()
+    _dataclassio_binary_speed_test()
+
+
+def _dataclassio_batch_speed_test() -> None:
+    # pylint: disable=too-many-locals
+    import os
+    import time
+    import functools
+    import datetime
+    from concurrent.futures import ProcessPoolExecutor
+
+    from efro.terminal import Clr
+    from efro.logging import LogEntry, LogLevel
+    from efro.dataclassio import (
+        dataclass_to_dict,
+        dataclass_from_dict,
+        dataclasses_to_dicts,
+        dataclasses_from_dicts,
+    )
+
+    def _time(call: Callable[[], Any], count: int) -> str:
+        reps = max(1, 100000 // count)
+        start = time.perf_counter()
+        for _i in range(reps):
+            call()
+        duration = time.perf_counter() - start
+        return (
+            f'{Clr.SMAG}{duration * 1000000.0 / (reps * count):.2f}us{Clr.RST}'
+        )
+
+    def _encode_each(entries: list[LogEntry]) -> None:
+        for entry in entries:
+            dataclass_to_dict(entry)
+
+    def _decode_each(dicts: list[dict]) -> None:
+        for value in dicts:
+            dataclass_from_dict(LogEntry, value)
+
+    now = datetime.datetime.now(datetime.UTC)
+    print(f'{Clr.BLU}LogEntry batches (per-item cost):{Clr.RST}')
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for count in (1, 100, 100000):
+            entries = [
+                LogEntry(
+                    name='ba.app',
+                    message=f'Test message number {i}.',
+                    level=LogLevel.INFO,
+                    time=now,
+                )
+                for i in range(count)
+            ]
+            dicts = dataclasses_to_dicts(entries)
+            calls: list[tuple[str, Callable[[], Any], Callable[[], Any]]] = [
+                (
+                    'each',
+                    functools.partial(_encode_each, entries),
+                    functools.partial(_decode_each, dicts),
+                ),
+                (
+                    'batch',
+                    functools.partial(dataclasses_to_dicts, entries),
+                    functools.partial(dataclasses_from_dicts, LogEntry, dicts),
+                ),
+            ]
+            if count >= 100000:
+                calls.append(
+                    (
+                        'procpool',
+                        functools.partial(
+                            dataclasses_to_dicts, entries, executor=executor
+                        ),
+                        functools.partial(
+                            dataclasses_from_dicts,
+                            LogEntry,
+                            dicts,
+                            executor=executor,
+                        ),
+                    )
+                )
+            for name, encode, decode in calls:
+                print(
+                    f'  {count:>6} {name:<8}'
+                    f' encode {_time(encode, count)}'
+                    f' decode {_time(decode, count)}'
+                )
+
+
+def _dataclassio_stream_speed_test() -> None:
+    # pylint: disable=too-many-locals
+    import os
+    import time
+    import datetime
+    import tempfile
+    import tracemalloc
+
+    from efro.terminal import Clr
+    from efro.logging import LogArchive, LogEntry, LogLevel
+    from efro.dataclassio import (
+        dataclass_to_json,
+        dataclass_from_json,
+        dataclass_to_json_stream,
+        dataclass_from_json_stream,
+    )
+
+    entrycount = 50000
+    now = datetime.datetime.now(datetime.UTC)
+    archive = LogArchive(
+        log_size=entrycount,
+        start_index=0,
+        entries=[
+            LogEntry(
+                name='ba.app',
+                message=f'Test message number {i}.',
+                level=LogLevel.INFO,
+                time=now,
+            )
+            for i in range(entrycount)
+        ],
+    )
+
+    def _measure(call: Callable[[], Any]) -> tuple[float, float]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        call()
+        duration = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return duration, peak / (1024 * 1024)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, 'archive.json')
+
+        def _write_regular() -> None:
+            with open(path, 'w', encoding='utf-8') as outfile:
+                outfile.write(dataclass_to_json(archive))
+
+        def _write_stream() -> None:
+            with open(path, 'w', encoding='utf-8') as outfile:
+                dataclass_to_json_stream(archive, outfile)
+
+        def _read_regular() -> None:
+            with open(path, encoding='utf-8') as infile:
+                dataclass_from_json(LogArchive, infile.read())
+
+        def _read_stream() -> None:
+            with open(path, encoding='utf-8') as infile:
+                dataclass_from_json_stream(LogArchive, infile)
+
+        _write_regular()
+        size = os.path.getsize(path) / (1024 * 1024)
+        print(
+            f'{Clr.BLU}LogArchive with {entrycount} entries'
+            f' ({size:.1f}MB json):{Clr.RST}'
+        )
+        for name, call in [
+            ('write', _write_regular),
+            ('write stream', _write_stream),
+            ('read', _read_regular),
+            ('read stream', _read_stream),
+        ]:
+            duration, peak = _measure(call)
+            print(
+                f'  {name:<12} {Clr.SMAG}{duration*1000.0:.0f}ms{Clr.RST}'
+                f' peak-mem {Clr.SMAG}{peak:.1f}MB{Clr.RST}'
+            )
+
+
+def _dataclassio_binary_speed_test() -> None:
+    # pylint: disable=too-many-locals
+    import os
+    import time
+    import functools
+    import datetime
+
+    from efro.terminal import Clr
+    from efro.dataclassio import (
+        dataclass_to_json,
+        dataclass_from_json,
+        dataclass_to_binary,
+        dataclass_from_binary,
+    )
+    from bacommon.bs import (
+        InboxRequestResponse,
+        ClientUIWrapper,
+        BasicClientUI,
+        BasicClientUIComponentText,
+        BasicClientUIExpireTime,
+    )
+    from bacommon.cloud import WorkspaceFetchResponse, WorkspaceFetchState
+    from bacommon.transfer import DirectoryManifest, DirectoryManifestFile
+
+    now = datetime.datetime.now(datetime.UTC)
+    inbox = InboxRequestResponse(
+        wrappers=[
+            ClientUIWrapper(
+                id=f'msg{i:06d}',
+                createtime=now,
+                ui=BasicClientUI(
+                    components=[
+                        BasicClientUIComponentText(
+                            text='You placed ${RANK} in the ${NAME} tourney.',
+                            subs=['${RANK}', str(i), '${NAME}', 'Onslaught'],
+                        ),
+                        BasicClientUIExpireTime(time=now),
+                    ]
+                ),
+            )
+            for i in range(25)
+        ]
+    )
+    workspace = WorkspaceFetchResponse(
+        state=WorkspaceFetchState(
+            manifest=DirectoryManifest(
+                files={
+                    f'scripts/module{i}.py': DirectoryManifestFile(
+                        hash_sha256=os.urandom(32).hex(), size=1000 + i
+                    )
+                    for i in range(300)
+                },
+                exists=True,
+            )
+        ),
+        downloads_inline={
+            f'scripts/module{i}.py': os.urandom(4096) for i in range(10)
+        },
+    )
+
+    def _time(call: Callable[[], Any]) -> float:
+        call()
+        count = 50
+        start = time.perf_counter()
+        for _i in range(count):
+            call()
+        return (time.perf_counter() - start) / count
+
+    for title, obj in [
+        ('bacommon.bs.InboxRequestResponse (25 entries)', inbox),
+        ('bacommon.cloud.WorkspaceFetchResponse (300 files)', workspace),
+    ]:
+        cls = type(obj)
+        jsondata = dataclass_to_json(obj)
+        bindata = dataclass_to_binary(obj)
+        assert dataclass_from_binary(cls, bindata) == obj
+        print(f'{Clr.BLU}{title}:{Clr.RST}')
+        for name, size, enctime, dectime in [
+            (
+                'json',
+                len(jsondata.encode()),
+                _time(functools.partial(dataclass_to_json, obj)),
+                _time(functools.partial(dataclass_from_json, cls, jsondata)),
+            ),
+            (
+                'binary',
+                len(bindata),
+                _time(functools.partial(dataclass_to_binary, obj)),
+                _time(functools.partial(dataclass_from_binary, cls, bindata)),
+            ),
+        ]:
+            print(
+                f'  {name:<8} {Clr.SMAG}{size}{Clr.RST} bytes'
+                f' encode {Clr.SMAG}{enctime*1000.0:.3f}ms{Clr.RST}'
+                f' decode {Clr.SMAG}{dectime*1000.0:.3f}ms{Clr.RST}'
+            )
+
+
+def rpc_speed_test() -> None:
+    """Measure efro.rpc throughput and latency over loopback."""
+    import asyncio
+
+    from efro.terminal import Clr
+
+    pcommand.disallow_in_batch()
+
+    configs: list[tuple[str, dict[str, Any]]] = [
+        ('unbatched', {'write_batching': False}),
+        ('batched', {}),
+        ('batched+1ms', {'write_batch_delay': 0.001}),
+    ]
+    print(
+        f'{Clr.BLU}RPC loopback; 64 byte messages'
+        f' (throughput with 500 in flight; latency sequential):{Clr.RST}'
+    )
+    for name, endpoint_kwargs in configs:
+        rate, mean, p99, perwrite = asyncio.run(
+            _rpc_speed_test_small(endpoint_kwargs)
+        )
+        print(
+            f'  {name:<12} {Clr.SMAG}{rate:.0f}{Clr.RST} msgs/sec'
+            f' latency mean {Clr.SMAG}{mean * 1000000.0:.0f}us{Clr.RST}'
+            f' p99 {Clr.SMAG}{p99 * 1000000.0:.0f}us{Clr.RST}'
+            f' packets/write {perwrite:.1f}'
+        )
+
+    asyncio.run(_rpc_speed_test_compression())
+    asyncio.run(_rpc_speed_test_connect())
+
+
+class _RPCLoopback:
+    """Echoing RPCEndpoints connected over loopback."""
+
+    def __init__(self, endpoint_kwargs: dict[str, Any]) -> None:
+        self.endpoint_kwargs = endpoint_kwargs
+        self.clients: list[Any] = []
+        self._client_tasks: list[Any] = []
+        self._server_tasks: list[Any] = []
+        self._server: Any = None
+        self._port: int | None = None
+
+    @property
+    def client(self) -> Any:
+        """The first client endpoint."""
+        return self.clients[0]
+
+    async def start(self, connect: bool = True) -> None:
+        """Bring up the server and (optionally) connect a client to it."""
+        import asyncio
+
+        from efro.rpc import RPCEndpoint
+
+        async def _handle_client(
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            self._server_tasks.append(asyncio.current_task())
+            await RPCEndpoint(
+                self._handle,
+                reader,
+                writer,
+                'speedtest server',
+                **self.endpoint_kwargs,
+            ).run()
+
+        self._server = await asyncio.start_server(
+            _handle_client, '127.0.0.1', 0, backlog=1024
+        )
+        self._port = self._server.sockets[0].getsockname()[1]
+        if connect:
+            await self.connect()
+
+    async def connect(self) -> Any:
+        """Connect a new client endpoint to our server."""
+        import asyncio
+
+        from efro.rpc import RPCEndpoint
+
+        assert self._port is not None
+        reader, writer = await asyncio.open_connection('127.0.0.1', self._port)
+        client = RPCEndpoint(
+            self._handle,
+            reader,
+            writer,
+            'speedtest client',
+            **self.endpoint_kwargs,
+        )
+        self.clients.append(client)
+        self._client_tasks.append(asyncio.create_task(client.run()))
+        return client
+
+    async def stop(self) -> None:
+        """Tear everything down."""
+        import asyncio
+
+        for client in self.clients:
+            client.close()
+        await asyncio.gather(*self._client_tasks)
+        await asyncio.gather(*self._server_tasks)
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, message: bytes) -> bytes:
+        return message
+
+
+async def _rpc_speed_test_small(
+    endpoint_kwargs: dict[str, Any],
+) -> tuple[float, float, float, float]:
+    import time
+    import asyncio
+
+    loopback = _RPCLoopback(endpoint_kwargs)
+    await loopback.start()
+    client = loopback.client
+    message = bytes(64)
+
+    # Warm up.
+    await asyncio.gather(*[client.send_message(message) for _ in range(100)])
+
+    # Throughput; keep a window of messages in flight.
+    count = 20000
+    window = 500
+    start = time.perf_counter()
+    for _i in range(count // window):
+        await asyncio.gather(
+            *[client.send_message(message) for _ in range(window)]
+        )
+    msgs_per_sec = count / (time.perf_counter() - start)
+    stats = client.get_stats()
+
+    # Latency; one message at a time.
+    times: list[float] = []
+    for _i in range(2000):
+        start = time.perf_counter()
+        await client.send_message(message)
+        times.append(time.perf_counter() - start)
+    times.sort()
+
+    await loopback.stop()
+
+    return (
+        msgs_per_sec,
+        sum(times) / len(times),
+        times[int(len(times) * 0.99)],
+        stats.packets_written / stats.write_calls,
+    )
+
+
+async def _rpc_speed_test_compression() -> None:
+    # pylint: disable=too-many-locals
+    import time
+    import datetime
+
+    from efro.terminal import Clr
+    from efro.logging import LogArchive, LogEntry, LogLevel
+    from efro.dataclassio import dataclass_to_json
+
+    # A log archive makes for a reasonably realistic big json payload.
+    now = datetime.datetime.now(datetime.UTC)
+    message = dataclass_to_json(
+        LogArchive(
+            log_size=1000,
+            start_index=0,
+            entries=[
+                LogEntry(
+                    name='ba.app',
+                    message=f'Test message number {i}.',
+                    level=LogLevel.INFO,
+                    time=now + datetime.timedelta(seconds=i * 0.123),
+                    labels={'foo': 'bar'} if i % 2 else {},
+                )
+                for i in range(1000)
+            ],
+        )
+    ).encode()
+
+    print(
+        f'{Clr.BLU}RPC loopback; {len(message)} byte json messages'
+        f' (sequential round trips):{Clr.RST}'
+    )
+    for name, compression in [('raw', False), ('compressed', True)]:
+        loopback = _RPCLoopback({'compression': compression})
+        await loopback.start()
+        client = loopback.client
+        await client.send_message(message)
+        count = 200
+        start = time.perf_counter()
+        for _i in range(count):
+            await client.send_message(message)
+        duration = time.perf_counter() - start
+        stats = client.get_stats()
+        await loopback.stop()
+        cpu = stats.compress_cpu_time + stats.decompress_cpu_time
+        print(
+            f'  {name:<12}'
+            f' {Clr.SMAG}{count / duration:.0f}{Clr.RST} msgs/sec'
+            f' ratio {Clr.SMAG}{stats.compression_ratio:.3f}{Clr.RST}'
+            f' client compress+decompress cpu'
+            f' {Clr.SMAG}{cpu * 1000.0 / (count + 1):.3f}ms{Clr.RST}/msg'
+        )
+
+
+async def _rpc_speed_test_connect() -> None:
+    import time
+    import asyncio
+
+    from efro.terminal import Clr
+
+    count = 1000
+    loopback = _RPCLoopback({})
+    await loopback.start(connect=False)
+    times: list[float] = []
+
+    async def _connect_and_send() -> None:
+        client = await loopback.connect()
+        start = time.perf_counter()
+        await client.send_message(b'hello')
+        times.append(time.perf_counter() - start)
+
+    print(
+        f'{Clr.BLU}RPC loopback; time-to-first-response'
+        f' for {count} connections:{Clr.RST}'
+    )
+    for name, simultaneous in [('sequential', False), ('simultaneous', True)]:
+        times.clear()
+        start = time.perf_counter()
+        if simultaneous:
+            await asyncio.gather(*[_connect_and_send() for _ in range(count)])
+        else:
+            for _i in range(count):
+                await _connect_and_send()
+        duration = time.perf_counter() - start
+        times.sort()
+        print(
+            f'  {name:<12} total {Clr.SMAG}{duration * 1000.0:.0f}ms{Clr.RST}'
+            f' mean {Clr.SMAG}{sum(times) / count * 1000.0:.2f}ms{Clr.RST}'
+            f' p50 {Clr.SMAG}{times[count // 2] * 1000.0:.2f}ms{Clr.RST}'
+            f' p99 {Clr.SMAG}{times[int(count * 0.99)] * 1000.0:.2f}ms{Clr.RST}'
+        )
+    await loopback.stop()
+
+
+def message_speed_test() -> None:
+    """Measure efro.message round trip throughput."""
+    # pylint: disable=too-many-locals
+    import time
+    import asyncio
+    import datetime
+    import functools
+    from dataclasses import dataclass
+    from typing import Annotated, override
+
+    from efro.terminal import Clr
+    from efro.logging import LogEntry, LogLevel
+    from efro.dataclassio import ioprep, IOAttrs
+    from efro.message import (
+        Message,
+        BoolResponse,
+        StringResponse,
+        MessageProtocol,
+        MessageSender,
+        MessageReceiver,
+        MessageMetrics,
+    )
+
+    pcommand.disallow_in_batch()
+
+    # Note: we're defining things locally here so need to explicitly
+    # provide what our annotations refer to.
+    @dataclass
+    class TinyMessage(Message):
+        """A message with a single int."""
+
+        value: Annotated[int, IOAttrs('v')]
+
+        @override
+        @classmethod
+        def get_response_types(cls) -> list[type[Response] | None]:
+            return [BoolResponse]
+
+    @dataclass
+    class LargeMessage(Message):
+        """A message with lots of nested data."""
+
+        entries: Annotated[list[LogEntry], IOAttrs('e')]
+
+        @override
+        @classmethod
+        def get_response_types(cls) -> list[type[Response] | None]:
+            return [StringResponse]
+
+    globalns = {
+        'Annotated': Annotated,
+        'IOAttrs': IOAttrs,
+        'LogEntry': LogEntry,
+    }
+    ioprep(TinyMessage, globalns=globalns)
+    ioprep(LargeMessage, globalns=globalns)
+
+    protocol = MessageProtocol(
+        message_types={0: TinyMessage, 1: LargeMessage},
+        response_types={0: BoolResponse, 1: StringResponse},
+    )
+    receiver = MessageReceiver(protocol)
+
+    def _handle_tiny(self: Any, msg: Any) -> Any:
+        del self  # Unused.
+        return BoolResponse(value=msg.value > 0)
+
+    def _handle_large(self: Any, msg: Any) -> Any:
+        del self  # Unused.
+        return StringResponse(value=f'{len(msg.entries)}')
+
+    _handle_tiny.__annotations__ = {'msg': TinyMessage, 'return': BoolResponse}
+    _handle_large.__annotations__ = {
+        'msg': LargeMessage,
+        'return': StringResponse,
+    }
+    receiver.register_handler(_handle_tiny)
+    receiver.register_handler(_handle_large)
+
+    sender = MessageSender(protocol)
+    bound_obj = object()
+    sender.send_method(receiver.handle_raw_message)
+
+    now = datetime.datetime.now(datetime.UTC)
+    large = LargeMessage(
+        entries=[
+            LogEntry(
+                name='ba.app',
+                message=f'Test message number {i}.',
+                level=LogLevel.INFO,
+                time=now,
+                labels={'foo': 'bar'} if i % 2 else {},
+            )
+            for i in range(1000)
+        ]
+    )
+
+    def _rate(call: Callable[[], Any], count: int) -> str:
+        call()  # Warm up.
+        start = time.perf_counter()
+        for _i in range(count):
+            call()
+        rate = count / (time.perf_counter() - start)
+        return f'{Clr.SMAG}{rate:.0f}{Clr.RST} msgs/sec'
+
+    for name, message, count in [
+        ('tiny', TinyMessage(value=1), 20000),
+        ('large (1000 entries)', large, 50),
+    ]:
+        raw = protocol.encode_dict(protocol.message_to_dict(message))
+        rawbytes = raw.encode()
+        print(f'{Clr.BLU}{name} message ({len(raw)} bytes):{Clr.RST}')
+        calls: list[tuple[str, Callable[[], Any]]] = [
+            ('round trip', functools.partial(sender.send, bound_obj, message)),
+            (
+                'receive str',
+                functools.partial(receiver.handle_raw_message, bound_obj, raw),
+            ),
+            (
+                'receive bytes',
+                functools.partial(
+                    receiver.handle_raw_message, bound_obj, rawbytes
+                ),
+            ),
+        ]
+        for desc, call in calls:
+            print(f'  {desc:<14} {_rate(call, count)}')
+
+    # Recording metrics on both ends (compare to the tiny round trip
+    # above to see the overhead).
+    protocol.metrics = MessageMetrics()
+    print(f'{Clr.BLU}tiny message with metrics enabled:{Clr.RST}')
+    call = functools.partial(sender.send, bound_obj, TinyMessage(value=1))
+    desc = 'round trip'
+    print(f'  {desc:<14} {_rate(call, 20000)}')
+    protocol.metrics = None
+
+    asyncio.run(
+        _message_speed_test_batch(protocol, receiver, TinyMessage(value=1))
+    )
+
+
+async def _message_speed_test_batch(
+    protocol: MessageProtocol, receiver: MessageReceiver, message: Message
+) -> None:
+    # pylint: disable=too-many-locals
+    import time
+    import asyncio
+
+    from efro.terminal import Clr
+    from efro.message import MessageSender
+
+    # Simulate a transport with a fixed round trip time.
+    rtt = 0.001
+    bound_obj = object()
+    sender = MessageSender(protocol)
+
+    async def _send(obj: Any, data: str) -> str:
+        await asyncio.sleep(rtt)
+        return receiver.handle_raw_message(obj, data)
+
+    sender.send_async_method(_send)
+
+    count = 100
+
+    async def _sequential() -> None:
+        for _i in range(count):
+            await sender.send_async(bound_obj, message)
+
+    async def _concurrent() -> None:
+        await asyncio.gather(
+            *[sender.send_async(bound_obj, message) for _ in range(count)]
+        )
+
+    async def _batch() -> None:
+        await sender.send_batch_async(bound_obj, [message] * count)
+
+    print(
+        f'{Clr.BLU}{count} tiny messages'
+        f' ({rtt * 1000.0:.0f}ms simulated round trip):{Clr.RST}'
+    )
+    for desc, call in [
+        ('sequential', _sequential),
+        ('concurrent', _concurrent),
+        ('batch', _batch),
+    ]:
+        await call()  # Warm up.
+        reps = 10
+        start = time.perf_counter()
+        for _i in range(reps):
+            await call()
+        rate = count * reps / (time.perf_counter() - start)
+        print(f'  {desc:<14} {Clr.SMAG}{rate:.0f}{Clr.RST} msgs/sec')
+
+
+def log_speed_test() -> None:
+    """Measure print throughput with stdout going to efro.logging."""
+    # pylint: disable=too-many-locals
+    import os
+    import time
+    import threading
+
+    from efro.terminal import Clr
+    from efro.logging import LogHandler, FileLogEcho
+
+    pcommand.disallow_in_batch()
+
+    handler = LogHandler(
+        path=None,
+        echofile=None,
+        cache_size_limit=1024 * 1024 * 1024,
+        cache_time_limit=None,
+    )
+
+    def _drain() -> None:
+        # Flush and wait until the logging thread has caught up.
+        handler.file_flush('stdout')
+        done = threading.Event()
+        handler.call_in_thread(done.set)
+        done.wait()
+
+    with open(os.devnull, 'w', encoding='utf-8') as devnull:
+        echo = FileLogEcho(devnull, 'stdout', handler)
+
+        def _print_lines(count: int) -> None:
+            for i in range(count):
+                print(f'Chat message number {i} from some player.', file=echo)
+
+        def _print_fragmented(count: int) -> None:
+            # Like the '^^^^^' lines in stack traces, which arrive one
+            # character at a time.
+            for _i in range(count):
+                for _j in range(40):
+                    echo.write('^')
+                echo.write('\n')
+
+        for desc, call, count in [
+            ('short lines', _print_lines, 50000),
+            ('fragmented', _print_fragmented, 5000),
+        ]:
+            _drain()
+            entries_before = handler.get_cached().log_size
+            start = time.perf_counter()
+            call(count)
+            printed = time.perf_counter()
+            _drain()
+            drained = time.perf_counter()
+            entries = handler.get_cached().log_size - entries_before
+            print(
+                f'{desc:<12}'
+                f' {Clr.SMAG}{count / (printed - start):.0f}{Clr.RST}'
+                f' prints/sec at call site,'
+                f' {Clr.SMAG}{count / (drained - start):.0f}{Clr.RST}'
+                f' prints/sec logged ({entries} entries)'
+            )
+
+    _log_cache_speed_test()
+
+
+def _log_cache_speed_test() -> None:
+    # pylint: disable=too-many-locals
+    import time
+    import logging
+    import threading
+
+    from efro.terminal import Clr
+    from efro.logging import LogHandler
+
+    handler = LogHandler(
+        path=None,
+        echofile=None,
+        cache_size_limit=1024 * 1024 * 1024,
+        cache_time_limit=None,
+    )
+    logger = logging.Logger('log_speed_test')
+    logger.addHandler(handler)
+
+    def _drain() -> None:
+        done = threading.Event()
+        handler.call_in_thread(done.set)
+        done.wait()
+
+    def _emit(count: int) -> float:
+        start = time.perf_counter()
+        for i in range(count):
+            logger.info('Test log entry number %d.', i)
+        _drain()
+        return count / (time.perf_counter() - start)
+
+    def _reads(call: Callable[[], Any], count: int) -> float:
+        start = time.perf_counter()
+        for _i in range(count):
+            call()
+        return count / (time.perf_counter() - start)
+
+    entry_count = 100000
+    print(f'{Clr.BLU}Log cache with {entry_count} entries:{Clr.RST}')
+    _emit(entry_count)
+    log_size = handler.get_cached(max_entries=0).log_size
+    reads: list[tuple[str, Callable[[], Any], int]] = [
+        ('tail read', lambda: handler.get_cached(log_size - 10), 1000),
+        ('middle read', lambda: handler.get_cached(log_size // 2, 10), 1000),
+        ('full read', handler.get_cached, 20),
+    ]
+    for desc, call, count in reads:
+        print(
+            f'  {desc:<12} {Clr.SMAG}{_reads(call, count):.0f}{Clr.RST}'
+            f' reads/sec'
+        )
+
+    # Now emit more entries while some threads poll for new ones (like
+    # log-forwarding clients would) and others page through the whole
+    # cache.
+    running = True
+    polls = 0
+
+    def _poll(start_index: int, max_entries: int | None) -> None:
+        nonlocal polls
+        index = start_index
+        while running:
+            archive = handler.get_cached(index, max_entries)
+            index = archive.start_index + len(archive.entries)
+            if max_entries is not None and index >= archive.log_size:
+                index = 0
+            polls += 1
+            time.sleep(0.001)
+
+    baseline = _emit(20000)
+    threads = [
+        threading.Thread(target=_poll, args=args)
+        for args in [(log_size, None), (log_size, None), (0, 1000), (0, 1000)]
+    ]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    polling = _emit(20000)
+    duration = time.perf_counter() - start
+    running = False
+    for thread in threads:
+        thread.join()
+    print(
+        f'  emits        {Clr.SMAG}{baseline:.0f}{Clr.RST}/sec alone,'
+        f' {Clr.SMAG}{polling:.0f}{Clr.RST}/sec with 4 pollers'
+        f' ({Clr.SMAG}{polls / duration:.0f}{Clr.RST} polls/sec)'
+    )
+
+
+def efrocache_speed_test() -> None:
+    """Measure efrocache fetch/extract throughput against local repos."""
+    # pylint: disable=too-many-locals
+    # pylint: disable=too-many-statements
+    # pylint: disable=protected-access
+    import os
+    import json
+    import time
+    import random
+    import shutil
+    import tempfile
+    import threading
+    import functools
+    import contextlib
+    from typing import override
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+    from efro.terminal import Clr
+    from efrotools import efrocache
+
+    pcommand.disallow_in_batch()
+
+    class _Handler(SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        # Otherwise separate header/body writes hit delayed-ack stalls
+        # on kept-alive connections.
+        disable_nagle_algorithm = True
+
+        @override
+        def log_message(self, format: str, *args: Any) -> None:
+            # pylint: disable=redefined-builtin
+            pass
+
+    origdir = os.getcwd()
+    origenv = {
+        key: os.environ.get(key)
+        for key in ('EFROCACHE_DIR', 'EFROCACHE_REPOSITORY_URL')
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        try:
+            # Build a repository of files with a spread of sizes and
+            # some compressibility.
+            rnd = random.Random(123)
+            cachemap: dict[str, str] = {}
+            total_size = 0
+            for i in range(500):
+                path = f'build/f{i}'
+                size = rnd.choice([1000, 10000, 50000, 200000])
+                os.makedirs('build', exist_ok=True)
+                with open(path, 'wb') as outfile:
+                    outfile.write(rnd.randbytes(size // 4) * 4)
+                total_size += size
+                with contextlib.redirect_stdout(None):
+                    _fname, fhash, _hpath = efrocache._write_cache_file(
+                        'repo', path
+                    )
+                cachemap[path] = fhash
+            shutil.rmtree('build')
+            with open(efrocache.CACHE_MAP_NAME, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(cachemap))
+            paths = list(cachemap)
+
+            server = ThreadingHTTPServer(
+                ('127.0.0.1', 0),
+                functools.partial(_Handler, directory=os.path.abspath('repo')),
+            )
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            os.environ['EFROCACHE_DIR'] = 'localcache'
+
+            def _run(desc: str, call: Any) -> None:
+                shutil.rmtree('build', ignore_errors=True)
+                start = time.perf_counter()
+                call()
+                duration = time.perf_counter() - start
+                print(
+                    f'{desc:<26}'
+                    f' {Clr.SMAG}{len(paths) / duration:.0f}{Clr.RST}'
+                    f' files/sec,'
+                    f' {Clr.SMAG}{total_size / duration / 1e6:.1f}{Clr.RST}'
+                    f' MB/sec'
+                )
+
+            for desc, url in [
+                ('local http', f'http://127.0.0.1:{server.server_port}'),
+                ('local dir', os.path.abspath('repo')),
+            ]:
+                os.environ['EFROCACHE_REPOSITORY_URL'] = url
+                for workers in (1, efrocache.GET_TARGETS_MAX_WORKERS):
+                    shutil.rmtree('localcache', ignore_errors=True)
+                    _run(
+                        f'{desc} fetch ({workers} workers)',
+                        functools.partial(
+                            efrocache.get_targets,
+                            paths,
+                            batch=True,
+                            clr=Clr,
+                            max_workers=workers,
+                        ),
+                    )
+            _run(
+                'extract only (1 worker)',
+                functools.partial(
+                    efrocache.get_targets,
+                    paths,
+                    batch=True,
+                    clr=Clr,
+                    max_workers=1,
+                ),
+            )
+            server.shutdown()
+            server.server_close()
+        finally:
+            os.chdir(origdir)
+            for key, val in origenv.items():
+                if val is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = val
+
+
+def manifest_delta_speed_test() -> None:
+    """Measure manifest chunking speed and delta sizes for typical edits."""
+    # pylint: disable=too-many-locals
+    import os
+    import time
+    import random
+    import tempfile
+    from pathlib import Path
+
+    from efro.terminal import Clr
+    from bacommon.transfer import (
+        DirectoryManifest,
+        make_file_delta,
+        apply_file_delta,
+    )
+
+    pcommand.disallow_in_batch()
+
+    rnd = random.Random(123)
+    size = 4 * 1024 * 1024
+    original = rnd.randbytes(size)
+    mid = size // 2
+    edits = {
+        'append 1KB': original + rnd.randbytes(1000),
+        'prepend 1KB': rnd.randbytes(1000) + original,
+        'insert 100B': original[:mid] + rnd.randbytes(100) + original[mid:],
+        'modify 100B': original[:mid] + b'x' * 100 + original[mid + 100 :],
+        'delete 5KB': original[:mid] + original[mid + 5000 :],
+        'scattered 10x10B': b''.join(
+            original[i : i + size // 10][:-10] + b'x' * 10
+            for i in range(0, size, size // 10)
+        ),
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        olddir = Path(tmpdir, 'old')
+        newdir = Path(tmpdir, 'new')
+        os.makedirs(olddir)
+        os.makedirs(newdir)
+        (olddir / 'f').write_bytes(original)
+
+        for chunked in (False, True):
+            start = time.perf_counter()
+            old = DirectoryManifest.create_from_disk(olddir, chunked=chunked)
+            duration = time.perf_counter() - start
+            desc = 'chunked' if chunked else 'plain'
+            print(
+                f'{desc} manifest:'
+                f' {Clr.SMAG}{size / duration / 1e6:.1f}{Clr.RST} MB/sec'
+            )
+        oldfile = old.files['f']
+        print(f'{len(oldfile.get_chunks())} chunks for {size} bytes.')
+
+        for desc, data in edits.items():
+            (newdir / 'f').write_bytes(data)
+            newfile = DirectoryManifest.create_from_disk(
+                newdir, chunked=True
+            ).files['f']
+            delta = make_file_delta(oldfile, newfile, newdir / 'f')
+            patched = Path(tmpdir, 'patched')
+            patched.write_bytes(original)
+            apply_file_delta(oldfile, patched, delta, patched)
+            assert patched.read_bytes() == data
+            print(
+                f'{desc:<18} sent'
+                f' {Clr.SMAG}{delta.data_size}{Clr.RST} of {len(data)}'
+                f' bytes ({delta.data_size / len(data) * 100.0:.2f}%)'
+            )
+
+
 def null() -> None:
     """Do nothing. Useful for speed tests and whatnot."""